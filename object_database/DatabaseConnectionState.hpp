@@ -17,6 +17,7 @@
 
 #include <map>
 #include <memory>
+#include <set>
 
 #include <typed_python/SerializationContext.hpp>
 #include <typed_python/DeserializationBuffer.hpp>
@@ -90,6 +91,25 @@ public:
       cleanup(tid);
    }
 
+   // forget the objects in 'writes', which just left our subscriptions: drop every
+   // version of their fields and take them out of the indices in 'setRemoves' as
+   // of 'tid'. Unlike 'incomingTransaction', this isn't a change to the objects.
+   void dropObjects(
+         transaction_id tid,
+         ConstDict<ObjectFieldId, OneOf<None, Bytes> > writes,
+         ConstDict<IndexId, TupleOf<object_id> > setRemoves
+         ) {
+      for (auto keyValuePair: writes) {
+         m_objects->removeObject(keyValuePair.first.fieldId(), keyValuePair.first.objId());
+      }
+
+      for (auto indexAndOids: setRemoves) {
+         for (auto o: indexAndOids.second) {
+            m_objects->indexRemove(indexAndOids.first.fieldId(), indexAndOids.first.indexValue(), tid, o);
+         }
+      }
+   }
+
    void setContext(std::shared_ptr<SerializationContext> inContext) {
       m_serialization_context = inContext;
    }
@@ -243,6 +263,37 @@ public:
       markObjectSubscribed(oid, tid);
    }
 
+   // stop treating every object of type 't' as visible. Objects we're
+   // subscribed to individually stay visible.
+   void markTypeUnsubscribed(SchemaAndTypeName t) {
+      m_subscribed_types.erase(t);
+   }
+
+   void markObjectUnsubscribed(object_id oid) {
+      m_subscribed_objects.erase(oid);
+      m_lazy_objects.erase(oid);
+   }
+
+   // only let views read 'fields' of objects of type 't'. Types we've never
+   // projected expose every field.
+   void setFieldProjection(SchemaAndTypeName t, std::set<std::string> fields) {
+      m_field_projections[t] = fields;
+   }
+
+   void clearFieldProjection(SchemaAndTypeName t) {
+      m_field_projections.erase(t);
+   }
+
+   bool fieldIsProjected(SchemaAndTypeName t, const std::string& fieldName) {
+      auto it = m_field_projections.find(t);
+
+      if (it == m_field_projections.end()) {
+         return true;
+      }
+
+      return it->second.find(fieldName) != it->second.end();
+   }
+
    void markObjectLazy(SchemaAndTypeName schemaAndType, object_id oid) {
       m_lazy_objects[oid] = schemaAndType;
    }
@@ -314,4 +365,8 @@ private:
    PyObjectHolder m_trigger_lazy_load;
 
    std::unordered_map<object_id, SchemaAndTypeName> m_lazy_objects;
+
+   //for each type where we subscribed to a subset of the fields, the fields
+   //we're allowed to read.
+   std::unordered_map<SchemaAndTypeName, std::set<std::string> > m_field_projections;
 };
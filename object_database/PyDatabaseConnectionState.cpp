@@ -33,6 +33,10 @@ PyMethodDef PyDatabaseConnectionState_methods[] = {
     {"serializedObjectDataAtTid", (PyCFunction)PyDatabaseConnectionState::serializedObjectDataAtTid, METH_VARARGS | METH_KEYWORDS, NULL},
     {"markTypeSubscribed", (PyCFunction)PyDatabaseConnectionState::markTypeSubscribed, METH_VARARGS | METH_KEYWORDS, NULL},
     {"markObjectSubscribed", (PyCFunction)PyDatabaseConnectionState::markObjectSubscribed, METH_VARARGS | METH_KEYWORDS, NULL},
+    {"markTypeUnsubscribed", (PyCFunction)PyDatabaseConnectionState::markTypeUnsubscribed, METH_VARARGS | METH_KEYWORDS, NULL},
+    {"markObjectUnsubscribed", (PyCFunction)PyDatabaseConnectionState::markObjectUnsubscribed, METH_VARARGS | METH_KEYWORDS, NULL},
+    {"dropObjects", (PyCFunction)PyDatabaseConnectionState::dropObjects, METH_VARARGS | METH_KEYWORDS, NULL},
+    {"setFieldProjection", (PyCFunction)PyDatabaseConnectionState::setFieldProjection, METH_VARARGS | METH_KEYWORDS, NULL},
     {"markObjectLazy", (PyCFunction)PyDatabaseConnectionState::markObjectLazy, METH_VARARGS | METH_KEYWORDS, NULL},
     {"markObjectNotLazy", (PyCFunction)PyDatabaseConnectionState::markObjectNotLazy, METH_VARARGS | METH_KEYWORDS, NULL},
     {"typeSubscriptionLowestTransaction", (PyCFunction)PyDatabaseConnectionState::typeSubscriptionLowestTransaction, METH_VARARGS | METH_KEYWORDS, NULL},
@@ -275,6 +279,113 @@ PyObject* PyDatabaseConnectionState::markObjectSubscribed(PyDatabaseConnectionSt
     });
 }
 
+/* static */
+PyObject* PyDatabaseConnectionState::markTypeUnsubscribed(PyDatabaseConnectionState* self, PyObject* args, PyObject* kwargs) {
+    static const char *kwlist[] = {"schema", "typename", NULL};
+
+    const char* schemaName;
+    const char* typeName;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "ss", (char**)kwlist, &schemaName, &typeName)) {
+        return NULL;
+    }
+
+    return translateExceptionToPyObject([&]() {
+        if (!self->state) {
+            throw std::runtime_error("Invalid PyDatabaseConnectionState (nullptr)");
+        }
+
+        self->state->markTypeUnsubscribed(SchemaAndTypeName(schemaName, typeName));
+
+        return incref(Py_None);
+    });
+}
+
+/* static */
+PyObject* PyDatabaseConnectionState::markObjectUnsubscribed(PyDatabaseConnectionState* self, PyObject* args, PyObject* kwargs) {
+    static const char *kwlist[] = {"object_id", NULL};
+
+    object_id oid;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "l", (char**)kwlist, &oid)) {
+        return NULL;
+    }
+
+    return translateExceptionToPyObject([&]() {
+        if (!self->state) {
+            throw std::runtime_error("Invalid PyDatabaseConnectionState (nullptr)");
+        }
+
+        self->state->markObjectUnsubscribed(oid);
+
+        return incref(Py_None);
+    });
+}
+
+/* static */
+PyObject* PyDatabaseConnectionState::dropObjects(PyDatabaseConnectionState* self, PyObject* args, PyObject* kwargs)
+{
+    static const char *kwlist[] = {"transaction_id", "writes", "set_removes", NULL};
+
+    transaction_id tid;
+    PyObject* writes;
+    PyObject* set_removes;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "lOO", (char**)kwlist, &tid, &writes, &set_removes)) {
+        return NULL;
+    }
+
+    return translateExceptionToPyObject([&]() {
+        if (!self->state) {
+            throw std::runtime_error("Invalid PyDatabaseConnectionState (nullptr)");
+        }
+
+        auto cd_writes = ConstDict<ObjectFieldId, OneOf<None, Bytes> >::fromPython(writes);
+        auto cd_set_removes = ConstDict<IndexId, TupleOf<object_id> >::fromPython(set_removes);
+
+        self->state->dropObjects(tid, cd_writes, cd_set_removes);
+
+        return incref(Py_None);
+    });
+}
+
+/* static */
+PyObject* PyDatabaseConnectionState::setFieldProjection(PyDatabaseConnectionState* self, PyObject* args, PyObject* kwargs) {
+    static const char *kwlist[] = {"schema", "typename", "fields", NULL};
+
+    const char* schemaName;
+    const char* typeName;
+    PyObject* fields;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "ssO", (char**)kwlist, &schemaName, &typeName, &fields)) {
+        return NULL;
+    }
+
+    return translateExceptionToPyObject([&]() {
+        if (!self->state) {
+            throw std::runtime_error("Invalid PyDatabaseConnectionState (nullptr)");
+        }
+
+        if (fields == Py_None) {
+            self->state->clearFieldProjection(SchemaAndTypeName(schemaName, typeName));
+            return incref(Py_None);
+        }
+
+        std::set<std::string> fieldNames;
+
+        iterate(fields, [&](PyObject* o) {
+            if (!PyUnicode_Check(o)) {
+                throw std::runtime_error("Please pass strings for field names.");
+            }
+            fieldNames.insert(PyUnicode_AsUTF8(o));
+        });
+
+        self->state->setFieldProjection(SchemaAndTypeName(schemaName, typeName), fieldNames);
+
+        return incref(Py_None);
+    });
+}
+
 /* static */
 PyObject* PyDatabaseConnectionState::typeSubscriptionLowestTransaction(PyDatabaseConnectionState* self, PyObject* args, PyObject* kwargs) {
     static const char *kwlist[] = {"schema", "typename", NULL};
@@ -56,6 +56,14 @@ public:
 
     static PyObject* markObjectSubscribed(PyDatabaseConnectionState* self, PyObject* args, PyObject* kwargs);
 
+    static PyObject* markTypeUnsubscribed(PyDatabaseConnectionState* self, PyObject* args, PyObject* kwargs);
+
+    static PyObject* markObjectUnsubscribed(PyDatabaseConnectionState* self, PyObject* args, PyObject* kwargs);
+
+    static PyObject* dropObjects(PyDatabaseConnectionState* self, PyObject* args, PyObject* kwargs);
+
+    static PyObject* setFieldProjection(PyDatabaseConnectionState* self, PyObject* args, PyObject* kwargs);
+
     static PyObject* typeSubscriptionLowestTransaction(PyDatabaseConnectionState* self, PyObject* args, PyObject* kwargs);
 
     static PyObject* objectSubscriptionLowestTransaction(PyDatabaseConnectionState* self, PyObject* args, PyObject* kwargs);
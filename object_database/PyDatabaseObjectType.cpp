@@ -683,6 +683,16 @@ PyObject* PyDatabaseObjectType::lookupFieldValue(PyDatabaseObjectType* obType, o
 
     field_id fieldId = obType->fieldIdForNameAndState(attr, &view->getConnectionState());
 
+    if (!view->fieldIsReadable(obType->m_schema_and_typename, attr, fieldId, oid)) {
+        PyErr_Format(
+            getFieldNotSubscribedException(),
+            "%s.%s isn't one of the fields we subscribed to",
+            obType->m_schema_and_typename.typeName().c_str(),
+            attr.c_str()
+        );
+        throw PythonExceptionSet();
+    }
+
     instance_ptr data = view->getField(fieldId, oid, fieldType);
 
     if (!data) {
@@ -746,6 +756,23 @@ PyObject* PyDatabaseObjectType::getObjectDoesntExistException() {
     return objectDoesntExistException;
 }
 
+/* static */
+PyObject* PyDatabaseObjectType::getFieldNotSubscribedException() {
+    static PyObject* viewModule = PyImport_ImportModule("object_database.view");
+
+    if (!viewModule) {
+        throw std::runtime_error("Can't find object_database.view");
+    }
+
+    static PyObject* fieldNotSubscribedException = PyObject_GetAttrString(viewModule, "FieldNotSubscribedException");
+
+    if (!fieldNotSubscribedException) {
+        throw std::runtime_error("Can't find object_database.view.FieldNotSubscribedException");
+    }
+
+    return fieldNotSubscribedException;
+}
+
 PyObject* PyDatabaseObjectType::pyDelete(PyObject *self, PyObject* args, PyObject* kwargs)
 {
     PyDatabaseObjectType* obType = (PyDatabaseObjectType*)self->ob_type;
@@ -102,6 +102,9 @@ struct PyDatabaseObjectType {
   //lookup the ObjectDoesntExistException python exception object.
   static PyObject* getObjectDoesntExistException();
 
+  //lookup the FieldNotSubscribedException python exception object.
+  static PyObject* getFieldNotSubscribedException();
+
   //python entrypoint for calling the 'fromIdentity' method
   static PyObject* fromIdentity(PyObject* self, PyObject* args);
 
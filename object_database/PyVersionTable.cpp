@@ -0,0 +1,328 @@
+/******************************************************************************
+   Copyright 2017-2019 object_database Authors
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+******************************************************************************/
+
+#include <Python.h>
+#include <memory>
+#include <vector>
+#include <typed_python/util.hpp>
+
+#include "PyVersionTable.hpp"
+#include "VersionTable.hpp"
+
+void PyVersionTable::dealloc(PyVersionTable* self)
+{
+    self->table.~shared_ptr();
+
+    Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+PyObject* PyVersionTable::new_(PyTypeObject *type, PyObject *args, PyObject *kwds)
+{
+    PyVersionTable *self;
+    self = (PyVersionTable*)type->tp_alloc(type, 0);
+
+    if (self != NULL) {
+        new (&self->table) std::shared_ptr<VersionTable>();
+    }
+    return (PyObject*)self;
+}
+
+int PyVersionTable::init(PyVersionTable *self, PyObject *args, PyObject *kwds)
+{
+    self->table.reset(new VersionTable());
+
+    return 0;
+}
+
+PyObject* PyVersionTable::check(PyVersionTable* self, PyObject* args, PyObject* kwargs) {
+    static const char* kwlist[] = {"as_of_version", "keys_to_check", "indices_to_check", NULL};
+
+    int64_t asOfVersion;
+    PyObject* keysToCheck;
+    PyObject* indicesToCheck;
+
+    if (!PyArg_ParseTupleAndKeywords(
+            args, kwargs, "lOO", (char**)kwlist, &asOfVersion, &keysToCheck, &indicesToCheck
+            )) {
+        return nullptr;
+    }
+
+    return translateExceptionToPyObject([&]() {
+        auto keysToCheckTup = TupleOf<ObjectFieldId>::fromPython(keysToCheck);
+        auto indicesToCheckTup = TupleOf<IndexId>::fromPython(indicesToCheck);
+
+        int64_t conflict;
+
+        {
+            PyEnsureGilReleased releaseTheGil;
+
+            conflict = self->table->check(asOfVersion, keysToCheckTup, indicesToCheckTup);
+        }
+
+        if (conflict < 0) {
+            return incref(Py_None);
+        }
+
+        return PyLong_FromLong(conflict);
+    });
+}
+
+PyObject* PyVersionTable::checkAndStamp(PyVersionTable* self, PyObject* args, PyObject* kwargs) {
+    static const char* kwlist[] = {
+        "as_of_version",
+        "keys_to_check",
+        "indices_to_check",
+        "transaction_id",
+        "keys_to_stamp",
+        "indices_to_stamp",
+        "timestamp",
+        NULL
+    };
+
+    int64_t asOfVersion;
+    PyObject* keysToCheck;
+    PyObject* indicesToCheck;
+    int64_t tid;
+    PyObject* keysToStamp;
+    PyObject* indicesToStamp;
+    double timestamp;
+
+    if (!PyArg_ParseTupleAndKeywords(
+            args,
+            kwargs,
+            "lOOlOOd",
+            (char**)kwlist,
+            &asOfVersion,
+            &keysToCheck,
+            &indicesToCheck,
+            &tid,
+            &keysToStamp,
+            &indicesToStamp,
+            &timestamp
+            )) {
+        return nullptr;
+    }
+
+    return translateExceptionToPyObject([&]() {
+        // these are free if we're passed the right TupleOf types already
+        auto keysToCheckTup = TupleOf<ObjectFieldId>::fromPython(keysToCheck);
+        auto indicesToCheckTup = TupleOf<IndexId>::fromPython(indicesToCheck);
+        auto keysToStampTup = TupleOf<ObjectFieldId>::fromPython(keysToStamp);
+        auto indicesToStampTup = TupleOf<IndexId>::fromPython(indicesToStamp);
+
+        int64_t conflict;
+
+        {
+            PyEnsureGilReleased releaseTheGil;
+
+            conflict = self->table->checkAndStamp(
+                asOfVersion,
+                keysToCheckTup,
+                indicesToCheckTup,
+                tid,
+                keysToStampTup,
+                indicesToStampTup,
+                timestamp
+            );
+        }
+
+        if (conflict < 0) {
+            return incref(Py_None);
+        }
+
+        return PyLong_FromLong(conflict);
+    });
+}
+
+PyObject* PyVersionTable::popExpired(PyVersionTable* self, PyObject* args, PyObject* kwargs) {
+    static const char* kwlist[] = { "threshold", "max_count", NULL };
+
+    double threshold;
+    int64_t maxCount;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "dl", (char**)kwlist, &threshold, &maxCount)) {
+        return nullptr;
+    }
+
+    return translateExceptionToPyObject([&]() {
+        std::vector<ObjectFieldId> keys;
+        std::vector<IndexId> indices;
+
+        self->table->popExpired(
+            threshold,
+            maxCount,
+            [&](const VersionTableFieldKey& k) { keys.push_back(k.toKey()); },
+            [&](const VersionTableIndexKey& k) { indices.push_back(k.toKey()); }
+        );
+
+        PyObjectStealer keysObj(TupleOf<ObjectFieldId>(keys).toPython());
+        PyObjectStealer indicesObj(TupleOf<IndexId>(indices).toPython());
+
+        return PyTuple_Pack(2, (PyObject*)keysObj, (PyObject*)indicesObj);
+    });
+}
+
+PyObject* PyVersionTable::erase(PyVersionTable* self, PyObject* args, PyObject* kwargs) {
+    static const char* kwlist[] = { "keys", "indices", NULL };
+
+    PyObject* keys;
+    PyObject* indices;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OO", (char**)kwlist, &keys, &indices)) {
+        return nullptr;
+    }
+
+    return translateExceptionToPyObject([&]() {
+        return PyLong_FromLong(
+            self->table->erase(
+                TupleOf<ObjectFieldId>::fromPython(keys),
+                TupleOf<IndexId>::fromPython(indices)
+            )
+        );
+    });
+}
+
+PyObject* PyVersionTable::keyCount(PyVersionTable* self, PyObject* args, PyObject* kwargs) {
+    static const char* kwlist[] = { NULL };
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "", (char**)kwlist)) {
+        return nullptr;
+    }
+
+    return translateExceptionToPyObject([&]() {
+        return PyLong_FromLong(self->table->size());
+    });
+}
+
+PyObject* PyVersionTable::queuedCount(PyVersionTable* self, PyObject* args, PyObject* kwargs) {
+    static const char* kwlist[] = { NULL };
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "", (char**)kwlist)) {
+        return nullptr;
+    }
+
+    return translateExceptionToPyObject([&]() {
+        return PyLong_FromLong(self->table->queuedCount());
+    });
+}
+
+PyObject* PyVersionTable::beginJournal(PyVersionTable* self, PyObject* args, PyObject* kwargs) {
+    static const char* kwlist[] = { NULL };
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "", (char**)kwlist)) {
+        return nullptr;
+    }
+
+    return translateExceptionToPyObject([&]() {
+        self->table->beginJournal();
+        return incref(Py_None);
+    });
+}
+
+PyObject* PyVersionTable::endJournal(PyVersionTable* self, PyObject* args, PyObject* kwargs) {
+    static const char* kwlist[] = { NULL };
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "", (char**)kwlist)) {
+        return nullptr;
+    }
+
+    return translateExceptionToPyObject([&]() {
+        self->table->endJournal();
+        return incref(Py_None);
+    });
+}
+
+PyObject* PyVersionTable::rollbackJournal(PyVersionTable* self, PyObject* args, PyObject* kwargs) {
+    static const char* kwlist[] = { NULL };
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "", (char**)kwlist)) {
+        return nullptr;
+    }
+
+    return translateExceptionToPyObject([&]() {
+        self->table->rollbackJournal();
+        return incref(Py_None);
+    });
+}
+
+PyMethodDef PyVersionTable_methods[] = {
+    {"check", (PyCFunction) PyVersionTable::check, METH_VARARGS | METH_KEYWORDS},
+    {"checkAndStamp", (PyCFunction) PyVersionTable::checkAndStamp, METH_VARARGS | METH_KEYWORDS},
+    {"popExpired", (PyCFunction) PyVersionTable::popExpired, METH_VARARGS | METH_KEYWORDS},
+    {"erase", (PyCFunction) PyVersionTable::erase, METH_VARARGS | METH_KEYWORDS},
+    {"keyCount", (PyCFunction) PyVersionTable::keyCount, METH_VARARGS | METH_KEYWORDS},
+    {"queuedCount", (PyCFunction) PyVersionTable::queuedCount, METH_VARARGS | METH_KEYWORDS},
+    {"beginJournal", (PyCFunction) PyVersionTable::beginJournal, METH_VARARGS | METH_KEYWORDS},
+    {"endJournal", (PyCFunction) PyVersionTable::endJournal, METH_VARARGS | METH_KEYWORDS},
+    {"rollbackJournal", (PyCFunction) PyVersionTable::rollbackJournal, METH_VARARGS | METH_KEYWORDS},
+
+    {NULL}  /* Sentinel */
+};
+
+PyTypeObject PyType_VersionTable = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "VersionTable",
+    .tp_basicsize = sizeof(PyVersionTable),
+    .tp_itemsize = 0,
+    .tp_dealloc = (destructor) PyVersionTable::dealloc,
+    #if PY_MINOR_VERSION < 8
+    .tp_print = 0,
+    #else
+    .tp_vectorcall_offset = 0,                  // printfunc  (Changed to tp_vectorcall_offset in Python 3.8)
+    #endif
+    .tp_getattr = 0,
+    .tp_setattr = 0,
+    .tp_as_async = 0,
+    .tp_repr = 0,
+    .tp_as_number = 0,
+    .tp_as_sequence = 0,
+    .tp_as_mapping = 0,
+    .tp_hash = 0,
+    .tp_call = 0,
+    .tp_str = 0,
+    .tp_getattro = 0,
+    .tp_setattro = 0,
+    .tp_as_buffer = 0,
+    .tp_flags = Py_TPFLAGS_DEFAULT,
+    .tp_doc = 0,
+    .tp_traverse = 0,
+    .tp_clear = 0,
+    .tp_richcompare = 0,
+    .tp_weaklistoffset = 0,
+    .tp_iter = 0,
+    .tp_iternext = 0,
+    .tp_methods = PyVersionTable_methods,
+    .tp_members = 0,
+    .tp_getset = 0,
+    .tp_base = 0,
+    .tp_dict = 0,
+    .tp_descr_get = 0,
+    .tp_descr_set = 0,
+    .tp_dictoffset = 0,
+    .tp_init = (initproc) PyVersionTable::init,
+    .tp_alloc = 0,
+    .tp_new = PyVersionTable::new_,
+    .tp_free = 0,
+    .tp_is_gc = 0,
+    .tp_bases = 0,
+    .tp_mro = 0,
+    .tp_cache = 0,
+    .tp_subclasses = 0,
+    .tp_weaklist = 0,
+    .tp_del = 0,
+    .tp_version_tag = 0,
+    .tp_finalize = 0,
+};
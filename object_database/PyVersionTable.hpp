@@ -0,0 +1,53 @@
+/******************************************************************************
+   Copyright 2017-2019 object_database Authors
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+******************************************************************************/
+
+#pragma once
+
+#include <Python.h>
+#include "VersionTable.hpp"
+#include <memory>
+
+extern PyTypeObject PyType_VersionTable;
+
+class PyVersionTable {
+public:
+    PyObject_HEAD;
+    std::shared_ptr<VersionTable> table;
+
+    static void dealloc(PyVersionTable *self);
+
+    static PyObject *new_(PyTypeObject *type, PyObject *args, PyObject *kwds);
+
+    static PyObject* check(PyVersionTable* self, PyObject* args, PyObject* kwargs);
+
+    static PyObject* checkAndStamp(PyVersionTable* self, PyObject* args, PyObject* kwargs);
+
+    static PyObject* popExpired(PyVersionTable* self, PyObject* args, PyObject* kwargs);
+
+    static PyObject* erase(PyVersionTable* self, PyObject* args, PyObject* kwargs);
+
+    static PyObject* keyCount(PyVersionTable* self, PyObject* args, PyObject* kwargs);
+
+    static PyObject* queuedCount(PyVersionTable* self, PyObject* args, PyObject* kwargs);
+
+    static PyObject* beginJournal(PyVersionTable* self, PyObject* args, PyObject* kwargs);
+
+    static PyObject* endJournal(PyVersionTable* self, PyObject* args, PyObject* kwargs);
+
+    static PyObject* rollbackJournal(PyVersionTable* self, PyObject* args, PyObject* kwargs);
+
+    static int init(PyVersionTable *self, PyObject *args, PyObject *kwds);
+};
@@ -0,0 +1,514 @@
+/******************************************************************************
+   Copyright 2017-2019 object_database Authors
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+******************************************************************************/
+
+#pragma once
+
+#include <algorithm>
+#include <deque>
+#include <vector>
+#include "Common.hpp"
+#include "ObjectFieldId.hpp"
+
+/*************
+
+VersionTable is the server's record of the last transaction id that wrote
+each ObjectFieldId and IndexId, which is what we check optimistic-concurrency
+conflicts against.
+
+Keys live in a flat open-addressed hash table. Each key also remembers when
+it was last written, and we keep a queue of keys in the order they were first
+written so that garbage collection only ever looks at keys that have expired.
+
+The table isn't threadsafe: callers must serialize access to it.
+
+*************/
+
+class VersionTableFieldKey {
+public:
+    VersionTableFieldKey() : objId(NO_OBJECT), fieldId(NO_FIELD), isIndexValue(false)
+    {
+    }
+
+    VersionTableFieldKey(const ObjectFieldId& key) :
+            objId(key.objId()),
+            fieldId(key.fieldId()),
+            isIndexValue(key.isIndexValue())
+    {
+    }
+
+    bool operator==(const VersionTableFieldKey& other) const {
+        return objId == other.objId && fieldId == other.fieldId && isIndexValue == other.isIndexValue;
+    }
+
+    size_t hash() const {
+        uint64_t h = (uint64_t)objId * 0x9E3779B97F4A7C15ULL;
+        h ^= (uint64_t)fieldId + 0x7F4A7C159E3779B9ULL + (h << 6) + (h >> 2);
+        return h ^ (isIndexValue ? 1 : 0);
+    }
+
+    ObjectFieldId toKey() const {
+        return ObjectFieldId(objId, fieldId, isIndexValue);
+    }
+
+    object_id objId;
+    field_id fieldId;
+    bool isIndexValue;
+};
+
+class VersionTableIndexKey {
+public:
+    VersionTableIndexKey() : fieldId(NO_FIELD), hashVal(0)
+    {
+    }
+
+    VersionTableIndexKey(const IndexId& key) :
+            fieldId(key.fieldId()),
+            indexValue(key.indexValue()),
+            hashVal(key.indexValue().hashValue())
+    {
+    }
+
+    bool operator==(const VersionTableIndexKey& other) const {
+        return fieldId == other.fieldId && hashVal == other.hashVal
+            && !(indexValue < other.indexValue) && !(other.indexValue < indexValue);
+    }
+
+    size_t hash() const {
+        return ((uint64_t)fieldId * 0x9E3779B97F4A7C15ULL) ^ hashVal;
+    }
+
+    IndexId toKey() const {
+        return IndexId(fieldId, indexValue);
+    }
+
+    field_id fieldId;
+    index_value indexValue;
+    typed_python_hash_type hashVal;
+};
+
+/*************
+
+A map from key to (transaction id, timestamp) using open addressing with
+linear probing. Deletes shift later entries back, so we never need tombstones.
+
+*************/
+
+template<class key_type>
+class FlatVersionMap {
+public:
+    class Entry {
+    public:
+        Entry() : occupied(false), tid(NO_TRANSACTION), timestamp(0), queued(false)
+        {
+        }
+
+        bool occupied;
+        key_type key;
+        transaction_id tid;
+        double timestamp;
+        // is this key somewhere in our GC queue?
+        bool queued;
+    };
+
+    FlatVersionMap() : mCount(0)
+    {
+        mSlots.resize(16);
+    }
+
+    size_t size() const {
+        return mCount;
+    }
+
+    // return the entry for 'key', or nullptr
+    Entry* find(const key_type& key) {
+        size_t mask = mSlots.size() - 1;
+
+        for (size_t i = key.hash() & mask; mSlots[i].occupied; i = (i + 1) & mask) {
+            if (mSlots[i].key == key) {
+                return &mSlots[i];
+            }
+        }
+
+        return nullptr;
+    }
+
+    // return the entry for 'key', creating an empty one if necessary.
+    // The result is only valid until the next insert or erase.
+    Entry& findOrInsert(const key_type& key) {
+        if ((mCount + 1) * 4 > mSlots.size() * 3) {
+            resize(mSlots.size() * 2);
+        }
+
+        size_t mask = mSlots.size() - 1;
+        size_t i = key.hash() & mask;
+
+        for (; mSlots[i].occupied; i = (i + 1) & mask) {
+            if (mSlots[i].key == key) {
+                return mSlots[i];
+            }
+        }
+
+        mSlots[i].occupied = true;
+        mSlots[i].key = key;
+        mSlots[i].tid = NO_TRANSACTION;
+        mSlots[i].timestamp = 0;
+        mSlots[i].queued = false;
+        mCount++;
+
+        return mSlots[i];
+    }
+
+    bool erase(const key_type& key) {
+        size_t mask = mSlots.size() - 1;
+        size_t i = key.hash() & mask;
+
+        while (true) {
+            if (!mSlots[i].occupied) {
+                return false;
+            }
+            if (mSlots[i].key == key) {
+                break;
+            }
+            i = (i + 1) & mask;
+        }
+
+        // shift back any entry that probed past the slot we're emptying
+        size_t j = i;
+        while (true) {
+            j = (j + 1) & mask;
+
+            if (!mSlots[j].occupied) {
+                break;
+            }
+
+            size_t home = mSlots[j].key.hash() & mask;
+
+            bool canMove = (j > i) ? (home <= i || home > j) : (home <= i && home > j);
+
+            if (canMove) {
+                mSlots[i] = mSlots[j];
+                i = j;
+            }
+        }
+
+        mSlots[i] = Entry();
+        mCount--;
+
+        return true;
+    }
+
+private:
+    void resize(size_t newSize) {
+        std::vector<Entry> oldSlots;
+        oldSlots.swap(mSlots);
+
+        mSlots.resize(newSize);
+        mCount = 0;
+
+        for (auto& e: oldSlots) {
+            if (e.occupied) {
+                Entry& newEntry = findOrInsert(e.key);
+                newEntry.tid = e.tid;
+                newEntry.timestamp = e.timestamp;
+                newEntry.queued = e.queued;
+            }
+        }
+    }
+
+    std::vector<Entry> mSlots;
+
+    size_t mCount;
+};
+
+template<class key_type>
+class VersionTableOf {
+public:
+    VersionTableOf() : mJournaling(false)
+    {
+    }
+
+    size_t size() const {
+        return mMap.size();
+    }
+
+    size_t queuedCount() const {
+        return mQueue.size();
+    }
+
+    // true if anything wrote 'key' after 'asOfVersion'
+    bool conflicts(const key_type& key, transaction_id asOfVersion) {
+        auto* entry = mMap.find(key);
+
+        return entry && asOfVersion < entry->tid;
+    }
+
+    void stamp(const key_type& key, transaction_id tid, double timestamp) {
+        if (mJournaling) {
+            auto* prior = mMap.find(key);
+
+            if (prior) {
+                mJournal.push_back(JournalEntry(key, true, prior->tid, prior->timestamp));
+            } else {
+                mJournal.push_back(JournalEntry(key, false, NO_TRANSACTION, 0));
+            }
+        }
+
+        auto& entry = mMap.findOrInsert(key);
+
+        entry.tid = tid;
+        entry.timestamp = timestamp;
+
+        if (!entry.queued) {
+            entry.queued = true;
+            mQueue.push_back(std::make_pair(timestamp, key));
+        }
+    }
+
+    // pop keys that haven't been written since 'threshold' off of the queue,
+    // stopping after 'maxCount' if it's not negative. Keys that were rewritten
+    // since we queued them go back on the end of the queue. Returns the number
+    // of keys we passed to 'onExpired'.
+    template<class func_type>
+    int64_t popExpired(double threshold, int64_t maxCount, const func_type& onExpired) {
+        int64_t count = 0;
+
+        while (mQueue.size() && mQueue.front().first < threshold && (maxCount < 0 || count < maxCount)) {
+            key_type key = mQueue.front().second;
+            mQueue.pop_front();
+
+            auto* entry = mMap.find(key);
+
+            if (!entry) {
+                continue;
+            }
+
+            if (entry->timestamp >= threshold) {
+                mQueue.push_back(std::make_pair(entry->timestamp, key));
+                continue;
+            }
+
+            entry->queued = false;
+            count++;
+
+            onExpired(key);
+        }
+
+        return count;
+    }
+
+    // drop 'key' from the table, returning the transaction id it had.
+    transaction_id erase(const key_type& key) {
+        auto* entry = mMap.find(key);
+
+        if (!entry) {
+            return NO_TRANSACTION;
+        }
+
+        transaction_id tid = entry->tid;
+
+        mMap.erase(key);
+
+        return tid;
+    }
+
+    // start remembering what each 'stamp' overwrites
+    void beginJournal() {
+        mJournaling = true;
+        mJournal.clear();
+    }
+
+    // stop remembering, keeping the stamps
+    void endJournal() {
+        mJournaling = false;
+        mJournal.clear();
+    }
+
+    // undo every stamp since 'beginJournal'. Keys we queued stay queued, which
+    // is harmless: 'popExpired' skips keys that are gone and re-checks timestamps.
+    void rollbackJournal() {
+        for (auto it = mJournal.rbegin(); it != mJournal.rend(); ++it) {
+            if (!it->existed) {
+                mMap.erase(it->key);
+            } else {
+                auto& entry = mMap.findOrInsert(it->key);
+                entry.tid = it->tid;
+                entry.timestamp = it->timestamp;
+            }
+        }
+
+        endJournal();
+    }
+
+private:
+    class JournalEntry {
+    public:
+        JournalEntry(const key_type& inKey, bool inExisted, transaction_id inTid, double inTimestamp) :
+                key(inKey),
+                existed(inExisted),
+                tid(inTid),
+                timestamp(inTimestamp)
+        {
+        }
+
+        key_type key;
+        bool existed;
+        transaction_id tid;
+        double timestamp;
+    };
+
+    FlatVersionMap<key_type> mMap;
+
+    std::deque<std::pair<double, key_type> > mQueue;
+
+    bool mJournaling;
+
+    std::vector<JournalEntry> mJournal;
+};
+
+class VersionTable {
+public:
+    size_t size() const {
+        return mFields.size() + mIndices.size();
+    }
+
+    size_t queuedCount() const {
+        return mFields.queuedCount() + mIndices.queuedCount();
+    }
+
+    /******
+    check that nothing in 'keysToCheck' or 'indicesToCheck' was written after
+    'asOfVersion'.
+
+    Returns the index of the first conflicting key, counting 'keysToCheck' and
+    then 'indicesToCheck', or -1 if there was no conflict.
+    ******/
+    int64_t check(
+            transaction_id asOfVersion,
+            const TupleOf<ObjectFieldId>& keysToCheck,
+            const TupleOf<IndexId>& indicesToCheck
+            ) {
+        int64_t keysToCheckCount = keysToCheck.size();
+
+        for (int64_t k = 0; k < keysToCheckCount; k++) {
+            if (mFields.conflicts(VersionTableFieldKey(keysToCheck[k]), asOfVersion)) {
+                return k;
+            }
+        }
+
+        for (int64_t k = 0; k < (int64_t)indicesToCheck.size(); k++) {
+            if (mIndices.conflicts(VersionTableIndexKey(indicesToCheck[k]), asOfVersion)) {
+                return keysToCheckCount + k;
+            }
+        }
+
+        return -1;
+    }
+
+    /******
+    'check', and if there was no conflict, mark everything in 'keysToStamp' and
+    'indicesToStamp' as written by 'tid'.
+
+    Returns the index of the first conflicting key, counting 'keysToCheck' and
+    then 'indicesToCheck', or -1 if there was no conflict (in which case we stamped).
+    ******/
+    int64_t checkAndStamp(
+            transaction_id asOfVersion,
+            const TupleOf<ObjectFieldId>& keysToCheck,
+            const TupleOf<IndexId>& indicesToCheck,
+            transaction_id tid,
+            const TupleOf<ObjectFieldId>& keysToStamp,
+            const TupleOf<IndexId>& indicesToStamp,
+            double timestamp
+            ) {
+        int64_t conflict = check(asOfVersion, keysToCheck, indicesToCheck);
+
+        if (conflict >= 0) {
+            return conflict;
+        }
+
+        for (int64_t k = 0; k < (int64_t)keysToStamp.size(); k++) {
+            mFields.stamp(VersionTableFieldKey(keysToStamp[k]), tid, timestamp);
+        }
+
+        for (int64_t k = 0; k < (int64_t)indicesToStamp.size(); k++) {
+            mIndices.stamp(VersionTableIndexKey(indicesToStamp[k]), tid, timestamp);
+        }
+
+        return -1;
+    }
+
+    template<class field_func_type, class index_func_type>
+    void popExpired(
+            double threshold,
+            int64_t maxCount,
+            const field_func_type& onExpiredField,
+            const index_func_type& onExpiredIndex
+            ) {
+        int64_t popped = mFields.popExpired(threshold, maxCount, onExpiredField);
+
+        if (maxCount >= 0) {
+            if (popped >= maxCount) {
+                return;
+            }
+            maxCount -= popped;
+        }
+
+        mIndices.popExpired(threshold, maxCount, onExpiredIndex);
+    }
+
+    // drop keys from the table, returning the highest transaction id they had
+    transaction_id erase(
+            const TupleOf<ObjectFieldId>& keys,
+            const TupleOf<IndexId>& indices
+            ) {
+        transaction_id res = NO_TRANSACTION;
+
+        for (int64_t k = 0; k < (int64_t)keys.size(); k++) {
+            res = std::max(res, mFields.erase(VersionTableFieldKey(keys[k])));
+        }
+
+        for (int64_t k = 0; k < (int64_t)indices.size(); k++) {
+            res = std::max(res, mIndices.erase(VersionTableIndexKey(indices[k])));
+        }
+
+        return res;
+    }
+
+    /******
+    remember what 'checkAndStamp' overwrites from now on, so that a group of
+    transactions that fails to commit can be undone with 'rollbackJournal'.
+    'endJournal' keeps the stamps.
+    ******/
+    void beginJournal() {
+        mFields.beginJournal();
+        mIndices.beginJournal();
+    }
+
+    void endJournal() {
+        mFields.endJournal();
+        mIndices.endJournal();
+    }
+
+    void rollbackJournal() {
+        mFields.rollbackJournal();
+        mIndices.rollbackJournal();
+    }
+
+private:
+    VersionTableOf<VersionTableFieldKey> mFields;
+
+    VersionTableOf<VersionTableIndexKey> mIndices;
+};
@@ -0,0 +1,206 @@
+#   Copyright 2019 Nativepython Authors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from typed_python import TupleOf
+from object_database._types import VersionTable
+from object_database.schema import ObjectFieldId, IndexId
+
+import unittest
+
+
+def keys(*objIds, fieldId=1):
+    return TupleOf(ObjectFieldId)(
+        [ObjectFieldId(objId=o, fieldId=fieldId, isIndexValue=False) for o in objIds]
+    )
+
+
+def indices(*values, fieldId=2):
+    return TupleOf(IndexId)([IndexId(fieldId=fieldId, indexValue=v) for v in values])
+
+
+class VersionTableTest(unittest.TestCase):
+    def stamp(self, table, tid, keysToStamp=(), indicesToStamp=(), timestamp=0.0):
+        return table.checkAndStamp(
+            as_of_version=tid - 1,
+            keys_to_check=(),
+            indices_to_check=(),
+            transaction_id=tid,
+            keys_to_stamp=keysToStamp,
+            indices_to_stamp=indicesToStamp,
+            timestamp=timestamp,
+        )
+
+    def test_conflicts(self):
+        table = VersionTable()
+
+        self.assertIsNone(self.stamp(table, 10, keys(1, 2), indices(b"a")))
+        self.assertEqual(table.keyCount(), 3)
+
+        def check(asOf, keysToCheck=(), indicesToCheck=()):
+            return table.checkAndStamp(
+                as_of_version=asOf,
+                keys_to_check=keysToCheck,
+                indices_to_check=indicesToCheck,
+                transaction_id=100,
+                keys_to_stamp=(),
+                indices_to_stamp=(),
+                timestamp=0.0,
+            )
+
+        self.assertIsNone(check(10, keys(1, 2, 3), indices(b"a", b"b")))
+        self.assertEqual(check(9, keys(3, 2)), 1)
+        self.assertEqual(check(9, keys(3), indices(b"b", b"a")), 2)
+
+        # untyped keys work too
+        self.assertEqual(check(9, list(keys(2))), 0)
+
+    def test_conflicts_dont_stamp(self):
+        table = VersionTable()
+
+        self.stamp(table, 10, keys(1))
+
+        self.assertEqual(
+            table.checkAndStamp(
+                as_of_version=5,
+                keys_to_check=keys(1),
+                indices_to_check=(),
+                transaction_id=11,
+                keys_to_stamp=keys(2),
+                indices_to_stamp=(),
+                timestamp=0.0,
+            ),
+            0,
+        )
+        self.assertEqual(table.keyCount(), 1)
+
+    def test_check_doesnt_stamp(self):
+        table = VersionTable()
+
+        self.stamp(table, 10, keys(1))
+
+        self.assertEqual(
+            table.check(as_of_version=5, keys_to_check=keys(1), indices_to_check=()), 0
+        )
+        self.assertEqual(
+            table.check(
+                as_of_version=5, keys_to_check=keys(2), indices_to_check=indices(b"a")
+            ),
+            None,
+        )
+        self.assertEqual(table.keyCount(), 1)
+
+    def test_many_keys(self):
+        table = VersionTable()
+
+        self.stamp(table, 10, keys(*range(10000)))
+        self.assertEqual(table.keyCount(), 10000)
+
+        self.assertEqual(table.erase(keys=keys(*range(0, 10000, 2)), indices=()), 10)
+        self.assertEqual(table.keyCount(), 5000)
+
+        for i in range(10000):
+            tid = table.checkAndStamp(
+                as_of_version=9,
+                keys_to_check=keys(i),
+                indices_to_check=(),
+                transaction_id=11,
+                keys_to_stamp=(),
+                indices_to_stamp=(),
+                timestamp=0.0,
+            )
+            self.assertEqual(tid, None if i % 2 == 0 else 0)
+
+    def test_pop_expired(self):
+        table = VersionTable()
+
+        self.stamp(table, 10, keys(1, 2), indices(b"a"), timestamp=1.0)
+        self.stamp(table, 11, keys(3), timestamp=2.0)
+
+        # rewriting a key pushes it back
+        self.stamp(table, 12, keys(1), timestamp=3.0)
+
+        self.assertEqual(table.queuedCount(), 4)
+
+        expiredKeys, expiredIndices = table.popExpired(threshold=2.5, max_count=-1)
+
+        self.assertEqual(sorted(k.objId for k in expiredKeys), [2, 3])
+        self.assertEqual([i.indexValue for i in expiredIndices], [b"a"])
+
+        # expired keys stay in the table until we erase them
+        self.assertEqual(table.keyCount(), 4)
+        self.assertEqual(table.queuedCount(), 1)
+
+        self.assertEqual(table.erase(keys=keys(2), indices=expiredIndices), 10)
+        self.assertEqual(table.keyCount(), 2)
+
+        expiredKeys, expiredIndices = table.popExpired(threshold=2.5, max_count=-1)
+        self.assertEqual(len(expiredKeys) + len(expiredIndices), 0)
+
+        self.stamp(table, 13, keys(4, 5, 6), timestamp=4.0)
+
+        expiredKeys, _ = table.popExpired(threshold=5.0, max_count=2)
+        self.assertEqual(len(expiredKeys), 2)
+        self.assertEqual(table.queuedCount(), 2)
+
+    def test_rollback_journal(self):
+        table = VersionTable()
+
+        self.stamp(table, 10, keys(1), indices(b"a"), timestamp=1.0)
+
+        table.beginJournal()
+        self.stamp(table, 11, keys(1, 2), indices(b"a", b"b"), timestamp=2.0)
+        self.stamp(table, 12, keys(1), timestamp=3.0)
+        self.assertEqual(table.keyCount(), 4)
+
+        table.rollbackJournal()
+
+        # keys the journal created are gone, and the rest have their old versions
+        self.assertEqual(table.keyCount(), 2)
+        self.assertEqual(self.stamp(table, 11, keys(3)), None)
+        self.assertEqual(
+            table.checkAndStamp(
+                as_of_version=10,
+                keys_to_check=keys(1, 2),
+                indices_to_check=indices(b"a"),
+                transaction_id=13,
+                keys_to_stamp=(),
+                indices_to_stamp=(),
+                timestamp=4.0,
+            ),
+            None,
+        )
+
+        expiredKeys, expiredIndices = table.popExpired(threshold=1.5, max_count=-1)
+        self.assertEqual([k.objId for k in expiredKeys], [1])
+        self.assertEqual([i.indexValue for i in expiredIndices], [b"a"])
+
+        # after 'endJournal', stamps stick
+        table.beginJournal()
+        self.stamp(table, 14, keys(1), timestamp=5.0)
+        table.endJournal()
+        table.rollbackJournal()
+
+        self.assertEqual(self.stamp(table, 15, keys(2)), None)
+        self.assertEqual(
+            table.checkAndStamp(
+                as_of_version=13,
+                keys_to_check=keys(1),
+                indices_to_check=(),
+                transaction_id=16,
+                keys_to_stamp=(),
+                indices_to_stamp=(),
+                timestamp=6.0,
+            ),
+            0,
+        )
@@ -65,6 +65,11 @@ public:
         return versionedObjectsForFieldId(fieldId)->markDeleted(objectId, version);
     }
 
+    // forget every version of 'objectId' in 'fieldId'
+    void removeObject(field_id fieldId, object_id objectId) {
+        versionedObjectsForFieldId(fieldId)->removeObject(objectId);
+    }
+
     object_id indexLookupOne(field_id fid, index_value i, transaction_id t) {
         IndexKey key(fid,i);
 
@@ -110,6 +110,17 @@ public:
       m_connection_state->loadLazyObjectIfNeeded(oid);
    }
 
+   // can we read 'fieldName' of objects of type 'obType'? Fields we've written
+   // in this view are always readable, even if our subscription doesn't include them.
+   bool fieldIsReadable(SchemaAndTypeName obType, const std::string& fieldName, field_id field, object_id oid) {
+      if (m_connection_state->fieldIsProjected(obType, fieldName)) {
+         return true;
+      }
+
+      return m_write_cache.find(std::make_pair(field, oid)) != m_write_cache.end()
+         || m_delete_cache.find(std::make_pair(field, oid)) != m_delete_cache.end();
+   }
+
    void newObject(SchemaAndTypeName obType, object_id oid) {
       m_connection_state->markObjectSubscribed(obType, oid, m_tid);
    }
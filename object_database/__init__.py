@@ -25,7 +25,12 @@ import object_database._types
 
 from object_database.tcp_server import connect, TcpServer, TcpProxyServer
 from object_database.logging_transaction_watcher import LoggingTransactionWatcher
-from object_database.persistence import RedisPersistence, InMemoryPersistence
+from object_database.persistence import (
+    RedisPersistence,
+    InMemoryPersistence,
+    MemoryMappedPersistence,
+    WriteAheadLogPersistence,
+)
 from object_database.schema import Schema, Indexed, Index, SubscribeLazilyByDefault
 from object_database.core_schema import core_schema
 from object_database.service_manager.ServiceSchema import service_schema
@@ -36,6 +41,7 @@ from object_database.view import (
     revisionConflictRetry,
     RevisionConflictException,
     DisconnectedException,
+    FieldNotSubscribedException,
     current_transaction,
     MaskView,
 )
@@ -3,6 +3,7 @@
 #include <typed_python/AllTypes.hpp>
 #include <typed_python/PyInstance.hpp>
 #include "PyVersionedIdSet.hpp"
+#include "PyVersionTable.hpp"
 #include "PyDatabaseObjectType.hpp"
 #include "PyDatabaseConnectionState.hpp"
 #include "PyDatabaseConnectionPumpLoop.hpp"
@@ -51,6 +52,9 @@ PyInit__types(void)
     if (PyType_Ready(&PyType_VersionedIdSet) < 0)
         return NULL;
 
+    if (PyType_Ready(&PyType_VersionTable) < 0)
+        return NULL;
+
     if (PyType_Ready(&PyType_DatabaseConnectionState) < 0)
         return NULL;
 
@@ -66,6 +70,7 @@ PyInit__types(void)
         return NULL;
 
     PyModule_AddObject(module, "VersionedIdSet", (PyObject *)&PyType_VersionedIdSet);
+    PyModule_AddObject(module, "VersionTable", (PyObject *)&PyType_VersionTable);
     PyModule_AddObject(module, "DatabaseConnectionState", (PyObject *)&PyType_DatabaseConnectionState);
     PyModule_AddObject(module, "DatabaseConnectionPumpLoop", (PyObject *)&PyType_DatabaseConnectionPumpLoop);
     PyModule_AddObject(module, "View", (PyObject *)&PyType_View);
@@ -9,4 +9,5 @@ with the object_database implementation.
 #include "PyDatabaseConnectionState.cpp"
 #include "PyDatabaseConnectionPumpLoop.cpp"
 #include "PyVersionedIdSet.cpp"
+#include "PyVersionTable.cpp"
 #include "PyDatabaseObjectType.cpp"
@@ -0,0 +1,345 @@
+#   Copyright 2017-2019 object_database Authors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Change-data-capture: streams of committed transactions, without the objects.
+
+If configured to with Server.setChangeLogRetention, the server keeps a
+ChangeLog of recent transactions. A client that sends SubscribeChanges gets
+a ChangeSubscription on the server, which sends it the transactions after a
+given transaction id that touch the schema, type and fields it asked for,
+as ChangeData messages. On the client these show up in a ChangeStream.
+
+The client acknowledges each change once it's processed it, and the server
+never has more than 'window' unacknowledged changes in flight on a stream.
+The last acknowledged transaction id, along with the epoch of the server
+that committed it, is the stream's cursor. Transaction ids start over when
+the server restarts, so a cursor is only good against the server run whose
+epoch it names. Subscribing again from the cursor (which ChangeStream can
+keep in a file for us) picks up where we left off, as long as that server
+still retains those transactions.
+"""
+
+import bisect
+import collections
+import os
+import queue
+
+from object_database.messages import ClientToServer, ServerToClient
+from object_database.view import DisconnectedException
+
+DEFAULT_CHANGE_LOG_TRANSACTIONS = 0
+DEFAULT_CHANGE_WINDOW = 100
+
+
+class ChangesUnavailableException(Exception):
+    pass
+
+
+class ChangeLog:
+    """The transactions a server committed most recently.
+
+    We keep at least the last 'maxTransactions' of them (and at most twice
+    that), and know we have every transaction after 'retainedAfter'. Each one
+    holds a copy of everything the transaction wrote, so retaining them costs
+    memory in proportion to the server's write volume. With 'maxTransactions'
+    of zero we keep nothing.
+    """
+
+    def __init__(self, maxTransactions, startTransactionId):
+        self.maxTransactions = maxTransactions
+        self.retainedAfter = startTransactionId
+
+        self._transactionIds = []
+        # (writes, set_adds, set_removes) for each of '_transactionIds'
+        self._changes = []
+
+    def append(self, transactionId, writes, set_adds, set_removes):
+        if not self.maxTransactions:
+            self.retainedAfter = transactionId
+            return
+
+        self._transactionIds.append(transactionId)
+        self._changes.append(
+            (
+                dict(writes),
+                {k: tuple(v) for k, v in set_adds.items()},
+                {k: tuple(v) for k, v in set_removes.items()},
+            )
+        )
+
+        # trim in bulk so appending stays cheap
+        if len(self._transactionIds) > 2 * self.maxTransactions:
+            dropCount = len(self._transactionIds) - self.maxTransactions
+
+            self.retainedAfter = self._transactionIds[dropCount - 1]
+
+            del self._transactionIds[:dropCount]
+            del self._changes[:dropCount]
+
+    def discardAfter(self, transactionId):
+        """Forget the transactions after 'transactionId', which didn't commit after all."""
+        keep = bisect.bisect_right(self._transactionIds, transactionId)
+
+        del self._transactionIds[keep:]
+        del self._changes[keep:]
+
+        self.retainedAfter = min(self.retainedAfter, transactionId)
+
+    def covers(self, transactionId):
+        """Do we hold every transaction after 'transactionId'?"""
+        return transactionId >= self.retainedAfter
+
+    def changesAfter(self, transactionId):
+        """Yield (transactionId, writes, set_adds, set_removes) after 'transactionId'."""
+        for i in range(
+            bisect.bisect_right(self._transactionIds, transactionId), len(self._changes)
+        ):
+            yield (self._transactionIds[i],) + self._changes[i]
+
+
+class TransactionCoalescer:
+    """Merges a run of transactions, oldest first, into one with the same effect.
+
+    A later write to a key replaces an earlier one, and an identity that's added
+    to an index and then removed (or the reverse) ends up only on the later side.
+    """
+
+    def __init__(self):
+        self.transactionId = None
+        self.transactionCount = 0
+
+        self.writes = {}
+        # IndexId -> set of identities
+        self.setAdds = {}
+        self.setRemoves = {}
+
+    def add(self, transactionId, writes, set_adds, set_removes):
+        self.transactionId = transactionId
+        self.transactionCount += 1
+
+        for key, value in writes.items():
+            self.writes[key] = value
+
+        for indexId, identities in set_adds.items():
+            self.setAdds.setdefault(indexId, set()).update(identities)
+
+            if indexId in self.setRemoves:
+                self.setRemoves[indexId].difference_update(identities)
+
+        for indexId, identities in set_removes.items():
+            self.setRemoves.setdefault(indexId, set()).update(identities)
+
+            if indexId in self.setAdds:
+                self.setAdds[indexId].difference_update(identities)
+
+    @property
+    def keyCount(self):
+        """The number of keys and index memberships we're holding."""
+        return (
+            len(self.writes)
+            + sum(len(i) for i in self.setAdds.values())
+            + sum(len(i) for i in self.setRemoves.values())
+        )
+
+    def addTransaction(self, msg):
+        """Add a ServerToClient.Transaction, which mustn't have field_operations."""
+        assert not msg.field_operations
+
+        self.add(msg.transaction_id, msg.writes, msg.set_adds, msg.set_removes)
+
+    def message(self):
+        """The ServerToClient.Transaction for everything we've added."""
+        return ServerToClient.Transaction(
+            writes=self.writes,
+            set_adds={k: tuple(v) for k, v in self.setAdds.items() if v},
+            set_removes={k: tuple(v) for k, v in self.setRemoves.items() if v},
+            transaction_id=self.transactionId,
+        )
+
+
+class ChangeSubscription:
+    """The server's state for one SubscribeChanges stream."""
+
+    def __init__(self, connectedChannel, msg):
+        self.connectedChannel = connectedChannel
+        self.guid = msg.subscription_guid
+        self.schema = msg.schema
+        self.typename = msg.typename
+        self.fields = set(msg.fields) if msg.fields is not None else None
+        self.window = max(msg.window, 1)
+
+        # the last transaction id we've looked at
+        self.lastSentTransactionId = msg.from_transaction_id
+
+        # the transaction ids we've sent and that haven't been acknowledged
+        self.unacknowledged = collections.deque()
+
+        # fieldId -> whether this stream wants it
+        self._fieldIdMatches = {}
+
+    def _matches(self, fieldId, typeMap):
+        if fieldId not in self._fieldIdMatches:
+            fieldDef = typeMap.fieldIdToDef.get(fieldId)
+
+            self._fieldIdMatches[fieldId] = (
+                fieldDef is not None
+                and fieldDef.schema == self.schema
+                and (self.typename is None or fieldDef.typename == self.typename)
+                and (
+                    self.fields is None
+                    or fieldDef.fieldname in self.fields
+                    or fieldDef.fieldname == " exists"
+                )
+            )
+
+        return self._fieldIdMatches[fieldId]
+
+    def acknowledge(self, transactionId):
+        while self.unacknowledged and self.unacknowledged[0] <= transactionId:
+            self.unacknowledged.popleft()
+
+    def pendingMessages(self, changeLog, typeMap):
+        """Return the ChangeData messages we can send now, advancing our position.
+
+        Returns None if the log no longer has what we need to send next.
+        """
+        if not changeLog.covers(self.lastSentTransactionId):
+            return None
+
+        messages = []
+
+        for transactionId, writes, set_adds, set_removes in changeLog.changesAfter(
+            self.lastSentTransactionId
+        ):
+            if len(self.unacknowledged) >= self.window:
+                break
+
+            self.lastSentTransactionId = transactionId
+
+            writes = {k: v for k, v in writes.items() if self._matches(k.fieldId, typeMap)}
+            set_adds = {k: v for k, v in set_adds.items() if self._matches(k.fieldId, typeMap)}
+            set_removes = {
+                k: v for k, v in set_removes.items() if self._matches(k.fieldId, typeMap)
+            }
+
+            if writes or set_adds or set_removes:
+                self.unacknowledged.append(transactionId)
+
+                messages.append(
+                    ServerToClient.ChangeData(
+                        subscription_guid=self.guid,
+                        transaction_id=transactionId,
+                        writes=writes,
+                        set_adds=set_adds,
+                        set_removes=set_removes,
+                    )
+                )
+
+        return messages
+
+
+class ChangeStream:
+    """The client's end of a stream from DatabaseConnection.subscribeToChanges.
+
+    Call 'next' to get each ChangeData message in turn, and 'acknowledge' it
+    once it's been dealt with. 'cursor' is the last transaction id we
+    acknowledged, and 'serverEpoch' the epoch of the server run it came from.
+    If 'cursorPath' isn't None, we write both to that file every time the
+    cursor advances.
+    """
+
+    def __init__(self, connection, guid, serverEpoch, fromTransactionId, cursorPath=None):
+        self._connection = connection
+        self.guid = guid
+        self.serverEpoch = serverEpoch
+        self.cursor = fromTransactionId
+        self.cursorPath = cursorPath
+        self._queue = queue.Queue()
+
+    @staticmethod
+    def loadCursor(cursorPath):
+        """Return the (serverEpoch, transactionId) in 'cursorPath', or None if there isn't one.
+
+        Cursors written before we recorded the epoch come back with an empty
+        epoch, which no server will accept.
+        """
+        if not os.path.exists(cursorPath):
+            return None
+
+        with open(cursorPath, "r") as f:
+            parts = f.read().split()
+
+        if len(parts) == 1:
+            return "", int(parts[0])
+
+        return parts[0], int(parts[1])
+
+    def _saveCursor(self):
+        with open(self.cursorPath + ".tmp", "w") as f:
+            f.write(f"{self.serverEpoch} {self.cursor}")
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(self.cursorPath + ".tmp", self.cursorPath)
+
+    def _onChangeData(self, msg):
+        self._queue.put(msg)
+
+    def _onChangesUnavailable(self, msg):
+        self._queue.put(ChangesUnavailableException(msg.reason))
+
+    def _onDisconnected(self):
+        self._queue.put(DisconnectedException())
+
+    def next(self, timeout=None):
+        """Return the next ChangeData message, or None if none arrives within 'timeout'.
+
+        Raises ChangesUnavailableException or DisconnectedException once the
+        stream is over.
+        """
+        try:
+            item = self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+        if isinstance(item, Exception):
+            # keep raising it for anybody else who asks
+            self._queue.put(item)
+            raise item
+
+        return item
+
+    def __iter__(self):
+        while True:
+            yield self.next()
+
+    def acknowledge(self, change):
+        """Tell the server we're done with 'change' and everything before it."""
+        self.cursor = change.transaction_id
+
+        if self.cursorPath is not None:
+            self._saveCursor()
+
+        self._connection._channel.write(
+            ClientToServer.AcknowledgeChanges(
+                subscription_guid=self.guid, transaction_id=change.transaction_id
+            )
+        )
+
+    def fieldDefinition(self, fieldId):
+        """Return the FieldDefinition of a fieldId in a change, or None if it's unknown."""
+        return self._connection._field_id_to_field_def.get(fieldId)
+
+    def close(self):
+        self._connection._dropChangeStream(self)
@@ -12,16 +12,34 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+from typed_python import serialize, deserialize
+
 from .messages import ClientToServer, ServerToClient
 
 
 class ServerToClientChannel:
     """Base class for channels that a Server holds to talk to a client."""
 
+    # True if this channel serializes messages on the way out, in which case
+    # handing it already-serialized bytes with 'sendSerialized' saves work.
+    wantsSerializedMessages = False
+
     def sendMessage(self, msg: ServerToClient):
         """Send a message to the client."""
         raise NotImplementedError(self)
 
+    def sendSerialized(self, serializedMsg: bytes):
+        """Send a message that has already been serialized as a ServerToClient.
+
+        Channels that set 'wantsSerializedMessages' should override this to send
+        the bytes directly.
+        """
+        self.sendMessage(deserialize(ServerToClient, serializedMsg))
+
+    def pendingBytecount(self):
+        """How many bytes are waiting to be written to the client, or None if unknown."""
+        return None
+
     def setClientToServerHandler(self, handler):
         """Set the callback to call when we get a message from this client.
 
@@ -77,3 +95,28 @@ class ClientToServerChannel:
         No further calls to 'handler' should be made after this is called.
         """
         raise NotImplementedError(self)
+
+
+class BroadcastMessage:
+    """A ServerToClient message that we're sending to many channels.
+
+    The message is serialized at most once, the first time we send it to a channel
+    that wants serialized messages, and the same buffer is shared by every channel
+    after that.
+    """
+
+    def __init__(self, msg: ServerToClient):
+        self.msg = msg
+        self._serializedMsg = None
+
+    def serialized(self):
+        if self._serializedMsg is None:
+            self._serializedMsg = serialize(ServerToClient, self.msg)
+
+        return self._serializedMsg
+
+    def sendTo(self, channel: ServerToClientChannel):
+        if channel.wantsSerializedMessages:
+            channel.sendSerialized(self.serialized())
+        else:
+            channel.sendMessage(self.msg)
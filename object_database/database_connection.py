@@ -13,8 +13,13 @@
 #   limitations under the License.
 
 from object_database.schema import ObjectFieldId, IndexId, FieldDefinition, indexValueFor
-from object_database.messages import ClientToServer, getHeartbeatInterval
+from object_database.messages import (
+    ClientToServer,
+    applyFieldOperation,
+    getHeartbeatInterval,
+)
 from object_database.core_schema import core_schema
+from object_database.change_stream import ChangeStream, DEFAULT_CHANGE_WINDOW
 
 from object_database.view import View, Transaction, _cur_view
 from object_database.reactor import Reactor
@@ -92,6 +97,20 @@ class DatabaseConnection:
 
         self._pendingSubscriptions = {}
 
+        # (schema, typename, fieldname_and_val) -> the number of times we've asked
+        # for that subscription without a matching unsubscribe
+        self._subscriptionRefcounts = {}
+
+        # (schema, typename, fieldname_and_val) -> Event set on UnsubscribeComplete
+        self._pendingUnsubscriptions = {}
+
+        # (schema, typename, fieldname_and_val) -> whether we subscribed lazily
+        self._subscriptionLaziness = {}
+
+        # (schema, typename) -> the set of fieldnames we've subscribed to, or None
+        # if some subscription asked for all of them
+        self._fieldProjections = {}
+
         # (schema, typename, fieldname_and_val) -> {'values', 'index_values', 'identities'}
         # where (fieldname_and_val) is OneOf(None, (str, IndexValue))
         self._subscription_buildup = {}
@@ -109,6 +128,20 @@ class DatabaseConnection:
         self._max_tid_by_schema = {}
         self._max_tid_by_schema_and_type = {}
 
+        # subscription_guid -> ChangeStream
+        self._changeStreams = {}
+        self._changeStreamGuid = 0
+
+        # what the server's Initialize told us, which we need to reconnect
+        self._serverEpoch = None
+        self._identityRoot = None
+        self._initialTransactionNum = None
+
+        # while we're reconnecting, the server's answer to ResumeSubscriptions
+        self._reconnecting = False
+        self._resumeResponse = threading.Event()
+        self._resumed = False
+
     @property
     def auth_token(self):
         return self._auth_token
@@ -188,9 +221,18 @@ class DatabaseConnection:
             for e in self._pendingSubscriptions.values():
                 e.set()
 
+            for e in self._pendingUnsubscriptions.values():
+                e.set()
+
             for e in self._schema_response_events.values():
                 e.set()
 
+            self._resumeResponse.set()
+
+            for stream in self._changeStreams.values():
+                stream._onDisconnected()
+            self._changeStreams = {}
+
             for q in self._transaction_callbacks.values():
                 try:
                     q(TransactionResult.Disconnected())
@@ -200,6 +242,138 @@ class DatabaseConnection:
             self._transaction_callbacks = {}
             self._flushEvents = {}
 
+    def reconnect(self, channel, timeout=None):
+        """Pick up where we left off, over 'channel', after we've been disconnected.
+
+        If every one of our subscriptions is an eager subscription to a whole
+        type, and the server still has every transaction since the last one we
+        saw, it sends us just those transactions and we keep the objects we
+        have. Otherwise we start over with an empty state and subscribe to
+        everything again, as a new connection would.
+
+        Returns:
+            True if we resumed our subscriptions, False if we started over.
+        """
+        with self._lock:
+            assert self.disconnected.is_set(), "We're still connected."
+
+            lastEpoch = self._serverEpoch
+            lastTransactionId = self._cur_transaction_num
+            schemas = list(self._schemas)
+            subscriptionLaziness = {
+                key: self._subscriptionLaziness.get(key, False)
+                for key in self._pendingSubscriptions
+            }
+
+            self._channel = channel
+            self._reconnecting = True
+            self._resumed = False
+            self._resumeResponse = threading.Event()
+            self._schemas = set()
+            self._schema_response_events = {}
+            self._pendingSubscriptions = {}
+            self._pendingUnsubscriptions = {}
+            self._subscription_buildup = {}
+            self._connection_state.setTriggerLazyLoad(self.loadLazyObject)
+
+            self.initialized.clear()
+            self.disconnected.clear()
+
+        try:
+            self._channel.setServerToClientHandler(self._onMessage)
+
+            if self._auth_token is not None:
+                self._channel.write(ClientToServer.Authenticate(token=self._auth_token))
+
+            if not self.initialized.wait(timeout):
+                raise Exception(f"Failed to reconnect within {timeout} seconds")
+
+            for schema in schemas:
+                self.addSchema(schema, timeout=timeout)
+
+            if lastEpoch and all(
+                key[2] is None and not isLazy for key, isLazy in subscriptionLaziness.items()
+            ):
+                with self._lock:
+                    if self.disconnected.is_set():
+                        raise DisconnectedException()
+
+                    for key in subscriptionLaziness:
+                        self._pendingSubscriptions[key] = threading.Event()
+
+                    types = []
+                    for schema, typename, _ in subscriptionLaziness:
+                        projection = self._fieldProjections.get((schema, typename))
+
+                        types.append(
+                            (
+                                schema,
+                                typename,
+                                None if projection is None else tuple(sorted(projection)),
+                            )
+                        )
+
+                    self._channel.write(
+                        ClientToServer.ResumeSubscriptions(
+                            server_epoch=lastEpoch,
+                            transaction_id=lastTransactionId,
+                            types=types,
+                        )
+                    )
+
+                if not self._resumeResponse.wait(timeout):
+                    raise Exception(f"Failed to resume subscriptions within {timeout} seconds")
+
+                if self.disconnected.is_set():
+                    raise DisconnectedException()
+        finally:
+            with self._lock:
+                self._reconnecting = False
+
+        if self._resumed:
+            return True
+
+        self._startOver(subscriptionLaziness, timeout)
+
+        return False
+
+    def _startOver(self, subscriptionLaziness, timeout):
+        """Drop everything we know about objects and subscribe to them again."""
+        with self._lock:
+            self._cur_transaction_num = self._initialTransactionNum
+            self._max_tid_by_schema = {}
+            self._max_tid_by_schema_and_type = {}
+            self._pendingSubscriptions = {}
+
+            self._connection_state = DatabaseConnectionState()
+            self._connection_state.setSerializationContext(self.serializationContext)
+            self._connection_state.setTriggerLazyLoad(self.loadLazyObject)
+            self._connection_state.setIdentityRoot(IDENTITY_BLOCK_SIZE * self._identityRoot)
+
+            for fieldId, fieldDef in self._field_id_to_field_def.items():
+                self._connection_state.setFieldId(
+                    fieldDef.schema, fieldDef.typename, fieldDef.fieldname, fieldId
+                )
+
+            subscriptionRefcounts = dict(self._subscriptionRefcounts)
+
+            subscriptionTuples = []
+            for key, isLazy in subscriptionLaziness.items():
+                projection = self._fieldProjections.get(key[:2])
+
+                subscriptionTuples.append(
+                    key + (isLazy, None if projection is None else tuple(projection))
+                )
+
+            # the projections get rebuilt as we subscribe
+            self._fieldProjections = {}
+
+        self.subscribeMultiple(subscriptionTuples, timeout=timeout)
+
+        with self._lock:
+            # subscribeMultiple counted these as new subscriptions
+            self._subscriptionRefcounts = subscriptionRefcounts
+
     def _noViewsOutstanding(self):
         with self._lock:
             return self._connection_state.outstandingViewCount() == 0
@@ -287,7 +461,16 @@ class DatabaseConnection:
             return desiredLaziness
         return typeObj.isLazyByDefault()
 
-    def subscribeToIndex(self, t, block=True, lazySubscription=None, timeout=None, **kwarg):
+    def subscribeToIndex(
+        self, t, block=True, lazySubscription=None, timeout=None, fields=None, **kwarg
+    ):
+        """Subscribe to the objects of type 't' with the given index values.
+
+        Args:
+            fields: if not None, a list of fieldnames. We only receive those
+                fields of each object, and reading any other field raises
+                FieldNotSubscribedException.
+        """
         self.addSchema(t.__schema__, block=block, timeout=timeout)
 
         toSubscribe = []
@@ -305,20 +488,28 @@ class DatabaseConnection:
                     t.__qualname__,
                     (fieldname, indexVal),
                     self._lazinessForType(t, lazySubscription),
+                    fields,
                 )
             )
 
         return self.subscribeMultiple(toSubscribe, block=block, timeout=timeout)
 
-    def subscribeToType(self, t, block=True, lazySubscription=None, timeout=None):
+    def subscribeToType(self, t, block=True, lazySubscription=None, timeout=None, fields=None):
+        """Subscribe to every object of type 't'.
+
+        Args:
+            fields: if not None, a list of fieldnames. We only receive those
+                fields of each object, and reading any other field raises
+                FieldNotSubscribedException.
+        """
         self.addSchema(t.__schema__, block=block, timeout=timeout)
 
-        if (
-            self._connection_state.typeSubscriptionLowestTransaction(
-                t.__schema__.name, t.__qualname__
-            )
-            is not None
+        if self._connection_state.typeSubscriptionLowestTransaction(
+            t.__schema__.name, t.__qualname__
+        ) is not None and self._fieldProjectionCovers(
+            t.__schema__.name, t.__qualname__, fields
         ):
+            self._increfSubscriptions([(t.__schema__.name, t.__qualname__, None)])
             return ()
 
         return self.subscribeMultiple(
@@ -328,6 +519,7 @@ class DatabaseConnection:
                     t.__qualname__,
                     None,
                     self._lazinessForType(t, lazySubscription),
+                    fields,
                 )
             ],
             block,
@@ -341,12 +533,22 @@ class DatabaseConnection:
             self.addSchema(schemaName, block=block, timeout=timeout)
 
         unsubscribedTypes = []
+        subscribedTypes = []
         for schema in schemas:
             for tname, t in schema._types.items():
-                if not self.isSubscribedToType(t) and t not in excluding:
+                if t in excluding:
+                    continue
+
+                if not self.isSubscribedToType(t) or not self._fieldProjectionCovers(
+                    schema.name, tname, None
+                ):
                     unsubscribedTypes.append(
                         (schema.name, tname, None, self._lazinessForType(t, lazySubscription))
                     )
+                else:
+                    subscribedTypes.append((schema.name, tname, None))
+
+        self._increfSubscriptions(subscribedTypes)
 
         if unsubscribedTypes:
             return self.subscribeMultiple(unsubscribedTypes, block=block, timeout=timeout)
@@ -404,6 +606,8 @@ class DatabaseConnection:
 
             events = []
 
+            self._increfSubscriptions(subscriptionTuples)
+
             for tup in subscriptionTuples:
                 e = self._pendingSubscriptions.get(tup)
 
@@ -412,12 +616,18 @@ class DatabaseConnection:
 
                     assert tup[0] and tup[1]
 
+                    fields = tup[4] if len(tup) > 4 else None
+
+                    self._subscriptionLaziness[tup[:3]] = tup[3]
+                    self._widenFieldProjection(tup[0], tup[1], fields)
+
                     self._channel.write(
                         ClientToServer.Subscribe(
                             schema=tup[0],
                             typename=tup[1],
                             fieldname_and_value=tup[2],
                             isLazy=tup[3],
+                            fields=None if fields is None else tuple(fields),
                         )
                     )
 
@@ -436,6 +646,255 @@ class DatabaseConnection:
 
         return ()
 
+    def _fieldProjectionCovers(self, schema, typename, fields):
+        """Are we already subscribed to 'fields' (or every field, if None) of a type?"""
+        with self._lock:
+            if (schema, typename) not in self._fieldProjections:
+                return True
+
+            projection = self._fieldProjections[(schema, typename)]
+
+            if projection is None:
+                return True
+
+            return fields is not None and set(fields) <= projection
+
+    def _widenFieldProjection(self, schema, typename, fields):
+        """Make 'fields' of a type readable, in addition to what we could read before."""
+        with self._lock:
+            key = (schema, typename)
+
+            if key in self._fieldProjections and self._fieldProjections[key] is None:
+                return
+
+            if fields is None:
+                projection = None
+            else:
+                projection = self._fieldProjections.get(key, set()) | set(fields)
+
+            self._fieldProjections[key] = projection
+
+            self._connection_state.setFieldProjection(
+                schema=schema,
+                typename=typename,
+                fields=None if projection is None else sorted(projection),
+            )
+
+    def _increfSubscriptions(self, subscriptionTuples):
+        with self._lock:
+            for tup in subscriptionTuples:
+                self._subscriptionRefcounts[tup[:3]] = (
+                    self._subscriptionRefcounts.get(tup[:3], 0) + 1
+                )
+
+    def unsubscribeFromType(self, t, block=True, timeout=None):
+        return self.unsubscribeMultiple(
+            [(t.__schema__.name, t.__qualname__, None)], block=block, timeout=timeout
+        )
+
+    def unsubscribeFromSchema(self, *schemas, block=True, excluding=(), timeout=None):
+        return self.unsubscribeMultiple(
+            [
+                (schema.name, tname, None)
+                for schema in schemas
+                for tname, t in schema._types.items()
+                if t not in excluding and self.isSubscribedToType(t)
+            ],
+            block=block,
+            timeout=timeout,
+        )
+
+    def unsubscribeFromIndex(self, t, block=True, timeout=None, **kwarg):
+        toUnsubscribe = []
+
+        for fieldname, fieldvalue in kwarg.items():
+            indexVal = indexValueFor(
+                t.__schema__.indexType(t.__qualname__, fieldname),
+                fieldvalue,
+                self.serializationContext,
+            )
+
+            toUnsubscribe.append((t.__schema__.name, t.__qualname__, (fieldname, indexVal)))
+
+        return self.unsubscribeMultiple(toUnsubscribe, block=block, timeout=timeout)
+
+    def unsubscribeFromObject(self, t, block=True, timeout=None):
+        return self.unsubscribeFromObjects([t], block=block, timeout=timeout)
+
+    def unsubscribeFromObjects(self, objects, block=True, timeout=None):
+        return self.unsubscribeMultiple(
+            [
+                (
+                    type(t).__schema__.name,
+                    type(t).__qualname__,
+                    ("_identity", indexValueFor(type(t), t, self.serializationContext)),
+                )
+                for t in objects
+            ],
+            block=block,
+            timeout=timeout,
+        )
+
+    def unsubscribeMultiple(self, subscriptionTuples, block=True, timeout=None):
+        """Release subscriptions taken with 'subscribeMultiple'.
+
+        Subscriptions are reference counted: we only tell the server to drop a
+        subscription once every call that asked for it has been matched by an
+        unsubscribe. Once the server has acknowledged, objects that are no
+        longer covered by any of our subscriptions are dropped from our state.
+
+        Args:
+            subscriptionTuples: a list of (schema, typename, fieldname_and_value)
+                tuples, in the same form we pass to 'subscribeMultiple'.
+        """
+        toRelease = []
+
+        with self._lock:
+            if self.disconnected.is_set():
+                raise DisconnectedException()
+
+            for tup in subscriptionTuples:
+                key = tup[:3]
+
+                refcount = self._subscriptionRefcounts.get(key, 0)
+
+                if not refcount:
+                    raise Exception(f"Can't unsubscribe from {key} as we're not subscribed")
+
+                if refcount > 1:
+                    self._subscriptionRefcounts[key] = refcount - 1
+                else:
+                    del self._subscriptionRefcounts[key]
+                    toRelease.append(key)
+
+            pending = [
+                self._pendingSubscriptions[key]
+                for key in toRelease
+                if key in self._pendingSubscriptions
+            ]
+
+        # the server has to finish handing us a subscription before we can drop it
+        for e in pending:
+            if not e.wait(timeout=timeout):
+                raise Exception(f"Failed to subscribe within {timeout} seconds")
+
+        with self._lock:
+            if self.disconnected.is_set():
+                raise DisconnectedException()
+
+            events = []
+
+            for key in toRelease:
+                if self._subscriptionRefcounts.get(key):
+                    # somebody subscribed again while we were waiting
+                    continue
+
+                self._pendingSubscriptions.pop(key, None)
+                self._subscriptionLaziness.pop(key, None)
+
+                e = self._pendingUnsubscriptions.get(key)
+
+                if not e:
+                    e = self._pendingUnsubscriptions[key] = threading.Event()
+
+                    self._channel.write(
+                        ClientToServer.Unsubscribe(
+                            schema=key[0], typename=key[1], fieldname_and_value=key[2]
+                        )
+                    )
+
+                events.append(e)
+
+        if not block:
+            return tuple(events)
+
+        for e in events:
+            if not e.wait(timeout=timeout):
+                raise Exception(f"Failed to unsubscribe within {timeout} seconds")
+
+        with self._lock:
+            if self.disconnected.is_set():
+                raise DisconnectedException()
+
+        return ()
+
+    def subscribeToChanges(
+        self,
+        schema,
+        typename=None,
+        fields=None,
+        fromTransactionId=None,
+        cursorPath=None,
+        window=DEFAULT_CHANGE_WINDOW,
+        serverEpoch=None,
+    ):
+        """Stream the changes committed to 'schema' after a given transaction.
+
+        We only send the values of the fields, not the objects they belong to,
+        so this doesn't subscribe us to anything.
+
+        Args:
+            schema - the schema to watch.
+            typename - if not None, only watch this type.
+            fields - if not None, only watch these fields (and " exists").
+            fromTransactionId - send the transactions after this one. If None,
+                we resume from the cursor in 'cursorPath', or else start from
+                our current transaction id.
+            cursorPath - if not None, a file in which the stream keeps the
+                last transaction id we acknowledged, and its server epoch.
+            window - the most changes the server sends before we acknowledge them.
+            serverEpoch - the epoch of the server run 'fromTransactionId' came
+                from (a ChangeStream's 'serverEpoch'). If None, we assume it's
+                the one we're connected to. If it isn't, the stream is unavailable.
+
+        Returns:
+            a ChangeStream.
+        """
+        self.addSchema(schema)
+
+        if fromTransactionId is None and cursorPath is not None:
+            cursor = ChangeStream.loadCursor(cursorPath)
+
+            if cursor is not None:
+                serverEpoch, fromTransactionId = cursor
+
+        with self._lock:
+            if self.disconnected.is_set():
+                raise DisconnectedException()
+
+            if fromTransactionId is None:
+                fromTransactionId = self._cur_transaction_num
+
+            if serverEpoch is None:
+                serverEpoch = self._serverEpoch or ""
+
+            self._changeStreamGuid += 1
+            stream = ChangeStream(
+                self, self._changeStreamGuid, serverEpoch, fromTransactionId, cursorPath
+            )
+            self._changeStreams[stream.guid] = stream
+
+            self._channel.write(
+                ClientToServer.SubscribeChanges(
+                    subscription_guid=stream.guid,
+                    schema=schema.name,
+                    typename=typename,
+                    fields=tuple(fields) if fields is not None else None,
+                    server_epoch=serverEpoch,
+                    from_transaction_id=fromTransactionId,
+                    window=window,
+                )
+            )
+
+        return stream
+
+    def _dropChangeStream(self, stream):
+        with self._lock:
+            if self._changeStreams.pop(stream.guid, None) is not None:
+                self._channel.write(
+                    ClientToServer.UnsubscribeChanges(subscription_guid=stream.guid)
+                )
+
     def waitForCondition(self, cond, timeout, maxSleepTime=None):
         """Wait for 'cond' to return True.
 
@@ -514,7 +973,15 @@ class DatabaseConnection:
                     e.set()
         elif msg.matches.Initialize:
             with self._lock:
-                self._cur_transaction_num = msg.transaction_num
+                self._serverEpoch = msg.server_epoch
+                self._identityRoot = msg.identity_root
+                self._initialTransactionNum = msg.transaction_num
+
+                # if we're reconnecting, we stay where we were until we know
+                # whether we can resume our subscriptions
+                if not self._reconnecting:
+                    self._cur_transaction_num = msg.transaction_num
+
                 self._connection_state.setIdentityRoot(IDENTITY_BLOCK_SIZE * msg.identity_root)
                 self.connectionObject = core_schema.Connection.fromIdentity(msg.connIdentity)
                 self.initialized.set()
@@ -532,24 +999,61 @@ class DatabaseConnection:
                     self._logger.exception("Transaction commit callback threw an exception:")
         elif msg.matches.Transaction:
             with self._lock:
+                writes = msg.writes
+
+                if msg.field_operations:
+                    try:
+                        writes = self._applyIncomingFieldOperations(msg)
+                    except Exception:
+                        # our copy of the field would be wrong from here on, so we
+                        # stop applying transactions. Reconnecting starts us over.
+                        self._logger.exception(
+                            "Can't apply transaction %s. Disconnecting.", msg.transaction_id
+                        )
+                        self.disconnect()
+                        return
+
                 self._markSchemaAndTypeMaxTids(
-                    set(k.fieldId for k in msg.writes), msg.transaction_id
+                    set(k.fieldId for k in writes), msg.transaction_id
                 )
 
                 self._connection_state.incomingTransaction(
-                    msg.transaction_id, msg.writes, msg.set_adds, msg.set_removes
+                    msg.transaction_id, writes, msg.set_adds, msg.set_removes
                 )
 
                 self._cur_transaction_num = msg.transaction_id
 
             for handler in list(self._onTransactionHandlers):
                 try:
-                    handler(msg.writes, msg.set_adds, msg.set_removes, msg.transaction_id)
+                    handler(writes, msg.set_adds, msg.set_removes, msg.transaction_id)
                 except Exception:
                     self._logger.exception(
                         "_onTransaction handler %s threw an exception:", handler
                     )
 
+        elif msg.matches.SubscriptionsResumed:
+            with self._lock:
+                if msg.resumed:
+                    # the server has sent us every transaction we missed
+                    assert self._cur_transaction_num <= msg.tid
+
+                    self._cur_transaction_num = msg.tid
+
+                    for e in self._pendingSubscriptions.values():
+                        e.set()
+
+                self._resumed = msg.resumed
+                self._resumeResponse.set()
+        elif msg.matches.ChangeData:
+            with self._lock:
+                stream = self._changeStreams.get(msg.subscription_guid)
+                if stream is not None:
+                    stream._onChangeData(msg)
+        elif msg.matches.ChangesUnavailable:
+            with self._lock:
+                stream = self._changeStreams.pop(msg.subscription_guid, None)
+                if stream is not None:
+                    stream._onChangesUnavailable(msg)
         elif msg.matches.SchemaMapping:
             with self._lock:
                 for fieldDef, fieldId in msg.mapping.items():
@@ -584,9 +1088,11 @@ class DatabaseConnection:
                         "markedLazy": False,
                     }
                 else:
-                    assert not self._subscription_buildup[lookupTuple][
-                        "markedLazy"
-                    ], "received non-lazy data for a lazy subscription"
+                    # a lazy subscription may still carry values for fields it made
+                    # visible on a type we were already subscribed to
+                    assert not self._subscription_buildup[lookupTuple]["markedLazy"] or (
+                        not msg.identities and not msg.index_values
+                    ), "received non-lazy data for a lazy subscription"
 
                 self._subscription_buildup[lookupTuple]["values"].update(
                     {k: msg.values[k] for k in msg.values}
@@ -704,9 +1210,64 @@ class DatabaseConnection:
                 self._cur_transaction_num = msg.tid
 
                 event.set()
+        elif msg.matches.UnsubscribeComplete:
+            with self._lock:
+                lookupTuple = (
+                    msg.schema,
+                    msg.typename,
+                    tuple(msg.fieldname_and_value)
+                    if msg.fieldname_and_value is not None
+                    else None,
+                )
+
+                if msg.fieldname_and_value is None:
+                    self._connection_state.markTypeUnsubscribed(msg.schema, msg.typename)
+
+                for oid in set(k.objId for k in msg.writes):
+                    self._connection_state.markObjectUnsubscribed(oid)
+
+                # this should be inline with the stream of messages coming from the server
+                assert self._cur_transaction_num <= msg.tid
+
+                # the objects didn't change, we just stopped watching them, so we
+                # forget them rather than applying a transaction that deletes them
+                self._connection_state.dropObjects(msg.tid, msg.writes, msg.set_removes)
+
+                e = self._pendingUnsubscriptions.pop(lookupTuple, None)
+                if e:
+                    e.set()
         else:
             assert False, "unknown message type " + msg._which
 
+    def _applyIncomingFieldOperations(self, msg):
+        """Rebuild the values of the fields a Transaction sent us as appends.
+
+        Returns:
+            the Transaction's writes, plus the new value of each appended field.
+
+        Raises:
+            Exception: if we don't have the value of a field we got appends for.
+                The server only sends appends to clients it knows hold the value.
+        """
+        writes = dict(msg.writes)
+
+        for key, ops in msg.field_operations.items():
+            value = self._connection_state.serializedObjectDataAtTid(
+                key.objId, key.fieldId, msg.transaction_id
+            )
+
+            if value is None:
+                raise Exception(
+                    f"Received an append to {key}, which we don't have a value for"
+                )
+
+            for op in ops:
+                value = applyFieldOperation(value, op)
+
+            writes[key] = value
+
+        return writes
+
     def _markSchemaAndTypeMaxTids(self, fieldIds, tid):
         for fieldId in fieldIds:
             fieldDef = self._field_id_to_field_def.get(fieldId)
@@ -790,6 +1351,7 @@ class DatabaseConnection:
         as_of_version,
         confirmCallback,
         no_log=False,
+        field_operations=None,
     ):
         assert confirmCallback is not None
 
@@ -916,6 +1478,7 @@ class DatabaseConnection:
                 key_versions=keys_to_check_versions,
                 index_versions=indices_to_check_versions,
                 transaction_guid=transaction_guid,
+                field_operations=field_operations or {},
             )
         )
 
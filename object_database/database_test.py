@@ -15,25 +15,43 @@
 from flaky import flaky
 from typed_python import Alternative, TupleOf, OneOf, ConstDict
 
-from object_database.schema import Indexed, Index, Schema, SubscribeLazilyByDefault
+from object_database.schema import (
+    Indexed,
+    Index,
+    Schema,
+    SubscribeLazilyByDefault,
+    ObjectFieldId,
+    IndexId,
+    indexValueFor,
+)
 from object_database.core_schema import core_schema
 from object_database.view import (
     RevisionConflictException,
     DisconnectedException,
+    FieldNotSubscribedException,
     ObjectDoesntExistException,
     ServerError,
 )
+from object_database.change_stream import ChangeStream, ChangesUnavailableException
 from object_database.database_connection import DatabaseConnection
 from object_database.tcp_server import TcpServer
 from object_database.inmem_server import InMemServer
-from object_database.persistence import InMemoryPersistence, RedisPersistence
+from object_database.persistence import (
+    InMemoryPersistence,
+    MemoryMappedPersistence,
+    RedisPersistence,
+    WriteAheadLogPersistence,
+)
 from object_database.util import configureLogging, genToken
 from object_database.test_util import currentMemUsageMb
 from object_database.RedisTestHelper import RedisTestHelper
 
+import object_database.channel as channel_module
 import object_database.messages as messages
+import object_database.server as server_module
 import queue
 import unittest
+import unittest.mock
 import tempfile
 import logging
 import numpy
@@ -488,6 +506,98 @@ class ObjectDatabaseTests:
                 else:
                     self.assertFalse(someThings[i].exists())
 
+    def test_unsubscribe_is_refcounted(self):
+        db1 = self.createNewDb()
+        db1.subscribeToSchema(schema)
+
+        db2 = self.createNewDb()
+
+        with db1.transaction():
+            c = Counter(k=1)
+            Counter(k=2)
+
+        db2.subscribeToIndex(Counter, k=1)
+        db2.subscribeToIndex(Counter, k=1)
+
+        db2.unsubscribeFromIndex(Counter, k=1)
+
+        with db2.view():
+            self.assertTrue(c.exists())
+
+        db2.unsubscribeFromIndex(Counter, k=1)
+
+        with db2.view():
+            self.assertFalse(c.exists())
+            self.assertEqual(Counter.lookupAll(k=1), ())
+
+        with self.assertRaises(Exception):
+            db2.unsubscribeFromIndex(Counter, k=1)
+
+    def test_unsubscribe_forgets_objects_without_a_transaction(self):
+        db1 = self.createNewDb()
+        db1.subscribeToSchema(schema)
+
+        db2 = self.createNewDb()
+
+        with db1.transaction():
+            c = Counter(k=1, x=5)
+
+        db2.subscribeToIndex(Counter, k=1)
+
+        writesSeen = []
+        db2.registerOnTransactionHandler(
+            lambda writes, set_adds, set_removes, tid: writesSeen.extend(writes)
+        )
+
+        tid = self.server._cur_transaction_num
+
+        db2.unsubscribeFromIndex(Counter, k=1)
+
+        # nothing was written, so nobody saw a transaction
+        self.assertEqual(self.server._cur_transaction_num, tid)
+        self.assertEqual(writesSeen, [])
+
+        with db2.view():
+            self.assertFalse(c.exists())
+            self.assertEqual(Counter.lookupAll(k=1), ())
+
+        # and we can pick the object up again later
+        db2.subscribeToIndex(Counter, k=1)
+
+        with db2.view():
+            self.assertEqual(c.x, 5)
+            self.assertEqual(Counter.lookupAll(k=1), (c,))
+
+    def test_unsubscribe_keeps_overlapping_subscriptions(self):
+        db1 = self.createNewDb()
+        db1.subscribeToSchema(schema)
+
+        db2 = self.createNewDb()
+
+        with db1.transaction():
+            c1 = Counter(k=1)
+            c2 = Counter(k=2)
+
+        db2.subscribeToType(Counter)
+        db2.subscribeToIndex(Counter, k=1)
+
+        db2.unsubscribeFromType(Counter)
+
+        with db2.view():
+            self.assertTrue(c1.exists())
+            self.assertFalse(c2.exists())
+
+        # writes to objects we no longer see stop arriving
+        with db1.transaction():
+            c2.k = 3
+            c1.x = 10
+
+        db2.flush()
+
+        with db2.view():
+            self.assertEqual(c1.x, 10)
+            self.assertFalse(c2.exists())
+
     def test_reading_many_python_objects_from_many_threads(self):
         # this test simply verifies that we don't segfault when we do this.
         # we need to verify that multiple threads writing into the view background
@@ -1952,170 +2062,533 @@ class ObjectDatabaseTests:
             # verify we see the write on c1
             self.assertTrue(c1.exists())
 
-    def test_moving_into_index(self):
+    def test_kvstore_snapshot(self):
+        keys = [ObjectFieldId(objId=1000000 + i, fieldId=0) for i in range(3)]
+
+        self.mem_store.setSeveral({keys[0]: b"a", keys[1]: b"b"})
+
+        snapshot = self.mem_store.snapshot()
+
+        self.mem_store.setSeveral({keys[0]: b"a2", keys[1]: None, keys[2]: b"c"})
+        self.mem_store.setSeveral({keys[0]: b"a3"})
+
+        self.assertEqual(snapshot.getSeveral(keys), [b"a", b"b", None])
+        self.assertEqual(self.mem_store.getSeveral(keys), [b"a3", None, b"c"])
+
+        snapshot.release()
+
+        self.mem_store.setSeveral({keys[2]: None})
+        self.assertEqual(self.mem_store.get(keys[2]), None)
+
+    def test_transactions_projected_to_subscriptions(self):
         db1 = self.createNewDb()
+        db1.subscribeToSchema(schema)
+
         db2 = self.createNewDb()
+        db2.subscribeToType(Counter)
 
-        db1.subscribeToSchema(schema)
-        db2.subscribeToIndex(Counter, k=123)
+        db3 = self.createNewDb()
+        db3.subscribeToIndex(Counter, k=1)
 
-        with db1.transaction():
-            c = Counter(k=0)
+        def recordWrites(db):
+            seen = []
+            db.registerOnTransactionHandler(
+                lambda writes, set_adds, set_removes, tid: seen.append(
+                    (dict(writes), dict(set_adds))
+                )
+            )
+            return seen
 
-        db2.flush()
-        with db2.view():
-            self.assertFalse(c.exists())
+        seen2 = recordWrites(db2)
+        seen3 = recordWrites(db3)
 
         with db1.transaction():
-            c.k = 123
-            c.x = 100
+            c1 = Counter(k=1)
+            c2 = Counter(k=2)
+            ThingWithDicts(x={"a": b"b"})
 
         db2.flush()
+        db3.flush()
+
+        def typenamesSeen(db, seen):
+            return set(
+                db._field_id_to_field_def[k.fieldId].typename
+                for writes, set_adds in seen
+                for k in list(writes) + list(set_adds)
+            )
+
+        self.assertEqual(typenamesSeen(db2, seen2), {"Counter"})
+        self.assertEqual(typenamesSeen(db3, seen3), {"Counter"})
+
+        self.assertEqual(set(k.objId for writes, _ in seen3 for k in writes), {c1._identity})
+
         with db2.view():
-            self.assertTrue(c.exists())
-            self.assertEqual(c.x, 100)
+            self.assertTrue(c1.exists())
+            self.assertTrue(c2.exists())
+
+        with db3.view():
+            self.assertTrue(c1.exists())
+            self.assertFalse(c2.exists())
+
+    def test_field_projected_subscriptions(self):
+        db1 = self.createNewDb()
+        db1.subscribeToSchema(schema)
+
+        db2 = self.createNewDb()
+        db2.subscribeToType(Counter, fields=["k"])
+
+        db3 = self.createNewDb()
+        db3.subscribeToIndex(Counter, k=1, fields=["x"])
+
+        writesSeen = []
+        db2.registerOnTransactionHandler(
+            lambda writes, set_adds, set_removes, tid: writesSeen.extend(writes)
+        )
 
         with db1.transaction():
-            c.k = 0
+            c = Counter(k=1, x=5)
 
         db2.flush()
+        db3.flush()
+
         with db2.view():
             self.assertTrue(c.exists())
-            self.assertEqual(c.k, 0)
+            self.assertEqual(c.k, 1)
+
+            with self.assertRaises(FieldNotSubscribedException):
+                c.x
+
+        with db3.view():
+            self.assertEqual(c.x, 5)
+
+            with self.assertRaises(FieldNotSubscribedException):
+                c.k
 
         with db1.transaction():
-            c.x = 101
+            c.x = 6
 
         db2.flush()
-        with db2.view():
-            self.assertTrue(c.exists())
-            self.assertEqual(c.x, 101)
+        db3.flush()
 
-    def test_multithreading_and_subscribing(self):
-        # Verify that if one thread is subscribing and the other is repeatedly looking
-        # at indices, that everything works correctly.
+        xFieldIds = set(
+            fieldId
+            for fieldId, fieldDef in db2._field_id_to_field_def.items()
+            if fieldDef.typename == "Counter" and fieldDef.fieldname == "x"
+        )
+        self.assertFalse([k for k in writesSeen if k.fieldId in xFieldIds])
 
+        with db3.view():
+            self.assertEqual(c.x, 6)
+
+        # subscribing to every field widens the projection
+        db2.subscribeToType(Counter)
+
+        with db2.view():
+            self.assertEqual(c.x, 6)
+
+    def test_field_projection_hides_fields_of_subscribed_objects(self):
         db1 = self.createNewDb()
+        db1.subscribeToSchema(schema)
+
         db2 = self.createNewDb()
+        db2.subscribeToIndex(Counter, k=1, fields=["x"])
 
-        testSize = 200
+        with db1.transaction():
+            c = Counter(k=1, x=5)
 
-        shouldStop = [False]
-        isOK = [False]
-        lastSeen = [0]
+        db2.flush()
 
-        def readerthread():
-            try:
-                db1.subscribeToNone(Counter)
+        writesSeen = []
+        db2.registerOnTransactionHandler(
+            lambda writes, set_adds, set_removes, tid: writesSeen.extend(writes)
+        )
 
-                while not shouldStop[0]:
-                    with db1.view():
-                        ct = 0
-                        for x in Counter.lookupAll(k=0):
-                            Counter.lookupAny(k=0)
-                            ct += 1
-                        time.sleep(0.0001)
-                        lastSeen[0] = ct
+        # db2 sees 'c' through its index subscription, but not its 'k' field
+        with db1.transaction():
+            c.k = 1
+            c.x = 6
 
-                isOK[0] = True
-            except BaseException:
-                logging.exception("READ THREAD FAILED:")
+        db2.flush()
 
-        r = threading.Thread(target=readerthread)
-        r.daemon = True
-        r.start()
+        kFieldIds = set(
+            fieldId
+            for fieldId, fieldDef in db2._field_id_to_field_def.items()
+            if fieldDef.typename == "Counter" and fieldDef.fieldname == "k"
+        )
+        self.assertTrue(writesSeen)
+        self.assertFalse(
+            [k for k in writesSeen if k.fieldId in kFieldIds and not k.isIndexValue]
+        )
 
-        db2.subscribeToNone(Counter)
-        counters = []
-        with db2.transaction():
-            for i in range(testSize):
-                c = Counter(k=0, x=i)
-                counters.append(c)
+        with db2.view():
+            self.assertEqual(c.x, 6)
 
-        for i in range(testSize):
-            db1.subscribeToObject(counters[i])
-            time.sleep(0.001)
-            print("wrote", i, "of", testSize, "and last saw", lastSeen[0])
+    def test_widening_field_projection_backfills_objects_held_by_index(self):
+        db1 = self.createNewDb()
+        db1.subscribeToSchema(schema)
 
-        t0 = time.time()
-        while lastSeen[0] != testSize and time.time() - t0 < 1.0:
-            time.sleep(0.01)
+        with db1.transaction():
+            c1 = Counter(k=1, x=5)
+            c2 = Counter(k=2, x=6)
 
-        shouldStop[0] = True
-        r.join()
+        db2 = self.createNewDb()
+        db2.subscribeToIndex(Counter, k=1, fields=["k"])
 
-        self.assertEqual(lastSeen[0], testSize)
-        self.assertTrue(isOK[0])
+        with db2.view():
+            with self.assertRaises(FieldNotSubscribedException):
+                c1.x
 
-    def test_subscription_matching_is_linear(self):
-        schemas = []
-        dbs = []
+        # an index subscription asking for every field makes 'x' visible on the
+        # Counters we already hold through the first one
+        db2.subscribeToIndex(Counter, k=2)
 
-        db = self.createNewDb()
+        with db2.view():
+            self.assertEqual(c1.x, 5)
+            self.assertEqual(c2.x, 6)
 
-        while len(schemas) < 20:
-            # make a new schema
-            s = Schema("schema_" + str(len(schemas)))
+        with db1.transaction():
+            c1.x = 7
 
-            @s.define
-            class Thing:
-                x = int
+        db2.flush()
 
-            schemas.append(s)
+        with db2.view():
+            self.assertEqual(c1.x, 7)
 
-            # create a new database for this new schema and subscribe in both this one and
-            # the main connection
-            dbs.append(self.createNewDb())
-            dbs[-1].subscribeToSchema(s)
-            db.subscribeToSchema(s)
+    def test_widening_field_projection_through_an_index(self):
+        db1 = self.createNewDb()
+        db1.subscribeToSchema(schema)
 
-            # create a new object in the schema
-            things = []
-            for i in range(len(schemas)):
-                with dbs[i].transaction():
-                    things.append(schemas[i].Thing(x=10))
+        with db1.transaction():
+            c1 = Counter(k=1, x=5)
+            c2 = Counter(k=2, x=6)
 
-            # make sure that the main db sees it
-            for thing in things:
-                db.waitForCondition(lambda: thing.exists(), 10 * self.PERFORMANCE_FACTOR)
+        db2 = self.createNewDb()
+        db2.subscribeToType(Counter, fields=["k"])
 
-            # verify the main db sees something quadratic in the number of
-            # transactions plus a constant
-            self.assertLess(db._messages_received, (len(schemas) + 1) * (len(schemas) + 2) + 8)
+        with db2.view():
+            with self.assertRaises(FieldNotSubscribedException):
+                c2.x
 
-            # each database sees two transactions each pass
-            for i in range(len(dbs)):
-                self.assertTrue(dbs[i]._messages_received < (len(schemas) - i) * 2 + 10)
+        # an index subscription asking for every field makes 'x' visible on
+        # every Counter, including the ones outside the index
+        db2.subscribeToIndex(Counter, k=1)
 
-    def test_transaction_time_constant(self):
-        db1 = self.createNewDb()
-        db2 = self.createNewDb()
+        with db2.view():
+            self.assertEqual(c1.x, 5)
+            self.assertEqual(c2.x, 6)
 
-        db1.subscribeToSchema(schema)
-        db2.subscribeToSchema(schema)
+        with db1.transaction():
+            c2.x = 7
 
-        times = []
-        for i in range(10000):
-            t0 = time.time()
-            with db1.transaction():
-                schema.Root()
-            times.append(time.time() - t0)
+        db2.flush()
 
-        m1 = numpy.mean(times[:1000])
-        m2 = numpy.mean(times[-1000:])
-        self.assertTrue(abs(m2 / m1 - 1) < 1, (m1, m2))
+        with db2.view():
+            self.assertEqual(c2.x, 7)
+
+    def test_field_operations_dont_conflict(self):
+        schema = Schema("test_schema")
+
+        @schema.define
+        class Tally:
+            count = int
+            highWater = float
+            tags = TupleOf(str)
+            k = Indexed(int)
 
-    @flaky(max_runs=3, min_passes=1)
-    def test_memory_growth(self):
         db1 = self.createNewDb()
         db2 = self.createNewDb()
-
         db1.subscribeToSchema(schema)
         db2.subscribeToSchema(schema)
 
-        m0 = currentMemUsageMb()
+        with db1.transaction() as t:
+            tally = Tally(tags=("a",))
+            t.increment(tally, "count", 2)
 
-        for passIx in range(10):
+        db2.flush()
+
+        # both transactions start from the same version, and neither reads the
+        # fields, so neither conflicts
+        t1 = db1.transaction()
+        t2 = db2.transaction()
+
+        with t1:
+            t1.increment(tally, "count")
+            t1.max(tally, "highWater", 3)
+            t1.setInsert(tally, "tags", ["b", "a"])
+
+            # we don't see our own operations until they're applied
+            self.assertEqual(tally.count, 2)
+
+        with t2:
+            t2.increment(tally, "count", 10)
+            t2.max(tally, "highWater", 1.5)
+            t2.setRemove(tally, "tags", ["a"])
+
+        for db in [db1, db2]:
+            db.flush()
+
+            with db.view():
+                self.assertEqual(tally.count, 13)
+                self.assertEqual(tally.highWater, 3.0)
+                self.assertEqual(tally.tags, ("b",))
+
+        with db1.transaction() as t:
+            with self.assertRaises(TypeError):
+                t.increment(tally, "tags")
+
+            with self.assertRaises(TypeError):
+                t.increment(tally, "k")
+
+        with db1.transaction():
+            tally.delete()
+
+        with self.assertRaises(ServerError):
+            with db1.transaction() as t:
+                t.increment(tally, "count")
+
+    def test_append_operations(self):
+        schema = Schema("test_schema")
+
+        @schema.define
+        class Log:
+            k = Indexed(int)
+            text = str
+            data = bytes
+            entries = TupleOf(int)
+
+        db1 = self.createNewDb()
+        db1.subscribeToSchema(schema)
+
+        with db1.transaction() as t:
+            log = Log(k=1, text="a")
+            t.append(log, "text", "b")
+
+        # a type-level subscriber gets just the appended data, an index-level or
+        # lazy subscriber gets the whole value. They all see the same thing.
+        db2 = self.createNewDb()
+        db2.subscribeToType(Log)
+
+        db3 = self.createNewDb()
+        db3.subscribeToIndex(Log, k=1)
+
+        db4 = self.createNewDb()
+        db4.subscribeToType(Log, lazySubscription=True)
+
+        for i in range(3):
+            with db1.transaction() as t:
+                t.append(log, "text", str(i))
+                t.append(log, "data", bytes([i]))
+                t.append(log, "entries", [i, i])
+
+        for db in [db1, db2, db3, db4]:
+            db.flush()
+
+            with db.view():
+                self.assertEqual(log.text, "ab012")
+                self.assertEqual(log.data, b"\x00\x01\x02")
+                self.assertEqual(log.entries, (0, 0, 1, 1, 2, 2))
+
+        with db1.transaction() as t:
+            with self.assertRaises(TypeError):
+                t.append(log, "k", 1)
+
+    def test_append_without_a_value_disconnects(self):
+        schema = Schema("test_schema")
+
+        @schema.define
+        class Log:
+            text = str
+
+        db1 = self.createNewDb()
+        db1.subscribeToSchema(schema)
+
+        db2 = self.createNewDb(forceNotProxy=True)
+        db2.subscribeToType(Log)
+
+        # lose the transaction that creates the object, so db2 has nothing to
+        # append to
+        dropped = []
+
+        def dropFirstTransaction(msg):
+            if msg.matches.Transaction and not dropped:
+                dropped.append(msg)
+                return True
+            return False
+
+        db2._shouldSuppressMessage = dropFirstTransaction
+
+        with db1.transaction():
+            log = Log(text="a")
+
+        with db1.transaction() as t:
+            t.append(log, "text", "b")
+
+        self.assertTrue(db2.disconnected.wait(timeout=5.0))
+
+    def test_moving_into_index(self):
+        db1 = self.createNewDb()
+        db2 = self.createNewDb()
+
+        db1.subscribeToSchema(schema)
+        db2.subscribeToIndex(Counter, k=123)
+
+        with db1.transaction():
+            c = Counter(k=0)
+
+        db2.flush()
+        with db2.view():
+            self.assertFalse(c.exists())
+
+        with db1.transaction():
+            c.k = 123
+            c.x = 100
+
+        db2.flush()
+        with db2.view():
+            self.assertTrue(c.exists())
+            self.assertEqual(c.x, 100)
+
+        with db1.transaction():
+            c.k = 0
+
+        db2.flush()
+        with db2.view():
+            self.assertTrue(c.exists())
+            self.assertEqual(c.k, 0)
+
+        with db1.transaction():
+            c.x = 101
+
+        db2.flush()
+        with db2.view():
+            self.assertTrue(c.exists())
+            self.assertEqual(c.x, 101)
+
+    def test_multithreading_and_subscribing(self):
+        # Verify that if one thread is subscribing and the other is repeatedly looking
+        # at indices, that everything works correctly.
+
+        db1 = self.createNewDb()
+        db2 = self.createNewDb()
+
+        testSize = 200
+
+        shouldStop = [False]
+        isOK = [False]
+        lastSeen = [0]
+
+        def readerthread():
+            try:
+                db1.subscribeToNone(Counter)
+
+                while not shouldStop[0]:
+                    with db1.view():
+                        ct = 0
+                        for x in Counter.lookupAll(k=0):
+                            Counter.lookupAny(k=0)
+                            ct += 1
+                        time.sleep(0.0001)
+                        lastSeen[0] = ct
+
+                isOK[0] = True
+            except BaseException:
+                logging.exception("READ THREAD FAILED:")
+
+        r = threading.Thread(target=readerthread)
+        r.daemon = True
+        r.start()
+
+        db2.subscribeToNone(Counter)
+        counters = []
+        with db2.transaction():
+            for i in range(testSize):
+                c = Counter(k=0, x=i)
+                counters.append(c)
+
+        for i in range(testSize):
+            db1.subscribeToObject(counters[i])
+            time.sleep(0.001)
+            print("wrote", i, "of", testSize, "and last saw", lastSeen[0])
+
+        t0 = time.time()
+        while lastSeen[0] != testSize and time.time() - t0 < 1.0:
+            time.sleep(0.01)
+
+        shouldStop[0] = True
+        r.join()
+
+        self.assertEqual(lastSeen[0], testSize)
+        self.assertTrue(isOK[0])
+
+    def test_subscription_matching_is_linear(self):
+        schemas = []
+        dbs = []
+
+        db = self.createNewDb()
+
+        while len(schemas) < 20:
+            # make a new schema
+            s = Schema("schema_" + str(len(schemas)))
+
+            @s.define
+            class Thing:
+                x = int
+
+            schemas.append(s)
+
+            # create a new database for this new schema and subscribe in both this one and
+            # the main connection
+            dbs.append(self.createNewDb())
+            dbs[-1].subscribeToSchema(s)
+            db.subscribeToSchema(s)
+
+            # create a new object in the schema
+            things = []
+            for i in range(len(schemas)):
+                with dbs[i].transaction():
+                    things.append(schemas[i].Thing(x=10))
+
+            # make sure that the main db sees it
+            for thing in things:
+                db.waitForCondition(lambda: thing.exists(), 10 * self.PERFORMANCE_FACTOR)
+
+            # verify the main db sees something quadratic in the number of
+            # transactions plus a constant
+            self.assertLess(db._messages_received, (len(schemas) + 1) * (len(schemas) + 2) + 8)
+
+            # each database sees two transactions each pass
+            for i in range(len(dbs)):
+                self.assertTrue(dbs[i]._messages_received < (len(schemas) - i) * 2 + 10)
+
+    def test_transaction_time_constant(self):
+        db1 = self.createNewDb()
+        db2 = self.createNewDb()
+
+        db1.subscribeToSchema(schema)
+        db2.subscribeToSchema(schema)
+
+        times = []
+        for i in range(10000):
+            t0 = time.time()
+            with db1.transaction():
+                schema.Root()
+            times.append(time.time() - t0)
+
+        m1 = numpy.mean(times[:1000])
+        m2 = numpy.mean(times[-1000:])
+        self.assertTrue(abs(m2 / m1 - 1) < 1, (m1, m2))
+
+    @flaky(max_runs=3, min_passes=1)
+    def test_memory_growth(self):
+        db1 = self.createNewDb()
+        db2 = self.createNewDb()
+
+        db1.subscribeToSchema(schema)
+        db2.subscribeToSchema(schema)
+
+        m0 = currentMemUsageMb()
+
+        for passIx in range(10):
             for i in range(1000):
                 with db1.transaction():
                     x = schema.Root()
@@ -2136,95 +2609,915 @@ class ObjectDatabaseTests:
         with db2.view():
             assert len(schema.Root.lookupAll()) == 0
 
-        self.assertLess(db1._connection_state.objectCount(), 10)
+        self.assertLess(db1._connection_state.objectCount(), 10)
+
+        self.assertEqual(
+            db1._connection_state.objectCount(), db2._connection_state.objectCount()
+        )
+
+        time.sleep(0.1)
+
+        self.assertTrue(self.server._version_numbers.keyCount() > 10)
+
+        self.server._garbage_collect(intervalOverride=0.1)
+
+        self.assertTrue(self.server._version_numbers.keyCount() < 10)
+
+    def test_version_gc_is_incremental(self):
+        db = self.createNewDb()
+        db.subscribeToSchema(schema)
+
+        for _ in range(20):
+            with db.transaction():
+                x = schema.Root()
+
+            with db.transaction():
+                x.delete()
+
+        self.server._gc_interval = 0.1
+        self.server._gc_keys_per_step = 5
+        self.server._resetGcMetrics()
+
+        trackedBefore = self.server.gcMetrics()["trackedKeys"]
+
+        time.sleep(0.2)
+
+        self.server._garbage_collect()
+
+        metrics = self.server.gcMetrics()
+        self.assertEqual(metrics["steps"], 1)
+        self.assertEqual(metrics["examined"], 5)
+        self.assertGreater(metrics["pendingKeys"], 0)
+
+        examined = None
+        while examined != self.server.gcMetrics()["examined"]:
+            examined = self.server.gcMetrics()["examined"]
+            self.server._garbage_collect()
+
+        metrics = self.server.gcMetrics()
+        self.assertGreater(metrics["collected"], 0)
+        self.assertLess(metrics["trackedKeys"], trackedBefore)
+        self.assertGreaterEqual(metrics["maxPause"], 0.0)
+
+    def test_max_tid(self):
+        schema1 = Schema("schema1")
+        schema2 = Schema("schema2")
+
+        @schema1.define
+        class T11:
+            k = int
+
+        @schema1.define
+        class T12:
+            k = int
+
+        @schema2.define
+        class T2:
+            k = int
+
+        db1 = self.createNewDb()
+
+        self.assertEqual(db1.currentTransactionId(), 1)
+        for t in [T11, T12, T2]:
+            self.assertEqual(db1.currentTransactionIdForType(t), 0)
+
+        db1.subscribeToSchema(schema1)
+        db1.subscribeToSchema(schema2)
+
+        with db1.transaction():
+            T11(k=0)
+
+        self.assertEqual(db1.currentTransactionId(), 2)
+        self.assertEqual(db1.currentTransactionIdForType(T11), 2)
+        self.assertEqual(db1.currentTransactionIdForType(T12), 0)
+        self.assertEqual(db1.currentTransactionIdForSchema(schema1), 2)
+        self.assertEqual(db1.currentTransactionIdForSchema(schema2), 0)
+
+        with db1.transaction():
+            T12(k=0)
+
+        self.assertEqual(db1.currentTransactionId(), 3)
+        self.assertEqual(db1.currentTransactionIdForType(T11), 2)
+        self.assertEqual(db1.currentTransactionIdForType(T12), 3)
+        self.assertEqual(db1.currentTransactionIdForSchema(schema1), 3)
+        self.assertEqual(db1.currentTransactionIdForSchema(schema2), 0)
+
+    def test_change_stream(self):
+        schema = Schema("test_schema")
+
+        @schema.define
+        class Watched:
+            k = int
+            other = int
+
+        @schema.define
+        class Unwatched:
+            k = int
+
+        self.server.setChangeLogRetention(1000)
+
+        db1 = self.createNewDb(forceNotProxy=True)
+        db1.subscribeToSchema(schema)
+
+        db2 = self.createNewDb(forceNotProxy=True)
+        stream = db2.subscribeToChanges(schema, typename="Watched", fields=["k"])
+
+        with db1.transaction():
+            w = Watched(k=1, other=2)
+            Unwatched(k=3)
+
+        with db1.transaction():
+            w.other = 4
+
+        with db1.transaction():
+            w.k = 5
+
+        change = stream.next(timeout=2.0)
+        self.assertIsNotNone(change)
+        self.assertEqual(
+            set(stream.fieldDefinition(k.fieldId).fieldname for k in change.writes),
+            {"k", " exists"},
+        )
+        stream.acknowledge(change)
+
+        # the transaction that only touched 'other' doesn't show up
+        change = stream.next(timeout=2.0)
+        self.assertIsNotNone(change)
+        self.assertEqual(
+            [stream.fieldDefinition(k.fieldId).fieldname for k in change.writes], ["k"]
+        )
+        stream.acknowledge(change)
+
+        self.assertIsNone(stream.next(timeout=0.1))
+
+        stream.close()
+
+    def test_change_stream_window(self):
+        schema = Schema("test_schema")
+
+        @schema.define
+        class Counter:
+            k = int
+
+        self.server.setChangeLogRetention(1000)
+
+        db1 = self.createNewDb(forceNotProxy=True)
+        db1.subscribeToSchema(schema)
+
+        db2 = self.createNewDb(forceNotProxy=True)
+        stream = db2.subscribeToChanges(schema, window=2)
+
+        for i in range(5):
+            with db1.transaction():
+                Counter(k=i)
+
+        first = stream.next(timeout=2.0)
+        self.assertIsNotNone(first)
+        self.assertIsNotNone(stream.next(timeout=2.0))
+
+        # the server waits for an acknowledgement before sending any more
+        self.assertIsNone(stream.next(timeout=0.2))
+
+        stream.acknowledge(first)
+        self.assertIsNotNone(stream.next(timeout=2.0))
+        self.assertIsNone(stream.next(timeout=0.2))
+
+        stream.close()
+
+    def test_change_stream_resumes_from_cursor(self):
+        schema = Schema("test_schema")
+
+        @schema.define
+        class Counter:
+            k = int
+
+        self.server.setChangeLogRetention(1000)
+
+        db1 = self.createNewDb(forceNotProxy=True)
+        db1.subscribeToSchema(schema)
+
+        with tempfile.TemporaryDirectory() as tempDir:
+            cursorPath = os.path.join(tempDir, "cursor")
+
+            db2 = self.createNewDb(forceNotProxy=True)
+            stream = db2.subscribeToChanges(schema, cursorPath=cursorPath)
+
+            with db1.transaction():
+                Counter(k=0)
+
+            first = stream.next(timeout=2.0)
+            stream.acknowledge(first)
+            db2.disconnect()
+
+            self.assertEqual(
+                ChangeStream.loadCursor(cursorPath), (stream.serverEpoch, first.transaction_id)
+            )
+
+            with self.assertRaises(DisconnectedException):
+                stream.next(timeout=2.0)
+
+            with db1.transaction():
+                Counter(k=1)
+
+            db1.flush()
+
+            db3 = self.createNewDb(forceNotProxy=True)
+            stream = db3.subscribeToChanges(schema, cursorPath=cursorPath)
+
+            change = stream.next(timeout=2.0)
+            self.assertIsNotNone(change)
+            self.assertEqual(change.transaction_id, db1.currentTransactionId())
+
+    def test_change_stream_cursor_from_another_server_run(self):
+        schema = Schema("test_schema")
+
+        @schema.define
+        class Counter:
+            k = int
+
+        self.server.setChangeLogRetention(1000)
+
+        db1 = self.createNewDb(forceNotProxy=True)
+        db1.subscribeToSchema(schema)
+
+        with tempfile.TemporaryDirectory() as tempDir:
+            cursorPath = os.path.join(tempDir, "cursor")
+
+            db2 = self.createNewDb(forceNotProxy=True)
+            stream = db2.subscribeToChanges(schema, cursorPath=cursorPath)
+
+            with db1.transaction():
+                Counter(k=0)
+
+            stream.acknowledge(stream.next(timeout=2.0))
+            stream.close()
+
+            # as if the server had restarted, which starts transaction ids over
+            self.server._epoch = genToken()
+
+            for i in range(5):
+                with db1.transaction():
+                    Counter(k=i)
+
+            stream = db2.subscribeToChanges(schema, cursorPath=cursorPath)
+
+            with self.assertRaises(ChangesUnavailableException):
+                stream.next(timeout=2.0)
+
+            # a cursor without an epoch can't be trusted either
+            with open(cursorPath, "w") as f:
+                f.write(str(db1.currentTransactionId()))
+
+            stream = db2.subscribeToChanges(schema, cursorPath=cursorPath)
+
+            with self.assertRaises(ChangesUnavailableException):
+                stream.next(timeout=2.0)
+
+    def test_change_stream_unavailable(self):
+        schema = Schema("test_schema")
+
+        @schema.define
+        class Counter:
+            k = int
+
+        db1 = self.createNewDb(forceNotProxy=True)
+        db1.subscribeToSchema(schema)
+
+        tid = db1.currentTransactionId()
+
+        self.server.setChangeLogRetention(1)
+
+        for i in range(5):
+            with db1.transaction():
+                Counter(k=i)
+
+        db2 = self.createNewDb(forceNotProxy=True)
+        stream = db2.subscribeToChanges(schema, fromTransactionId=tid)
+
+        with self.assertRaises(ChangesUnavailableException):
+            stream.next(timeout=2.0)
+
+    def test_reconnect_resumes_subscriptions(self):
+        schema = Schema("test_schema")
+
+        @schema.define
+        class Thing:
+            k = int
+
+        self.server.setChangeLogRetention(1000)
+
+        db1 = self.createNewDb(forceNotProxy=True)
+        db1.subscribeToSchema(schema)
+
+        db2 = self.createNewDb(forceNotProxy=True)
+        db2.subscribeToSchema(schema)
+
+        with db2.transaction():
+            kept = Thing(k=0)
+            deleted = Thing(k=1)
+
+        db1.flush()
+        db1.disconnect()
+
+        with db2.transaction():
+            kept.k = 2
+            deleted.delete()
+            added = Thing(k=3)
+
+        received = []
+
+        def record(msg):
+            received.append(msg)
+            return False
+
+        db1._shouldSuppressMessage = record
+
+        self.assertTrue(self.server.reconnect(db1))
+        db1.flush()
+
+        self.assertFalse(any(msg.matches.SubscriptionData for msg in received))
+
+        with db1.view():
+            self.assertEqual(kept.k, 2)
+            self.assertFalse(deleted.exists())
+            self.assertEqual(added.k, 3)
+
+        # and we keep getting updates
+        with db2.transaction():
+            kept.k = 4
+
+        db1.flush()
+
+        with db1.view():
+            self.assertEqual(kept.k, 4)
+
+        with db1.transaction():
+            added.k = 5
+
+        db2.flush()
+
+        with db2.view():
+            self.assertEqual(added.k, 5)
+
+    def test_reconnect_starts_over_without_history(self):
+        schema = Schema("test_schema")
+
+        @schema.define
+        class Thing:
+            k = int
+
+        db1 = self.createNewDb(forceNotProxy=True)
+        db1.subscribeToSchema(schema)
+
+        db2 = self.createNewDb(forceNotProxy=True)
+        db2.subscribeToSchema(schema)
+
+        with db2.transaction():
+            kept = Thing(k=0)
+            deleted = Thing(k=1)
+
+        db1.flush()
+        db1.disconnect()
+
+        self.server.setChangeLogRetention(1)
+
+        with db2.transaction():
+            deleted.delete()
+
+        for i in range(5):
+            with db2.transaction():
+                kept.k = i
+
+        self.assertFalse(self.server.reconnect(db1))
+
+        with db1.view():
+            self.assertEqual(kept.k, 4)
+            self.assertFalse(deleted.exists())
+            self.assertEqual(len(Thing.lookupAll()), 1)
+
+    def _serverChannelFor(self, db):
+        with self.server._lock:
+            for channel, connectedChannel in self.server._clientChannels.items():
+                if (
+                    connectedChannel.connectionObject._identity
+                    == db.connectionObject._identity
+                ):
+                    return channel
+
+    def _slowConsumerRoundTrip(self, policy):
+        """Back up a subscriber's channel, write to it, drain it, and return what it got."""
+        schema = Schema("test_schema")
+
+        @schema.define
+        class Thing:
+            k = int
+
+        self.server.setSlowConsumerPolicy(policy)
+        self.server.setChangeLogRetention(1000)
+
+        db1 = self.createNewDb(forceNotProxy=True)
+        db1.subscribeToSchema(schema)
+
+        db2 = self.createNewDb(forceNotProxy=True)
+        db2.subscribeToSchema(schema)
+
+        with db2.transaction():
+            kept = Thing(k=0)
+            deleted = Thing(k=1)
+
+        db1.flush()
+
+        channel = self._serverChannelFor(db1)
+        self.server.channelBackedUp(channel, 0)
+
+        received = []
+
+        def record(msg):
+            received.append(msg)
+            return False
+
+        db1._shouldSuppressMessage = record
+
+        with db2.transaction():
+            deleted.delete()
+            added = Thing(k=2)
+
+        for i in range(5):
+            with db2.transaction():
+                kept.k = i + 10
+
+        metrics = [
+            m
+            for m in self.server.connectionMetrics()
+            if m["connIdentity"] == db1.connectionObject._identity
+        ][0]
+
+        self.assertEqual(metrics["state"], policy)
+        self.assertEqual(metrics["transactionLag"], 6)
+
+        # we haven't heard about any of it
+        time.sleep(0.1)
+        self.assertFalse(any(msg.matches.Transaction for msg in received))
+
+        self.server.channelDrained(channel)
+        db1.flush()
+
+        with db1.view():
+            self.assertEqual(kept.k, 14)
+            self.assertFalse(deleted.exists())
+            self.assertEqual(added.k, 2)
+
+        return received
+
+    def test_slow_consumer_paused_and_coalesced(self):
+        received = self._slowConsumerRoundTrip(server_module.SLOW_CONSUMER_PAUSE)
+
+        # six transactions, merged into one
+        self.assertEqual(len([msg for msg in received if msg.matches.Transaction]), 1)
+
+    def test_slow_consumer_resynced_from_change_log(self):
+        received = self._slowConsumerRoundTrip(server_module.SLOW_CONSUMER_RESYNC)
+
+        self.assertEqual(len([msg for msg in received if msg.matches.Transaction]), 1)
+
+    def _backUpWithHeldKeyCap(self, maxHeldKeys):
+        """Back up a subscriber's channel and write more keys than it may hold."""
+        schema = Schema("test_schema")
+
+        @schema.define
+        class Thing:
+            k = int
+
+        self.server.setSlowConsumerPolicy(
+            server_module.SLOW_CONSUMER_PAUSE, maxHeldKeys=maxHeldKeys
+        )
+
+        db1 = self.createNewDb(forceNotProxy=True)
+        db1.subscribeToSchema(schema)
+
+        db2 = self.createNewDb(forceNotProxy=True)
+        db2.subscribeToSchema(schema)
+
+        channel = self._serverChannelFor(db1)
+        self.server.channelBackedUp(channel, 0)
+
+        # one coalesced message, but far more than 'maxHeldKeys' keys
+        for i in range(20):
+            with db2.transaction():
+                Thing(k=i)
+
+        return db1, channel, Thing
+
+    def test_slow_consumer_held_key_cap_disconnects(self):
+        db1, channel, Thing = self._backUpWithHeldKeyCap(10)
+
+        self.assertTrue(db1.disconnected.wait(timeout=5.0))
+        self.assertIsNone(self._serverChannelFor(db1))
+
+    def test_slow_consumer_held_key_cap_resyncs(self):
+        self.server.setChangeLogRetention(1000)
+
+        db1, channel, Thing = self._backUpWithHeldKeyCap(10)
+
+        metrics = [
+            m
+            for m in self.server.connectionMetrics()
+            if m["connIdentity"] == db1.connectionObject._identity
+        ][0]
+
+        self.assertEqual(metrics["state"], server_module.SLOW_CONSUMER_RESYNC)
+        self.assertLessEqual(metrics["heldKeys"], 10)
+
+        self.server.channelDrained(channel)
+        db1.flush()
+
+        with db1.view():
+            self.assertEqual(sorted(t.k for t in Thing.lookupAll()), list(range(20)))
+
+    def test_slow_consumer_disconnected(self):
+        schema = Schema("test_schema")
+
+        @schema.define
+        class Thing:
+            k = int
+
+        self.server.setSlowConsumerPolicy(server_module.SLOW_CONSUMER_DISCONNECT)
+
+        db1 = self.createNewDb(forceNotProxy=True)
+        db1.subscribeToSchema(schema)
+
+        self.server.channelBackedUp(self._serverChannelFor(db1), 0)
+
+        self.assertIsNone(self._serverChannelFor(db1))
+        self.assertTrue(db1.disconnected.wait(timeout=5.0))
+
+    def test_classmethods(self):
+        db = self.createNewDb()
+
+        schema = Schema("test_schema")
+
+        class OrdinaryBase:
+            @classmethod
+            def f(cls):
+                return (OrdinaryBase, cls)
+
+        @schema.define
+        class SchematicBase:
+            @classmethod
+            def f(cls):
+                return (SchematicBase, cls)
+
+        @schema.define
+        class Child1(OrdinaryBase, SchematicBase):
+            pass
+
+        @schema.define
+        class Child2(SchematicBase, OrdinaryBase):
+            pass
+
+        db.subscribeToSchema(schema)
+
+        with db.transaction():
+            assert Child1().f() == (OrdinaryBase, Child1)
+            assert Child2().f() == (SchematicBase, Child2)
+
+
+class ObjectDatabaseOverChannelTestsWithRedis(unittest.TestCase, ObjectDatabaseTests):
+    @classmethod
+    def setUpClass(cls):
+        ObjectDatabaseTests.setUpClass()
+
+    def setUp(self):
+        self.tempDir = tempfile.TemporaryDirectory()
+        self.tempDirName = self.tempDir.__enter__()
+        self.auth_token = genToken()
+
+        if hasattr(self, "redisProcess") and self.redisProcess:
+            self.redisProcess.tearDown()
+
+        self.redisProcess = RedisTestHelper(port=1115)
+
+        try:
+            self.mem_store = self.makeStore()
+            self.server = InMemServer(self.mem_store, self.auth_token)
+            self.server._gc_interval = 0.1
+            self.server.start()
+        except Exception:
+            self.redisProcess.tearDown()
+            raise
+
+    def makeStore(self):
+        return RedisPersistence(port=1115)
+
+    def createNewDb(self, forceNotProxy=False):
+        return self.server.connect(self.auth_token)
+
+    def tearDown(self):
+        self.server.stop()
+        self.redisProcess.tearDown()
+        self.redisProcess = None
+        self.tempDir.cleanup()
+
+    def test_reboot_against_redis(self):
+        db1 = self.createNewDb()
+        db1.subscribeToSchema(schema)
+
+        with db1.transaction():
+            c = Counter(k=123)
+
+        self.server.stop()
+        self.mem_store = self.makeStore()
+        self.server = InMemServer(self.mem_store, self.auth_token)
+        self.server.start()
+
+        db1.disconnect()
+
+        db1 = self.createNewDb()
+        db1.subscribeToSchema(schema)
+        with db1.view():
+            self.assertTrue(c.exists())
+            self.assertEqual(c.k, 123)
+            self.assertEqual(list(Counter.lookupAll()), [c])
+            self.assertEqual(list(Counter.lookupAll(k=123)), [c])
+            self.assertEqual(list(Counter.lookupAll(k=124)), [])
+
+        with db1.transaction():
+            c.k = 124
+
+    def test_group_commit(self):
+        self.server.stop()
+        self.server = InMemServer(self.mem_store, self.auth_token)
+        self.server.enableGroupCommit(0.005, maxTransactions=32)
+        self.server.start()
+
+        batchesCommitted = [0]
+        origCommitBatch = self.mem_store.commitBatch
+
+        def countingCommitBatch():
+            batchesCommitted[0] += 1
+            return origCommitBatch()
+
+        self.mem_store.commitBatch = countingCommitBatch
+
+        db = self.createNewDb()
+        db.subscribeToSchema(schema)
+
+        with db.transaction():
+            shared = Counter()
+            counters = [Counter() for _ in range(16)]
+
+        def incrementLoop(c):
+            for _ in range(20):
+                with db.transaction():
+                    c.x = c.x + 1
+
+                # everybody also fights over 'shared', which only works if
+                # transactions within a group get conflict-checked in order
+                while True:
+                    try:
+                        with db.transaction():
+                            shared.x = shared.x + 1
+                        break
+                    except RevisionConflictException:
+                        pass
+
+        threads = [threading.Thread(target=incrementLoop, args=(c,)) for c in counters]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        with db.view():
+            self.assertEqual(shared.x, 16 * 20)
+            for c in counters:
+                self.assertEqual(c.x, 20)
+
+        self.assertLess(batchesCommitted[0], 16 * 20 * 2)
+
+        # everything made it into redis
+        self.server.stop()
+        self.mem_store = self.makeStore()
+        self.server = InMemServer(self.mem_store, self.auth_token)
+        self.server.start()
+
+        db.disconnect()
+
+        db = self.createNewDb()
+        db.subscribeToSchema(schema)
+
+        with db.view():
+            self.assertEqual(shared.x, 16 * 20)
+            for c in counters:
+                self.assertEqual(c.x, 20)
+
+    def test_set_updates_use_constant_round_trips(self):
+        keys = [IndexId(fieldId=1, indexValue=b"%d" % i) for i in range(1000)]
+
+        self.mem_store.setSeveral({}, {k: [1] for k in keys})
+
+        # a fresh store with nothing cached
+        store = self.makeStore()
+
+        pipelines = [0]
+        origPipeline = store.redis.pipeline
+
+        def countingPipeline(*args, **kwargs):
+            pipelines[0] += 1
+            return origPipeline(*args, **kwargs)
+
+        store.redis.pipeline = countingPipeline
+        store.redis.smembers = None
+
+        newSets, droppedSets = store.setSeveral(
+            {}, {k: [2] for k in keys}, {k: [1] for k in keys}
+        )
+
+        self.assertEqual(newSets, set())
+        self.assertEqual(droppedSets, set())
+
+        # one to load the sets and one to write
+        self.assertEqual(pipelines[0], 2)
+
+        newSets, droppedSets = store.setSeveral({}, {}, {k: [2] for k in keys})
+
+        self.assertEqual(droppedSets, set(keys))
+        self.assertEqual(pipelines[0], 3)
+
+        self.assertEqual(self.makeStore().getSetMembers(keys[0]), set())
+
+    def test_warm_up(self):
+        db = self.createNewDb()
+        db.subscribeToSchema(schema)
+
+        with db.transaction():
+            counters = [Counter(k=i % 10, x=i) for i in range(500)]
+
+        db.disconnect()
+        self.server.stop()
+
+        self.mem_store = self.makeStore()
+        self.server = InMemServer(self.mem_store, self.auth_token)
+        self.server.enableWarmUp(threadCount=4, batchSize=50, hotSchemas=[schema.name])
+        self.server.start()
+
+        progress = self.server.warmUpProgress()
+        self.assertTrue(progress["done"])
+        self.assertEqual(progress["processed"], progress["total"])
+        self.assertGreater(len(self.mem_store.cache), 500)
+
+        misses = self.mem_store.cacheMetrics()["misses"]
+
+        db = self.createNewDb()
+        db.subscribeToSchema(schema)
+
+        with db.view():
+            self.assertEqual(sorted(c.x for c in counters), list(range(500)))
+            self.assertEqual(len(Counter.lookupAll(k=3)), 50)
+
+        # nothing about our schema had to be read from redis
+        self.assertLess(self.mem_store.cacheMetrics()["misses"] - misses, 10)
+
+    def test_throughput(self):
+        pass
+
+    def test_object_versions_robust(self):
+        pass
+
+    def test_flush_db_works(self):
+        pass
+
+
+class ObjectDatabaseOverChannelTestsWithBoundedRedisCache(
+    ObjectDatabaseOverChannelTestsWithRedis
+):
+    def makeStore(self):
+        # small enough that the whole suite keeps evicting and refetching
+        return RedisPersistence(port=1115, cacheBytes=4096)
+
+    def test_cache_evicts_and_refetches(self):
+        db = self.createNewDb()
+        db.subscribeToSchema(schema)
+
+        with db.transaction():
+            counters = [Counter(k=1, x=i) for i in range(200)]
+
+        metrics = self.mem_store.cacheMetrics()
+        self.assertGreater(metrics["evictions"], 0)
+        self.assertLessEqual(metrics["bytes"], metrics["maxBytes"])
+
+        db2 = self.createNewDb()
+        db2.subscribeToSchema(schema)
+
+        with db2.view():
+            self.assertEqual([c.x for c in counters], list(range(200)))
+            self.assertEqual(len(Counter.lookupAll(k=1)), 200)
+
+        self.assertGreater(self.mem_store.cacheMetrics()["misses"], metrics["misses"])
+
+    def test_subscribed_indices_are_pinned(self):
+        db = self.createNewDb()
+        db.subscribeToSchema(schema)
+
+        with db.transaction():
+            Counter(k=1)
+
+        db2 = self.createNewDb()
+        db2.subscribeToIndex(Counter, k=1)
 
-        self.assertEqual(
-            db1._connection_state.objectCount(), db2._connection_state.objectCount()
-        )
+        pinned = list(self.server._index_to_channel)
+        self.assertTrue(pinned)
 
-        time.sleep(0.1)
+        # push everything else out of the cache
+        with db.transaction():
+            for i in range(200):
+                Counter(k=2, x=i)
 
-        self.assertTrue(len(self.server._version_numbers) > 10)
+        self.assertGreater(self.mem_store.cacheMetrics()["evictions"], 0)
 
-        self.server._garbage_collect(intervalOverride=0.1)
+        for indexId in pinned:
+            self.assertIn(indexId, self.mem_store.cache)
 
-        self.assertTrue(len(self.server._version_numbers) < 10)
+        db2.disconnect(block=True)
 
-    def test_max_tid(self):
-        schema1 = Schema("schema1")
-        schema2 = Schema("schema2")
+        t0 = time.time()
+        while self.server._index_to_channel and time.time() - t0 < 5.0:
+            time.sleep(0.01)
 
-        @schema1.define
-        class T11:
-            k = int
+        for indexId in pinned:
+            self.assertNotIn(indexId, self.mem_store.cache._pinCounts)
 
-        @schema1.define
-        class T12:
-            k = int
+    def test_subscribed_types_are_pinned(self):
+        db = self.createNewDb()
+        db.subscribeToSchema(schema)
 
-        @schema2.define
-        class T2:
-            k = int
+        with db.transaction():
+            Counter(k=1)
 
-        db1 = self.createNewDb()
+        existsIndexKey = IndexId(
+            fieldId=self.server._currentTypeMap().fieldIdFor(
+                schema.name, "Counter", " exists"
+            ),
+            indexValue=indexValueFor(bool, True),
+        )
+        pinCounts = self.mem_store.cache._pinCounts
+        pinnedByDb = pinCounts.get(existsIndexKey)
+        self.assertTrue(pinnedByDb)
 
-        self.assertEqual(db1.currentTransactionId(), 1)
-        for t in [T11, T12, T2]:
-            self.assertEqual(db1.currentTransactionIdForType(t), 0)
+        db2 = self.createNewDb(forceNotProxy=True)
+        db2.subscribeToType(Counter)
+        self.assertEqual(pinCounts.get(existsIndexKey), pinnedByDb + 1)
 
-        db1.subscribeToSchema(schema1)
-        db1.subscribeToSchema(schema2)
+        # push everything else out of the cache
+        with db.transaction():
+            for i in range(200):
+                Counter(k=2, x=i)
 
-        with db1.transaction():
-            T11(k=0)
+        self.assertGreater(self.mem_store.cacheMetrics()["evictions"], 0)
+        self.assertIn(existsIndexKey, self.mem_store.cache)
 
-        self.assertEqual(db1.currentTransactionId(), 2)
-        self.assertEqual(db1.currentTransactionIdForType(T11), 2)
-        self.assertEqual(db1.currentTransactionIdForType(T12), 0)
-        self.assertEqual(db1.currentTransactionIdForSchema(schema1), 2)
-        self.assertEqual(db1.currentTransactionIdForSchema(schema2), 0)
+        db2.unsubscribeFromType(Counter)
+        self.assertEqual(pinCounts.get(existsIndexKey), pinnedByDb)
 
-        with db1.transaction():
-            T12(k=0)
+        db2.subscribeToType(Counter)
+        db2.disconnect(block=True)
 
-        self.assertEqual(db1.currentTransactionId(), 3)
-        self.assertEqual(db1.currentTransactionIdForType(T11), 2)
-        self.assertEqual(db1.currentTransactionIdForType(T12), 3)
-        self.assertEqual(db1.currentTransactionIdForSchema(schema1), 3)
-        self.assertEqual(db1.currentTransactionIdForSchema(schema2), 0)
+        t0 = time.time()
+        while pinCounts.get(existsIndexKey) != pinnedByDb and time.time() - t0 < 5.0:
+            time.sleep(0.01)
 
-    def test_classmethods(self):
-        db = self.createNewDb()
+        self.assertEqual(pinCounts.get(existsIndexKey), pinnedByDb)
 
-        schema = Schema("test_schema")
+    def test_warm_up(self):
+        db = self.createNewDb()
+        db.subscribeToSchema(schema)
 
-        class OrdinaryBase:
-            @classmethod
-            def f(cls):
-                return (OrdinaryBase, cls)
+        with db.transaction():
+            counters = [Counter(x=i) for i in range(500)]
 
-        @schema.define
-        class SchematicBase:
-            @classmethod
-            def f(cls):
-                return (SchematicBase, cls)
+        db.disconnect()
+        self.server.stop()
 
-        @schema.define
-        class Child1(OrdinaryBase, SchematicBase):
-            pass
+        self.mem_store = self.makeStore()
+        self.server = InMemServer(self.mem_store, self.auth_token)
+        self.server.enableWarmUp(threadCount=1, batchSize=10)
+        self.server.start()
 
-        @schema.define
-        class Child2(SchematicBase, OrdinaryBase):
-            pass
+        # we stop loading once the cache is full, rather than churning through it
+        metrics = self.mem_store.cacheMetrics()
+        self.assertLess(self.server.warmUpProgress()["processed"], 500)
+        self.assertEqual(metrics["evictions"], 0)
 
+        db = self.createNewDb()
         db.subscribeToSchema(schema)
 
-        with db.transaction():
-            assert Child1().f() == (OrdinaryBase, Child1)
-            assert Child2().f() == (SchematicBase, Child2)
+        with db.view():
+            self.assertEqual(sorted(c.x for c in counters), list(range(500)))
 
+    def test_throughput(self):
+        pass
 
-class ObjectDatabaseOverChannelTestsWithRedis(unittest.TestCase, ObjectDatabaseTests):
+
+class ObjectDatabaseOverChannelTestsWithWriteAheadLog(unittest.TestCase, ObjectDatabaseTests):
     @classmethod
     def setUpClass(cls):
         ObjectDatabaseTests.setUpClass()
@@ -2234,63 +3527,292 @@ class ObjectDatabaseOverChannelTestsWithRedis(unittest.TestCase, ObjectDatabaseT
         self.tempDirName = self.tempDir.__enter__()
         self.auth_token = genToken()
 
-        if hasattr(self, "redisProcess") and self.redisProcess:
-            self.redisProcess.tearDown()
-
-        self.redisProcess = RedisTestHelper(port=1115)
+        self.mem_store = self.makeStore()
+        self.server = InMemServer(self.mem_store, self.auth_token)
+        self.server._gc_interval = 0.1
+        self.server.start()
 
-        try:
-            self.mem_store = RedisPersistence(port=1115)
-            self.server = InMemServer(self.mem_store, self.auth_token)
-            self.server._gc_interval = 0.1
-            self.server.start()
-        except Exception:
-            self.redisProcess.tearDown()
-            raise
+    def makeStore(self, **kwargs):
+        return WriteAheadLogPersistence(self.tempDirName, **kwargs)
 
     def createNewDb(self, forceNotProxy=False):
         return self.server.connect(self.auth_token)
 
     def tearDown(self):
         self.server.stop()
-        self.redisProcess.tearDown()
-        self.redisProcess = None
+        self.mem_store.close()
         self.tempDir.cleanup()
 
-    def test_reboot_against_redis(self):
+    def reboot(self, **kwargs):
+        self.server.stop()
+        self.mem_store.close()
+
+        self.mem_store = self.makeStore(**kwargs)
+        self.server = InMemServer(self.mem_store, self.auth_token)
+        self.server.start()
+
+    def test_reboot_against_wal(self):
         db1 = self.createNewDb()
         db1.subscribeToSchema(schema)
 
         with db1.transaction():
             c = Counter(k=123)
+            c2 = Counter(k=123)
 
-        self.server.stop()
-        self.mem_store = RedisPersistence(port=1115)
-        self.server = InMemServer(self.mem_store, self.auth_token)
-        self.server.start()
+        with db1.transaction():
+            c2.delete()
+
+        self.mem_store.snapshotNow()
+
+        with db1.transaction():
+            c.x = 5
 
         db1.disconnect()
+        self.reboot()
 
         db1 = self.createNewDb()
         db1.subscribeToSchema(schema)
         with db1.view():
             self.assertTrue(c.exists())
-            self.assertEqual(c.k, 123)
+            self.assertFalse(c2.exists())
+            self.assertEqual(c.x, 5)
             self.assertEqual(list(Counter.lookupAll()), [c])
             self.assertEqual(list(Counter.lookupAll(k=123)), [c])
-            self.assertEqual(list(Counter.lookupAll(k=124)), [])
 
         with db1.transaction():
             c.k = 124
 
+        with db1.view():
+            self.assertEqual(list(Counter.lookupAll(k=124)), [c])
+
+    def test_snapshots_compact_the_log(self):
+        self.reboot(snapshotLogBytes=10000)
+
+        db = self.createNewDb()
+        db.subscribeToSchema(schema)
+
+        with db.transaction():
+            c = Counter()
+
+        for i in range(500):
+            with db.transaction():
+                c.x = i
+
+        self.mem_store.snapshotNow()
+
+        # only the newest snapshot and its (empty) log are left
+        self.assertEqual(
+            len(
+                [
+                    name
+                    for name in os.listdir(self.tempDirName)
+                    if name.startswith(("log-", "snapshot-"))
+                ]
+            ),
+            2,
+        )
+
+        db.disconnect()
+        self.reboot()
+
+        db = self.createNewDb()
+        db.subscribeToSchema(schema)
+        with db.view():
+            self.assertEqual(c.x, 499)
+
+    def test_torn_log_write_is_discarded(self):
+        db = self.createNewDb()
+        db.subscribeToSchema(schema)
+
+        with db.transaction():
+            c = Counter(x=1)
+
+        db.disconnect()
+        self.server.stop()
+        self.mem_store.close()
+
+        logs = [name for name in os.listdir(self.tempDirName) if name.startswith("log-")]
+        with open(os.path.join(self.tempDirName, max(logs)), "ab") as f:
+            f.write(b"\x05\x00\x00")
+
+        self.reboot()
+
+        db = self.createNewDb()
+        db.subscribeToSchema(schema)
+
+        with db.view():
+            self.assertEqual(c.x, 1)
+
+        with db.transaction():
+            c.x = 2
+
+        db.disconnect()
+        self.reboot()
+
+        db = self.createNewDb()
+        db.subscribeToSchema(schema)
+
+        with db.view():
+            self.assertEqual(c.x, 2)
+
+    def test_failed_group_commit_is_undone(self):
+        self.server.stop()
+        self.server = InMemServer(self.mem_store, self.auth_token)
+        self.server.enableGroupCommit(0.005)
+        self.server.start()
+
+        db = self.createNewDb()
+        db.subscribeToSchema(schema)
+
+        indexDb = self.createNewDb()
+        indexDb.subscribeToIndex(Counter, k=5)
+
+        with db.transaction():
+            c = Counter(x=1)
+
+        tid = self.server._cur_transaction_num
+
+        def failingSync():
+            raise IOError("the disk is full")
+
+        self.mem_store._sync = failingSync
+
+        with self.assertRaises(Exception):
+            with db.transaction():
+                c.x = 2
+                c2 = Counter(k=5)
+
+        del self.mem_store._sync
+
+        self.assertEqual(self.server._cur_transaction_num, tid)
+        self.assertEqual(list(self.server._changeLog.changesAfter(tid)), [])
+        self.assertNotIn(c2._identity, self.server._id_to_channel)
+
+        with db.view():
+            self.assertEqual(c.x, 1)
+            self.assertEqual(Counter.lookupAll(), (c,))
+
+        db2 = self.createNewDb()
+        db2.subscribeToSchema(schema)
+
+        with db2.view():
+            self.assertEqual(c.x, 1)
+            self.assertFalse(c2.exists())
+
+        # this would conflict if the failed transaction had left its version stamps
+        with db.transaction():
+            c.x = 3
+
+        indexDb.flush()
+        with indexDb.view():
+            self.assertEqual(Counter.lookupAll(k=5), ())
+
+        db.disconnect()
+        db2.disconnect()
+        indexDb.disconnect()
+        self.reboot()
+
+        db = self.createNewDb()
+        db.subscribeToSchema(schema)
+
+        with db.view():
+            self.assertEqual(c.x, 3)
+            self.assertEqual(Counter.lookupAll(), (c,))
+
     def test_throughput(self):
         pass
 
-    def test_object_versions_robust(self):
-        pass
 
-    def test_flush_db_works(self):
-        pass
+class ObjectDatabaseOverChannelTestsWithMemoryMap(
+    ObjectDatabaseOverChannelTestsWithWriteAheadLog
+):
+    def makeStore(self, **kwargs):
+        # put every value out in the segment files so the whole suite exercises them
+        kwargs.setdefault("largeValueBytes", 1)
+        return MemoryMappedPersistence(self.tempDirName, **kwargs)
+
+    def test_segments_are_compacted(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            store = MemoryMappedPersistence(tempDir, largeValueBytes=10, segmentBytes=1000)
+
+            key = ObjectFieldId(objId=1, fieldId=1, isIndexValue=False)
+            otherKey = ObjectFieldId(objId=2, fieldId=1, isIndexValue=False)
+
+            store.set(otherKey, b"y" * 100)
+
+            for i in range(100):
+                store.set(key, b"x" * 100 + str(i).encode())
+
+            self.assertGreater(len(store._segmentSizes), 10)
+
+            store.snapshotNow()
+
+            # the live values got moved into the newest segments
+            self.assertLessEqual(
+                len([name for name in os.listdir(tempDir) if name.startswith("values-")]), 2
+            )
+            self.assertEqual(store.get(key), b"x" * 100 + b"99")
+
+            store.close()
+
+            store = MemoryMappedPersistence(tempDir, largeValueBytes=10, segmentBytes=1000)
+
+            self.assertEqual(store.get(key), b"x" * 100 + b"99")
+            self.assertEqual(store.get(otherKey), b"y" * 100)
+
+            store.close()
+
+    def test_reboot_after_snapshot_and_overwrite(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            store = MemoryMappedPersistence(tempDir, largeValueBytes=10)
+
+            key = ObjectFieldId(objId=1, fieldId=1, isIndexValue=False)
+            otherKey = ObjectFieldId(objId=2, fieldId=1, isIndexValue=False)
+
+            store.setSeveral({key: b"x" * 100, otherKey: b"y" * 100})
+            store.snapshotNow()
+
+            # replaying these releases the values the snapshot loaded
+            store.set(key, b"z" * 100)
+            store.delete(otherKey)
+            store.close()
+
+            store = MemoryMappedPersistence(tempDir, largeValueBytes=10)
+
+            self.assertEqual(store.get(key), b"z" * 100)
+            self.assertIsNone(store.get(otherKey))
+            self.assertEqual(sum(store._segmentLiveBytes.values()), 100)
+
+            store.set(key, b"w" * 100)
+            self.assertEqual(sum(store._segmentLiveBytes.values()), 100)
+
+            store.close()
+
+    def test_get_several_buffers(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            store = MemoryMappedPersistence(tempDir, largeValueBytes=10)
+
+            small = ObjectFieldId(objId=1, fieldId=1, isIndexValue=False)
+            large = ObjectFieldId(objId=2, fieldId=1, isIndexValue=False)
+            missing = ObjectFieldId(objId=3, fieldId=1, isIndexValue=False)
+
+            store.setSeveral({small: b"abc", large: b"z" * 1000})
+
+            smallValue, largeValue, missingValue = store.getSeveralBuffers(
+                [small, large, missing]
+            )
+
+            self.assertEqual(smallValue, b"abc")
+            self.assertIsInstance(largeValue, memoryview)
+            self.assertEqual(bytes(largeValue), b"z" * 1000)
+            self.assertIsNone(missingValue)
+
+            # overwriting the key doesn't invalidate buffers we handed out
+            store.set(large, b"w" * 1000)
+            self.assertEqual(bytes(largeValue), b"z" * 1000)
+            self.assertEqual(store.get(large), b"w" * 1000)
+
+            store.close()
 
 
 class ObjectDatabaseOverChannelTestsInMemory(unittest.TestCase, ObjectDatabaseTests):
@@ -2613,3 +4135,59 @@ class ObjectDatabaseOverSocketTests(unittest.TestCase, ObjectDatabaseTests):
 
         finally:
             messages.setHeartbeatInterval(old_interval)
+
+    def test_broadcast_transactions_serialized_once(self):
+        writer = self.createNewDb()
+        writer.subscribeToType(Counter)
+
+        with writer.transaction():
+            c = Counter()
+
+        serverTime = [0.0]
+        origCommit = self.server._commitAndBroadcastNewTransaction
+
+        def timedCommit(*args):
+            t0 = time.process_time()
+            try:
+                return origCommit(*args)
+            finally:
+                serverTime[0] += time.process_time() - t0
+
+        serializeCalls = [0]
+        origSerialize = channel_module.serialize
+
+        def countingSerialize(T, msg):
+            serializeCalls[0] += 1
+            return origSerialize(T, msg)
+
+        subscribers = []
+
+        for subscriberCount in [1, 10, 50]:
+            while len(subscribers) < subscriberCount:
+                db = self.createNewDb()
+                db.subscribeToType(Counter)
+                subscribers.append(db)
+
+            serverTime[0] = 0.0
+            serializeCalls[0] = 0
+
+            with unittest.mock.patch.object(
+                self.server, "_commitAndBroadcastNewTransaction", timedCommit
+            ), unittest.mock.patch.object(channel_module, "serialize", countingSerialize):
+                for _ in range(100):
+                    with writer.transaction():
+                        c.k = c.k + 1
+
+            # every channel shares one serialized buffer per transaction
+            self.assertEqual(serializeCalls[0], 100)
+
+            print(
+                f"{subscriberCount} subscribers: "
+                f"{serverTime[0] / 100 * 1000000:.0f} us of server CPU per commit"
+            )
+
+        for db in subscribers:
+            db.flush()
+
+            with db.view():
+                self.assertEqual(c.k, 300)
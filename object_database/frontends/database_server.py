@@ -18,7 +18,18 @@ import argparse
 import sys
 import time
 
-from object_database.persistence import InMemoryPersistence, RedisPersistence
+from object_database.persistence import (
+    InMemoryPersistence,
+    MemoryMappedPersistence,
+    RedisPersistence,
+    WriteAheadLogPersistence,
+)
+from object_database.server import (
+    DEFAULT_MAX_HELD_KEYS,
+    SLOW_CONSUMER_DISCONNECT,
+    SLOW_CONSUMER_PAUSE,
+    SLOW_CONSUMER_RESYNC,
+)
 from object_database.tcp_server import TcpServer
 from object_database.util import sslContextFromCertPathOrNone
 
@@ -42,14 +53,132 @@ def main(argv):
     )
     parser.add_argument("--redis_port", type=int, default=None)
     parser.add_argument("--redis_host", type=str, default=None)
+    parser.add_argument(
+        "--redis-cache-mb",
+        type=float,
+        default=None,
+        help="roughly how many megabytes of redis data to cache in memory. "
+        "By default we cache everything we touch.",
+    )
     parser.add_argument("--inmem", default=False, action="store_true")
+    parser.add_argument(
+        "--wal-dir",
+        type=str,
+        default=None,
+        help="keep the database in memory, persisted to a write-ahead log and "
+        "snapshots in this directory, instead of in redis",
+    )
+    parser.add_argument(
+        "--mmap-dir",
+        type=str,
+        default=None,
+        help="like --wal-dir, but keep large values in memory-mapped files in this "
+        "directory rather than in memory, for databases that don't fit in RAM",
+    )
+    parser.add_argument(
+        "--group-commit-window",
+        type=float,
+        default=None,
+        help="if set, batch transactions arriving within this many seconds "
+        "into a single write against the backing store",
+    )
+    parser.add_argument(
+        "--group-commit-max",
+        type=int,
+        default=100,
+        help="the most transactions to batch into a single group commit",
+    )
+    parser.add_argument(
+        "--warm-up",
+        default=False,
+        action="store_true",
+        help="bulk-load the backing store into memory before accepting connections",
+    )
+    parser.add_argument(
+        "--warm-up-in-background",
+        default=False,
+        action="store_true",
+        help="with --warm-up, accept connections while we're still loading",
+    )
+    parser.add_argument(
+        "--warm-up-threads",
+        type=int,
+        default=4,
+        help="the number of threads loading from the backing store during warm-up",
+    )
+    parser.add_argument(
+        "--warm-up-hot-schemas",
+        type=str,
+        default="",
+        help="a comma-separated list of schemas whose data we should warm up first",
+    )
+    parser.add_argument(
+        "--subscription-workers",
+        type=int,
+        default=None,
+        help="the number of threads servicing large subscriptions",
+    )
+    parser.add_argument(
+        "--socket-threads",
+        type=int,
+        default=1,
+        help="the number of threads reading and writing client connections",
+    )
+    parser.add_argument(
+        "--deserialization-threads",
+        type=int,
+        default=0,
+        help="if set, the number of threads deserializing large client messages "
+        "off the socket threads",
+    )
+    parser.add_argument(
+        "--connection-high-water-mark-mb",
+        type=float,
+        default=None,
+        help="if set, apply the slow-consumer policy to clients once this many MB "
+        "are waiting to be sent to them",
+    )
+    parser.add_argument(
+        "--slow-consumer-policy",
+        choices=[SLOW_CONSUMER_PAUSE, SLOW_CONSUMER_RESYNC, SLOW_CONSUMER_DISCONNECT],
+        default=SLOW_CONSUMER_PAUSE,
+        help="what to do with a client that isn't keeping up with what we send it",
+    )
+
+    parser.add_argument(
+        "--max-held-keys",
+        type=int,
+        default=DEFAULT_MAX_HELD_KEYS,
+        help="resync or disconnect a client we're holding messages for once they "
+        "carry more than this many keys",
+    )
+
+    parser.add_argument(
+        "--change-log-transactions",
+        type=int,
+        default=0,
+        help="the number of recent transactions to keep in memory for change streams, "
+        "resuming subscriptions and the resync policy",
+    )
 
     parsedArgs = parser.parse_args(argv[1:])
 
     if parsedArgs.inmem:
         mem_store = InMemoryPersistence()
+    elif parsedArgs.wal_dir is not None:
+        mem_store = WriteAheadLogPersistence(parsedArgs.wal_dir)
+    elif parsedArgs.mmap_dir is not None:
+        mem_store = MemoryMappedPersistence(parsedArgs.mmap_dir)
     else:
-        mem_store = RedisPersistence(host=parsedArgs.redis_host, port=parsedArgs.redis_port)
+        mem_store = RedisPersistence(
+            host=parsedArgs.redis_host,
+            port=parsedArgs.redis_port,
+            cacheBytes=(
+                int(parsedArgs.redis_cache_mb * 1024 * 1024)
+                if parsedArgs.redis_cache_mb is not None
+                else None
+            ),
+        )
 
     ssl_ctx = sslContextFromCertPathOrNone(parsedArgs.ssl_path)
     databaseServer = TcpServer(
@@ -58,7 +187,34 @@ def main(argv):
         mem_store,
         ssl_context=ssl_ctx,
         auth_token=parsedArgs.service_token,
+        socketThreadCount=parsedArgs.socket_threads,
+        deserializationThreadCount=parsedArgs.deserialization_threads,
+        connectionHighWaterMark=(
+            int(parsedArgs.connection_high_water_mark_mb * 1024 * 1024)
+            if parsedArgs.connection_high_water_mark_mb is not None
+            else None
+        ),
+    )
+
+    databaseServer.setSlowConsumerPolicy(
+        parsedArgs.slow_consumer_policy, maxHeldKeys=parsedArgs.max_held_keys
     )
+    databaseServer.setChangeLogRetention(parsedArgs.change_log_transactions)
+
+    if parsedArgs.group_commit_window is not None:
+        databaseServer.enableGroupCommit(
+            parsedArgs.group_commit_window, parsedArgs.group_commit_max
+        )
+
+    if parsedArgs.subscription_workers is not None:
+        databaseServer.setSubscriptionWorkerCount(parsedArgs.subscription_workers)
+
+    if parsedArgs.warm_up:
+        databaseServer.enableWarmUp(
+            threadCount=parsedArgs.warm_up_threads,
+            hotSchemas=[s for s in parsedArgs.warm_up_hot_schemas.split(",") if s],
+            block=not parsedArgs.warm_up_in_background,
+        )
 
     databaseServer.start()
 
@@ -34,6 +34,11 @@ def main(argv):
     )
     parser.add_argument("seconds", type=float)
     parser.add_argument("--threads", dest="threads", type=int, default=1)
+    parser.add_argument(
+        "--atomic",
+        action="store_true",
+        help="share one counter between threads and increment it on the server",
+    )
 
     parsedArgs = parser.parse_args(argv[1:])
 
@@ -51,7 +56,21 @@ def main(argv):
 
     transactionCount = []
 
+    with db.transaction():
+        sharedCounter = Counter()
+
     def doWork():
+        if parsedArgs.atomic:
+            count = 0
+
+            while time.time() - t0 < parsedArgs.seconds:
+                with db.transaction() as t:
+                    t.increment(sharedCounter, "k")
+                count += 1
+
+            transactionCount.append(count)
+            return
+
         with db.transaction():
             c = Counter()
 
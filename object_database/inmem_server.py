@@ -158,6 +158,9 @@ class InMemServer(Server):
         dbc.initialized.wait()
         return dbc
 
+    def reconnect(self, dbc):
+        return dbc.reconnect(self.getChannel())
+
     def checkForDeadConnectionsLoop(self):
         lastCheck = time.time()
         while not self.stopped.is_set():
@@ -1,32 +1,163 @@
+import hashlib
+import logging
+import mmap
 import os
+import queue
 import time
 import struct
 import threading
 
 from typed_python.SerializationContext import SerializationContext
 
+SEGMENT_PREFIX = "transactions_"
+
+# sidecar files next to each segment
+INDEX_SUFFIX = ".index"
+BLOOM_SUFFIX = ".bloom"
+
+DEFAULT_SEGMENT_BYTES = 256 * 1024 * 1024
+DEFAULT_BLOOM_BITS = 1 << 20
+BLOOM_HASH_COUNT = 4
+
+# each packet in a segment is preceded by its length
+_PACKET_HEADER = struct.Struct("q")
+
+# one entry per packet in a segment's index: transaction_id, timestamp, offset
+_INDEX_RECORD = struct.Struct("<qdq")
+
+
+def _segmentTimestamp(name):
+    """Return the timestamp in the name of a segment file, or None if it's not one."""
+    if not name.startswith(SEGMENT_PREFIX):
+        return None
+
+    try:
+        return float(name[len(SEGMENT_PREFIX) :])
+    except ValueError:
+        return None
+
+
+class BloomFilter:
+    """A set of object ids that may report false positives but never false negatives."""
+
+    def __init__(self, bitCount=DEFAULT_BLOOM_BITS, bits=None):
+        self.bitCount = bitCount
+        self.bits = bytearray(bits) if bits is not None else bytearray((bitCount + 7) // 8)
+
+    def _positions(self, objId):
+        digest = hashlib.blake2b(
+            struct.pack("<q", objId), digest_size=4 * BLOOM_HASH_COUNT
+        ).digest()
+
+        for i in range(BLOOM_HASH_COUNT):
+            yield int.from_bytes(digest[i * 4 : i * 4 + 4], "little") % self.bitCount
+
+    def add(self, objId):
+        for pos in self._positions(objId):
+            self.bits[pos // 8] |= 1 << (pos % 8)
+
+    def mightContain(self, objId):
+        return all(self.bits[pos // 8] & (1 << (pos % 8)) for pos in self._positions(objId))
+
+    def write(self, path):
+        with open(path + ".tmp", "wb") as f:
+            f.write(struct.pack("<q", self.bitCount))
+            f.write(self.bits)
+
+        os.rename(path + ".tmp", path)
+
+    @staticmethod
+    def read(path):
+        with open(path, "rb") as f:
+            data = f.read()
+
+        return BloomFilter(struct.unpack("<q", data[:8])[0], data[8:])
+
 
 class LoggingTransactionWatcher:
-    def __init__(self, logDir):
+    """Log every transaction the server processes to files in 'logDir'.
+
+    'onTransaction' is called with the server's lock held, so it just queues
+    its arguments. A background thread serializes them and writes them out.
+
+    We start a new segment file once the current one holds 'segmentBytes'.
+    Next to each segment we keep an index from transaction id and timestamp
+    to file offset, and once the segment is finished, a bloom filter of the
+    object ids its transactions wrote, so that TransactionLogReader can find
+    things without reading everything. Finished segments are never touched
+    again, so they can be compressed or archived.
+
+    Args:
+        logDir - the directory to write to.
+        maxQueueSize - the most transactions we'll hold waiting to be written.
+        whenFull - what 'onTransaction' does if the queue is full: "block"
+            until there's room, or "drop" the transaction (counting it in
+            'droppedCount').
+        segmentBytes - roughly how large to let each segment get.
+        bloomBits - the size of each segment's bloom filter.
+    """
+
+    def __init__(
+        self,
+        logDir,
+        maxQueueSize=10000,
+        whenFull="block",
+        segmentBytes=DEFAULT_SEGMENT_BYTES,
+        bloomBits=DEFAULT_BLOOM_BITS,
+    ):
+        assert whenFull in ("block", "drop"), whenFull
+
         try:
             if not os.path.exists(logDir):
                 os.makedirs(logDir)
         except OSError:
             pass
 
-        self.file = open(os.path.join(logDir, f"transactions_{time.time()}"), "wb")
+        self.logDir = logDir
+        self.segmentBytes = segmentBytes
+        self.bloomBits = bloomBits
         self.serializationContext = SerializationContext()
 
+        self.whenFull = whenFull
+        self.droppedCount = 0
+        self.queue = queue.Queue(maxQueueSize)
+
         self.lock = threading.Lock()
+        self._segmentTimestamp = None
+        # the timestamp of the last transaction we wrote
+        self._lastTimestamp = None
+        self._openSegment()
+
         self.shouldStop = threading.Event()
-        self.flushThread = threading.Thread(target=self.flushLoop)
-        self.flushThread.daemon = True
-        self.flushThread.start()
+        self.writeThread = threading.Thread(target=self.writeLoop)
+        self.writeThread.daemon = True
+        self.writeThread.start()
+
+    def _openSegment(self):
+        timestamp = time.time()
+
+        # segment names have to be unique and in order
+        if self._segmentTimestamp is not None and timestamp <= self._segmentTimestamp:
+            timestamp = self._segmentTimestamp + 0.001
+
+        self._segmentTimestamp = timestamp
+        self.path = os.path.join(self.logDir, f"{SEGMENT_PREFIX}{timestamp}")
+
+        self.file = open(self.path, "wb")
+        self.indexFile = open(self.path + INDEX_SUFFIX, "wb")
+        self.bloom = BloomFilter(self.bloomBits)
+
+    def _closeSegment(self):
+        self.file.close()
+        self.indexFile.close()
+        self.bloom.write(self.path + BLOOM_SUFFIX)
 
     def stop(self):
         self.shouldStop.set()
-        self.flushThread.join()
-        self.file.close()
+        self.writeThread.join()
+
+        with self.lock:
+            self._closeSegment()
 
     def onTransaction(
         self,
@@ -44,6 +175,52 @@ class LoggingTransactionWatcher:
         succeeded,
         conflictingKeyIfFailed,
         errorOrNone,
+    ):
+        # the server builds all of these fresh for each transaction and doesn't
+        # modify them afterwards, so we can hold onto them without copying.
+        args = (
+            time.time(),
+            connectionId,
+            key_value,
+            prerequisites,
+            set_adds,
+            set_removes,
+            keys_to_check_versions,
+            indices_to_check_versions,
+            as_of_version,
+            transaction_id,
+            transaction_guid,
+            channelConnsSentTo,
+            succeeded,
+            conflictingKeyIfFailed,
+            errorOrNone,
+        )
+
+        if self.whenFull == "block":
+            self.queue.put(args)
+        else:
+            try:
+                self.queue.put_nowait(args)
+            except queue.Full:
+                self.droppedCount += 1
+
+    def _writeTransaction(
+        self,
+        timestamp,
+        connectionId,
+        key_value,
+        prerequisites,
+        set_adds,
+        set_removes,
+        keys_to_check_versions,
+        indices_to_check_versions,
+        as_of_version,
+        transaction_id,
+        transaction_guid,
+        channelConnsSentTo,
+        succeeded,
+        conflictingKeyIfFailed,
+        errorOrNone,
     ):
         serializedBytes = self.serializationContext.serialize(
             dict(
@@ -64,34 +241,80 @@ class LoggingTransactionWatcher:
             )
         )
         with self.lock:
-            self.file.write(struct.pack("q", len(serializedBytes)))
+            # readers binary search on the index's timestamps, so they mustn't go
+            # backwards, even if the wall clock does
+            if self._lastTimestamp is not None:
+                timestamp = max(timestamp, self._lastTimestamp)
+
+            self._lastTimestamp = timestamp
+
+            offset = self.file.tell()
+
+            self.file.write(_PACKET_HEADER.pack(len(serializedBytes)))
             self.file.write(serializedBytes)
+            self.indexFile.write(_INDEX_RECORD.pack(transaction_id, timestamp, offset))
+
+            for key in key_value or ():
+                objId = getattr(key, "objId", None)
+                if objId is not None:
+                    self.bloom.add(objId)
+
+            if self.file.tell() >= self.segmentBytes:
+                self._closeSegment()
+                self._openSegment()
+
+    def _flushFiles(self):
+        # the index goes second, so it never points past what's on disk
+        self.file.flush()
+        self.indexFile.flush()
 
     def flush(self):
+        """Block until everything we've been handed is written to disk."""
+        self.queue.join()
+
         with self.lock:
-            self.file.flush()
+            self._flushFiles()
+
+    def writeLoop(self):
+        lastFlush = time.time()
+
+        while not (self.shouldStop.is_set() and self.queue.empty()):
+            try:
+                args = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                args = None
 
-    def flushLoop(self):
-        while not self.shouldStop.is_set():
-            self.shouldStop.wait(0.1)
+            if args is not None:
+                try:
+                    self._writeTransaction(*args)
+                except Exception:
+                    logging.getLogger(__name__).exception("Failed to log a transaction:")
+                finally:
+                    self.queue.task_done()
 
-            with self.lock:
-                self.file.flush()
+            if args is None or time.time() - lastFlush > 0.1:
+                with self.lock:
+                    self._flushFiles()
+                lastFlush = time.time()
 
     @staticmethod
     def replayEvents(logDir, onEvent):
         tsToPath = {}
 
         for path in os.listdir(logDir):
-            if path.startswith("transactions_"):
-                tsToPath[float(path.split("_")[1])] = os.path.join(logDir, path)
+            timestamp = _segmentTimestamp(path)
+            if timestamp is not None:
+                tsToPath[timestamp] = os.path.join(logDir, path)
 
         for timestamp, path in sorted(tsToPath.items()):
-            LoggingTransactionWatcher.replayEventsFromFile(open(path, "rb"), onEvent)
+            with open(path, "rb") as f:
+                LoggingTransactionWatcher.replayEventsFromFile(f, onEvent)
 
     @staticmethod
     def replayEventsFromFile(file, onEvent):
-        PACKET_HEADER_SIZE = struct.calcsize("q")
+        PACKET_HEADER_SIZE = _PACKET_HEADER.size
+
+        serializationContext = SerializationContext()
 
         while True:
             dat = file.read(PACKET_HEADER_SIZE)
@@ -99,28 +322,224 @@ class LoggingTransactionWatcher:
             if len(dat) != PACKET_HEADER_SIZE:
                 return
 
-            packetSize = struct.unpack("q", dat)[0]
+            packetSize = _PACKET_HEADER.unpack(dat)[0]
 
             dat = file.read(packetSize)
 
             if len(dat) != packetSize:
                 return
 
-            packet = SerializationContext().deserialize(dat)
-
-            onEvent(
-                packet["connectionId"],
-                packet["key_value"],
-                packet["prerequisites"],
-                packet["set_adds"],
-                packet["set_removes"],
-                packet["keys_to_check_versions"],
-                packet["indices_to_check_versions"],
-                packet["as_of_version"],
-                packet["transaction_id"],
-                packet["transaction_guid"],
-                packet["succeeded"],
-                packet["conflictingKeyIfFailed"],
-                packet["channelConnsSentTo"],
-                packet["errorOrNone"],
-            )
+            packet = serializationContext.deserialize(dat)
+
+            onEvent(*LoggedTransaction.eventArgs(packet))
+
+
+class LoggedTransaction:
+    """One transaction in a log, decoded only when somebody asks for 'packet'."""
+
+    __slots__ = ["transaction_id", "timestamp", "_buffer", "_packet", "_serializationContext"]
+
+    def __init__(self, transaction_id, timestamp, buffer, serializationContext):
+        self.transaction_id = transaction_id
+        self.timestamp = timestamp
+        self._buffer = buffer
+        self._packet = None
+        self._serializationContext = serializationContext
+
+    @property
+    def packet(self):
+        """The dict of 'onTransaction' arguments that we logged."""
+        if self._packet is None:
+            self._packet = self._serializationContext.deserialize(bytes(self._buffer))
+            self._buffer = None
+
+        return self._packet
+
+    def touchesObject(self, objId):
+        return any(getattr(key, "objId", None) == objId for key in self.packet["key_value"])
+
+    @staticmethod
+    def eventArgs(packet):
+        """Return the arguments to 'onTransaction' that produced 'packet'."""
+        return (
+            packet["connectionId"],
+            packet["key_value"],
+            packet["prerequisites"],
+            packet["set_adds"],
+            packet["set_removes"],
+            packet["keys_to_check_versions"],
+            packet["indices_to_check_versions"],
+            packet["as_of_version"],
+            packet["transaction_id"],
+            packet["transaction_guid"],
+            packet["succeeded"],
+            packet["conflictingKeyIfFailed"],
+            packet["channelConnsSentTo"],
+            packet["errorOrNone"],
+        )
+
+
+class _LogSegment:
+    def __init__(self, path, timestamp):
+        self.path = path
+        self.timestamp = timestamp
+        self.data = self._map(path)
+
+        if os.path.exists(path + INDEX_SUFFIX):
+            self._index = self._map(path + INDEX_SUFFIX)
+            self._scannedEntries = None
+            self.entryCount = len(self._index) // _INDEX_RECORD.size
+        else:
+            # written before we kept indices, so we have to read the whole thing
+            self._index = None
+            self._scannedEntries = self._scanEntries()
+            self.entryCount = len(self._scannedEntries)
+
+        self.bloom = (
+            BloomFilter.read(path + BLOOM_SUFFIX)
+            if os.path.exists(path + BLOOM_SUFFIX)
+            else None
+        )
+
+    @staticmethod
+    def _map(path):
+        with open(path, "rb") as f:
+            if not os.fstat(f.fileno()).st_size:
+                return b""
+
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _scanEntries(self):
+        entries = []
+        offset = 0
+        serializationContext = SerializationContext()
+
+        while True:
+            buffer = self.packetBuffer(offset)
+
+            if buffer is None:
+                return entries
+
+            packet = serializationContext.deserialize(bytes(buffer))
+            entries.append((packet["transaction_id"], self.timestamp, offset))
+
+            offset += _PACKET_HEADER.size + len(buffer)
+
+    def entry(self, i):
+        """Return the (transaction_id, timestamp, offset) of the i'th packet."""
+        if self._index is None:
+            return self._scannedEntries[i]
+
+        return _INDEX_RECORD.unpack_from(self._index, i * _INDEX_RECORD.size)
+
+    def mightContain(self, objId):
+        return self.bloom is None or self.bloom.mightContain(objId)
+
+    def firstEntryAtOrAfter(self, column, value):
+        """Binary search for the first entry whose 'column' is at least 'value'."""
+        lo, hi = 0, self.entryCount
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+
+            if self.entry(mid)[column] < value:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return lo
+
+    def packetBuffer(self, offset):
+        """Return the packet at 'offset', or None if it's not all there (yet)."""
+        start = offset + _PACKET_HEADER.size
+
+        if start > len(self.data):
+            return None
+
+        size = _PACKET_HEADER.unpack_from(self.data, offset)[0]
+
+        if start + size > len(self.data):
+            return None
+
+        return memoryview(self.data)[start : start + size]
+
+
+class TransactionLogReader:
+    """Find transactions in a directory written by LoggingTransactionWatcher.
+
+    Segments are memory-mapped, and we use their indices to seek straight to
+    the transactions asked for, and their bloom filters to skip segments that
+    never touched an object. Packets are only decoded if you look at them.
+    """
+
+    def __init__(self, logDir):
+        self.logDir = logDir
+        self.serializationContext = SerializationContext()
+
+    def _segments(self):
+        res = []
+
+        for name in os.listdir(self.logDir):
+            timestamp = _segmentTimestamp(name)
+
+            if timestamp is not None:
+                res.append((timestamp, os.path.join(self.logDir, name)))
+
+        return [_LogSegment(path, timestamp) for timestamp, path in sorted(res)]
+
+    def transactions(
+        self, minTid=None, maxTid=None, minTimestamp=None, maxTimestamp=None, objId=None
+    ):
+        """Yield a LoggedTransaction for each matching transaction, in order.
+
+        Args:
+            minTid, maxTid - if not None, the (inclusive) range of transaction ids.
+            minTimestamp, maxTimestamp - if not None, the (inclusive) range of
+                times at which the transactions were logged.
+            objId - if not None, only transactions that wrote to this object.
+        """
+        for segment in self._segments():
+            if not segment.entryCount:
+                continue
+
+            lastTid, lastTimestamp, _ = segment.entry(segment.entryCount - 1)
+
+            if minTid is not None and lastTid < minTid:
+                continue
+
+            if minTimestamp is not None and lastTimestamp < minTimestamp:
+                continue
+
+            if objId is not None and not segment.mightContain(objId):
+                continue
+
+            start = 0
+
+            if minTid is not None:
+                start = max(start, segment.firstEntryAtOrAfter(0, minTid))
+
+            if minTimestamp is not None:
+                start = max(start, segment.firstEntryAtOrAfter(1, minTimestamp))
+
+            for i in range(start, segment.entryCount):
+                tid, timestamp, offset = segment.entry(i)
+
+                if maxTid is not None and tid > maxTid:
+                    return
+
+                if maxTimestamp is not None and timestamp > maxTimestamp:
+                    return
+
+                buffer = segment.packetBuffer(offset)
+
+                if buffer is None:
+                    break
+
+                transaction = LoggedTransaction(
+                    tid, timestamp, buffer, self.serializationContext
+                )
+
+                if objId is not None and not transaction.touchesObject(objId):
+                    continue
+
+                yield transaction
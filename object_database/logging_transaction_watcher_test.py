@@ -12,14 +12,20 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import os
+import threading
 import unittest
 import tempfile
+import time
 
 from object_database.util import genToken
 from object_database.persistence import InMemoryPersistence
 from object_database.inmem_server import InMemServer
-from object_database.logging_transaction_watcher import LoggingTransactionWatcher
-from object_database.schema import Schema
+from object_database.logging_transaction_watcher import (
+    LoggingTransactionWatcher,
+    TransactionLogReader,
+)
+from object_database.schema import Schema, ObjectFieldId
 
 
 schema = Schema("test_schema")
@@ -108,3 +114,118 @@ class LoggingTransactionWatcherTest(unittest.TestCase):
         LoggingTransactionWatcher.replayEvents(self.dir.name, handler)
 
         assert count[0] == 3  # one for connection, one for create, one for assign
+
+    def test_drops_when_full(self):
+        with tempfile.TemporaryDirectory() as logDir:
+            watcher = LoggingTransactionWatcher(logDir, maxQueueSize=2, whenFull="drop")
+
+            release = threading.Event()
+            context = watcher.serializationContext
+
+            class BlockingContext:
+                def serialize(self, value):
+                    release.wait()
+                    return context.serialize(value)
+
+            watcher.serializationContext = BlockingContext()
+
+            for i in range(10):
+                watcher.onTransaction(
+                    None, {}, {}, {}, {}, (), (), 0, i, None, None, True, None, None
+                )
+
+            # one being written and two queued, at most
+            self.assertGreaterEqual(watcher.droppedCount, 7)
+
+            release.set()
+            watcher.flush()
+
+            count = [0]
+
+            def handler(*args):
+                count[0] += 1
+
+            LoggingTransactionWatcher.replayEvents(logDir, handler)
+
+            self.assertEqual(count[0], 10 - watcher.droppedCount)
+
+            watcher.stop()
+
+    def test_reader_seeks(self):
+        with tempfile.TemporaryDirectory() as logDir:
+            watcher = LoggingTransactionWatcher(logDir, segmentBytes=2000, bloomBits=1024)
+
+            for tid in range(100):
+                key_value = {
+                    ObjectFieldId(objId=tid % 10, fieldId=1, isIndexValue=False): b"x"
+                }
+
+                watcher.onTransaction(
+                    None,
+                    key_value,
+                    {},
+                    {},
+                    {},
+                    (),
+                    (),
+                    tid - 1,
+                    tid,
+                    None,
+                    None,
+                    True,
+                    None,
+                    None,
+                )
+
+            watcher.stop()
+
+            # each finished segment gets a bloom filter
+            self.assertGreater(len([n for n in os.listdir(logDir) if n.endswith(".bloom")]), 1)
+
+            reader = TransactionLogReader(logDir)
+
+            self.assertEqual(
+                [t.transaction_id for t in reader.transactions(minTid=40, maxTid=59)],
+                list(range(40, 60)),
+            )
+            self.assertEqual(
+                [t.transaction_id for t in reader.transactions(objId=3)],
+                list(range(3, 100, 10)),
+            )
+
+            first = next(reader.transactions(minTid=90))
+            self.assertEqual(first.transaction_id, 90)
+            self.assertEqual(first.packet["as_of_version"], 89)
+
+            # the plain replay still reads everything
+            count = [0]
+
+            def handler(*args):
+                count[0] += 1
+
+            LoggingTransactionWatcher.replayEvents(logDir, handler)
+
+            self.assertEqual(count[0], 100)
+
+    def test_reader_seeks_by_time_when_the_clock_steps_back(self):
+        with tempfile.TemporaryDirectory() as logDir:
+            watcher = LoggingTransactionWatcher(logDir)
+
+            # queue transactions as 'onTransaction' would, stamped by a wall
+            # clock that steps backwards
+            now = time.time()
+
+            for tid, timestamp in enumerate([now, now + 10, now - 100, now + 20]):
+                watcher.queue.put(
+                    (timestamp, None, {}, {}, {}, {}, (), (), tid - 1, tid)
+                    + (None, None, True, None, None)
+                )
+
+            watcher.stop()
+
+            reader = TransactionLogReader(logDir)
+
+            self.assertEqual(
+                [t.transaction_id for t in reader.transactions(minTimestamp=now + 5)],
+                [1, 2, 3],
+            )
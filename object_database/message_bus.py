@@ -18,6 +18,7 @@ Classes for maintaining a strongly-typed message bus over sockets,
 along with classes to simulate this in tests.
 """
 
+import collections
 import ssl
 import time
 import threading
@@ -37,6 +38,27 @@ from object_database.socket_watcher import SocketWatcher
 MESSAGE_LEN_BYTES = 4  # sizeof an int32 used to pack messages
 EPOLL_TIMEOUT = 5.0
 MSG_BUF_SIZE = 128 * 1024
+DESERIALIZE_INLINE_BELOW = 64 * 1024
+
+# messages smaller than this get copied into one buffer with their length
+# prefix. Larger ones are queued as-is, prefix and body separately.
+COALESCE_WRITES_BELOW = 4 * 1024
+# the most buffers we hand to one 'sendmsg' call (Linux's IOV_MAX is 1024)
+MAX_BUFFERS_PER_SEND = 512
+# TLS sockets can't 'sendmsg', so we join small buffers into writes up to this size
+SSL_WRITE_BYTES = 256 * 1024
+
+# How a message may be reordered against the others on its connection. CONTROL
+# messages overtake any BULK messages we haven't started writing. NORMAL messages
+# are never reordered against anything.
+PRIORITY_CONTROL = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+
+# we commit BULK messages to the wire order only while we have fewer than this
+# many bytes ahead of them, so a CONTROL message waits behind at most this much
+# plus one BULK message.
+BULK_WRITE_AHEAD_BYTES = 256 * 1024
 
 
 class MessageBusLoopExit(Exception):
@@ -58,6 +80,12 @@ class MessageBuffer:
                 same integer value.
         """
         self.buffer = bytearray()
+
+        # the offset in 'buffer' of the first byte we haven't consumed. We only
+        # drop consumed bytes from the front of the buffer once they're the
+        # bulk of it, so consuming a message doesn't move the ones behind it.
+        self.readOffset = 0
+
         self.messagesEver = 0
         self.extraMessageSizeCheck = extraMessageSizeCheck
 
@@ -65,7 +93,7 @@ class MessageBuffer:
         self.curMessageLen = None
 
     def pendingBytecount(self):
-        return len(self.buffer)
+        return len(self.buffer) - self.readOffset
 
     @staticmethod
     def encode(bytes, extraMessageSizeCheck: bool):
@@ -89,41 +117,197 @@ class MessageBuffer:
         """
         messages = []
 
-        self.buffer.extend(bytesToWrite)
+        buffer = self.buffer
+        buffer.extend(bytesToWrite)
 
-        while True:
-            if self.curMessageLen is None:
-                if len(self.buffer) >= MESSAGE_LEN_BYTES:
-                    self.curMessageLen = struct.unpack("i", self.buffer[:MESSAGE_LEN_BYTES])[0]
-                    self.buffer[:MESSAGE_LEN_BYTES] = b""
+        offset = self.readOffset
+        end = len(buffer)
+        trailerLen = MESSAGE_LEN_BYTES if self.extraMessageSizeCheck else 0
 
-            if self.curMessageLen is None:
-                return messages
+        with memoryview(buffer) as view:
+            while True:
+                if self.curMessageLen is None:
+                    if end - offset < MESSAGE_LEN_BYTES:
+                        break
 
-            if self.extraMessageSizeCheck:
-                if len(self.buffer) >= self.curMessageLen + MESSAGE_LEN_BYTES:
-                    messages.append(bytes(self.buffer[: self.curMessageLen]))
-                    self.messagesEver += 1
-                    msgLen = self.curMessageLen
-                    sizeCheckBytes = self.buffer[msgLen : msgLen + MESSAGE_LEN_BYTES]
-                    sizeCheck = struct.unpack("i", sizeCheckBytes)[0]
+                    self.curMessageLen = struct.unpack_from("i", buffer, offset)[0]
+                    offset += MESSAGE_LEN_BYTES
+
+                msgLen = self.curMessageLen
 
-                    self.buffer[: msgLen + MESSAGE_LEN_BYTES] = b""
-                    self.curMessageLen = None
+                if end - offset < msgLen + trailerLen:
+                    break
+
+                # 'deserialize' needs bytes, so this is the one copy we make
+                messages.append(bytes(view[offset : offset + msgLen]))
+                self.messagesEver += 1
+
+                if trailerLen:
+                    sizeCheck = struct.unpack_from("i", buffer, offset + msgLen)[0]
 
                     if sizeCheck != msgLen:
+                        self.readOffset = offset + msgLen + trailerLen
+                        self.curMessageLen = None
                         raise CorruptMessageStream(f"{sizeCheck} != {msgLen}")
 
-                else:
-                    return messages
+                offset += msgLen + trailerLen
+                self.curMessageLen = None
+
+        if offset == end:
+            del buffer[:]
+            offset = 0
+        elif offset > end - offset:
+            del buffer[:offset]
+            offset = 0
+
+        self.readOffset = offset
+
+        return messages
+
+
+class WriteBuffer:
+    def __init__(self, extraMessageSizeCheck: bool):
+        """The bytes waiting to be written to one socket.
+
+        We keep a queue of immutable buffers rather than one contiguous
+        bytearray, so a message isn't copied on its way to the socket, and the
+        same serialized message can be queued on many sockets at once.
+
+        BULK messages wait in a separate queue until we're close to running out
+        of other bytes to write, so that CONTROL messages can get ahead of them.
+
+        Args:
+            extraMessageSizeCheck (bool): when True, each message is also
+                followed by its length, as 'MessageBuffer' expects.
+        """
+        # the buffers to write, in the order we'll write them
+        self.buffers = collections.deque()
+
+        # how many bytes of 'buffers[0]' we've already written
+        self.headOffset = 0
+
+        # the BULK messages (each a list of buffers) that we haven't yet
+        # committed to 'buffers', and their total size
+        self.bulkMessages = collections.deque()
+        self.bulkBytecount = 0
+
+        # the number of bytes we have yet to write, including BULK messages
+        self.bytecount = 0
+
+        # True once we've gone over the bus's connection high-water mark, until
+        # we drain back under half of it
+        self.backedUp = False
+
+        self.extraMessageSizeCheck = extraMessageSizeCheck
+
+    def __len__(self):
+        return self.bytecount
+
+    def append(self, msg, priority=PRIORITY_NORMAL):
+        """Queue 'msg' along with its length prefix.
+
+        Returns:
+            the number of bytes we queued.
+        """
+        prefix = struct.pack("i", len(msg))
+
+        if len(msg) < COALESCE_WRITES_BELOW:
+            if self.extraMessageSizeCheck:
+                msgBuffers = [prefix + msg + prefix]
             else:
-                if len(self.buffer) >= self.curMessageLen:
-                    messages.append(bytes(self.buffer[: self.curMessageLen]))
-                    self.messagesEver += 1
-                    self.buffer[: self.curMessageLen] = b""
-                    self.curMessageLen = None
-                else:
-                    return messages
+                msgBuffers = [prefix + msg]
+        else:
+            msgBuffers = [prefix, msg]
+
+            if self.extraMessageSizeCheck:
+                msgBuffers.append(prefix)
+
+        bytecount = len(msg) + len(prefix) * (2 if self.extraMessageSizeCheck else 1)
+        self.bytecount += bytecount
+
+        if priority == PRIORITY_BULK:
+            self.bulkMessages.append(msgBuffers)
+            self.bulkBytecount += bytecount
+        else:
+            if priority != PRIORITY_CONTROL:
+                # nothing gets ahead of a NORMAL message, and it doesn't get
+                # ahead of anything either
+                self._commitBulkMessages(None)
+
+            self.buffers.extend(msgBuffers)
+
+        return bytecount
+
+    def _commitBulkMessages(self, aheadBytecount):
+        """Move BULK messages into 'buffers' until 'aheadBytecount' bytes are ahead of them.
+
+        If 'aheadBytecount' is None, move all of them.
+        """
+        while self.bulkMessages and (
+            aheadBytecount is None or self.bytecount - self.bulkBytecount < aheadBytecount
+        ):
+            msgBuffers = self.bulkMessages.popleft()
+            self.bulkBytecount -= sum(len(buf) for buf in msgBuffers)
+            self.buffers.extend(msgBuffers)
+
+    def peek(self, maxBuffers=MAX_BUFFERS_PER_SEND, maxBytes=None):
+        """Return a list of the next buffers to write.
+
+        We return at most 'maxBuffers' buffers, and stop before a buffer that would
+        take us over 'maxBytes', but we always return at least one buffer if we
+        have any bytes at all.
+        """
+        self._commitBulkMessages(BULK_WRITE_AHEAD_BYTES)
+
+        buffers = self.buffers
+        result = []
+        bytecount = 0
+
+        for i in range(min(maxBuffers, len(buffers))):
+            buf = buffers[i]
+
+            if i == 0 and self.headOffset:
+                buf = memoryview(buf)[self.headOffset :]
+
+            if result and maxBytes is not None and bytecount + len(buf) > maxBytes:
+                break
+
+            result.append(buf)
+            bytecount += len(buf)
+
+        return result
+
+    def consume(self, bytecount):
+        """Drop the first 'bytecount' bytes, which have been written."""
+        self.bytecount -= bytecount
+
+        buffers = self.buffers
+
+        while bytecount:
+            remaining = len(buffers[0]) - self.headOffset
+
+            if bytecount < remaining:
+                self.headOffset += bytecount
+                return
+
+            buffers.popleft()
+            self.headOffset = 0
+            bytecount -= remaining
+
+    @staticmethod
+    def send(sock, buffers):
+        """Write a list of buffers from 'peek' to 'sock' with one system call.
+
+        Returns:
+            the number of bytes written. Raises whatever 'sock.send' raises.
+        """
+        if len(buffers) == 1:
+            return sock.send(buffers[0])
+
+        if isinstance(sock, ssl.SSLSocket) or not hasattr(sock, "sendmsg"):
+            return sock.send(b"".join(buffers))
+
+        return sock.sendmsg(buffers)
 
 
 class Disconnected:
@@ -142,6 +326,10 @@ class TriggerConnect:
     """A singleton for signaling we should connect to a channel."""
 
 
+class TriggerWatch:
+    """A singleton for handing a newly accepted socket to a _SocketShard."""
+
+
 Endpoint = NamedTuple(host=str, port=int)
 
 
@@ -168,6 +356,12 @@ def MessageBusEvent(MessageType):
         OutgoingConnectionFailed=dict(connectionId=ConnectionId),
         # an outgoing connection closed
         OutgoingConnectionClosed=dict(connectionId=ConnectionId),
+        # we have at least the connection high-water mark of bytes waiting to
+        # be written to this connection. Only fired if 'setConnectionHighWaterMark'
+        # has been called.
+        ConnectionBackedUp=dict(connectionId=ConnectionId, pendingBytes=int),
+        # a connection that was backed up has drained to half its high-water mark
+        ConnectionDrained=dict(connectionId=ConnectionId),
     )
 
 
@@ -185,6 +379,9 @@ class MessageBus(object):
         wantsSSL=True,
         sslContext=None,
         extraMessageSizeCheck=True,
+        socketThreadCount=1,
+        deserializationThreadCount=0,
+        deserializeInlineBelow=DESERIALIZE_INLINE_BELOW,
     ):
         """Initialize a MessageBus
 
@@ -210,6 +407,19 @@ class MessageBus(object):
             certPath(str or None): if we use SSL, an optional path to a cert file.
             wantsSSL(bool): should we encrypt our channel with SSL
             sslContext - an SSL context if we've already got one
+            socketThreadCount - if greater than 1, we spread incoming connections
+                across this many _SocketShard threads, each with its own epoll,
+                which do the reading, framing, deserializing and writing for
+                the connections they own. The main socket thread still accepts
+                connections and handles outgoing ones.
+            deserializationThreadCount - if greater than 0, socket threads hand
+                incoming messages of at least 'deserializeInlineBelow' bytes to
+                this many worker threads to deserialize, so a large message
+                doesn't hold up every other connection. Each connection's events
+                still reach 'onEvent' in the order its messages arrived.
+            deserializeInlineBelow - the size below which we deserialize a
+                message on the socket thread, unless the connection already has
+                messages on a worker.
 
         The MessageBus listens for connection on the endpoint and calls
         onEvent from the read thread whenever a new event occurs.
@@ -267,7 +477,8 @@ class MessageBus(object):
         self._connIdToIncomingEndpoint = {}  # connectionId -> Endpoint
         self._connIdToOutgoingEndpoint = {}  # connectionId -> Endpoint
         self._connIdPendingOutgoingConnection = set()
-        self._messagesForUnconnectedOutgoingConnection = {}  # connectionId- > [bytes]
+        # connectionId -> [(bytes, priority)]
+        self._messagesForUnconnectedOutgoingConnection = {}
 
         self._messageToSendWakePipe = None
         self._eventToFireWakePipe = None
@@ -299,14 +510,36 @@ class MessageBus(object):
         self._wantsSSL = wantsSSL
         self._sslContext = sslContext
 
-        # socket -> bytes that need to be written
+        # socket -> WriteBuffer of bytes that need to be written
         self._socketToBytesNeedingWrite = {}
+
+        # if not None, the number of bytes waiting for a single connection
+        # at which we fire ConnectionBackedUp
+        self._connectionHighWaterMark = None
         self._socketsWithSslWantWrite = set()
         self._allSockets = None  # SocketWatcher
 
         # dict from 'socket' object to MessageBuffer
         self._incomingSocketBuffers = {}
 
+        assert socketThreadCount >= 1
+        self._socketThreadCount = socketThreadCount
+
+        # the _SocketShards we hand incoming connections to, if any, and the
+        # shard that owns each connection. A connection never changes shards,
+        # so its messages are read, and written, in order.
+        self._shards = []
+        self._connIdToShard = {}
+
+        # if we deserialize on worker threads, a queue of (connId, bytes or event)
+        # for each worker, and for each connection, the number of items it has
+        # on its worker's queue. A connection always uses the same worker.
+        self._deserializationThreadCount = deserializationThreadCount
+        self._deserializeInlineBelow = deserializeInlineBelow
+        self._deserializationQueues = []
+        self._deserializationThreads = []
+        self._connIdToPendingDeserializations = {}
+
         if self._wantsSSL:
             self._outboundSslContext = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
             self._outboundSslContext.check_hostname = False
@@ -340,8 +573,45 @@ class MessageBus(object):
         """Insist that we block any _sending_ threads if our outgoing queue gets too large."""
         self._messagesToSendQueue.setMaxBytes(queueSize)
 
+        for shard in self._shards:
+            shard.messagesToSend.setMaxBytes(queueSize)
+
+    def setConnectionHighWaterMark(self, bytecount):
+        """Fire ConnectionBackedUp when this many bytes are waiting to go to one connection.
+
+        Once the connection drains to half of 'bytecount' we fire ConnectionDrained.
+        Use None to stop watching.
+        """
+        with self._lock:
+            self._connectionHighWaterMark = bytecount
+
+    def pendingBytecount(self, connectionId):
+        """The number of bytes we have waiting to be written to a connection.
+
+        Returns None if we don't know the connection.
+        """
+        with self._lock:
+            sock = self._connIdToIncomingSocket.get(connectionId)
+
+            if sock is None:
+                sock = self._connIdToOutgoingSocket.get(connectionId)
+
+            if sock is None:
+                return None
+
+            shard = self._connIdToShard.get(connectionId)
+
+            if shard is not None:
+                writeBuffer = shard.bytesNeedingWrite.get(sock)
+            else:
+                writeBuffer = self._socketToBytesNeedingWrite.get(sock)
+
+            return len(writeBuffer) if writeBuffer is not None else 0
+
     def isWriteQueueBlocked(self):
-        return self._messagesToSendQueue.isBlocked()
+        return self._messagesToSendQueue.isBlocked() or any(
+            shard.messagesToSend.isBlocked() for shard in self._shards
+        )
 
     def start(self):
         """
@@ -364,10 +634,28 @@ class MessageBus(object):
             if self._acceptSocket is not None:
                 self._allSockets.addForRead(self._acceptSocket)
 
+            if self._socketThreadCount > 1:
+                self._shards = [_SocketShard(self, i) for i in range(self._socketThreadCount)]
+
+                for shard in self._shards:
+                    shard.messagesToSend.setMaxBytes(self._messagesToSendQueue.maxBytes)
+
             self.started = True
             self._socketThread.start()
             self._eventThread.start()
 
+            for shard in self._shards:
+                shard.thread.start()
+
+            for _ in range(self._deserializationThreadCount):
+                workQueue = queue.Queue()
+                thread = threading.Thread(
+                    target=self._deserializationThreadLoop, args=(workQueue,), daemon=True
+                )
+                self._deserializationQueues.append(workQueue)
+                self._deserializationThreads.append(thread)
+                thread.start()
+
     def stop(self, timeout=None):
         """
         Stop the message bus.
@@ -394,6 +682,25 @@ class MessageBus(object):
         if self._socketThread.is_alive():
             raise Exception("Failed to shutdown our threads!")
 
+        for shard in self._shards:
+            shard.put(Disconnected)
+
+        for shard in self._shards:
+            shard.thread.join(timeout=timeout)
+
+            if shard.thread.is_alive():
+                raise Exception("Failed to shutdown our threads!")
+
+        # let the workers fire what they've got before the event loop goes away
+        for workQueue in self._deserializationQueues:
+            workQueue.put(None)
+
+        for thread in self._deserializationThreads:
+            thread.join(timeout=timeout)
+
+            if thread.is_alive():
+                raise Exception("Failed to shutdown our threads!")
+
         # shutdown the event loop after the threadloops, so that we're guaranteed
         # that we fire the shutdown events.
         self._eventQueue.put(None)
@@ -422,6 +729,9 @@ class MessageBus(object):
 
         self._allSockets.teardown()
 
+        for shard in self._shards:
+            shard.teardown()
+
     def connect(self, endpoint: Endpoint) -> ConnectionId:
         """Make a connection to another endpoint and return a ConnectionId for it.
 
@@ -465,8 +775,19 @@ class MessageBus(object):
                 and connectionId not in self._connIdToIncomingEndpoint
             )
 
-    def _putOnSendQueue(self, connectionId, msg):
-        self._messagesToSendQueue.put((connectionId, msg))
+    def _putOnSendQueue(self, connectionId, msg, priority=PRIORITY_NORMAL):
+        shard = self._connIdToShard.get(connectionId)
+
+        if shard is not None:
+            shard.put((connectionId, msg, priority))
+            return
+
+        # CONTROL messages are small, so we don't make them wait for room
+        # behind a backlog of large ones
+        self._messagesToSendQueue.put(
+            (connectionId, msg, priority),
+            allowWriteWhileOverLimit=priority == PRIORITY_CONTROL,
+        )
         assert os.write(self._messageToSendWakePipe[1], b" ") == 1
 
     def scheduleCallback(self, callback, *, atTimestamp=None, delay=None):
@@ -503,7 +824,7 @@ class MessageBus(object):
                 if written != 1:
                     raise Exception("Internal Error: Failed to write to general wake pipe")
 
-    def sendMessage(self, connectionId, message):
+    def sendMessage(self, connectionId, message, priority=PRIORITY_NORMAL):
         """Send a message to another endpoint endpoint.
 
         Send a message and return immediately (before guaranteeding we've sent
@@ -513,6 +834,10 @@ class MessageBus(object):
         Args:
             targetEndpoint - a host and port tuple.
             message - a message of type (self.MessageType) to send to the other endpoint.
+            priority - PRIORITY_CONTROL for small messages that may overtake any
+                PRIORITY_BULK messages we haven't started writing to the connection,
+                PRIORITY_BULK for large messages that may be overtaken, or
+                PRIORITY_NORMAL for messages that must stay in order.
 
         Returns:
             True if the message was queued, False if we preemptively dropped it because the
@@ -521,17 +846,38 @@ class MessageBus(object):
         if not self.started:
             raise Exception(f"Bus {self.busIdentity} is not active")
 
+        return self.sendSerialized(connectionId, self.serializeMessage(message), priority)
+
+    def serializeMessage(self, message):
+        """Serialize a message of type (self.outMessageType) the way 'sendMessage' would.
+
+        Clients sending the same message to many connections can serialize it once
+        with this function and then pass the result to 'sendSerialized'.
+        """
         if self.serializationContext is None:
-            serializedMessage = serialize(self.outMessageType, message)
+            return serialize(self.outMessageType, message)
         else:
-            serializedMessage = self.serializationContext.serialize(
+            return self.serializationContext.serialize(
                 message, serializeType=self.outMessageType
             )
 
+    def sendSerialized(self, connectionId, serializedMessage, priority=PRIORITY_NORMAL):
+        """Send a message that has already been serialized with 'serializeMessage'.
+
+        The bytes are not copied or modified, so the same buffer may be handed to
+        any number of connections. 'priority' is as for 'sendMessage'.
+
+        Returns:
+            True if the message was queued, False if we preemptively dropped it because the
+            other endpoint is disconnected.
+        """
+        if not self.started:
+            raise Exception(f"Bus {self.busIdentity} is not active")
+
         if self._isDefinitelyDead(connectionId):
             return False
 
-        self._putOnSendQueue(connectionId, serializedMessage)
+        self._putOnSendQueue(connectionId, serializedMessage, priority)
 
         return True
 
@@ -546,7 +892,7 @@ class MessageBus(object):
         if not isinstance(msg, tuple):
             return 0
 
-        if msg[1] is TriggerConnect or msg[1] is TriggerDisconnect:
+        if msg[1] is TriggerConnect or msg[1] is TriggerDisconnect or msg[1] is TriggerWatch:
             return 0
 
         return len(msg[1])
@@ -602,7 +948,7 @@ class MessageBus(object):
         else:
             return True
 
-    def _scheduleBytesForWrite(self, connId, msg):
+    def _scheduleBytesForWrite(self, connId, msg, priority=PRIORITY_NORMAL):
         """Accessed by: socketThread and eventThread
 
         It is called under self._lock when called by the eventThread (through _connectTo)
@@ -627,20 +973,24 @@ class MessageBus(object):
 
             with self._lock:
                 self._messagesForUnconnectedOutgoingConnection.setdefault(connId, []).append(
-                    msg
+                    (msg, priority)
                 )
 
             return
 
-        msgBytes = MessageBuffer.encode(msg, self.extraMessageSizeCheck)
-
         with self._lock:
-            self.totalBytesPendingInOutputLoop += len(msgBytes)
+            writeBuffer = self._socketToBytesNeedingWrite.get(sslSock)
 
-            if sslSock not in self._socketToBytesNeedingWrite:
-                self._socketToBytesNeedingWrite[sslSock] = bytearray(msgBytes)
-            else:
-                self._socketToBytesNeedingWrite[sslSock].extend(msgBytes)
+            if writeBuffer is None:
+                writeBuffer = WriteBuffer(self.extraMessageSizeCheck)
+                self._socketToBytesNeedingWrite[sslSock] = writeBuffer
+
+            self.totalBytesPendingInOutputLoop += writeBuffer.append(msg, priority)
+
+            event = self._highWaterMarkEvent(connId, writeBuffer)
+
+        if event is not None:
+            self._fireEvent(event)
 
     def _handleReadReadySocket(self, socketWithData):
         """Our select loop indicated 'socketWithData' has data pending.
@@ -670,7 +1020,13 @@ class MessageBus(object):
                     self._incomingSocketBuffers[newSocket] = MessageBuffer(
                         self.extraMessageSizeCheck
                     )
-                    self._allSockets.addForRead(newSocket)
+
+                    if self._shards:
+                        shard = self._shards[connId.id % len(self._shards)]
+                        self._connIdToShard[connId] = shard
+                    else:
+                        shard = None
+                        self._allSockets.addForRead(newSocket)
 
                 self._fireEvent(
                     self.eventType.NewIncomingConnection(
@@ -678,48 +1034,67 @@ class MessageBus(object):
                     )
                 )
 
+                # the shard only starts reading once we've fired the event above, so
+                # the connection's messages can't get ahead of it
+                if shard is not None:
+                    shard.put((newSocket, TriggerWatch))
+
                 return True
 
         elif socketWithData in self._allSockets:
+            return self._readFromSocket(socketWithData, self._socketsWithSslWantWrite)
+
+        else:
+            self._logger.warning(
+                "MessageBus got data on a socket it didn't know about: %s", socketWithData
+            )
+
+    def _readFromSocket(self, socketWithData, socketsWithSslWantWrite):
+        """Read what's pending on 'socketWithData' and fire any messages it completes.
+
+        Accessed by: socketThread, or the _SocketShard that owns the socket
+        """
+        try:
+            bytesReceived = socketWithData.recv(MSG_BUF_SIZE)
+        except ssl.SSLWantReadError:
+            bytesReceived = None
+        except ssl.SSLWantWriteError:
+            socketsWithSslWantWrite.add(socketWithData)
+            bytesReceived = None
+        except ConnectionResetError:
+            bytesReceived = b""
+        except Exception:
+            self._logger.exception("MessageBus read socket shutting down")
+            bytesReceived = b""
+
+        if bytesReceived is None:
+            # do nothing
+            pass
+        elif bytesReceived == b"":
+            self._markSocketClosed(socketWithData)
+            return True
+        else:
+            messageBuffer = self._incomingSocketBuffers[socketWithData]
+            oldBytecount = messageBuffer.pendingBytecount()
+
             try:
-                bytesReceived = socketWithData.recv(MSG_BUF_SIZE)
-            except ssl.SSLWantReadError:
-                bytesReceived = None
-            except ssl.SSLWantWriteError:
-                self._socketsWithSslWantWrite.add(socketWithData)
-            except ConnectionResetError:
-                bytesReceived = b""
-            except Exception:
-                self._logger.exception("MessageBus read socket shutting down")
-                bytesReceived = b""
+                newMessages = messageBuffer.write(bytesReceived)
 
-            if bytesReceived is None:
-                # do nothing
-                pass
-            elif bytesReceived == b"":
+            except CorruptMessageStream:
+                connId = self._getConnectionIdFromSocket(socketWithData)
+                if connId is not None:
+                    self._logger.error(
+                        f"Closing connection {connId} due to corrupted message stream."
+                    )
                 self._markSocketClosed(socketWithData)
                 return True
-            else:
-                self.totalBytesRead += len(bytesReceived)
-
-                messageBuffer = self._incomingSocketBuffers[socketWithData]
-                oldBytecount = messageBuffer.pendingBytecount()
-
-                try:
-                    newMessages = messageBuffer.write(bytesReceived)
 
-                except CorruptMessageStream:
-                    connId = self._getConnectionIdFromSocket(socketWithData)
-                    if connId is not None:
-                        self._logger.error(
-                            f"Closing connection {connId} due to corrupted message stream."
-                        )
-                    self._markSocketClosed(socketWithData)
-                    return True
+            # shards update these too
+            with self._lock:
+                self.totalBytesRead += len(bytesReceived)
 
                 self.totalBytesPendingInInputLoop += (
-                    self._incomingSocketBuffers[socketWithData].pendingBytecount()
-                    - oldBytecount
+                    messageBuffer.pendingBytecount() - oldBytecount
                 )
 
                 self.totalBytesPendingInInputLoopHighWatermark = max(
@@ -727,17 +1102,12 @@ class MessageBus(object):
                     self.totalBytesPendingInInputLoopHighWatermark,
                 )
 
-                for m in newMessages:
-                    if not self._handleIncomingMessage(m, socketWithData):
-                        self._markSocketClosed(socketWithData)
-                        break
-
-                return True
+            for m in newMessages:
+                if not self._handleIncomingMessage(m, socketWithData):
+                    self._markSocketClosed(socketWithData)
+                    break
 
-        else:
-            self._logger.warning(
-                "MessageBus got data on a socket it didn't know about: %s", socketWithData
-            )
+            return True
 
     def _socketThreadLoop(self):
         t0 = time.time()
@@ -873,7 +1243,7 @@ class MessageBus(object):
         if connectionAndMsg is Disconnected or connectionAndMsg is None:
             return
 
-        connId, msg = connectionAndMsg
+        connId, msg, priority = connectionAndMsg
 
         if msg is TriggerConnect:
             # preschedule the auth token write. When we connect we'll send it
@@ -886,7 +1256,7 @@ class MessageBus(object):
             self.scheduleCallback(lambda: self._connectTo(connId))
 
         else:
-            self._scheduleBytesForWrite(connId, msg)
+            self._scheduleBytesForWrite(connId, msg, priority)
 
     def _handleEventToFire(self):
         """Accessed by: the socketThread"""
@@ -900,6 +1270,10 @@ class MessageBus(object):
                 self.scheduleCallback(lambda: self._scheduleEvent(readMessage), delay=0.1)
                 return
 
+            elif connId in self._connIdToShard:
+                # only the shard that owns the socket may touch it
+                self._connIdToShard[connId].put(readMessage)
+
             else:
                 if connId in self._connIdToOutgoingSocket:
                     self._markSocketClosed(self._connIdToOutgoingSocket[connId])
@@ -935,24 +1309,43 @@ class MessageBus(object):
             else:
                 self._fireEvent(readMessage)
 
-    def _handleWriteReadySocket(self, writeable):
+    def _handleWriteReadySocket(self, writeable, shard=None):
         """Socket 'writeable' can accept more bytes.
 
-        Accessed by: the socketThread
+        Accessed by: the socketThread, or 'shard' if it owns the socket
 
         Returns (bool) didSomething
         """
-        if writeable not in self._socketToBytesNeedingWrite:
-            return
+        if shard is None:
+            sockets = self._allSockets
+            bytesNeedingWrite = self._socketToBytesNeedingWrite
+            socketsWithSslWantWrite = self._socketsWithSslWantWrite
+        else:
+            sockets = shard.sockets
+            bytesNeedingWrite = shard.bytesNeedingWrite
+            socketsWithSslWantWrite = shard.socketsWithSslWantWrite
+
+        # take the buffers under the lock: the eventThread may be adding to
+        # them while we write (see _connectTo).
+        with self._lock:
+            writeBuffer = bytesNeedingWrite.get(writeable)
+
+            if writeBuffer is None:
+                return
+
+            if isinstance(writeable, ssl.SSLSocket):
+                buffers = writeBuffer.peek(maxBytes=SSL_WRITE_BYTES)
+            else:
+                buffers = writeBuffer.peek()
 
         try:
-            bytesWritten = writeable.send(self._socketToBytesNeedingWrite[writeable])
+            bytesWritten = WriteBuffer.send(writeable, buffers)
 
         except ssl.SSLWantReadError:
             bytesWritten = -1
 
         except ssl.SSLWantWriteError:
-            self._socketsWithSslWantWrite.add(writeable)
+            socketsWithSslWantWrite.add(writeable)
             bytesWritten = -1
 
         except (OSError, BrokenPipeError):
@@ -966,10 +1359,10 @@ class MessageBus(object):
 
         if bytesWritten == 0:
             # the primary socket close pathway is in the socket handler.
-            self._allSockets.discardForWrite(writeable)
+            sockets.discardForWrite(writeable)
 
             with self._lock:
-                del self._socketToBytesNeedingWrite[writeable]
+                bytesNeedingWrite.pop(writeable, None)
 
             return True
 
@@ -982,12 +1375,22 @@ class MessageBus(object):
                 self.totalBytesPendingInOutputLoop -= bytesWritten
                 self.totalBytesWritten += bytesWritten
 
-                self._socketToBytesNeedingWrite[writeable][:bytesWritten] = b""
+                if shard is not None:
+                    shard.bytesPendingWrite -= bytesWritten
+
+                writeBuffer.consume(bytesWritten)
+
+                event = self._highWaterMarkEvent(
+                    self._getConnectionIdFromSocket(writeable), writeBuffer
+                )
 
-                if not self._socketToBytesNeedingWrite[writeable]:
+                if not writeBuffer:
                     # we have no bytes to flush
-                    self._allSockets.discardForWrite(writeable)
-                    del self._socketToBytesNeedingWrite[writeable]
+                    sockets.discardForWrite(writeable)
+                    del bytesNeedingWrite[writeable]
+
+            if event is not None:
+                self._fireEvent(event)
 
             return True
 
@@ -1003,18 +1406,22 @@ class MessageBus(object):
             pass
 
     def _markSocketClosed(self, socket):
-        """Accessed by: the socketThread"""
+        """Accessed by: the socketThread, or the _SocketShard that owns the socket"""
         toFire = []
+        shard = None
 
         with self._lock:
             if socket in self._socketToIncomingConnId:
                 connId = self._socketToIncomingConnId[socket]
+                shard = self._connIdToShard.pop(connId, None)
                 self._unauthenticatedConnections.discard(connId)
                 del self._connIdToIncomingSocket[connId]
                 del self._socketToIncomingConnId[socket]
                 del self._connIdToIncomingEndpoint[connId]
                 del self._incomingSocketBuffers[socket]
-                if socket in self._socketToBytesNeedingWrite:
+                if shard is not None:
+                    shard.discardPendingWrites(socket)
+                elif socket in self._socketToBytesNeedingWrite:
                     del self._socketToBytesNeedingWrite[socket]
                 toFire.append(self.eventType.IncomingConnectionClosed(connectionId=connId))
 
@@ -1030,15 +1437,40 @@ class MessageBus(object):
                 toFire.append(self.eventType.OutgoingConnectionClosed(connectionId=connId))
 
         self._ensureSocketClosed(socket)
-        self._allSockets.discard(socket)
+        (shard.sockets if shard is not None else self._allSockets).discard(socket)
 
         for event in toFire:
-            self._fireEvent(event)
+            self._fireConnectionEvent(event.connectionId, event)
 
     def isUnauthenticated(self, connId):
         with self._lock:
             return connId in self._unauthenticatedConnections
 
+    def _highWaterMarkEvent(self, connId, writeBuffer):
+        """The event to fire if 'writeBuffer' just crossed the connection high-water mark.
+
+        Returns ConnectionBackedUp if it just went over the mark, ConnectionDrained if
+        it was over and just drained to half of it, and None otherwise.
+
+        Accessed by: whichever thread owns the socket, under self._lock
+        """
+        mark = self._connectionHighWaterMark
+
+        if mark is None or connId is None:
+            return None
+
+        if not writeBuffer.backedUp and len(writeBuffer) >= mark:
+            writeBuffer.backedUp = True
+            return self.eventType.ConnectionBackedUp(
+                connectionId=connId, pendingBytes=len(writeBuffer)
+            )
+
+        if writeBuffer.backedUp and len(writeBuffer) <= mark // 2:
+            writeBuffer.backedUp = False
+            return self.eventType.ConnectionDrained(connectionId=connId)
+
+        return None
+
     def _getConnectionIdFromSocket(self, socket):
         """Accessed by: socketThread"""
         if socket in self._socketToIncomingConnId:
@@ -1068,13 +1500,19 @@ class MessageBus(object):
                 self._logger.exception("Failed to read incoming auth message for %s", connId)
                 return False
         else:
+            if self._deserializationQueues:
+                with self._lock:
+                    pending = self._connIdToPendingDeserializations.get(connId, 0)
+
+                    # once a connection has a message on a worker, everything
+                    # behind it has to go through the worker too
+                    if pending or len(serializedMessage) >= self._deserializeInlineBelow:
+                        self._connIdToPendingDeserializations[connId] = pending + 1
+                        self._deserializationQueueFor(connId).put((connId, serializedMessage))
+                        return True
+
             try:
-                if self.serializationContext is None:
-                    message = deserialize(self.inMessageType, serializedMessage)
-                else:
-                    message = self.serializationContext.deserialize(
-                        serializedMessage, self.inMessageType
-                    )
+                message = self._deserialize(serializedMessage)
             except Exception:
                 if serializedMessage != self._authToken:
                     self._logger.exception("Failed to deserialize a message")
@@ -1086,10 +1524,76 @@ class MessageBus(object):
 
             return True
 
+    def _deserialize(self, serializedMessage):
+        """Accessed by: socketThread, shards and deserialization threads"""
+        if self.serializationContext is None:
+            return deserialize(self.inMessageType, serializedMessage)
+        else:
+            return self.serializationContext.deserialize(serializedMessage, self.inMessageType)
+
+    def _deserializationQueueFor(self, connId):
+        return self._deserializationQueues[connId.id % len(self._deserializationQueues)]
+
+    def _deserializationThreadLoop(self, workQueue):
+        # connections whose messages we failed to deserialize. We drop anything
+        # else they send until we see them close.
+        brokenConnIds = set()
+
+        while True:
+            item = workQueue.get()
+
+            if item is None:
+                return
+
+            connId, bytesOrEvent = item
+
+            try:
+                if not isinstance(bytesOrEvent, bytes):
+                    # an event that had to wait for the messages in front of it
+                    brokenConnIds.discard(connId)
+                    self._fireEvent(bytesOrEvent)
+
+                elif connId not in brokenConnIds:
+                    try:
+                        message = self._deserialize(bytesOrEvent)
+                    except Exception:
+                        self._logger.exception("Failed to deserialize a message")
+                        brokenConnIds.add(connId)
+                        self.closeConnection(connId)
+                    else:
+                        self._fireEvent(
+                            self.eventType.IncomingMessage(
+                                connectionId=connId, message=message
+                            )
+                        )
+            finally:
+                with self._lock:
+                    pending = self._connIdToPendingDeserializations[connId] - 1
+
+                    if pending:
+                        self._connIdToPendingDeserializations[connId] = pending
+                    else:
+                        del self._connIdToPendingDeserializations[connId]
+
     def _fireEvent(self, event):
         """Accessed by: the socketThread"""
         self._eventQueue.put(event)
 
+    def _fireConnectionEvent(self, connId, event):
+        """Fire an event about 'connId' behind any of its messages still being deserialized.
+
+        Accessed by: socketThread and shards
+        """
+        with self._lock:
+            pending = self._connIdToPendingDeserializations.get(connId)
+
+            if pending:
+                self._connIdToPendingDeserializations[connId] = pending + 1
+                self._deserializationQueueFor(connId).put((connId, event))
+                return
+
+        self._fireEvent(event)
+
     def _connectTo(self, connId: ConnectionId):
         """Actually form an outgoing connection.
 
@@ -1119,8 +1623,8 @@ class MessageBus(object):
                 if connId in self._messagesForUnconnectedOutgoingConnection:
                     messages = self._messagesForUnconnectedOutgoingConnection.pop(connId)
 
-                    for m in messages:
-                        self._scheduleBytesForWrite(connId, m)
+                    for m, priority in messages:
+                        self._scheduleBytesForWrite(connId, m, priority)
 
                 self._connIdPendingOutgoingConnection.discard(connId)
 
@@ -1194,3 +1698,206 @@ class MessageBus(object):
                     msg()
                 except Exception:
                     self._logger.exception(f"User callback {msg} threw unexpected exception:")
+
+
+class _SocketShard:
+    """One of the threads that read and write a MessageBus's incoming connections.
+
+    Each shard has its own epoll, wake pipe, queue of messages to send and
+    write buffers, and it's the only thread that touches the sockets it owns.
+    """
+
+    def __init__(self, bus, index):
+        self.bus = bus
+        self.index = index
+
+        self.sockets = SocketWatcher()
+        self.wakePipe = os.pipe()
+        self.sockets.addForRead(self.wakePipe[0])
+
+        # (connId, bytes, priority) to write, (connId, TriggerDisconnect) to close a
+        # connection, (socket, TriggerWatch) to start reading a new one, or
+        # Disconnected to stop.
+        self.messagesToSend = BytecountLimitedQueue(MessageBus._bytesPerMsg)
+
+        # socket -> WriteBuffer of bytes that need to be written
+        self.bytesNeedingWrite = {}
+        self.socketsWithSslWantWrite = set()
+
+        # the total size of 'bytesNeedingWrite'
+        self.bytesPendingWrite = 0
+
+        self.thread = threading.Thread(
+            target=self._loop, name=f"MessageBusShard-{index}", daemon=True
+        )
+
+    def put(self, item):
+        """Accessed by: any thread"""
+        # only messages count against the queue's limit, so we never block
+        # the socketThread handing us a connection or a disconnect, and
+        # CONTROL messages never wait for room behind large ones
+        self.messagesToSend.put(
+            item,
+            allowWriteWhileOverLimit=item is Disconnected
+            or item[1] is TriggerWatch
+            or item[1] is TriggerDisconnect
+            or item[2] == PRIORITY_CONTROL,
+        )
+        assert os.write(self.wakePipe[1], b" ") == 1
+
+    def discardPendingWrites(self, sock):
+        """Drop anything we were going to write to 'sock'.
+
+        Accessed by: this shard's thread, under the bus's lock
+        """
+        pending = self.bytesNeedingWrite.pop(sock, None)
+
+        if pending:
+            self.bytesPendingWrite -= len(pending)
+            self.bus.totalBytesPendingInOutputLoop -= len(pending)
+
+    def teardown(self):
+        self.sockets.teardown()
+
+        os.close(self.wakePipe[0])
+        os.close(self.wakePipe[1])
+
+    def _scheduleBytesForWrite(self, connId, msg, priority):
+        """Accessed by: this shard's thread"""
+        bus = self.bus
+
+        sock = bus._connIdToIncomingSocket.get(connId)
+
+        if sock is None or not msg:
+            # the connection closed
+            return
+
+        with bus._lock:
+            writeBuffer = self.bytesNeedingWrite.get(sock)
+
+            if writeBuffer is None:
+                writeBuffer = WriteBuffer(bus.extraMessageSizeCheck)
+                self.bytesNeedingWrite[sock] = writeBuffer
+
+            bytecount = writeBuffer.append(msg, priority)
+
+            bus.totalBytesPendingInOutputLoop += bytecount
+            self.bytesPendingWrite += bytecount
+
+            event = bus._highWaterMarkEvent(connId, writeBuffer)
+
+        if event is not None:
+            bus._fireEvent(event)
+
+    def _handleWakePipe(self):
+        """Accessed by: this shard's thread"""
+        for _ in os.read(self.wakePipe[0], MSG_BUF_SIZE):
+            item = self.messagesToSend.get(timeout=0.0)
+
+            if item is Disconnected:
+                raise MessageBusLoopExit()
+
+            target, msg = item[0], item[1]
+
+            if msg is TriggerWatch:
+                self.sockets.addForRead(target)
+
+            elif msg is TriggerDisconnect:
+                sock = self.bus._connIdToIncomingSocket.get(target)
+
+                if sock is not None:
+                    self.bus._markSocketClosed(sock)
+
+            else:
+                self._scheduleBytesForWrite(target, msg, item[2])
+
+    def _loop(self):
+        bus = self.bus
+
+        t0 = time.time()
+        selectsWithNoUpdate = 0
+
+        while True:
+            try:
+                if time.time() - t0 > 0.01:
+                    t0 = time.time()
+                    selectsWithNoUpdate = 0
+
+                # don't take more messages to send unless we can absorb their bytes
+                canRead = (
+                    self.messagesToSend.maxBytes is None
+                    or self.bytesPendingWrite < self.messagesToSend.maxBytes
+                )
+
+                if canRead:
+                    self.sockets.addForRead(self.wakePipe[0])
+                else:
+                    self.sockets.discardForRead(self.wakePipe[0])
+
+                # if we're just spinning making no progress (say, an SSL socket
+                # that needs to read before it can write), don't bother
+                if selectsWithNoUpdate < 10:
+                    for sock in self.bytesNeedingWrite:
+                        self.sockets.addForWrite(sock)
+                else:
+                    for sock in self.bytesNeedingWrite:
+                        self.sockets.discardForWrite(sock)
+
+                try:
+                    readReady, writeReady = self.sockets.poll(EPOLL_TIMEOUT)
+
+                except ValueError:
+                    # one of the sockets must have failed
+                    failedSockets = self.sockets.gc()
+
+                    if not failedSockets:
+                        raise
+
+                    with bus._lock:
+                        for sock in failedSockets:
+                            self.discardPendingWrites(sock)
+
+                    continue
+
+                didSomething = False
+
+                for sock in readReady:
+                    if sock == self.wakePipe[0]:
+                        if canRead:
+                            self._handleWakePipe()
+                            didSomething = True
+
+                    elif sock in self.sockets:
+                        if bus._readFromSocket(sock, self.socketsWithSslWantWrite):
+                            didSomething = True
+
+                socketsWithSslWantWrite = list(self.socketsWithSslWantWrite)
+                self.socketsWithSslWantWrite.clear()
+
+                for sock in socketsWithSslWantWrite:
+                    self.sockets.discardForWrite(sock)
+                    if bus._handleWriteReadySocket(sock, self):
+                        didSomething = True
+
+                if selectsWithNoUpdate < 10:
+                    for sock in writeReady:
+                        if bus._handleWriteReadySocket(sock, self):
+                            didSomething = True
+
+                if didSomething:
+                    selectsWithNoUpdate = 0
+                else:
+                    selectsWithNoUpdate += 1
+
+            except MessageBusLoopExit:
+                bus._logger.debug(
+                    "Socket shard %s for MessageBus exiting gracefully", self.index
+                )
+                return
+
+            except Exception as e:
+                bus._logger.exception(
+                    f"INFO: MessageBus socket shard {self.index} encountered unexpected "
+                    f"exception (and ignoring): {str(e)}"
+                )
+                time.sleep(1.0)
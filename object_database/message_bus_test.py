@@ -24,7 +24,16 @@ import time
 import unittest
 
 from flaky import flaky
-from object_database.message_bus import MessageBus
+from object_database.message_bus import (
+    CorruptMessageStream,
+    MessageBuffer,
+    MessageBus,
+    MSG_BUF_SIZE,
+    PRIORITY_BULK,
+    PRIORITY_CONTROL,
+    PRIORITY_NORMAL,
+    WriteBuffer,
+)
 from object_database.bytecount_limited_queue import BytecountLimitedQueue
 
 
@@ -46,6 +55,9 @@ def numFds():
 
 
 class TestMessageBus(unittest.TestCase):
+    SOCKET_THREAD_COUNT = 1
+    DESERIALIZATION_THREAD_COUNT = 0
+
     def setUp(self):
         assert os.path.exists(
             "testcert.cert"
@@ -61,6 +73,8 @@ class TestMessageBus(unittest.TestCase):
             "auth_token",
             None,
             "testcert.cert",
+            socketThreadCount=self.SOCKET_THREAD_COUNT,
+            deserializationThreadCount=self.DESERIALIZATION_THREAD_COUNT,
         )
 
         self.messageQueue2 = queue.Queue()
@@ -73,6 +87,8 @@ class TestMessageBus(unittest.TestCase):
             "auth_token",
             None,
             "testcert.cert",
+            socketThreadCount=self.SOCKET_THREAD_COUNT,
+            deserializationThreadCount=self.DESERIALIZATION_THREAD_COUNT,
         )
 
         self.messageBus1.start()
@@ -578,6 +594,68 @@ class TestMessageBus(unittest.TestCase):
 
         thread.join()
 
+    def test_connection_high_water_mark(self):
+        self.messageBus2.setConnectionHighWaterMark(1024 * 1024)
+
+        # a client that connects and then doesn't read anything
+        naked_socket = socket.create_connection(self.messageBus2.listeningEndpoint)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        secure_sock = context.wrap_socket(naked_socket)
+
+        token = "auth_token".encode("utf-8")
+        secure_sock.sendall(
+            struct.pack("i", len(token)) + token + struct.pack("i", len(token))
+        )
+
+        event = self.messageQueue2.get(timeout=TIMEOUT)
+        self.assertTrue(event.matches.NewIncomingConnection)
+        connId = event.connectionId
+
+        # more than the OS will buffer for us
+        for _ in range(200):
+            self.messageBus2.sendMessage(connId, " " * 100000)
+
+        event = self.messageQueue2.get(timeout=TIMEOUT)
+        self.assertTrue(event.matches.ConnectionBackedUp)
+        self.assertEqual(event.connectionId, connId)
+        self.assertGreaterEqual(event.pendingBytes, 1024 * 1024)
+        self.assertGreater(self.messageBus2.pendingBytecount(connId), 0)
+
+        # once the client reads, the connection drains
+        secure_sock.settimeout(TIMEOUT)
+
+        t0 = time.time()
+        while self.messageQueue2.empty() and time.time() - t0 < TIMEOUT:
+            secure_sock.recv(MSG_BUF_SIZE)
+
+        event = self.messageQueue2.get(timeout=TIMEOUT)
+        self.assertTrue(event.matches.ConnectionDrained)
+        self.assertEqual(event.connectionId, connId)
+        self.assertLessEqual(self.messageBus2.pendingBytecount(connId), 512 * 1024)
+
+        secure_sock.close()
+
+    def test_mixed_size_messages_arrive_in_order(self):
+        conn1 = self.messageBus1.connect(("localhost", 8001))
+
+        # big enough to deserialize off the socket thread, if we're doing that
+        messages = [str(i) * (100000 if i % 7 == 0 else 1) for i in range(100)]
+
+        for m in messages:
+            self.messageBus1.sendMessage(conn1, m)
+
+        assert self.messageQueue2.get(timeout=TIMEOUT).matches.NewIncomingConnection
+
+        for m in messages:
+            self.assertEqual(self.messageQueue2.get(timeout=TIMEOUT).message, m)
+
+        self.messageBus1.closeConnection(conn1)
+
+        # the close comes after every message
+        assert self.messageQueue2.get(timeout=TIMEOUT).matches.IncomingConnectionClosed
+
     @flaky(max_runs=30, min_passes=30)
     def test_connect_send(self):
         """connect and immediately send: the send should never
@@ -591,3 +669,163 @@ class TestMessageBus(unittest.TestCase):
         msg = self.messageQueue2.get()
         assert msg.matches.IncomingMessage
         assert msg.message == "asdf"
+
+
+class TestMessageBusWithSocketShards(TestMessageBus):
+    SOCKET_THREAD_COUNT = 4
+
+
+class TestMessageBusWithDeserializationThreads(TestMessageBus):
+    DESERIALIZATION_THREAD_COUNT = 4
+
+
+class TestMessageBuffer(unittest.TestCase):
+    def feed(self, buffer, stream, chunkSize):
+        messages = []
+        for i in range(0, len(stream), chunkSize):
+            messages.extend(buffer.write(stream[i : i + chunkSize]))
+        return messages
+
+    def test_split_messages(self):
+        for extraMessageSizeCheck in [False, True]:
+            messages = [b"x" * (i % 37) for i in range(1000)]
+            stream = b"".join(MessageBuffer.encode(m, extraMessageSizeCheck) for m in messages)
+
+            for chunkSize in [1, 3, 100, len(stream)]:
+                buffer = MessageBuffer(extraMessageSizeCheck)
+
+                self.assertEqual(self.feed(buffer, stream, chunkSize), messages)
+                self.assertEqual(buffer.pendingBytecount(), 0)
+                self.assertEqual(buffer.messagesEver, len(messages))
+
+    def test_corrupt_size_check(self):
+        buffer = MessageBuffer(True)
+
+        with self.assertRaises(CorruptMessageStream):
+            buffer.write(struct.pack("i", 3) + b"abc" + struct.pack("i", 4))
+
+    def test_throughput(self):
+        # a flood of small messages, like heartbeats and TransactionResults
+        smallStream = b"".join(MessageBuffer.encode(b"x" * 20, False) for _ in range(100000))
+
+        t0 = time.time()
+        messages = self.feed(MessageBuffer(False), smallStream, MSG_BUF_SIZE)
+        smallElapsed = time.time() - t0
+
+        self.assertEqual(len(messages), 100000)
+
+        # a few large frames, like big SubscriptionData messages
+        largeStream = b"".join(
+            MessageBuffer.encode(b"y" * 8 * 1024 * 1024, False) for _ in range(4)
+        )
+
+        t0 = time.time()
+        messages = self.feed(MessageBuffer(False), largeStream, MSG_BUF_SIZE)
+        largeElapsed = time.time() - t0
+
+        self.assertEqual(len(messages), 4)
+
+        print(
+            f"MessageBuffer: 100000 small messages in {smallElapsed:.3f}s, "
+            f"32MB of large frames in {largeElapsed:.3f}s"
+        )
+
+
+class TestWriteBuffer(unittest.TestCase):
+    def drain(self, writeBuffer, maxBytes=None):
+        """Write 'writeBuffer' through a socketpair and return what arrived."""
+        writer, reader = socket.socketpair()
+        writer.setblocking(False)
+        received = bytearray()
+
+        try:
+            while writeBuffer:
+                try:
+                    written = WriteBuffer.send(writer, writeBuffer.peek(maxBytes=maxBytes))
+                    writeBuffer.consume(written)
+                except BlockingIOError:
+                    pass
+
+                received.extend(reader.recv(MSG_BUF_SIZE))
+
+            writer.close()
+
+            while True:
+                data = reader.recv(MSG_BUF_SIZE)
+                if not data:
+                    return bytes(received)
+                received.extend(data)
+        finally:
+            writer.close()
+            reader.close()
+
+    def test_matches_message_buffer_encoding(self):
+        for extraMessageSizeCheck in [False, True]:
+            messages = [b"x" * (i % 37) for i in range(1000)] + [b"y" * 1000000, b"z"]
+
+            for maxBytes in [None, 1000]:
+                writeBuffer = WriteBuffer(extraMessageSizeCheck)
+
+                for m in messages:
+                    writeBuffer.append(m)
+
+                self.assertEqual(
+                    self.drain(writeBuffer, maxBytes),
+                    b"".join(MessageBuffer.encode(m, extraMessageSizeCheck) for m in messages),
+                )
+                self.assertEqual(len(writeBuffer), 0)
+
+    def test_large_messages_are_not_copied(self):
+        msg = b"x" * 1000000
+
+        writeBuffer1 = WriteBuffer(False)
+        writeBuffer2 = WriteBuffer(False)
+
+        writeBuffer1.append(msg)
+        writeBuffer2.append(msg)
+
+        self.assertIs(writeBuffer1.peek()[1], msg)
+        self.assertIs(writeBuffer2.peek()[1], msg)
+
+        # a partial write leaves a view onto the original buffer
+        writeBuffer1.consume(10)
+        self.assertIs(writeBuffer1.peek()[0].obj, msg)
+        self.assertEqual(len(writeBuffer1), len(msg) - 6)
+
+    def test_control_messages_overtake_bulk_messages(self):
+        writeBuffer = WriteBuffer(False)
+
+        bulk = [bytes([i]) * 300000 for i in range(3)]
+
+        for m in bulk:
+            writeBuffer.append(m, PRIORITY_BULK)
+
+        writeBuffer.append(b"control", PRIORITY_CONTROL)
+
+        # a NORMAL message doesn't get ahead of anything, and nothing gets ahead of it
+        writeBuffer.append(b"bulk", PRIORITY_BULK)
+        writeBuffer.append(b"normal", PRIORITY_NORMAL)
+        writeBuffer.append(b"control2", PRIORITY_CONTROL)
+
+        self.assertEqual(
+            MessageBuffer(False).write(self.drain(writeBuffer)),
+            [b"control"] + bulk + [b"bulk", b"normal", b"control2"],
+        )
+
+    def test_control_messages_wait_for_message_boundaries(self):
+        writeBuffer = WriteBuffer(False)
+
+        writeBuffer.append(b"x" * 1000000, PRIORITY_BULK)
+        writeBuffer.append(b"y" * 1000000, PRIORITY_BULK)
+
+        # start writing the first message
+        writeBuffer.peek()
+        writeBuffer.consume(100)
+
+        writeBuffer.append(b"control", PRIORITY_CONTROL)
+
+        messages = MessageBuffer(False).write(
+            struct.pack("i", 1000000) + b"x" * 96 + self.drain(writeBuffer)
+        )
+
+        self.assertEqual(messages, [b"x" * 1000000, b"control", b"y" * 1000000])
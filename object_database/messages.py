@@ -1,4 +1,4 @@
-from typed_python import OneOf, Alternative, ConstDict, TupleOf, Tuple
+from typed_python import OneOf, Alternative, ConstDict, TupleOf, Tuple, serialize, deserialize
 from object_database.schema import (
     SchemaDefinition,
     ObjectId,
@@ -37,6 +37,9 @@ def MessageToStr(msg):
     if hasattr(msg, "writes"):
         fields["writes"] = f"#{len(msg.writes)}"
 
+    if hasattr(msg, "field_operations") and msg.field_operations:
+        fields["field_operations"] = f"#{len(msg.field_operations)}"
+
     if hasattr(msg, "set_adds"):
         fields["set_adds"] = f"#{len(msg.set_adds)}"
 
@@ -79,6 +82,71 @@ def MessageToStr(msg):
     return type(msg).__name__ + "(" + ", ".join([f"{k}={v}" for k, v in fields.items()]) + ")"
 
 
+# an operation the server applies to a field's current value when it commits a
+# transaction. The client doesn't read the field to produce these, so they
+# don't conflict with each other. Numeric operations are only valid on int and
+# float fields, set operations on TupleOf fields, whose elements are kept
+# unique, and Append on str, bytes and TupleOf fields.
+FieldOperation = Alternative(
+    "FieldOperation",
+    Increment={"amount": OneOf(int, float)},
+    Max={"value": OneOf(int, float)},
+    Min={"value": OneOf(int, float)},
+    SetInsert={"values": OneOf(TupleOf(int), TupleOf(float), TupleOf(str), TupleOf(bytes))},
+    SetRemove={"values": OneOf(TupleOf(int), TupleOf(float), TupleOf(str), TupleOf(bytes))},
+    Append={
+        "suffix": OneOf(str, bytes, TupleOf(int), TupleOf(float), TupleOf(str), TupleOf(bytes))
+    },
+)
+
+
+def applyFieldOperation(value, op):
+    """Apply a FieldOperation to a serialized field value.
+
+    Each operation is carried out in the type of its operand, which the client
+    chooses to match the field's type.
+
+    Returns:
+        the new serialized value of the field.
+    """
+    if op.matches.Increment or op.matches.Max or op.matches.Min:
+        operand = op.amount if op.matches.Increment else op.value
+        valueType = type(operand)
+        current = deserialize(valueType, value)
+
+        if op.matches.Increment:
+            return serialize(valueType, current + operand)
+        if op.matches.Max:
+            return serialize(valueType, max(current, operand))
+        return serialize(valueType, min(current, operand))
+
+    if op.matches.Append:
+        valueType = type(op.suffix)
+        current = deserialize(valueType, value)
+
+        if valueType in (str, bytes):
+            return serialize(valueType, current + op.suffix)
+
+        return serialize(valueType, valueType(list(current) + list(op.suffix)))
+
+    valueType = type(op.values)
+    current = deserialize(valueType, value)
+
+    if op.matches.SetInsert:
+        result = list(current)
+        seen = set(result)
+
+        for v in op.values:
+            if v not in seen:
+                seen.add(v)
+                result.append(v)
+    else:
+        toRemove = set(op.values)
+        result = [v for v in current if v not in toRemove]
+
+    return serialize(valueType, valueType(result))
+
+
 ClientToServer = Alternative(
     "ClientToServer",
     # start a transaction. the 'transaction_guid' identifies the transaction
@@ -89,6 +157,8 @@ ClientToServer = Alternative(
     # this transaction, and which must not have changed for this transaction to be
     # accepted, and 'index_versions' provides the same thing for the indices whose
     # states we read.
+    # 'field_operations' are applied in order to each field's value after 'writes',
+    # and the results are written as if the client had written them.
     # this can come in chunks, to prevent messages getting too large.
     TransactionData={
         "writes": ConstDict(ObjectFieldId, OneOf(None, bytes)),
@@ -98,6 +168,7 @@ ClientToServer = Alternative(
         "index_versions": TupleOf(IndexId),
         "transaction_guid": int,
         "prerequisites": ConstDict(ObjectFieldId, OneOf(None, bytes)),
+        "field_operations": ConstDict(ObjectFieldId, TupleOf(FieldOperation)),
     },
     # indicate that a transaction is complete. 'as_of_version' specifies the
     # transaction id that this was based off of.
@@ -134,6 +205,16 @@ ClientToServer = Alternative(
         "fieldname_and_value": OneOf(None, Tuple(str, IndexValue)),
         # load values when we first request them, instead of blocking on all the data.
         "isLazy": bool,
+        # if not None, only send us these fields of each object (and ' exists').
+        "fields": OneOf(None, TupleOf(str)),
+    },
+    # end a subscription made with 'Subscribe'. The server stops sending us updates
+    # for objects that are no longer covered by any of our other subscriptions and
+    # responds with an UnsubscribeComplete listing them.
+    Unsubscribe={
+        "schema": str,
+        "typename": str,
+        "fieldname_and_value": OneOf(None, Tuple(str, IndexValue)),
     },
     # send a round-trip message to the server. The server will respond with a FlushResponse.
     Flush={"guid": int},
@@ -147,6 +228,36 @@ ClientToServer = Alternative(
     # indicate that we may be getting new objects for this type
     # even if we have not subscribed to any indices.
     SubscribeNone={"schema": str, "typename": str},
+    # stream every transaction committed after 'from_transaction_id' that touches
+    # the given schema (and optionally type and fields) as ChangeData messages,
+    # without subscribing to the objects themselves. 'server_epoch' is the epoch
+    # (from Initialize) of the server run 'from_transaction_id' belongs to. The
+    # server stops sending once 'window' of them are unacknowledged.
+    # 'subscription_guid' is ours to choose.
+    SubscribeChanges={
+        "subscription_guid": int,
+        "schema": str,
+        "typename": OneOf(None, str),
+        "fields": OneOf(None, TupleOf(str)),
+        "server_epoch": str,
+        "from_transaction_id": int,
+        "window": int,
+    },
+    # indicate we've processed every ChangeData up to and including 'transaction_id'.
+    AcknowledgeChanges={"subscription_guid": int, "transaction_id": int},
+    # stop a stream started with SubscribeChanges.
+    UnsubscribeChanges={"subscription_guid": int},
+    # after reconnecting, ask to pick our type subscriptions back up where we left
+    # off. 'server_epoch' is the one from the Initialize of our last connection,
+    # and 'transaction_id' the last transaction we applied. 'types' holds the
+    # (schema, typename, fields) of each subscription. If the server still has
+    # every transaction since then, it subscribes us and sends us those
+    # transactions. Either way it responds with SubscriptionsResumed.
+    ResumeSubscriptions={
+        "server_epoch": str,
+        "transaction_id": int,
+        "types": TupleOf(Tuple(str, str, OneOf(None, TupleOf(str)))),
+    },
     __str__=MessageToStr,
 )
 
@@ -155,8 +266,15 @@ ServerToClient = Alternative(
     "ServerToClient",
     # initialize the connection. transaction_num indicates the current transaction ID.
     # connIdentity tells us what our own connectionObject's identity is. identity_root
-    # provides a block of object ids for us to allocate from.
-    Initialize={"transaction_num": int, "connIdentity": ObjectId, "identity_root": int},
+    # provides a block of object ids for us to allocate from. server_epoch changes
+    # every time the server starts (transaction ids start over when it does), and
+    # is empty if we can't resume subscriptions on this server.
+    Initialize={
+        "transaction_num": int,
+        "connIdentity": ObjectId,
+        "identity_root": int,
+        "server_epoch": str,
+    },
     # indicate whether a transaction was successful or not. If not, provide the reason
     TransactionResult={
         "transaction_guid": int,
@@ -212,17 +330,49 @@ ServerToClient = Alternative(
         "identities": TupleOf(ObjectId),
         "transaction_id": int,
     },
+    # respond to an Unsubscribe. 'writes' names every field of the objects that have
+    # left our scope, which the client forgets, and 'set_removes' the indices they're
+    # in, which it takes them out of as of 'tid', the current transaction id. Objects
+    # still covered by another subscription aren't mentioned.
+    UnsubscribeComplete={
+        "schema": str,
+        "typename": str,
+        "fieldname_and_value": OneOf(None, Tuple(str, IndexValue)),
+        "writes": ConstDict(ObjectFieldId, OneOf(None, bytes)),
+        "set_removes": ConstDict(IndexId, TupleOf(ObjectId)),
+        "tid": int,
+    },
     # we've been disconnected.
     Disconnected={},
     # receive some transaction data. We may not be subscribed to all fields
-    # in this transaction
+    # in this transaction. 'field_operations' are appends to fields we already
+    # hold the value of: we get the new value by applying them to our copy
+    # rather than from 'writes'.
     Transaction={
         "writes": ConstDict(ObjectFieldId, OneOf(None, bytes)),
         "set_adds": ConstDict(IndexId, TupleOf(ObjectId)),
         "set_removes": ConstDict(IndexId, TupleOf(ObjectId)),
         "transaction_id": int,
+        "field_operations": ConstDict(ObjectFieldId, TupleOf(FieldOperation)),
     },
     # respond with a dependent connection id.
     DependentConnectionId={"guid": str, "connIdentity": ObjectId, "identity_root": int},
+    # one transaction on a stream started with SubscribeChanges, cut down to
+    # the schema, type and fields it asked for.
+    ChangeData={
+        "subscription_guid": int,
+        "transaction_id": int,
+        "writes": ConstDict(ObjectFieldId, OneOf(None, bytes)),
+        "set_adds": ConstDict(IndexId, TupleOf(ObjectId)),
+        "set_removes": ConstDict(IndexId, TupleOf(ObjectId)),
+    },
+    # the server can't (or can no longer) stream the changes a SubscribeChanges
+    # asked for, for instance because they're older than the server retains.
+    # The stream is over.
+    ChangesUnavailable={"subscription_guid": int, "reason": str},
+    # respond to ResumeSubscriptions. If 'resumed', we're subscribed again and
+    # have been sent every transaction up to 'tid'. Otherwise nothing changed
+    # and the client has to subscribe from scratch.
+    SubscriptionsResumed={"resumed": bool, "tid": int},
     __str__=MessageToStr,
 )
@@ -13,22 +13,109 @@
 #   limitations under the License.
 
 import redis
+import collections
+import mmap
+import os
+import queue
+import struct
 import time
 import threading
 import logging
+import zlib
 
 from object_database.schema import ObjectFieldId, IndexId, FieldId, IndexValue
-from typed_python import serialize, deserialize, OneOf
+from typed_python import serialize, deserialize, ConstDict, NamedTuple, OneOf, TupleOf
 
 KeyType = OneOf(ObjectFieldId, IndexId, FieldId, "identityRoot", "types")
 
 SetValue = OneOf(int, bytes)
 
+# where a MemoryMappedPersistence wrote a large value
+BlobRef = NamedTuple(segment=int, offset=int, length=int)
+
+StoredValue = OneOf(bytes, BlobRef)
+
+# one 'setSeveral' in a WriteAheadLogPersistence log file
+LogRecord = NamedTuple(
+    writes=ConstDict(KeyType, OneOf(None, StoredValue)),
+    setAdds=ConstDict(KeyType, TupleOf(SetValue)),
+    setRemoves=ConstDict(KeyType, TupleOf(SetValue)),
+)
+
+# the full contents of a WriteAheadLogPersistence
+SnapshotRecord = NamedTuple(
+    values=ConstDict(KeyType, StoredValue), sets=ConstDict(KeyType, TupleOf(SetValue))
+)
+
+# each record in a log or snapshot file is preceded by its length and crc32
+_RECORD_HEADER = struct.Struct("<QI")
+
+DEFAULT_SNAPSHOT_LOG_BYTES = 64 * 1024 * 1024
+DEFAULT_LARGE_VALUE_BYTES = 4096
+DEFAULT_SEGMENT_BYTES = 256 * 1024 * 1024
+
+# rough per-key cost of a cache entry beyond its payload, and of each set member
+_CACHE_ENTRY_OVERHEAD_BYTES = 128
+_CACHE_SET_MEMBER_BYTES = 64
+
+
+class PersistenceSnapshot(object):
+    """A read-only view of a persistence object as of the moment it was taken.
+
+    This is copy-on-write: while the snapshot is live, the persistence object
+    hands it the old value of each value-style key just before overwriting it
+    for the first time. Reads prefer those values and otherwise fall through
+    to the live store. Set-style keys aren't captured.
+
+    Call 'release' once finished so the store stops copying values for us.
+    """
+
+    def __init__(self, store):
+        self._store = store
+        self._priorValues = {}
+
+    def _preserve(self, keys):
+        # called by the store, holding its lock, before it writes to 'keys'
+        keys = [k for k in keys if k not in self._priorValues]
+
+        if keys:
+            for key, value in zip(keys, self._store.getSeveral(keys)):
+                self._priorValues[key] = value
+
+    def get(self, key):
+        return self.getSeveral([key])[0]
+
+    def getSeveral(self, keys):
+        with self._store.lock:
+            values = self._store.getSeveral(keys)
+
+            return [
+                self._priorValues[k] if k in self._priorValues else v
+                for k, v in zip(keys, values)
+            ]
+
+    def release(self):
+        with self._store.lock:
+            self._store._snapshots.discard(self)
+            self._priorValues = {}
+
 
 class InMemoryPersistence(object):
     def __init__(self, db=0):
         self.values = {}
         self.lock = threading.RLock()
+        self._snapshots = set()
+
+        # if not None, the value each key had before the current batch first
+        # wrote to it (None if it had none), so that a subclass can undo the batch.
+        self._batchPriorValues = None
+
+    def snapshot(self):
+        """Return a PersistenceSnapshot of the current values in the store."""
+        with self.lock:
+            snapshot = PersistenceSnapshot(self)
+            self._snapshots.add(snapshot)
+            return snapshot
 
     def get(self, key):
         with self.lock:
@@ -45,12 +132,25 @@ class InMemoryPersistence(object):
             return val
 
     def set(self, key, value):
+        self._set(key, value)
+
+    def _recordPriorValue(self, key):
+        if self._batchPriorValues is not None and key not in self._batchPriorValues:
+            value = self.values.get(key)
+            self._batchPriorValues[key] = set(value) if isinstance(value, set) else value
+
+    def _set(self, key, value):
         if not isinstance(key, str) and key.isIndexValue and value is not None:
             value = serialize(IndexValue, value, None)
 
         assert isinstance(value, bytes) or value is None, (key, value)
 
         with self.lock:
+            self._recordPriorValue(key)
+
+            for snapshot in self._snapshots:
+                snapshot._preserve([key])
+
             if value is None:
                 if key in self.values:
                     del self.values[key]
@@ -62,6 +162,8 @@ class InMemoryPersistence(object):
             return
 
         with self.lock:
+            self._recordPriorValue(key)
+
             if key not in self.values:
                 self.values[key] = set()
             for value in values:
@@ -73,6 +175,8 @@ class InMemoryPersistence(object):
             return
 
         with self.lock:
+            self._recordPriorValue(key)
+
             if values:
                 assert self.values.get(key, set())
 
@@ -119,7 +223,7 @@ class InMemoryPersistence(object):
                 )
 
             for k, v in kvs.items():
-                self.set(k, v)
+                self._set(k, v)
 
             if adds:
                 for k, to_add in adds.items():
@@ -135,18 +239,725 @@ class InMemoryPersistence(object):
 
         return new_sets, dropped_sets
 
+    def beginBatch(self):
+        """Start a group of 'setSeveral' calls that may be written out together.
+
+        We have no backing store to write to, so this is a no-op.
+        """
+
+    def commitBatch(self):
+        """Finish a group of writes started by 'beginBatch'.
+
+        If this raises, none of the batch's writes took effect.
+        """
+
     def exists(self, key):
         with self.lock:
             return key in self.values
 
+    def pin(self, key):
+        """Ask the store to keep 'key' in memory until a matching 'unpin'.
+
+        Everything we hold is always in memory, so this is a no-op.
+        """
+
+    def unpin(self, key):
+        """Undo one call to 'pin'."""
+
+    def warmCache(self, threadCount=4, batchSize=1000, priority=None, onProgress=None):
+        """Load the backing store into memory ahead of time.
+
+        Everything we hold is always in memory, so this is a no-op.
+
+        Returns:
+            the number of keys loaded.
+        """
+        return 0
+
     def delete(self, key):
         with self.lock:
+            self._recordPriorValue(key)
+
+            for snapshot in self._snapshots:
+                snapshot._preserve([key])
+
             if key in self.values:
                 del self.values[key]
 
 
+class WriteAheadLogPersistence(InMemoryPersistence):
+    """An InMemoryPersistence that keeps its state in a directory on local disk.
+
+    Every write is appended to a log file in 'walDir' (and fsynced, unless
+    'fsync' is False) before we return. Inside of 'beginBatch' we only fsync
+    once, in 'commitBatch'. If that fails, we put back the values the batch
+    overwrote and cut its records off the end of the log.
+
+    Once a log holds more than 'snapshotLogBytes' we start a new one and write
+    a snapshot of everything in the background, after which we can delete the
+    older files. Starting up costs loading the latest snapshot and replaying
+    the logs written since.
+
+    Files are named 'snapshot-N' and 'log-N'. 'snapshot-N' holds the state as
+    of the start of 'log-N'.
+    """
+
+    SNAPSHOT_PREFIX = "snapshot-"
+    LOG_PREFIX = "log-"
+
+    def __init__(self, walDir, fsync=True, snapshotLogBytes=DEFAULT_SNAPSHOT_LOG_BYTES):
+        super().__init__()
+
+        self.walDir = walDir
+        self.snapshotLogBytes = snapshotLogBytes
+        self._fsync = fsync
+        self._inBatch = False
+        # where the log ended when the current batch began
+        self._batchLogOffset = None
+        self._snapshotThread = None
+        self._logger = logging.getLogger(__name__)
+
+        os.makedirs(walDir, exist_ok=True)
+
+        self._generation = self._recover()
+        self._logFile = self._openLog()
+
+    def _openLog(self):
+        # unbuffered, so that a failed batch can't leave its records in a buffer
+        # that gets flushed after we truncate them away
+        return open(self._path(self.LOG_PREFIX, self._generation), "ab", buffering=0)
+
+    def _path(self, prefix, generation):
+        return os.path.join(self.walDir, prefix + str(generation))
+
+    def _generations(self, prefix):
+        res = []
+
+        for name in os.listdir(self.walDir):
+            if name.startswith(prefix) and name[len(prefix) :].isdigit():
+                res.append(int(name[len(prefix) :]))
+
+        return sorted(res)
+
+    def _recover(self):
+        """Load the latest snapshot and replay the logs after it.
+
+        Returns:
+            the generation of the newest log, which we'll append to.
+        """
+        t0 = time.time()
+
+        snapshots = self._generations(self.SNAPSHOT_PREFIX)
+        generation = snapshots[-1] if snapshots else 0
+
+        if snapshots:
+            with open(self._path(self.SNAPSHOT_PREFIX, generation), "rb") as f:
+                self._loadSnapshot(
+                    deserialize(SnapshotRecord, self._readRecords(f, "snapshot")[0])
+                )
+
+        logs = [g for g in self._generations(self.LOG_PREFIX) if g >= generation]
+
+        recordCount = 0
+        for logGeneration in logs:
+            with open(self._path(self.LOG_PREFIX, logGeneration), "r+b") as f:
+                for payload in self._readRecords(f, "log"):
+                    record = deserialize(LogRecord, payload)
+
+                    InMemoryPersistence.setSeveral(
+                        self, record.writes, record.setAdds, record.setRemoves
+                    )
+                    recordCount += 1
+
+        self._removeGenerationsBefore(generation)
+
+        self._logger.info(
+            "Loaded %s keys from %s: snapshot %s and %s log records in %.2f seconds",
+            len(self.values),
+            self.walDir,
+            generation if snapshots else None,
+            recordCount,
+            time.time() - t0,
+        )
+
+        return max([generation] + logs)
+
+    def _loadSnapshot(self, snapshot):
+        for key, value in snapshot.values.items():
+            self.values[key] = value
+        for key, members in snapshot.sets.items():
+            self.values[key] = set(members)
+
+    def _readRecords(self, f, kind):
+        """Read the records in 'f', dropping (and truncating) any torn write at the end."""
+        records = []
+        goodBytes = 0
+
+        while True:
+            header = f.read(_RECORD_HEADER.size)
+
+            if not header:
+                break
+
+            if len(header) == _RECORD_HEADER.size:
+                length, crc = _RECORD_HEADER.unpack(header)
+                payload = f.read(length)
+
+                if len(payload) == length and zlib.crc32(payload) == crc:
+                    records.append(payload)
+                    goodBytes += _RECORD_HEADER.size + length
+                    continue
+
+            self._logger.warning(
+                "Discarding a partially written record at byte %s of %s %s",
+                goodBytes,
+                kind,
+                f.name,
+            )
+            f.truncate(goodBytes)
+            break
+
+        return records
+
+    def _removeGenerationsBefore(self, generation):
+        for prefix in [self.SNAPSHOT_PREFIX, self.LOG_PREFIX]:
+            for g in self._generations(prefix):
+                if g < generation:
+                    os.remove(self._path(prefix, g))
+
+    def _writeRecord(self, f, payload):
+        f.write(_RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+
+    def _sync(self):
+        self._logFile.flush()
+
+        if self._fsync:
+            os.fsync(self._logFile.fileno())
+
+    def _appendToLog(self, kvs, adds, removes):
+        record = LogRecord(
+            writes=kvs,
+            setAdds={k: tuple(v) for k, v in (adds or {}).items() if v},
+            setRemoves={k: tuple(v) for k, v in (removes or {}).items() if v},
+        )
+
+        self._writeRecord(self._logFile, serialize(LogRecord, record))
+
+        if not self._inBatch:
+            self._sync()
+
+            if self._logFile.tell() >= self.snapshotLogBytes:
+                self._startSnapshot()
+
+    def _startSnapshot(self):
+        # must be called with the lock held and the log synced.
+        if self._snapshotThread is not None:
+            return
+
+        self._logFile.close()
+        self._generation += 1
+        self._logFile = self._openLog()
+
+        # sets get modified in place, so copy them. Everything else is immutable.
+        values = {k: set(v) if isinstance(v, set) else v for k, v in self.values.items()}
+
+        self._snapshotThread = threading.Thread(
+            target=self._writeSnapshot, args=(self._generation, values), daemon=True
+        )
+        self._snapshotThread.start()
+
+    def _writeSnapshot(self, generation, values):
+        try:
+            t0 = time.time()
+
+            snapshot = SnapshotRecord(
+                values={k: v for k, v in values.items() if not isinstance(v, set)},
+                sets={k: tuple(v) for k, v in values.items() if isinstance(v, set)},
+            )
+
+            path = self._path(self.SNAPSHOT_PREFIX, generation)
+
+            with open(path + ".tmp", "wb") as f:
+                self._writeRecord(f, serialize(SnapshotRecord, snapshot))
+                f.flush()
+                os.fsync(f.fileno())
+
+            os.rename(path + ".tmp", path)
+
+            self._removeGenerationsBefore(generation)
+
+            self._logger.info(
+                "Wrote a snapshot of %s keys to %s in %.2f seconds",
+                len(values),
+                path,
+                time.time() - t0,
+            )
+        except Exception:
+            self._logger.exception("Failed to write a snapshot to %s:", self.walDir)
+        finally:
+            with self.lock:
+                self._snapshotThread = None
+
+    def snapshotNow(self):
+        """Write a snapshot and start a new log, blocking until the snapshot is on disk."""
+        with self.lock:
+            thread = self._snapshotThread
+
+        if thread is not None:
+            thread.join()
+
+        with self.lock:
+            self._sync()
+            self._startSnapshot()
+            thread = self._snapshotThread
+
+        thread.join()
+
+    def close(self):
+        with self.lock:
+            thread = self._snapshotThread
+
+        if thread is not None:
+            thread.join()
+
+        with self.lock:
+            self._sync()
+            self._logFile.close()
+
+    def beginBatch(self):
+        with self.lock:
+            assert not self._inBatch, "Batches can't be nested"
+            self._inBatch = True
+            self._batchLogOffset = self._logFile.tell()
+            self._batchPriorValues = {}
+
+    def commitBatch(self):
+        with self.lock:
+            self._inBatch = False
+            priorValues, self._batchPriorValues = self._batchPriorValues, None
+
+            try:
+                self._sync()
+            except Exception:
+                self._abandonBatch(priorValues)
+                raise
+
+            if self._logFile.tell() >= self.snapshotLogBytes:
+                self._startSnapshot()
+
+    def _abandonBatch(self, priorValues):
+        for key, value in priorValues.items():
+            self._restoreValue(key, value)
+
+        try:
+            os.ftruncate(self._logFile.fileno(), self._batchLogOffset)
+            self._logFile.seek(self._batchLogOffset)
+        except Exception:
+            self._logger.exception(
+                "Failed to drop an uncommitted batch from %s. Its writes will "
+                "reappear when we next load it.",
+                self._logFile.name,
+            )
+
+    def _restoreValue(self, key, value):
+        if value is None:
+            self.values.pop(key, None)
+        else:
+            self.values[key] = value
+
+    def set(self, key, value):
+        with self.lock:
+            super().set(key, value)
+            self._appendToLog({key: value}, None, None)
+
+    def setSeveral(self, kvs, adds=None, removes=None):
+        with self.lock:
+            res = super().setSeveral(kvs, adds, removes)
+            self._appendToLog(kvs, adds, removes)
+            return res
+
+    def delete(self, key):
+        with self.lock:
+            super().delete(key)
+            self._appendToLog({key: None}, None, None)
+
+
+class MemoryMappedPersistence(WriteAheadLogPersistence):
+    """A WriteAheadLogPersistence that keeps large values out of memory.
+
+    Sets and values smaller than 'largeValueBytes' are held in memory as
+    usual. Larger values are appended to 'values-N' segment files in 'walDir'.
+    We read them through a memory map, so they're only paged in when somebody
+    asks for them. The log and snapshots refer to them by their location.
+
+    When we write a snapshot, we move the live values out of any segment that
+    is mostly garbage, and delete the segment once the snapshot is on disk.
+    """
+
+    SEGMENT_PREFIX = "values-"
+
+    def __init__(
+        self,
+        walDir,
+        fsync=True,
+        snapshotLogBytes=DEFAULT_SNAPSHOT_LOG_BYTES,
+        largeValueBytes=DEFAULT_LARGE_VALUE_BYTES,
+        segmentBytes=DEFAULT_SEGMENT_BYTES,
+    ):
+        os.makedirs(walDir, exist_ok=True)
+
+        self.walDir = walDir
+        self.largeValueBytes = largeValueBytes
+        self.segmentBytes = segmentBytes
+
+        # segment -> bytes in it still referred to by a key
+        self._segmentLiveBytes = {}
+        # segment -> size of the segment file
+        self._segmentSizes = {}
+        # segment -> the mmap we read it through
+        self._maps = {}
+        # snapshot generation -> segments we can delete once it's on disk
+        self._segmentsRetiredAt = {}
+
+        for segment in self._generations(self.SEGMENT_PREFIX):
+            self._segmentSizes[segment] = os.path.getsize(
+                self._path(self.SEGMENT_PREFIX, segment)
+            )
+
+        # always start a fresh segment, so we never append after a torn write
+        self._activeSegment = max(self._segmentSizes, default=-1) + 1
+        self._activeFile = open(self._path(self.SEGMENT_PREFIX, self._activeSegment), "ab")
+        self._segmentSizes[self._activeSegment] = 0
+
+        super().__init__(walDir, fsync=fsync, snapshotLogBytes=snapshotLogBytes)
+
+        for segment in list(self._segmentSizes):
+            if segment != self._activeSegment and not self._segmentLiveBytes.get(segment):
+                self._deleteSegment(segment)
+
+    def _loadSnapshot(self, snapshot):
+        super()._loadSnapshot(snapshot)
+
+        # the snapshot doesn't record how much of each segment is live. We need
+        # the counts before replaying the logs, which release the values they overwrite.
+        for value in snapshot.values.values():
+            if isinstance(value, BlobRef):
+                self._segmentLiveBytes[value.segment] = (
+                    self._segmentLiveBytes.get(value.segment, 0) + value.length
+                )
+
+    def _deleteSegment(self, segment):
+        self._segmentSizes.pop(segment, None)
+        self._segmentLiveBytes.pop(segment, None)
+
+        # anybody still holding a buffer into the map keeps it alive
+        self._maps.pop(segment, None)
+
+        os.remove(self._path(self.SEGMENT_PREFIX, segment))
+
+    def _writeBlob(self, value):
+        size = self._segmentSizes[self._activeSegment]
+
+        if size and size + len(value) > self.segmentBytes:
+            self._activeFile.flush()
+            os.fsync(self._activeFile.fileno())
+            self._activeFile.close()
+
+            self._activeSegment += 1
+            self._activeFile = open(self._path(self.SEGMENT_PREFIX, self._activeSegment), "ab")
+            self._segmentSizes[self._activeSegment] = size = 0
+
+        self._activeFile.write(value)
+        self._segmentSizes[self._activeSegment] = size + len(value)
+
+        return BlobRef(segment=self._activeSegment, offset=size, length=len(value))
+
+    def _blobBuffer(self, ref):
+        m = self._maps.get(ref.segment)
+
+        if m is None or len(m) < ref.offset + ref.length:
+            if ref.segment == self._activeSegment:
+                self._activeFile.flush()
+
+            with open(self._path(self.SEGMENT_PREFIX, ref.segment), "rb") as f:
+                m = self._maps[ref.segment] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        return memoryview(m)[ref.offset : ref.offset + ref.length]
+
+    def _releaseBlob(self, value):
+        if isinstance(value, BlobRef):
+            self._segmentLiveBytes[value.segment] -= value.length
+
+    def _set(self, key, value):
+        with self.lock:
+            self._recordPriorValue(key)
+
+            if (
+                isinstance(value, bytes)
+                and len(value) >= self.largeValueBytes
+                and (isinstance(key, str) or not key.isIndexValue)
+            ):
+                value = self._writeBlob(value)
+
+            if not isinstance(value, BlobRef):
+                self._releaseBlob(self.values.get(key))
+                super()._set(key, value)
+                return
+
+            for snapshot in self._snapshots:
+                snapshot._preserve([key])
+
+            self._releaseBlob(self.values.get(key))
+
+            self.values[key] = value
+            self._segmentLiveBytes[value.segment] = (
+                self._segmentLiveBytes.get(value.segment, 0) + value.length
+            )
+
+    def _restoreValue(self, key, value):
+        self._releaseBlob(self.values.get(key))
+
+        super()._restoreValue(key, value)
+
+        if isinstance(value, BlobRef):
+            self._segmentLiveBytes[value.segment] = (
+                self._segmentLiveBytes.get(value.segment, 0) + value.length
+            )
+
+    def get(self, key):
+        with self.lock:
+            value = self.values.get(key)
+
+            if isinstance(value, BlobRef):
+                return bytes(self._blobBuffer(value))
+
+            return super().get(key)
+
+    def getSeveralBuffers(self, keys):
+        """Like 'getSeveral', but return large values as read-only memoryviews.
+
+        The buffers point straight into the mapped segment files, so nothing
+        is copied onto the Python heap until the caller reads them. They stay
+        valid even if the key is later overwritten.
+        """
+        with self.lock:
+            res = []
+
+            for key in keys:
+                value = self.values.get(key)
+
+                if isinstance(value, BlobRef):
+                    res.append(self._blobBuffer(value))
+                else:
+                    res.append(super().get(key))
+
+            return res
+
+    def delete(self, key):
+        with self.lock:
+            self._releaseBlob(self.values.get(key))
+            super().delete(key)
+
+    def _appendToLog(self, kvs, adds, removes):
+        # log large values as the place we wrote them, not their contents
+        kvs = {
+            k: self.values[k]
+            if v is not None and isinstance(self.values.get(k), BlobRef)
+            else v
+            for k, v in kvs.items()
+        }
+
+        super()._appendToLog(kvs, adds, removes)
+
+    def _sync(self):
+        # values have to be on disk before the log records that refer to them
+        self._activeFile.flush()
+
+        if self._fsync:
+            os.fsync(self._activeFile.fileno())
+
+        super()._sync()
+
+    def _startSnapshot(self):
+        if self._snapshotThread is not None:
+            return
+
+        retired = set(
+            segment
+            for segment, size in self._segmentSizes.items()
+            if segment != self._activeSegment
+            and self._segmentLiveBytes.get(segment, 0) * 2 < size
+        )
+
+        if retired:
+            for key, value in list(self.values.items()):
+                if isinstance(value, BlobRef) and value.segment in retired:
+                    moved = self._writeBlob(bytes(self._blobBuffer(value)))
+
+                    self.values[key] = moved
+                    self._segmentLiveBytes[moved.segment] = (
+                        self._segmentLiveBytes.get(moved.segment, 0) + moved.length
+                    )
+
+            # the logs before the snapshot still refer to the old copies, so we
+            # keep them until the snapshot is safely written
+            self._segmentsRetiredAt[self._generation + 1] = retired
+
+            for segment in retired:
+                self._segmentLiveBytes.pop(segment, None)
+
+        super()._startSnapshot()
+
+    def _writeSnapshot(self, generation, values):
+        # make sure anything we moved is on disk before the snapshot refers to it
+        with self.lock:
+            self._activeFile.flush()
+            os.fsync(self._activeFile.fileno())
+
+        super()._writeSnapshot(generation, values)
+
+    def _removeGenerationsBefore(self, generation):
+        super()._removeGenerationsBefore(generation)
+
+        with self.lock:
+            for retiredAt in [g for g in self._segmentsRetiredAt if g <= generation]:
+                for segment in self._segmentsRetiredAt.pop(retiredAt):
+                    self._deleteSegment(segment)
+
+    def close(self):
+        super().close()
+
+        with self.lock:
+            self._activeFile.close()
+            self._maps.clear()
+
+
+class BoundedCache(object):
+    """A dict from key to bytes or set that evicts least-recently-used keys.
+
+    Once the (approximate) size of what we hold goes over 'maxBytes', we drop
+    the oldest keys that aren't pinned. If 'maxBytes' is None we never evict.
+
+    Callers that mutate a cached set in place must call 'resized' afterwards.
+    Eviction can be held off (for instance, while a batch of writes that
+    haven't reached the backing store is in flight) with 'holdEvictions'.
+    """
+
+    def __init__(self, maxBytes=None):
+        self.maxBytes = maxBytes
+        self.totalBytes = 0
+
+        # key -> value, least recently used first
+        self._entries = collections.OrderedDict()
+        self._sizes = {}
+        self._pinCounts = {}
+        self._holdCount = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _sizeOf(value):
+        if isinstance(value, set):
+            return _CACHE_ENTRY_OVERHEAD_BYTES + len(value) * _CACHE_SET_MEMBER_BYTES
+
+        return _CACHE_ENTRY_OVERHEAD_BYTES + len(value)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getitem__(self, key):
+        value = self._entries[key]
+        self._entries.move_to_end(key)
+        return value
+
+    def get(self, key, default=None):
+        if key in self._entries:
+            return self[key]
+
+        return default
+
+    def __setitem__(self, key, value):
+        if key in self._entries:
+            self.totalBytes -= self._sizes[key]
+            self._entries.move_to_end(key)
+
+        self._entries[key] = value
+        self._sizes[key] = self._sizeOf(value)
+        self.totalBytes += self._sizes[key]
+
+        self._evict()
+
+    def __delitem__(self, key):
+        del self._entries[key]
+        self.totalBytes -= self._sizes.pop(key)
+
+    def hasRoomFor(self, value):
+        """Could we cache 'value' without evicting anything?"""
+        return self.maxBytes is None or self.totalBytes + self._sizeOf(value) <= self.maxBytes
+
+    def resized(self, key):
+        """Recompute the size of 'key' after its value was modified in place."""
+        self[key] = self._entries[key]
+
+    def clear(self):
+        self._entries.clear()
+        self._sizes.clear()
+        self.totalBytes = 0
+
+    def pin(self, key):
+        self._pinCounts[key] = self._pinCounts.get(key, 0) + 1
+
+    def unpin(self, key):
+        self._pinCounts[key] -= 1
+
+        if not self._pinCounts[key]:
+            del self._pinCounts[key]
+
+        self._evict()
+
+    def holdEvictions(self):
+        self._holdCount += 1
+
+    def releaseEvictions(self):
+        self._holdCount -= 1
+        self._evict()
+
+    def _evict(self):
+        if self.maxBytes is None or self._holdCount:
+            return
+
+        # pinned keys get moved to the back as we pass them, so each is skipped at most once
+        pinnedSkipsLeft = len(self._pinCounts)
+
+        while self.totalBytes > self.maxBytes and self._entries:
+            key = next(iter(self._entries))
+
+            if key in self._pinCounts:
+                if not pinnedSkipsLeft:
+                    return
+
+                pinnedSkipsLeft -= 1
+                self._entries.move_to_end(key)
+                continue
+
+            del self[key]
+            self.evictions += 1
+
+
 class RedisPersistence(object):
-    def __init__(self, db=0, port=None, host=None):
+    def __init__(self, db=0, port=None, host=None, cacheBytes=None):
+        """Keep our data in redis, caching what we've read or written.
+
+        Args:
+            cacheBytes - if not None, roughly how much data to cache. Beyond
+                that, we evict the least recently used keys and refetch them
+                from redis when needed. Keys passed to 'pin' are never evicted.
+        """
         self.lock = threading.RLock()
         kwds = {}
 
@@ -157,10 +968,210 @@ class RedisPersistence(object):
             kwds["host"] = host
 
         self.redis = redis.StrictRedis(db=db, **kwds)
-        self.cache = {}
+        self.cache = BoundedCache(cacheBytes)
+        self._snapshots = set()
+
+        # if we're inside of 'beginBatch', the pipeline that 'setSeveral' should
+        # write to, and the set of keys it has deleted but not yet sent to redis.
+        self._batchPipe = None
+        self._batchDeletedKeys = None
+
+        # while 'warmCache' is running, the keys written since it started. It
+        # mustn't overwrite those with what it read from redis.
+        self._warmingWrittenKeys = None
 
         self._logger = logging.getLogger(__name__)
 
+    def snapshot(self):
+        """Return a PersistenceSnapshot of the current values in the store."""
+        with self.lock:
+            snapshot = PersistenceSnapshot(self)
+            self._snapshots.add(snapshot)
+            return snapshot
+
+    def _isDeletedInBatch(self, key):
+        return self._batchDeletedKeys is not None and key in self._batchDeletedKeys
+
+    def cacheMetrics(self):
+        """Return a dict describing how well our cache of redis is working."""
+        with self.lock:
+            return dict(
+                hits=self.cache.hits,
+                misses=self.cache.misses,
+                evictions=self.cache.evictions,
+                keys=len(self.cache),
+                bytes=self.cache.totalBytes,
+                maxBytes=self.cache.maxBytes,
+            )
+
+    def warmCache(self, threadCount=4, batchSize=1000, priority=None, onProgress=None):
+        """Fill our cache from redis in bulk, rather than one key at a time on first use.
+
+        We SCAN the keyspace, then load keys in batches of 'batchSize' using
+        pipelined GET and SMEMBERS calls spread over 'threadCount' threads. It's
+        safe to read and write while this runs. We stop once the cache is full.
+
+        Args:
+            priority - if not None, a function from key to a sort key. Keys
+                that sort lower get loaded first.
+            onProgress - if not None, called as onProgress(keysLoaded, keysTotal)
+                after each batch.
+
+        Returns:
+            the number of keys loaded.
+        """
+        t0 = time.time()
+
+        with self.lock:
+            assert self._warmingWrittenKeys is None, "Already warming the cache"
+            self._warmingWrittenKeys = set()
+
+        try:
+            keys = [deserialize(KeyType, k) for k in self.redis.scan_iter(count=batchSize)]
+
+            if priority is not None:
+                keys.sort(key=priority)
+
+            self._logger.info("Warming our cache with %s keys from redis", len(keys))
+
+            batches = queue.Queue()
+            for i in range(0, len(keys), batchSize):
+                batches.put(keys[i : i + batchSize])
+
+            progress = dict(loaded=0, processed=0, full=False)
+            progressLock = threading.Lock()
+
+            def loadBatches():
+                while not progress["full"]:
+                    try:
+                        batch = batches.get_nowait()
+                    except queue.Empty:
+                        return
+
+                    loaded, full = self._warmBatch(batch)
+
+                    with progressLock:
+                        progress["loaded"] += loaded
+                        progress["processed"] += len(batch)
+
+                        if full:
+                            progress["full"] = True
+
+                        if onProgress is not None:
+                            onProgress(progress["processed"], len(keys))
+
+            threads = [threading.Thread(target=loadBatches) for _ in range(threadCount)]
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            self._logger.info(
+                "Loaded %s of %s keys from redis in %.2f seconds%s",
+                progress["loaded"],
+                len(keys),
+                time.time() - t0,
+                " (our cache is full)" if progress["full"] else "",
+            )
+
+            return progress["loaded"]
+        finally:
+            with self.lock:
+                self._warmingWrittenKeys = None
+
+    def _warmBatch(self, keys):
+        serializedKeys = [serialize(KeyType, k) for k in keys]
+
+        pipe = self.redis.pipeline(transaction=False)
+        for key in serializedKeys:
+            pipe.type(key)
+        types = pipe.execute()
+
+        pipe = self.redis.pipeline(transaction=False)
+        for key, keyType in zip(serializedKeys, types):
+            if keyType == b"string":
+                pipe.get(key)
+            elif keyType == b"set":
+                pipe.smembers(key)
+        values = iter(pipe.execute())
+
+        loaded = 0
+
+        with self.lock:
+            for key, keyType in zip(keys, types):
+                if keyType not in (b"string", b"set"):
+                    continue
+
+                value = next(values)
+
+                if (
+                    not value
+                    or key in self.cache
+                    or key in self._warmingWrittenKeys
+                    or self._isDeletedInBatch(key)
+                ):
+                    continue
+
+                if keyType == b"set":
+                    value = set([deserialize(SetValue, k) for k in value])
+
+                # we'd only be evicting things we just loaded
+                if not self.cache.hasRoomFor(value):
+                    return loaded, True
+
+                self.cache[key] = value
+                loaded += 1
+
+        return loaded, False
+
+    def _noteWritten(self, keys):
+        if self._warmingWrittenKeys is not None:
+            self._warmingWrittenKeys.update(keys)
+
+    def pin(self, key):
+        """Never evict 'key' from our cache until a matching call to 'unpin'."""
+        with self.lock:
+            self.cache.pin(key)
+
+    def unpin(self, key):
+        with self.lock:
+            self.cache.unpin(key)
+
+    def beginBatch(self):
+        """Start a group of 'setSeveral' calls that get written to redis together.
+
+        Writes inside of the batch are visible to reads immediately (they go into
+        our cache) but are only sent to redis, in a single pipeline, when
+        'commitBatch' is called.
+        """
+        with self.lock:
+            assert self._batchPipe is None, "Batches can't be nested"
+
+            self._batchPipe = self.redis.pipeline()
+            self._batchDeletedKeys = set()
+
+            # the batch's writes only exist in our cache until we commit
+            self.cache.holdEvictions()
+
+    def commitBatch(self):
+        """Send all the writes accumulated since 'beginBatch' to redis."""
+        with self.lock:
+            pipe = self._batchPipe
+
+            self._batchPipe = None
+            self._batchDeletedKeys = None
+
+            try:
+                pipe.execute()
+            except Exception:
+                # our cache holds writes that never made it into redis,
+                # so we can't trust any of it.
+                self.cache.clear()
+                raise
+            finally:
+                self.cache.releaseEvictions()
+
     def get(self, key):
         """Get the value stored in a value-style key, or None if no key exists.
 
@@ -169,8 +1180,14 @@ class RedisPersistence(object):
         with self.lock:
             if key in self.cache:
                 assert not isinstance(self.cache[key], set), "item is a set, not a string"
+                self.cache.hits += 1
                 return self.cache[key]
 
+            if self._isDeletedInBatch(key):
+                return None
+
+            self.cache.misses += 1
+
             success = False
             while not success:
                 try:
@@ -197,7 +1214,20 @@ class RedisPersistence(object):
         """Get the values (or None) stored in several value-style keys."""
 
         with self.lock:
-            needed_keys = [serialize(KeyType, k) for k in keys if k not in self.cache]
+            keys = list(keys)
+
+            # grab what we have up front, since filling the cache with the
+            # rest may evict some of it
+            res = {k: self.cache[k] for k in keys if k in self.cache}
+
+            needed_keys = [
+                serialize(KeyType, k)
+                for k in keys
+                if k not in res and not self._isDeletedInBatch(k)
+            ]
+
+            self.cache.hits += len(res)
+            self.cache.misses += len(needed_keys)
 
             if needed_keys:
                 success = False
@@ -211,16 +1241,23 @@ class RedisPersistence(object):
 
                 for ix in range(len(needed_keys)):
                     if vals[ix] is not None:
-                        self.cache[deserialize(KeyType, needed_keys[ix])] = vals[ix]
+                        key = deserialize(KeyType, needed_keys[ix])
+                        res[key] = self.cache[key] = vals[ix]
 
-            return [self.cache.get(k, None) for k in keys]
+            return [res.get(k, None) for k in keys]
 
     def getSetMembers(self, key):
         with self.lock:
             if key in self.cache:
                 assert isinstance(self.cache[key], set), "item is a string, not a set"
+                self.cache.hits += 1
                 return self.cache[key]
 
+            if self._isDeletedInBatch(key):
+                return set()
+
+            self.cache.misses += 1
+
             success = False
             while not success:
                 try:
@@ -232,71 +1269,143 @@ class RedisPersistence(object):
 
             if vals:
                 # set members are encoded as bytes but must be a 'SetValue'
-                self.cache[key] = set([deserialize(SetValue, k) for k in vals])
-                return self.cache[key]
+                members = set([deserialize(SetValue, k) for k in vals])
+                self.cache[key] = members
+                return members
             else:
                 return set()
 
-    def setSeveral(self, kvs, setAdds=None, setRemoves=None):
-        new_sets, dropped_sets = set(), set()
-        with self.lock:
-            pipe = self.redis.pipeline()
+    def _loadSets(self, keys):
+        """Make sure the cache holds each set-style key in 'keys' that exists in redis.
 
-            for key, value in kvs.items():
-                if value is None:
-                    pipe.delete(serialize(KeyType, key))
-                else:
-                    pipe.set(serialize(KeyType, key), value)
-
-            for key, to_add in (setAdds or {}).items():
-                if key not in self.cache:
-                    self.getSetMembers(key)
-
-                for to_add_val in to_add:
-                    pipe.sadd(serialize(KeyType, key), serialize(SetValue, to_add_val))
+        Everything we don't have gets fetched in a single pipelined round trip.
+        """
+        needed = [
+            k for k in set(keys) if k not in self.cache and not self._isDeletedInBatch(k)
+        ]
 
-            for key, to_remove in (setRemoves or {}).items():
-                if key not in self.cache:
-                    self.getSetMembers(key)
+        if not needed:
+            return
 
-                for to_remove_val in to_remove:
-                    pipe.srem(serialize(KeyType, key), serialize(SetValue, to_remove_val))
+        self.cache.misses += len(needed)
 
-            pipe.execute()
+        success = False
+        while not success:
+            try:
+                pipe = self.redis.pipeline(transaction=False)
+                for key in needed:
+                    pipe.smembers(serialize(KeyType, key))
+                vals = pipe.execute()
+                success = True
+            except redis.exceptions.BusyLoadingError:
+                self._logger.info("Redis is still loading. Waiting...")
+                time.sleep(1.0)
 
-            # update our cache _after_ executing the pipe
-            for key, value in kvs.items():
-                if value is None:
-                    if key in self.cache:
-                        del self.cache[key]
-                else:
-                    self.cache[key] = value
+        for key, members in zip(needed, vals):
+            if members:
+                self.cache[key] = set([deserialize(SetValue, k) for k in members])
 
-            for key, to_add in (setAdds or {}).items():
-                if to_add:
-                    if key not in self.cache or not self.cache[key]:
-                        self.cache[key] = set()
-                        assert key not in new_sets
-                        new_sets.add(key)
+    def setSeveral(self, kvs, setAdds=None, setRemoves=None):
+        new_sets, dropped_sets = set(), set()
+        with self.lock:
+            self._noteWritten(kvs)
+            self._noteWritten(setAdds or ())
+            self._noteWritten(setRemoves or ())
 
-                    for val in to_add:
-                        self.cache[key].add(val)
+            # the sets we load below have to stay cached until we've updated them
+            self.cache.holdEvictions()
 
-            for key, to_remove in (setRemoves or {}).items():
-                if to_remove:
-                    assert self.cache.get(key)
+            try:
+                for snapshot in self._snapshots:
+                    snapshot._preserve(kvs)
 
-                    for val in to_remove:
-                        self.cache[key].remove(val)
+                pipe = (
+                    self._batchPipe if self._batchPipe is not None else self.redis.pipeline()
+                )
 
-                    if not self.cache[key]:
-                        dropped_sets.add(key)
-                        del self.cache[key]
+                for key, value in kvs.items():
+                    if value is None:
+                        pipe.delete(serialize(KeyType, key))
+                    else:
+                        pipe.set(serialize(KeyType, key), value)
+
+                self._loadSets(list(setAdds or ()) + list(setRemoves or ()))
+
+                for key, to_add in (setAdds or {}).items():
+                    if to_add:
+                        pipe.sadd(
+                            serialize(KeyType, key), *[serialize(SetValue, v) for v in to_add]
+                        )
+
+                for key, to_remove in (setRemoves or {}).items():
+                    if to_remove:
+                        pipe.srem(
+                            serialize(KeyType, key),
+                            *[serialize(SetValue, v) for v in to_remove],
+                        )
+
+                if self._batchPipe is None:
+                    pipe.execute()
+
+                # update our cache _after_ executing the pipe
+                for key, value in kvs.items():
+                    if value is None:
+                        if key in self.cache:
+                            del self.cache[key]
+                        if self._batchDeletedKeys is not None:
+                            self._batchDeletedKeys.add(key)
+                    else:
+                        self.cache[key] = value
+                        if self._batchDeletedKeys is not None:
+                            self._batchDeletedKeys.discard(key)
+
+                for key, to_add in (setAdds or {}).items():
+                    if to_add:
+                        if key not in self.cache or not self.cache[key]:
+                            self.cache[key] = set()
+                            assert key not in new_sets
+                            new_sets.add(key)
+
+                            if self._batchDeletedKeys is not None:
+                                self._batchDeletedKeys.discard(key)
+
+                        for val in to_add:
+                            self.cache[key].add(val)
+
+                        self.cache.resized(key)
+
+                for key, to_remove in (setRemoves or {}).items():
+                    if to_remove:
+                        assert self.cache.get(key)
+
+                        for val in to_remove:
+                            self.cache[key].remove(val)
+
+                        if not self.cache[key]:
+                            dropped_sets.add(key)
+                            del self.cache[key]
+
+                            if self._batchDeletedKeys is not None:
+                                self._batchDeletedKeys.add(key)
+                        else:
+                            self.cache.resized(key)
+            finally:
+                self.cache.releaseEvictions()
 
         return new_sets, dropped_sets
 
     def set(self, key, value):
         with self.lock:
+            if self._batchPipe is not None:
+                # stay ordered with respect to the other writes in the batch
+                self.setSeveral({key: value})
+                return
+
+            self._noteWritten([key])
+
+            for snapshot in self._snapshots:
+                snapshot._preserve([key])
+
             if value is None:
                 self.redis.delete(serialize(KeyType, key))
                 if key in self.cache:
@@ -309,10 +1418,21 @@ class RedisPersistence(object):
         with self.lock:
             if key in self.cache:
                 return True
+            if self._isDeletedInBatch(key):
+                return False
             return self.redis.exists(serialize(KeyType, key))
 
     def delete(self, key):
         with self.lock:
+            if self._batchPipe is not None:
+                self.setSeveral({key: None})
+                return
+
+            self._noteWritten([key])
+
+            for snapshot in self._snapshots:
+                snapshot._preserve([key])
+
             if key in self.cache:
                 del self.cache[key]
             self.redis.delete(serialize(KeyType, key))
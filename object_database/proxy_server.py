@@ -43,8 +43,8 @@ from typed_python import (
     serialize,
 )
 from .core_schema import core_schema
-from .channel import ServerToClientChannel, ClientToServerChannel
-from .messages import ServerToClient, ClientToServer
+from .channel import ServerToClientChannel, ClientToServerChannel, BroadcastMessage
+from .messages import ServerToClient, ClientToServer, applyFieldOperation
 from .server import ObjectBase
 from .schema import (
     IndexValue,
@@ -211,6 +211,117 @@ class SubscriptionState:
             ).add((channel, subscriptionKey))
             self.channelToPendingSubscriptions.setdefault(channel).add(subscriptionKey)
 
+    def removeSubscription(self, channel, schema, typename, fieldname_and_value):
+        """Drop a subscription made with 'addSubscription'.
+
+        Sends the channel an UnsubscribeComplete deleting every object that's no
+        longer covered by one of its other subscriptions.
+        """
+        keys = [
+            k
+            for k in self.channelSubscriptions.setdefault(channel)
+            if k.schema == schema
+            and k.typename == typename
+            and k.fieldname_and_value == fieldname_and_value
+        ]
+
+        for key in keys:
+            self.channelSubscriptions[channel].discard(key)
+
+            if key in self.channelToPendingSubscriptions.get(channel, ()):
+                self.channelToPendingSubscriptions[channel].discard(key)
+                self.subscriptionsPendingSubscriptionOnServer.setdefault(
+                    (schema, typename)
+                ).discard((channel, key))
+
+        if (
+            channel in self.channelToPendingSubscriptions
+            and not self.channelToPendingSubscriptions[channel]
+        ):
+            self.channelToPendingSubscriptions.pop(channel)
+
+        typenameToFieldMap = Dict(str, int)()
+        if (
+            schema in self.schemaTypeAndNameToFieldId
+            and typename in self.schemaTypeAndNameToFieldId[schema]
+        ):
+            typenameToFieldMap = self.schemaTypeAndNameToFieldId[schema][typename]
+
+        removedKey = SubscriptionKey(
+            schema=schema,
+            typename=typename,
+            fieldname_and_value=fieldname_and_value,
+            isLazy=False,
+        )
+        candidates = self.objectIndentitiesForSubscriptionKey(removedKey)
+
+        if fieldname_and_value is None:
+            for fieldId in typenameToFieldMap.values():
+                self.fieldIdToSubscribedChannels.setdefault(fieldId).discard(channel)
+                self.channelToSubscribedFieldIds.setdefault(channel).discard(fieldId)
+                self.channelToLazilySubscribedFieldIds.setdefault(channel).discard(fieldId)
+        elif fieldname_and_value[0] != "_identity":
+            fieldname, indexValue = fieldname_and_value
+
+            if fieldname in typenameToFieldMap:
+                indexId = IndexId(fieldId=typenameToFieldMap[fieldname], indexValue=indexValue)
+
+                self.indexIdToSubscribedChannels.setdefault(indexId).discard(channel)
+                self.channelToSubscribedIndexIds.setdefault(channel).discard(indexId)
+                self.channelToLazilySubscribedIndexIds.setdefault(channel).discard(indexId)
+
+        dropped = Set(ObjectId)()
+
+        existsFieldId = typenameToFieldMap.get(" exists")
+
+        if existsFieldId is None or existsFieldId not in self.channelToSubscribedFieldIds.get(
+            channel, ()
+        ):
+            # anything still covered by one of the channel's other subscriptions stays
+            stillCovered = Set(ObjectId)()
+            for key in self.channelSubscriptions[channel]:
+                if key.schema == schema and key.typename == typename:
+                    stillCovered.update(self.objectIndentitiesForSubscriptionKey(key))
+
+            for oid in candidates:
+                if oid not in stillCovered:
+                    dropped.add(oid)
+
+        for oid in dropped:
+            self.channelToSubscribedOids.setdefault(channel).discard(oid)
+
+            if oid in self.oidToSubscribedChannels:
+                self.oidToSubscribedChannels[oid].discard(channel)
+                if not self.oidToSubscribedChannels[oid]:
+                    self.oidToSubscribedChannels.pop(oid)
+
+        writes = Dict(ObjectFieldId, OneOf(None, bytes))()
+        setRemoves = Dict(IndexId, ListOf(ObjectId))()
+
+        for fieldId in typenameToFieldMap.values():
+            for oid in dropped:
+                writes[ObjectFieldId(objId=oid, fieldId=fieldId, isIndexValue=False)] = None
+
+            if fieldId in self.indexValues:
+                oidToVal = self.indexValues[fieldId]
+
+                for oid in dropped:
+                    if oid in oidToVal:
+                        setRemoves.setdefault(
+                            IndexId(fieldId=fieldId, indexValue=oidToVal[oid])
+                        ).append(oid)
+
+        channel.sendMessage(
+            ServerToClient.UnsubscribeComplete(
+                schema=schema,
+                typename=typename,
+                fieldname_and_value=fieldname_and_value,
+                writes=writes,
+                set_removes={k: TupleOf(ObjectId)(v) for k, v in setRemoves.items()},
+                tid=self.transactionId,
+            )
+        )
+
     def sendDataForSubscription(self, channel, key: SubscriptionKey):
         # get the set of affected objects
         oids = self.objectIndentitiesForSubscriptionKey(key)
@@ -489,6 +600,32 @@ class SubscriptionState:
                             oid
                         )
 
+    def applyFieldOperations(self, writes, fieldOperations):
+        """Rebuild the values of the fields a Transaction sent us as appends.
+
+        Returns:
+            'writes', plus the new value of each appended field.
+
+        Raises:
+            Exception: if we don't have the value of a field we got appends for.
+        """
+        writes = dict(writes)
+
+        for ofi, ops in fieldOperations.items():
+            value = self.objectValues.setdefault(ofi.fieldId).get(ofi.objId)
+
+            if value is None:
+                raise Exception(
+                    f"Received an append to {ofi}, which we don't have a value for"
+                )
+
+            for op in ops:
+                value = applyFieldOperation(value, op)
+
+            writes[ofi] = value
+
+        return writes
+
     def handleTransaction(self, writes, set_adds, set_removes, transaction_id):
         # we may have to modify the transaction values
         writes = Dict(ObjectFieldId, OneOf(None, bytes))(writes)
@@ -620,8 +757,13 @@ class SubscriptionState:
         if transaction_id > self.transactionId:
             self.transactionId = transaction_id
 
-        for channel in channelsTriggeredForPriors:
-            channel.sendMessage(ServerToClient.LazyTransactionPriors(writes=priorValues))
+        if channelsTriggeredForPriors:
+            priorsMessage = BroadcastMessage(
+                ServerToClient.LazyTransactionPriors(writes=priorValues)
+            )
+
+            for channel in channelsTriggeredForPriors:
+                priorsMessage.sendTo(channel)
 
         if channels:
             msg = ServerToClient.Transaction(
@@ -634,8 +776,11 @@ class SubscriptionState:
                 ),
                 transaction_id=transaction_id,
             )
+
+            broadcast = BroadcastMessage(msg)
+
             for c in channels:
-                c.sendMessage(msg)
+                broadcast.sendTo(c)
 
     def increaseSubscriptionIfNecessary(self, channel, set_adds, transaction_id):
         """Mark any new objects we need to track based on contents of 'set_adds'.
@@ -970,6 +1115,14 @@ class ProxyServer:
             self._subscriptionState.addSubscription(channel, subscription)
             return
 
+        if msg.matches.Unsubscribe:
+            # we stay subscribed to the whole type upstream, since other channels
+            # may still want it, so this only changes what we route to 'channel'.
+            self._subscriptionState.removeSubscription(
+                channel, msg.schema, msg.typename, msg.fieldname_and_value
+            )
+            return
+
         if msg.matches.Flush:
             self._flushGuidIx += 1
             guid = self._flushGuidIx
@@ -1033,6 +1186,7 @@ class ProxyServer:
                     key_versions=msg.key_versions,
                     index_versions=msg.index_versions,
                     transaction_guid=guid,
+                    field_operations=msg.field_operations,
                 )
             )
             return
@@ -1070,6 +1224,25 @@ class ProxyServer:
                 self._channelToMissedHeartbeatCount[channel] = 0
             return
 
+        if msg.matches.SubscribeChanges:
+            # change streams need the server's ChangeLog, which we don't have
+            channel.sendMessage(
+                ServerToClient.ChangesUnavailable(
+                    subscription_guid=msg.subscription_guid,
+                    reason="Change streams aren't supported through a proxy.",
+                )
+            )
+            return
+
+        if msg.matches.AcknowledgeChanges or msg.matches.UnsubscribeChanges:
+            return
+
+        if msg.matches.ResumeSubscriptions:
+            channel.sendMessage(
+                ServerToClient.SubscriptionsResumed(resumed=False, tid=self._transactionNum)
+            )
+            return
+
         raise Exception("Don't know how to handle ", msg)
 
     def handleServerToClientMessage(self, msg: ServerToClient):
@@ -1107,6 +1280,8 @@ class ProxyServer:
                         transaction_num=self._transactionNum,
                         connIdentity=msg.connIdentity,
                         identity_root=msg.identity_root,
+                        # we don't retain transactions, so there's nothing to resume
+                        server_epoch="",
                     )
                 )
                 return
@@ -1150,8 +1325,30 @@ class ProxyServer:
                 return
 
             if msg.matches.Transaction:
+                writes = msg.writes
+
+                if msg.field_operations:
+                    try:
+                        writes = self._subscriptionState.applyFieldOperations(
+                            writes, msg.field_operations
+                        )
+                    except Exception:
+                        # we can't keep applying transactions on top of a value we
+                        # know is wrong, and we don't resubscribe on our own, so we
+                        # drop everybody and let them reconnect
+                        logging.exception(
+                            "Can't apply transaction %s. Disconnecting.", msg.transaction_id
+                        )
+
+                        for channel in list(self._downstreamChannels):
+                            channel.close()
+                            self.dropConnection(channel)
+
+                        self._channelToMainServer.close()
+                        return
+
                 self._subscriptionState.handleTransaction(
-                    msg.writes, msg.set_adds, msg.set_removes, msg.transaction_id
+                    writes, msg.set_adds, msg.set_removes, msg.transaction_id
                 )
                 return
 
@@ -112,6 +112,10 @@ class Schema:
         """
         return self._index_types.get(typename, {}).get(fieldname, None)
 
+    def fieldIsIndexed(self, typename, fieldname):
+        """Return True if any index on 'typename' depends on 'fieldname'."""
+        return any(fieldname in names for names in self._indices.get(typename, {}).values())
+
     @property
     def name(self):
         return self._name
@@ -12,12 +12,20 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
-from object_database.messages import ClientToServer, ServerToClient
+from object_database.messages import ClientToServer, ServerToClient, applyFieldOperation
+from object_database.channel import BroadcastMessage
+from object_database.change_stream import (
+    ChangeLog,
+    ChangeSubscription,
+    DEFAULT_CHANGE_LOG_TRANSACTIONS,
+    TransactionCoalescer,
+)
 from object_database.identity import IdentityProducer
 from object_database.schema import FieldDefinition, ObjectFieldId, IndexId, indexValueFor
 from object_database.core_schema import core_schema
 from object_database.messages import SchemaDefinition
-from object_database.util import Timer
+from object_database.util import Timer, genToken
+from object_database._types import VersionTable
 from typed_python import (
     serialize,
     deserialize,
@@ -27,8 +35,11 @@ from typed_python import (
     Dict,
     makeNamedTuple,
     NamedTuple,
+    TupleOf,
 )
 from typed_python.SerializationContext import SerializationContext
+import collections
+import functools
 import queue
 import time
 import logging
@@ -36,6 +47,20 @@ import threading
 import traceback
 
 DEFAULT_GC_INTERVAL = 900.0
+# the most expired version numbers we'll look at after a single transaction
+DEFAULT_GC_KEYS_PER_STEP = 1000
+DEFAULT_SUBSCRIPTION_WORKERS = 4
+# objects per message when we send a channel fields a new subscription made visible
+BACKFILL_BATCH_SIZE = 1000
+
+# what we do with a client whose channel backs up because it isn't reading what
+# we send it. See Server.setSlowConsumerPolicy.
+SLOW_CONSUMER_DISCONNECT = "disconnect"
+SLOW_CONSUMER_PAUSE = "pause"
+SLOW_CONSUMER_RESYNC = "resync"
+DEFAULT_MAX_HELD_MESSAGES = 10000
+# keys and index memberships, across every message we hold for one client
+DEFAULT_MAX_HELD_KEYS = 1000000
 
 
 defaultSerializationContext = SerializationContext().withoutCompression()
@@ -67,11 +92,48 @@ class TypeMap(Class, Final):
         return self.fieldDefToId.get(key)
 
 
+def _heldKeyCount(msg):
+    """The number of keys and index memberships a ServerToClient message carries."""
+    if msg.matches.Transaction or msg.matches.ChangeData:
+        return (
+            len(msg.writes)
+            + sum(len(i) for i in msg.set_adds.values())
+            + sum(len(i) for i in msg.set_removes.values())
+        )
+
+    if msg.matches.SubscriptionData:
+        return len(msg.values) + len(msg.index_values) + len(msg.identities or ())
+
+    if msg.matches.LazySubscriptionData:
+        return len(msg.index_values) + len(msg.identities)
+
+    if msg.matches.LazyTransactionPriors:
+        return len(msg.writes)
+
+    if msg.matches.LazyLoadResponse:
+        return len(msg.values)
+
+    return 1
+
+
+def _survivesResync(msg):
+    """Can we still send 'msg' after catching its client up from the change log?"""
+    return (
+        msg.matches.TransactionResult
+        or msg.matches.FlushResponse
+        or msg.matches.DependentConnectionId
+        or msg.matches.SchemaMapping
+        or msg.matches.ChangeData
+        or msg.matches.ChangesUnavailable
+    )
+
+
 class ConnectedChannel:
-    def __init__(self, initial_tid, channel, connectionObject, identityRoot):
+    def __init__(self, initial_tid, channel, connectionObject, identityRoot, serverEpoch):
         super(ConnectedChannel, self).__init__()
         self.channel = channel
         self.initial_tid = initial_tid
+        self.serverEpoch = serverEpoch
         self.connectionObject = connectionObject
         self.missedHeartbeats = 0
         self.definedSchemas = {}
@@ -79,12 +141,53 @@ class ConnectedChannel:
             {}
         )  # schema, type to the lazy transaction id (or -1 if not lazy)
         self.subscribedIds = set()  # identities
+        # for each identity in 'subscribedIds', the number of index or identity
+        # subscriptions (or object creations) that put it there
+        self.subscribedIdRefcounts = {}
         self.subscribedIndexKeys = {}  # full index keys to lazy transaction id
+        # full index keys to the identities that subscription brought into scope
+        self.subscribedIndexIdentities = {}
+        # the " exists" index keys of the types we subscribe to in full, which
+        # we've pinned in the kvstore's cache
+        self.pinnedTypeIndexKeys = set()
+        # (schema, typename) to the set of fieldnames we're allowed to see,
+        # or None if we subscribed to every field of the type
+        self.fieldProjections = {}
+        # field ids we never send, because every subscription to their type
+        # asked for a subset of fields that excludes them
+        self.hiddenFieldIds = set()
         self.identityRoot = identityRoot
         self.pendingTransactions = {}
+        # subscription_guid -> ChangeSubscription for each SubscribeChanges stream
+        self.changeSubscriptions = {}
         self.dependentConnections = set([connectionObject])
         self._needsAuthentication = True
 
+        # while the client is too far behind to send it anything (see
+        # Server.setSlowConsumerPolicy), the messages we're holding for it, in
+        # order, with each run of Transactions merged into a TransactionCoalescer.
+        # None when we're sending normally.
+        self.heldMessages = None
+        self.maxHeldMessages = None
+        # how many keys and index memberships 'heldMessages' carries, which is
+        # what costs memory: a coalesced run of Transactions is one message.
+        self.heldKeys = 0
+        self.maxHeldKeys = None
+        # if True, we may stop holding Transactions and resync the client instead
+        # once it's holding more than 'maxHeldKeys'
+        self.canResync = False
+        # when we started holding messages, and the last transaction id then
+        self.heldSince = None
+        self.heldSinceTransactionId = None
+        # if not None, we're dropping Transactions rather than holding them, and
+        # will catch the client up from the change log after this transaction id
+        self.resyncAfterTransactionId = None
+        # True if we've held something a resync can't be finished after
+        self.resyncInvalidated = False
+        # True once we've held too much and closed the channel
+        self.tooFarBehind = False
+        self._heldMessagesLock = threading.Lock()
+
     @property
     def needsAuthentication(self):
         return self._needsAuthentication
@@ -95,21 +198,185 @@ class ConnectedChannel:
     def heartbeat(self):
         self.missedHeartbeats = 0
 
-    def sendTransaction(self, msg):
-        # we need to cut the transaction down
+    def write(self, msg):
+        """Send a ServerToClient message, unless we're holding messages for the client."""
+        with self._heldMessagesLock:
+            if self.heldMessages is not None:
+                self._hold(msg)
+                return
+
         self.channel.write(msg)
 
+    def sendTransaction(self, broadcast):
+        # the server has already cut the transaction down to what we can see
+        with self._heldMessagesLock:
+            if self.heldMessages is not None:
+                self._hold(broadcast.msg)
+                return
+
+        broadcast.sendTo(self.channel)
+
+    @property
+    def isHoldingMessages(self):
+        return self.heldMessages is not None
+
+    def holdMessages(
+        self, transactionId, maxHeldMessages, maxHeldKeys, resync=False, canResync=False
+    ):
+        """Stop sending the client anything until 'releaseHeldMessages'.
+
+        Args:
+            transactionId: the last transaction id we've committed.
+            maxHeldMessages: if we'd hold more messages than this, close the
+                channel instead.
+            maxHeldKeys: if the messages we hold would carry more keys and index
+                memberships than this, resync the client (if 'canResync') or
+                close the channel.
+            resync: if True, drop Transactions rather than holding them, and
+                catch the client up from the change log when we release it.
+            canResync: if True, we could catch the client up from the change log.
+        """
+        with self._heldMessagesLock:
+            self.heldMessages = []
+            self.maxHeldMessages = maxHeldMessages
+            self.heldKeys = 0
+            self.maxHeldKeys = maxHeldKeys
+            self.canResync = canResync
+            self.heldSince = time.time()
+            self.heldSinceTransactionId = transactionId
+            self.resyncAfterTransactionId = transactionId if resync else None
+            self.resyncInvalidated = False
+
+    def releaseHeldMessages(self, catchUp=()):
+        """Send the messages in 'catchUp', then everything we held, and resume sending."""
+        with self._heldMessagesLock:
+            for msg in catchUp:
+                self.channel.write(msg)
+
+            for msg in self.heldMessages or ():
+                if isinstance(msg, TransactionCoalescer):
+                    msg = msg.message()
+
+                self.channel.write(msg)
+
+            self.heldMessages = None
+            self.heldKeys = 0
+            self.heldSince = None
+            self.heldSinceTransactionId = None
+            self.resyncAfterTransactionId = None
+
+    def heldMessageMetrics(self, transactionId):
+        with self._heldMessagesLock:
+            if self.heldMessages is None:
+                return dict(
+                    state=None, heldMessages=0, heldKeys=0, heldSeconds=0.0, transactionLag=0
+                )
+
+            return dict(
+                state=(
+                    SLOW_CONSUMER_RESYNC
+                    if self.resyncAfterTransactionId is not None
+                    else SLOW_CONSUMER_PAUSE
+                ),
+                heldMessages=len(self.heldMessages),
+                heldKeys=self.heldKeys,
+                heldSeconds=time.time() - self.heldSince,
+                transactionLag=transactionId - self.heldSinceTransactionId,
+            )
+
+    def _hold(self, msg):
+        """Hold 'msg' for later. Called with '_heldMessagesLock' held."""
+        if self.tooFarBehind:
+            return
+
+        held = self.heldMessages
+
+        if self.resyncAfterTransactionId is not None:
+            if msg.matches.Transaction:
+                # the catch-up from the change log will include it
+                return
+
+            if not _survivesResync(msg):
+                # anything else may depend on the Transactions we dropped
+                self.resyncInvalidated = True
+
+        elif msg.matches.Transaction and not msg.field_operations:
+            if not held or not isinstance(held[-1], TransactionCoalescer):
+                held.append(TransactionCoalescer())
+
+            keyCount = held[-1].keyCount
+            held[-1].addTransaction(msg)
+            self.heldKeys += held[-1].keyCount - keyCount
+
+            self._checkHeldKeys()
+            return
+
+        if len(held) >= self.maxHeldMessages:
+            self._closeTooFarBehind("%s messages" % self.maxHeldMessages)
+            return
+
+        held.append(msg)
+        self.heldKeys += _heldKeyCount(msg)
+
+        self._checkHeldKeys()
+
+    def _checkHeldKeys(self):
+        """Stop holding Transactions, or give up on the client, if we're holding too much.
+
+        Called with '_heldMessagesLock' held.
+        """
+        if self.maxHeldKeys is None or self.heldKeys <= self.maxHeldKeys:
+            return
+
+        if self.resyncAfterTransactionId is None and self.canResync:
+            logging.getLogger(__name__).info(
+                "Connection %s fell more than %s keys behind. Resyncing it instead.",
+                self.connectionObject._identity,
+                self.maxHeldKeys,
+            )
+
+            # the catch-up from the change log will include every Transaction
+            self.resyncAfterTransactionId = self.heldSinceTransactionId
+            self.heldMessages = [
+                msg
+                for msg in self.heldMessages
+                if not isinstance(msg, TransactionCoalescer) and not msg.matches.Transaction
+            ]
+            self.heldKeys = sum(_heldKeyCount(msg) for msg in self.heldMessages)
+
+            if not all(_survivesResync(msg) for msg in self.heldMessages):
+                self.resyncInvalidated = True
+
+            if self.heldKeys <= self.maxHeldKeys:
+                return
+
+        self._closeTooFarBehind("%s keys" % self.maxHeldKeys)
+
+    def _closeTooFarBehind(self, limit):
+        logging.getLogger(__name__).info(
+            "Connection %s fell more than %s behind. Closing it.",
+            self.connectionObject._identity,
+            limit,
+        )
+
+        # the Server drops us once the channel closes
+        self.tooFarBehind = True
+        self.heldMessages.clear()
+        self.heldKeys = 0
+        self.channel.close()
+
     def sendInitializationMessage(self):
-        self.channel.write(
+        self.write(
             ServerToClient.Initialize(
                 transaction_num=self.initial_tid,
                 connIdentity=self.connectionObject._identity,
                 identity_root=self.identityRoot,
+                server_epoch=self.serverEpoch,
             )
         )
 
     def sendTransactionSuccess(self, guid, success, badKey, isException):
-        self.channel.write(
+        self.write(
             ServerToClient.TransactionResult(
                 transaction_guid=guid, success=success, badKey=badKey, isException=isException
             )
@@ -123,8 +390,9 @@ class ConnectedChannel:
                 "prerequisites": {},
                 "set_adds": {},
                 "set_removes": {},
-                "key_versions": set(),
-                "index_versions": set(),
+                "key_versions": [],
+                "index_versions": [],
+                "field_operations": {},
             }
 
         self.pendingTransactions[guid]["writes"].update({k: msg.writes[k] for k in msg.writes})
@@ -137,11 +405,162 @@ class ConnectedChannel:
         self.pendingTransactions[guid]["set_removes"].update(
             {k: set(msg.set_removes[k]) for k in msg.set_removes if msg.set_removes[k]}
         )
-        self.pendingTransactions[guid]["key_versions"].update(msg.key_versions)
-        self.pendingTransactions[guid]["index_versions"].update(msg.index_versions)
+        # keep the typed tuples, so we can hand them straight to the version table
+        self.pendingTransactions[guid]["key_versions"].append(msg.key_versions)
+        self.pendingTransactions[guid]["index_versions"].append(msg.index_versions)
+
+        fieldOperations = self.pendingTransactions[guid]["field_operations"]
+        for k, ops in msg.field_operations.items():
+            fieldOperations.setdefault(k, []).extend(ops)
 
     def extractTransactionData(self, guid):
-        return self.pendingTransactions.pop(guid)
+        data = self.pendingTransactions.pop(guid)
+
+        for name, keyType in [("key_versions", ObjectFieldId), ("index_versions", IndexId)]:
+            chunks = data[name]
+
+            if len(chunks) == 1:
+                data[name] = chunks[0]
+            else:
+                data[name] = TupleOf(keyType)([key for chunk in chunks for key in chunk])
+
+        return data
+
+
+class SubscriptionScheduler:
+    """Hands queued subscriptions out to a pool of worker threads.
+
+    Bulk subscriptions are kept in a FIFO per connection, and connections are
+    served round-robin, so one client asking for a lot of large subscriptions
+    can't starve everybody else. Priority subscriptions (identity and index
+    lookups) go in a separate lane that's always served first, and bulk work
+    is never allowed to occupy every worker, so there's always one free to
+    pick up the priority lane.
+    """
+
+    def __init__(self, workerCount):
+        self.workerCount = workerCount
+        self.maxBulkWorkers = max(1, workerCount - 1)
+
+        self._cond = threading.Condition()
+        self._priority = collections.deque()
+
+        # connectedChannel -> deque of (msg, enqueueTime)
+        self._bulkByConnection = {}
+
+        # the connections with bulk work outstanding, in the order we'll serve them
+        self._bulkConnectionOrder = collections.deque()
+
+        self._bulkWorkersActive = 0
+        self._stopped = False
+
+        self.resetMetrics()
+
+    def resetMetrics(self):
+        with self._cond:
+            self._enqueued = 0
+            self._started = 0
+            self._totalWait = 0.0
+            self._maxWait = 0.0
+            self._maxDepth = self._depth()
+
+    def metrics(self):
+        """Return a dict of queue depths and wait times since the last 'resetMetrics'."""
+        with self._cond:
+            return dict(
+                priorityDepth=len(self._priority),
+                bulkDepth=sum(len(q) for q in self._bulkByConnection.values()),
+                bulkConnections=len(self._bulkByConnection),
+                activeBulkWorkers=self._bulkWorkersActive,
+                maxDepth=self._maxDepth,
+                enqueued=self._enqueued,
+                started=self._started,
+                avgWait=self._totalWait / self._started if self._started else 0.0,
+                maxWait=self._maxWait,
+            )
+
+    def _depth(self):
+        return len(self._priority) + sum(len(q) for q in self._bulkByConnection.values())
+
+    def put(self, connectedChannel, msg, isPriority):
+        with self._cond:
+            if isPriority:
+                self._priority.append((connectedChannel, msg, time.time()))
+            else:
+                if connectedChannel not in self._bulkByConnection:
+                    self._bulkByConnection[connectedChannel] = collections.deque()
+                    self._bulkConnectionOrder.append(connectedChannel)
+
+                self._bulkByConnection[connectedChannel].append((msg, time.time()))
+
+            self._enqueued += 1
+            self._maxDepth = max(self._maxDepth, self._depth())
+            self._cond.notify()
+
+    def get(self, timeout):
+        """Block until there's a subscription to work on.
+
+        Returns a tuple (connectedChannel, msg, isPriority), or None if we
+        timed out or were stopped. Callers must call 'taskDone' with
+        'isPriority' once the subscription has been handled.
+        """
+        deadline = time.time() + timeout
+
+        with self._cond:
+            while not self._stopped:
+                if self._priority:
+                    connectedChannel, msg, enqueueTime = self._priority.popleft()
+                    self._recordStart(enqueueTime)
+                    return connectedChannel, msg, True
+
+                if self._bulkConnectionOrder and self._bulkWorkersActive < self.maxBulkWorkers:
+                    connectedChannel = self._bulkConnectionOrder.popleft()
+                    pending = self._bulkByConnection[connectedChannel]
+
+                    msg, enqueueTime = pending.popleft()
+
+                    if pending:
+                        self._bulkConnectionOrder.append(connectedChannel)
+                    else:
+                        del self._bulkByConnection[connectedChannel]
+
+                    self._bulkWorkersActive += 1
+                    self._recordStart(enqueueTime)
+                    return connectedChannel, msg, False
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+
+                self._cond.wait(remaining)
+
+            return None
+
+    def _recordStart(self, enqueueTime):
+        wait = time.time() - enqueueTime
+        self._started += 1
+        self._totalWait += wait
+        self._maxWait = max(self._maxWait, wait)
+
+    def taskDone(self, isPriority):
+        if not isPriority:
+            with self._cond:
+                self._bulkWorkersActive -= 1
+                self._cond.notify()
+
+    def dropConnection(self, connectedChannel):
+        with self._cond:
+            self._priority = collections.deque(
+                entry for entry in self._priority if entry[0] is not connectedChannel
+            )
+
+            if self._bulkByConnection.pop(connectedChannel, None) is not None:
+                self._bulkConnectionOrder.remove(connectedChannel)
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
 
 
 class Server:
@@ -156,6 +575,7 @@ class Server:
         self.verbose = False
 
         self._gc_interval = DEFAULT_GC_INTERVAL
+        self._gc_keys_per_step = DEFAULT_GC_KEYS_PER_STEP
 
         self._typeMap = None
 
@@ -165,9 +585,13 @@ class Server:
         # id of the next transaction
         self._cur_transaction_num = 0
 
-        # for each key, the last version number we committed
-        self._version_numbers = {}
-        self._version_numbers_timestamps = {}
+        # transaction ids start over every time we start, so clients resuming
+        # subscriptions need to know whether they're talking to the same server
+        self._epoch = genToken()
+
+        # for each ObjectFieldId and IndexId, the last version number we committed
+        # and when, along with the queue of keys we need to check for garbage.
+        self._version_numbers = VersionTable()
         self._min_acceptable_version_number = -1
 
         # _field_id to set(subscribed channel)
@@ -179,6 +603,17 @@ class Server:
         # for each individually subscribed ID, a set of channels
         self._id_to_channel = {}
 
+        # recent transactions, for SubscribeChanges streams
+        self._changeLog = ChangeLog(DEFAULT_CHANGE_LOG_TRANSACTIONS, self._cur_transaction_num)
+
+        # every ChangeSubscription on every channel
+        self._changeSubscriptions = set()
+
+        # see 'setSlowConsumerPolicy'
+        self._slowConsumerPolicy = SLOW_CONSUMER_PAUSE
+        self._maxHeldMessages = DEFAULT_MAX_HELD_MESSAGES
+        self._maxHeldKeys = DEFAULT_MAX_HELD_KEYS
+
         self.longTransactionThreshold = 1.0
 
         self.logInterval = 10.0
@@ -198,24 +633,47 @@ class Server:
         self._index_values_updated = 0
         self._subscriptions_written = 0
 
-        self._subscriptionResponseThread = None
+        self._subscriptionWorkerCount = DEFAULT_SUBSCRIPTION_WORKERS
+        self._subscriptionWorkers = []
+
+        # group commit: if not None, the number of seconds we'll wait to gather
+        # CompleteTransaction messages into one write against the kvstore.
+        self._groupCommitWindow = None
+        self._groupCommitMaxTransactions = None
+        self._groupCommitQueue = queue.Queue()
+        self._groupCommitThread = None
+
+        # while committing a group, the (connectedChannel, message) pairs we
+        # can't send until the group has been written to the kvstore.
+        self._groupCommitOutbox = None
+
+        # while committing a group, the callables that undo what it did to our
+        # own state, and the transactionWatcher notifications we're holding back,
+        # in case the kvstore fails to write it.
+        self._groupCommitUndo = None
+        self._groupCommitNotifications = None
+
+        # if not None, the arguments to 'enableWarmUp'
+        self._warmUpConfig = None
+        self._warmUpThread = None
+        self._warmUpProgress = dict(processed=0, total=None, done=False)
 
         self._shouldStop = threading.Event()
 
         # a queue of queue-subscription messages. we have to handle
-        # these on another thread because they can be quite large, and we don't want
+        # these on other threads because they can be quite large, and we don't want
         # to prevent message processing on the main thread.
-        self._subscriptionQueue = queue.Queue()
+        self._subscriptionQueue = SubscriptionScheduler(self._subscriptionWorkerCount)
 
-        # if we're building a subscription up, all the objects that have changed while our
-        # lock was released.
-        self._pendingSubscriptionRecheck = None
+        # worker thread ident -> the transactions that have been committed since
+        # that worker took the kvstore snapshot it's streaming a subscription from.
+        self._pendingSubscriptionRechecks = {}
 
         # fault injector to test this thing
         self._subscriptionBackgroundThreadCallback = None
         self._lazyLoadCallback = None
 
-        self._last_garbage_collect_timestamp = None
+        self._resetGcMetrics()
 
         self.identityProducer = IdentityProducer(self.allocateNewIdentityRoot())
 
@@ -223,15 +681,215 @@ class Server:
 
         self._removeOldDeadConnections()
 
+    def enableGroupCommit(self, window, maxTransactions=100):
+        """Batch concurrent transactions into a single write against the kvstore.
+
+        Must be called before 'start'.
+
+        Args:
+            window (float): the number of seconds to wait for more transactions
+                to arrive once we have one to commit.
+            maxTransactions (int): the most transactions to commit in one group.
+        """
+        assert not self._subscriptionWorkers, "Server is already started"
+        assert window >= 0 and maxTransactions >= 1
+
+        self._groupCommitWindow = window
+        self._groupCommitMaxTransactions = maxTransactions
+
+    def enableWarmUp(self, threadCount=4, batchSize=1000, hotSchemas=(), block=True):
+        """Bulk-load the kvstore into memory when we start.
+
+        Must be called before 'start'.
+
+        Args:
+            threadCount (int): the number of threads loading from the kvstore.
+            batchSize (int): the number of keys each thread loads at once.
+            hotSchemas: names of schemas whose data we should load first.
+            block (bool): if True, 'start' doesn't return (and so a TcpServer
+                doesn't accept connections) until we're warm. Otherwise we warm
+                up in the background while serving.
+        """
+        assert not self._subscriptionWorkers, "Server is already started"
+        assert threadCount >= 1 and batchSize >= 1
+
+        self._warmUpConfig = dict(
+            threadCount=threadCount,
+            batchSize=batchSize,
+            hotSchemas=set(hotSchemas),
+            block=block,
+        )
+
+    def warmUpProgress(self):
+        """Return a dict with the number of keys our warm-up has processed, out of how many."""
+        return dict(self._warmUpProgress)
+
+    def _warmUp(self):
+        with self._lock:
+            typeMap = self._currentTypeMap()
+
+            hotFieldIds = set(
+                fieldId
+                for fieldId, fieldDef in typeMap.fieldIdToDef.items()
+                if fieldDef.schema in self._warmUpConfig["hotSchemas"]
+            )
+
+        def priority(key):
+            return 0 if getattr(key, "fieldId", None) in hotFieldIds else 1
+
+        lastLog = [time.time()]
+
+        def onProgress(processed, total):
+            self._warmUpProgress = dict(processed=processed, total=total, done=False)
+
+            if time.time() - lastLog[0] > self.logInterval:
+                lastLog[0] = time.time()
+                self._logger.info("Warming up: processed %s of %s keys", processed, total)
+
+        try:
+            self._kvstore.warmCache(
+                threadCount=self._warmUpConfig["threadCount"],
+                batchSize=self._warmUpConfig["batchSize"],
+                priority=priority,
+                onProgress=onProgress,
+            )
+        except Exception:
+            self._logger.exception("Failed to warm up our kvstore:")
+        finally:
+            self._warmUpProgress = dict(self._warmUpProgress, done=True)
+
+    def setSubscriptionWorkerCount(self, workerCount):
+        """Set the number of threads servicing large subscriptions.
+
+        Must be called before 'start'. With more than one worker, one of them
+        is always held back for identity and index subscriptions.
+        """
+        assert not self._subscriptionWorkers, "Server is already started"
+        assert workerCount >= 1
+
+        self._subscriptionWorkerCount = workerCount
+        self._subscriptionQueue = SubscriptionScheduler(workerCount)
+
+    def setChangeLogRetention(self, maxTransactions):
+        """Keep (at least) this many recent transactions in memory.
+
+        We keep none by default. The ChangeLog serves SubscribeChanges streams,
+        lets reconnecting clients resume their subscriptions, and lets the resync
+        slow-consumer policy catch clients up. Each retained transaction holds a
+        copy of its writes, so this costs up to twice 'maxTransactions' times
+        the size of a typical transaction.
+
+        Streams that fall further behind than this are ended with ChangesUnavailable.
+        Zero turns change streams off.
+        """
+        with self._lock:
+            self._changeLog = ChangeLog(maxTransactions, self._cur_transaction_num)
+
+            for subscription in list(self._changeSubscriptions):
+                self._pumpChanges(subscription)
+
+    def setSlowConsumerPolicy(
+        self,
+        policy,
+        maxHeldMessages=DEFAULT_MAX_HELD_MESSAGES,
+        maxHeldKeys=DEFAULT_MAX_HELD_KEYS,
+    ):
+        """Decide what we do when a client isn't reading what we send it.
+
+        The transport tells us (through 'channelBackedUp') when too many bytes are
+        waiting to go to a client. Then, depending on 'policy':
+
+            SLOW_CONSUMER_DISCONNECT: we drop the connection.
+            SLOW_CONSUMER_PAUSE: we hold everything we'd send the client, merging
+                each run of Transactions into one, until the transport tells us
+                (through 'channelDrained') that it has caught up.
+            SLOW_CONSUMER_RESYNC: as for PAUSE, but we drop the client's Transactions
+                instead of holding them, and once it's caught up we send it a single
+                Transaction with everything it missed from the change log. Clients
+                with anything but eager subscriptions to whole types are paused
+                instead, and clients we can't catch up are disconnected.
+
+        We close the connection to any client we'd hold more than 'maxHeldMessages'
+        messages for. Since one message can carry any number of writes, we also
+        bound what we hold for a client by 'maxHeldKeys', the keys and index
+        memberships its messages carry: past that, a paused client we could resync
+        is resynced instead, and any other is disconnected.
+        """
+        assert policy in (SLOW_CONSUMER_DISCONNECT, SLOW_CONSUMER_PAUSE, SLOW_CONSUMER_RESYNC)
+
+        with self._lock:
+            self._slowConsumerPolicy = policy
+            self._maxHeldMessages = maxHeldMessages
+            self._maxHeldKeys = maxHeldKeys
+
+    def subscriptionQueueMetrics(self):
+        return self._subscriptionQueue.metrics()
+
+    def connectionMetrics(self):
+        """Return a list of dicts describing how far behind each client is.
+
+        'pendingBytes' is what the transport has waiting to go to the client (or None
+        if it can't tell us). The rest describe what we're holding for clients we've
+        stopped sending to: 'state' is None, "pause" or "resync", 'heldKeys' is the
+        number of keys and index memberships in what we're holding, and
+        'transactionLag' is the number of transactions we've committed since we
+        stopped.
+        """
+        with self._lock:
+            return [
+                dict(
+                    connIdentity=connectedChannel.connectionObject._identity,
+                    pendingBytes=channel.pendingBytecount(),
+                    **connectedChannel.heldMessageMetrics(self._cur_transaction_num),
+                )
+                for channel, connectedChannel in self._clientChannels.items()
+            ]
+
+    def gcMetrics(self):
+        """Return a dict describing the version-number garbage collector.
+
+        'trackedKeys' and 'pendingKeys' are the sizes of '_version_numbers' and of the
+        queue of keys waiting to be checked. The rest accumulate since the last reset.
+        """
+        with self._lock:
+            return dict(
+                self._gcMetrics,
+                trackedKeys=self._version_numbers.keyCount(),
+                pendingKeys=self._version_numbers.queuedCount(),
+            )
+
+    def _resetGcMetrics(self):
+        self._gcMetrics = dict(steps=0, examined=0, collected=0, totalPause=0.0, maxPause=0.0)
+
     def start(self):
-        self._subscriptionResponseThread = threading.Thread(target=self.serviceSubscriptions)
-        self._subscriptionResponseThread.daemon = True
-        self._subscriptionResponseThread.start()
+        if self._warmUpConfig is not None:
+            if self._warmUpConfig["block"]:
+                self._warmUp()
+            else:
+                self._warmUpThread = threading.Thread(target=self._warmUp)
+                self._warmUpThread.daemon = True
+                self._warmUpThread.start()
+
+        for _ in range(self._subscriptionWorkerCount):
+            worker = threading.Thread(target=self.serviceSubscriptions)
+            worker.daemon = True
+            worker.start()
+            self._subscriptionWorkers.append(worker)
+
+        if self._groupCommitWindow is not None:
+            self._groupCommitThread = threading.Thread(target=self.serviceGroupCommits)
+            self._groupCommitThread.daemon = True
+            self._groupCommitThread.start()
 
     def stop(self):
         self._shouldStop.set()
-        self._subscriptionQueue.put((None, None))
-        self._subscriptionResponseThread.join()
+        self._subscriptionQueue.stop()
+        for worker in self._subscriptionWorkers:
+            worker.join()
+
+        if self._groupCommitThread is not None:
+            self._groupCommitQueue.put(None)
+            self._groupCommitThread.join()
 
     def allocateNewIdentityRoot(self):
         with self._lock:
@@ -248,16 +906,173 @@ class Server:
             return result
 
     def serviceSubscriptions(self):
+        while not self._shouldStop.is_set():
+            task = self._subscriptionQueue.get(timeout=1.0)
+
+            if task is None:
+                continue
+
+            connectedChannel, msg, isPriority = task
+
+            try:
+                self.handleSubscriptionOnBackgroundThread(connectedChannel, msg)
+            except Exception:
+                self._logger.exception("Unexpected error in serviceSubscription thread:")
+            finally:
+                self._subscriptionQueue.taskDone(isPriority)
+
+    def serviceGroupCommits(self):
         while not self._shouldStop.is_set():
             try:
                 try:
-                    (connectedChannel, msg) = self._subscriptionQueue.get(timeout=1.0)
-                    if connectedChannel is not None:
-                        self.handleSubscriptionOnBackgroundThread(connectedChannel, msg)
+                    group = [self._groupCommitQueue.get(timeout=1.0)]
                 except queue.Empty:
-                    pass
+                    continue
+
+                if group[0] is None:
+                    continue
+
+                deadline = time.time() + self._groupCommitWindow
+
+                while len(group) < self._groupCommitMaxTransactions:
+                    try:
+                        entry = self._groupCommitQueue.get(
+                            timeout=max(deadline - time.time(), 0.0)
+                        )
+                    except queue.Empty:
+                        break
+
+                    if entry is None:
+                        break
+
+                    group.append(entry)
+
+                self._commitGroup(group)
             except Exception:
-                self._logger.exception("Unexpected error in serviceSubscription thread:")
+                self._logger.exception("Unexpected error in serviceGroupCommits thread:")
+
+    def _commitGroup(self, group):
+        """Commit a list of (connectedChannel, msg, transStartTime) in order.
+
+        Each transaction is conflict-checked against the ones before it exactly as if
+        it had been committed on its own, but the kvstore sees a single write, and
+        nothing goes back to the clients until that write has succeeded. If it fails,
+        we undo the whole group.
+        """
+        results = []
+
+        with self._lock:
+            startTransactionId = self._cur_transaction_num
+
+            self._groupCommitOutbox = []
+            self._groupCommitUndo = []
+            self._groupCommitNotifications = []
+            self._version_numbers.beginJournal()
+            self._kvstore.beginBatch()
+
+            try:
+                for connectedChannel, msg, transStartTime in group:
+                    if msg.matches.Flush:
+                        result = None
+                    else:
+                        result = self._completeTransaction(
+                            connectedChannel, msg, transStartTime
+                        )
+
+                    results.append((connectedChannel, msg, result))
+            finally:
+                outbox = self._groupCommitOutbox
+                undo = self._groupCommitUndo
+                notifications = self._groupCommitNotifications
+
+                self._groupCommitOutbox = None
+                self._groupCommitUndo = None
+                self._groupCommitNotifications = None
+
+                try:
+                    self._kvstore.commitBatch()
+                except Exception:
+                    self._logger.exception("Failed to write a group of transactions:")
+                    badKey = traceback.format_exc()
+
+                    # none of these made it (the kvstore has already put itself back), so
+                    # undo them, drop the broadcasts, and tell everybody they failed
+                    self._rollBackGroup(startTransactionId, undo)
+
+                    outbox = []
+                    notifications = [
+                        args[:-4] + (None, False, "<EXCEPTION>", badKey) if args[-3] else args
+                        for args in notifications
+                    ]
+                    results = [
+                        (c, msg, None if result is None else (False, badKey, True))
+                        for c, msg, result in results
+                    ]
+                else:
+                    self._version_numbers.endJournal()
+
+            for connectedChannel, msg in outbox:
+                self._sendToChannel(connectedChannel, msg)
+
+            for args in notifications:
+                self.transactionWatcher.onTransaction(*args)
+
+            for subscription in list(self._changeSubscriptions):
+                self._pumpChanges(subscription)
+
+        for connectedChannel, msg, result in results:
+            if result is None:
+                connectedChannel.write(ServerToClient.FlushResponse(guid=msg.guid))
+            else:
+                isOK, badKey, isException = result
+
+                connectedChannel.sendTransactionSuccess(
+                    msg.transaction_guid, isOK, badKey, isException=isException
+                )
+
+    def _rollBackGroup(self, transactionId, undo):
+        """Put our own state back the way it was before a group that failed to commit.
+
+        Args:
+            transactionId - the last transaction id before the group.
+            undo - the callables registered with '_undoIfGroupFails', in order.
+        """
+        for action in reversed(undo):
+            action()
+
+        self._version_numbers.rollbackJournal()
+        self._changeLog.discardAfter(transactionId)
+
+        for pendingTransactions in self._pendingSubscriptionRechecks.values():
+            pendingTransactions[:] = [
+                t for t in pendingTransactions if t.transaction_id <= transactionId
+            ]
+
+        self._cur_transaction_num = transactionId
+
+    def _undoIfGroupFails(self, action):
+        """If we're committing a group, call 'action' should the kvstore fail to write it."""
+        if self._groupCommitUndo is not None:
+            self._groupCommitUndo.append(action)
+
+    def _notifyTransactionWatcher(self, *args):
+        """Pass a transaction to our transactionWatcher, once we know whether it committed."""
+        if self._groupCommitNotifications is not None:
+            self._groupCommitNotifications.append(args)
+        else:
+            self.transactionWatcher.onTransaction(*args)
+
+    def _sendToChannel(self, connectedChannel, msg):
+        """Send a ServerToClient or BroadcastMessage produced by a commit to a channel.
+
+        If we're in the middle of a group commit, hold it until the group is written.
+        """
+        if self._groupCommitOutbox is not None:
+            self._groupCommitOutbox.append((connectedChannel, msg))
+        elif isinstance(msg, BroadcastMessage):
+            connectedChannel.sendTransaction(msg)
+        else:
+            connectedChannel.write(msg)
 
     def _removeOldDeadConnections(self):
         existsFieldId = self._currentTypeMap().fieldIdFor("core", "Connection", " exists")
@@ -317,6 +1132,97 @@ class Server:
 
             self._logger.debug("Connection heartbeat distribution is %s", heartbeatCount)
 
+    def channelBackedUp(self, channel, pendingBytes):
+        """The transport has 'pendingBytes' waiting to go to 'channel', which is too many."""
+        with self._lock:
+            connectedChannel = self._clientChannels.get(channel)
+
+            if connectedChannel is None or connectedChannel.isHoldingMessages:
+                return
+
+            self._logger.info(
+                "Connection %s has %s bytes waiting to be sent to it. Policy is '%s'.",
+                connectedChannel.connectionObject._identity,
+                pendingBytes,
+                self._slowConsumerPolicy,
+            )
+
+            if self._slowConsumerPolicy == SLOW_CONSUMER_DISCONNECT:
+                channel.close()
+                self.dropConnection(channel)
+                return
+
+            canResync = self._canResync(connectedChannel)
+
+            connectedChannel.holdMessages(
+                self._cur_transaction_num,
+                self._maxHeldMessages,
+                self._maxHeldKeys,
+                resync=self._slowConsumerPolicy == SLOW_CONSUMER_RESYNC and canResync,
+                canResync=canResync,
+            )
+
+    def channelDrained(self, channel):
+        """The transport has caught up on what it had waiting to go to 'channel'."""
+        with self._lock:
+            connectedChannel = self._clientChannels.get(channel)
+
+            if connectedChannel is None or not connectedChannel.isHoldingMessages:
+                return
+
+            resyncAfter = connectedChannel.resyncAfterTransactionId
+
+            if resyncAfter is None:
+                connectedChannel.releaseHeldMessages()
+                return
+
+            if connectedChannel.resyncInvalidated or not self._changeLog.covers(resyncAfter):
+                self._logger.info(
+                    "Can't catch connection %s up from transaction %s. Closing it.",
+                    connectedChannel.connectionObject._identity,
+                    resyncAfter,
+                )
+                channel.close()
+                self.dropConnection(channel)
+                return
+
+            coalescer = TransactionCoalescer()
+
+            for change in self._changesVisibleTo(connectedChannel, resyncAfter):
+                coalescer.add(*change)
+
+            connectedChannel.releaseHeldMessages(
+                [coalescer.message()] if coalescer.transactionCount else []
+            )
+
+    def _canResync(self, connectedChannel):
+        """Can we catch this client up from the change log alone?
+
+        Only if it's subscribed to whole types, eagerly, and to nothing else.
+        """
+        return (
+            self._changeLog.maxTransactions > 0
+            and not connectedChannel.subscribedIndexKeys
+            and not connectedChannel.subscribedIds
+            and all(tid == -1 for tid in connectedChannel.subscribedFields.values())
+        )
+
+    def _addIndexSubscriber(self, index_key, connectedChannel):
+        if index_key not in self._index_to_channel:
+            self._index_to_channel[index_key] = set()
+
+            # keep the index's members cached while anybody's subscribed to it
+            self._kvstore.pin(index_key)
+
+        self._index_to_channel[index_key].add(connectedChannel)
+
+    def _removeIndexSubscriber(self, index_key, connectedChannel):
+        self._index_to_channel[index_key].discard(connectedChannel)
+
+        if not self._index_to_channel[index_key]:
+            del self._index_to_channel[index_key]
+            self._kvstore.unpin(index_key)
+
     def dropConnection(self, channel):
         with self._lock:
             if channel not in self._clientChannels:
@@ -329,9 +1235,10 @@ class Server:
                 self._field_id_to_channel[fieldId].discard(connectedChannel)
 
             for index_key in connectedChannel.subscribedIndexKeys:
-                self._index_to_channel[index_key].discard(connectedChannel)
-                if not self._index_to_channel[index_key]:
-                    del self._index_to_channel[index_key]
+                self._removeIndexSubscriber(index_key, connectedChannel)
+
+            for index_key in connectedChannel.pinnedTypeIndexKeys:
+                self._kvstore.unpin(index_key)
 
             for identity in connectedChannel.subscribedIds:
                 if identity in self._id_to_channel:
@@ -339,10 +1246,16 @@ class Server:
                     if not self._id_to_channel[identity]:
                         del self._id_to_channel[identity]
 
+            self._changeSubscriptions.difference_update(
+                connectedChannel.changeSubscriptions.values()
+            )
+
             connectionsToDrop = connectedChannel.dependentConnections
 
             del self._clientChannels[channel]
 
+            self._subscriptionQueue.dropConnection(connectedChannel)
+
             for co in connectionsToDrop:
                 self._dropConnectionEntry(co)
 
@@ -401,7 +1314,11 @@ class Server:
                 connectionObject, identityRoot = self._createConnectionEntry()
 
                 connectedChannel = ConnectedChannel(
-                    self._cur_transaction_num, channel, connectionObject, identityRoot
+                    self._cur_transaction_num,
+                    channel,
+                    connectionObject,
+                    identityRoot,
+                    self._epoch,
                 )
 
                 self._clientChannels[channel] = connectedChannel
@@ -431,7 +1348,9 @@ class Server:
                 and len(identities) < self.MAX_LAZY_TO_SEND_SYNCHRONOUSLY
                 or len(identities) < self.MAX_NORMAL_TO_SEND_SYNCHRONOUSLY
             ):
-                self._subscriptionQueue.put((channel, msg))
+                self._subscriptionQueue.put(
+                    channel, msg, isPriority=msg.fieldname_and_value is not None
+                )
                 return
 
             # handle this directly
@@ -443,6 +1362,7 @@ class Server:
                     typedef,
                     identities,
                     channel,
+                    fields=msg.fields,
                 )
                 return
 
@@ -455,7 +1375,7 @@ class Server:
                 identities,
                 set(identities),
                 BATCH_SIZE=None,
-                checkPending=False,
+                fields=msg.fields,
             )
 
             self._markSubscriptionComplete(
@@ -465,9 +1385,10 @@ class Server:
                 identities,
                 channel,
                 isLazy=False,
+                fields=msg.fields,
             )
 
-            channel.channel.write(
+            channel.write(
                 ServerToClient.SubscriptionComplete(
                     schema=msg.schema,
                     typename=msg.typename,
@@ -522,6 +1443,8 @@ class Server:
             msg.fieldname_and_value,
             msg.isLazy,
         ):
+            workerId = threading.get_ident()
+
             try:
                 with self._lock:
                     typedef, identities = self._parseSubscriptionMsg(connectedChannel, msg)
@@ -548,25 +1471,31 @@ class Server:
                             typedef,
                             identities,
                             connectedChannel,
+                            fields=msg.fields,
                         )
                         return True
 
-                    self._pendingSubscriptionRecheck = []
+                    # stream the subscription out of a snapshot taken at this tid,
+                    # so we don't need our lock while we do it. We keep track of
+                    # what gets committed in the meantime and bring the client
+                    # up to date once we're done.
+                    snapshot = self._kvstore.snapshot()
+
+                    fieldIds, indexFieldIds = self._subscriptionFieldIds(
+                        msg.schema, msg.typename, typedef, msg.fields
+                    )
+                    matchingIndexKey = self._subscriptionIndexKey(msg)
 
-                # we need to send everything we know about 'identities',
-                # keeping in mind that we have to check any new identities
-                # that get written to in the background to see if they
-                # belong in the new set
-                identities_left_to_send = set(identities)
+                    self._pendingSubscriptionRechecks[workerId] = []
 
-                messageCount = 0
-                while True:
-                    locktime_start = time.time()
+                try:
+                    identities_left_to_send = set(identities)
 
-                    if self._subscriptionBackgroundThreadCallback:
-                        self._subscriptionBackgroundThreadCallback(messageCount)
+                    messageCount = 0
+                    while identities_left_to_send:
+                        if self._subscriptionBackgroundThreadCallback:
+                            self._subscriptionBackgroundThreadCallback(messageCount)
 
-                    with self._lock:
                         messageCount += 1
                         if messageCount == 2:
                             self._logger.info(
@@ -576,6 +1505,46 @@ class Server:
                                 msg.fieldname_and_value,
                             )
 
+                        to_send = [
+                            identities_left_to_send.pop()
+                            for _ in range(min(100, len(identities_left_to_send)))
+                        ]
+
+                        self._writeSubscriptionData(
+                            connectedChannel,
+                            msg.schema,
+                            msg.typename,
+                            msg.fieldname_and_value,
+                            *self._readSubscriptionData(
+                                snapshot, fieldIds, indexFieldIds, to_send
+                            ),
+                            to_send,
+                        )
+                finally:
+                    snapshot.release()
+
+                with self._lock:
+                    if connectedChannel.channel not in self._clientChannels:
+                        self._logger.warn("Dropping subscription for channel that died.")
+                        return
+
+                    # resend anything that changed after our snapshot, and anything
+                    # that moved into the set we're subscribing to
+                    changed = set()
+
+                    for transactionMessage in self._pendingSubscriptionRechecks[workerId]:
+                        for key in transactionMessage.writes:
+                            if key.objId in identities:
+                                changed.add(key.objId)
+
+                        if matchingIndexKey is not None:
+                            changed.update(
+                                transactionMessage.set_adds.get(matchingIndexKey, ())
+                            )
+
+                    identities.update(changed)
+
+                    if changed:
                         self._sendPartialSubscription(
                             connectedChannel,
                             msg.schema,
@@ -583,134 +1552,621 @@ class Server:
                             msg.fieldname_and_value,
                             typedef,
                             identities,
-                            identities_left_to_send,
+                            changed,
+                            BATCH_SIZE=None,
+                            fields=msg.fields,
                         )
 
-                        self._pendingSubscriptionRecheck = []
+                    self._markSubscriptionComplete(
+                        msg.schema,
+                        msg.typename,
+                        msg.fieldname_and_value,
+                        identities,
+                        connectedChannel,
+                        isLazy=False,
+                        fields=msg.fields,
+                    )
 
-                        if not identities_left_to_send:
-                            self._markSubscriptionComplete(
-                                msg.schema,
-                                msg.typename,
-                                msg.fieldname_and_value,
-                                identities,
-                                connectedChannel,
-                                isLazy=False,
-                            )
+                    connectedChannel.write(
+                        ServerToClient.SubscriptionComplete(
+                            schema=msg.schema,
+                            typename=msg.typename,
+                            fieldname_and_value=msg.fieldname_and_value,
+                            tid=self._cur_transaction_num,
+                        )
+                    )
 
-                            connectedChannel.channel.write(
-                                ServerToClient.SubscriptionComplete(
-                                    schema=msg.schema,
-                                    typename=msg.typename,
-                                    fieldname_and_value=msg.fieldname_and_value,
-                                    tid=self._cur_transaction_num,
-                                )
-                            )
+                if self._subscriptionBackgroundThreadCallback:
+                    self._subscriptionBackgroundThreadCallback("DONE")
+            finally:
+                with self._lock:
+                    self._pendingSubscriptionRechecks.pop(workerId, None)
+
+    def _subscriptionFieldIds(self, schema_name, typename, typedef, fields=None):
+        """Return the field ids of the values and the index values of a type.
+
+        Args:
+            fields: if not None, the subset of 'typedef.fields' to send.
+
+        Returns:
+            a pair of lists of field ids, the first for 'typedef.fields'
+            and the second for 'typedef.indices'.
+        """
+        typeMap = self._currentTypeMap()
+
+        return (
+            [
+                typeMap.fieldIdFor(schema_name, typename, f)
+                for f in typedef.fields
+                if fields is None or f in fields or f == " exists"
+            ],
+            [typeMap.lookupOrAdd(schema_name, typename, f) for f in typedef.indices],
+        )
+
+    def _subscriptionIndexKey(self, msg):
+        """Return the IndexId whose membership defines a subscription, or None."""
+        if msg.fieldname_and_value is None:
+            field, val = " exists", indexValueFor(bool, True)
+        else:
+            field, val = msg.fieldname_and_value
+
+        if field == "_identity":
+            return None
+
+        return IndexId(
+            fieldId=self._currentTypeMap().lookupOrAdd(msg.schema, msg.typename, field),
+            indexValue=val,
+        )
+
+    def _readSubscriptionData(self, kvstore, fieldIds, indexFieldIds, identities):
+        """Read the values and index values of 'identities' out of 'kvstore'.
+
+        Returns:
+            a pair of dicts (values, index_values) from ObjectFieldId to value.
+        """
+        kvs = {}
+
+        for fieldId in fieldIds:
+            keys = [ObjectFieldId(fieldId=fieldId, objId=identity) for identity in identities]
+
+            vals = kvstore.getSeveral(keys)
+
+            for i in range(len(keys)):
+                kvs[keys[i]] = vals[i]
+
+        index_vals = {}
+
+        for fieldId in indexFieldIds:
+            keys = [
+                ObjectFieldId(fieldId=fieldId, objId=identity, isIndexValue=True)
+                for identity in identities
+            ]
+
+            vals = kvstore.getSeveral(keys)
+
+            for i in range(len(keys)):
+                index_vals[keys[i]] = vals[i]
+
+        return kvs, index_vals
+
+    def _writeSubscriptionData(
+        self,
+        connectedChannel,
+        schema_name,
+        typename,
+        fieldname_and_value,
+        kvs,
+        index_vals,
+        sent,
+    ):
+        connectedChannel.write(
+            ServerToClient.SubscriptionData(
+                schema=schema_name,
+                typename=typename,
+                fieldname_and_value=fieldname_and_value,
+                values=kvs,
+                index_values=index_vals,
+                identities=None if fieldname_and_value is None else tuple(sent),
+            )
+        )
+
+    def _completeLazySubscription(
+        self,
+        schema_name,
+        typename,
+        fieldname_and_value,
+        typedef,
+        identities,
+        connectedChannel,
+        fields=None,
+    ):
+        index_vals = self._buildIndexValueMap(typedef, schema_name, typename, identities)
+
+        connectedChannel.write(
+            ServerToClient.LazySubscriptionData(
+                schema=schema_name,
+                typename=typename,
+                fieldname_and_value=fieldname_and_value,
+                identities=identities,
+                index_values=index_vals,
+            )
+        )
+
+        # just send the identities
+        self._markSubscriptionComplete(
+            schema_name,
+            typename,
+            fieldname_and_value,
+            identities,
+            connectedChannel,
+            isLazy=True,
+            fields=fields,
+        )
+
+        connectedChannel.write(
+            ServerToClient.SubscriptionComplete(
+                schema=schema_name,
+                typename=typename,
+                fieldname_and_value=fieldname_and_value,
+                tid=self._cur_transaction_num,
+            )
+        )
+
+    def _buildIndexValueMap(self, typedef, schema_name, typename, identities):
+        # build a map from reverse-index-key to {identity}
+        index_vals = {}
+
+        for fieldname in typedef.indices:
+            fieldId = self._currentTypeMap().lookupOrAdd(schema_name, typename, fieldname)
+
+            keys = [
+                ObjectFieldId(fieldId=fieldId, objId=identity, isIndexValue=True)
+                for identity in identities
+            ]
+
+            vals = self._kvstore.getSeveral(keys)
+
+            for i in range(len(keys)):
+                index_vals[keys[i]] = vals[i]
+
+        return index_vals
+
+    def _markSubscriptionComplete(
+        self,
+        schema,
+        typename,
+        fieldname_and_value,
+        identities,
+        connectedChannel,
+        isLazy,
+        fields=None,
+    ):
+        newlyVisibleFieldIds = self._widenFieldProjection(
+            connectedChannel, schema, typename, fields
+        )
+
+        if fieldname_and_value is not None and newlyVisibleFieldIds:
+            self._backfillNewlyVisibleFields(
+                connectedChannel, schema, typename, fieldname_and_value, newlyVisibleFieldIds
+            )
+
+        if fieldname_and_value is not None:
+            # this is an index subscription
+            if fieldname_and_value[0] != "_identity":
+                fieldId = self._currentTypeMap().fieldIdFor(
+                    schema, typename, fieldname_and_value[0]
+                )
+                index_key = IndexId(fieldId=fieldId, indexValue=fieldname_and_value[1])
+
+                inScope = connectedChannel.subscribedIndexIdentities.setdefault(
+                    index_key, set()
+                )
+                self._addSubscribedIds(connectedChannel, set(identities) - inScope)
+                inScope.update(identities)
+
+                self._addIndexSubscriber(index_key, connectedChannel)
+
+                connectedChannel.subscribedIndexKeys[index_key] = (
+                    -1 if not isLazy else self._cur_transaction_num
+                )
+            else:
+                # an object's identity cannot change,
+                # so we don't need to track our subscription to it
+                assert not isLazy
+
+                self._addSubscribedIds(connectedChannel, identities)
+        else:
+            # this is a type-subscription. We re-read the type's members whenever
+            # the channel subscribes or widens, so keep them cached while it lasts.
+            existsIndexKey = IndexId(
+                fieldId=self._currentTypeMap().fieldIdFor(schema, typename, " exists"),
+                indexValue=indexValueFor(bool, True),
+            )
+
+            if existsIndexKey not in connectedChannel.pinnedTypeIndexKeys:
+                connectedChannel.pinnedTypeIndexKeys.add(existsIndexKey)
+                self._kvstore.pin(existsIndexKey)
+
+            for fieldname in connectedChannel.definedSchemas[schema][typename].fields:
+                fieldId = self._currentTypeMap().fieldIdFor(schema, typename, fieldname)
+                if fieldId in connectedChannel.hiddenFieldIds:
+                    continue
+
+                if fieldId not in self._field_id_to_channel:
+                    self._field_id_to_channel[fieldId] = set()
+
+                self._field_id_to_channel[fieldId].add(connectedChannel)
+
+                connectedChannel.subscribedFields[fieldId] = (
+                    -1 if not isLazy else self._cur_transaction_num
+                )
+
+    def _widenFieldProjection(self, connectedChannel, schema, typename, fields):
+        """Let 'connectedChannel' see 'fields' of a type, or every field if None.
+
+        A channel sees the union of the fields its subscriptions to a type asked for.
+
+        Returns:
+            the list of fieldIds that were hidden from the channel and no longer are.
+        """
+        projection = connectedChannel.fieldProjections.get((schema, typename), set())
+
+        if projection is None or fields is None:
+            projection = None
+        else:
+            projection = projection | set(fields) | {" exists"}
+
+        connectedChannel.fieldProjections[(schema, typename)] = projection
+
+        newlyVisible = []
+
+        for fieldname in connectedChannel.definedSchemas[schema][typename].fields:
+            fieldId = self._currentTypeMap().fieldIdFor(schema, typename, fieldname)
+
+            if projection is None or fieldname in projection:
+                if fieldId in connectedChannel.hiddenFieldIds:
+                    connectedChannel.hiddenFieldIds.discard(fieldId)
+                    newlyVisible.append(fieldId)
+            else:
+                connectedChannel.hiddenFieldIds.add(fieldId)
+
+        return newlyVisible
+
+    def _backfillNewlyVisibleFields(
+        self, connectedChannel, schema, typename, fieldname_and_value, fieldIds
+    ):
+        """Send a channel 'fieldIds' for the objects of a type it already holds.
+
+        Another subscription to the type just made these fields visible, but the
+        subscriptions that gave the channel its objects never sent them. We send
+        their current values as part of the new subscription's data. If the channel
+        subscribes to the whole type, the fields join that subscription too.
+        """
+        existsFieldId = self._currentTypeMap().fieldIdFor(schema, typename, " exists")
+        subscribedTid = connectedChannel.subscribedFields.get(existsFieldId)
+
+        identities = set()
+
+        if subscribedTid is not None:
+            for fieldId in fieldIds:
+                self._field_id_to_channel.setdefault(fieldId, set()).add(connectedChannel)
+                connectedChannel.subscribedFields[fieldId] = subscribedTid
+
+            identities.update(
+                self._kvstore.getSetMembers(
+                    IndexId(fieldId=existsFieldId, indexValue=indexValueFor(bool, True))
+                )
+            )
+
+        # objects held through index and identity subscriptions. 'subscribedIds'
+        # mixes every type, so we keep the ones that exist as this type.
+        candidates = list(connectedChannel.subscribedIds - identities)
+
+        if candidates:
+            exists = self._kvstore.getSeveral(
+                [ObjectFieldId(fieldId=existsFieldId, objId=ident) for ident in candidates]
+            )
+            identities.update(
+                ident for ident, value in zip(candidates, exists) if value is not None
+            )
+
+        identities = list(identities)
+
+        for i in range(0, len(identities), BACKFILL_BATCH_SIZE):
+            values, _ = self._readSubscriptionData(
+                self._kvstore, fieldIds, [], identities[i : i + BACKFILL_BATCH_SIZE]
+            )
+
+            connectedChannel.write(
+                ServerToClient.SubscriptionData(
+                    schema=schema,
+                    typename=typename,
+                    fieldname_and_value=fieldname_and_value,
+                    values=values,
+                    index_values={},
+                    identities=(),
+                )
+            )
+
+    def _addSubscribedIds(self, connectedChannel, identities):
+        """Take a reference to each of 'identities' on behalf of one subscription.
+
+        Returns:
+            the set of identities that weren't already routed to 'connectedChannel'.
+        """
+        identities = list(identities)
+        newIds = set()
+
+        self._undoIfGroupFails(
+            functools.partial(self._removeSubscribedIds, connectedChannel, identities)
+        )
+
+        for ident in identities:
+            refcount = connectedChannel.subscribedIdRefcounts.get(ident, 0)
+            connectedChannel.subscribedIdRefcounts[ident] = refcount + 1
+
+            if not refcount:
+                newIds.add(ident)
+                connectedChannel.subscribedIds.add(ident)
+                self._id_to_channel.setdefault(ident, set()).add(connectedChannel)
+
+        return newIds
+
+    def _removeSubscribedIds(self, connectedChannel, identities):
+        """Drop a reference to each of 'identities' taken by '_addSubscribedIds'.
+
+        Returns:
+            the set of identities that are no longer routed to 'connectedChannel'.
+        """
+        droppedIds = set()
+
+        for ident in identities:
+            refcount = connectedChannel.subscribedIdRefcounts.get(ident, 0)
+
+            if refcount > 1:
+                connectedChannel.subscribedIdRefcounts[ident] = refcount - 1
+            elif refcount == 1:
+                del connectedChannel.subscribedIdRefcounts[ident]
+                connectedChannel.subscribedIds.discard(ident)
+                droppedIds.add(ident)
+
+                channels = self._id_to_channel.get(ident)
+                if channels is not None:
+                    channels.discard(connectedChannel)
+                    if not channels:
+                        del self._id_to_channel[ident]
+
+        return droppedIds
+
+    def _handleUnsubscribe(self, connectedChannel, msg):
+        schema_name = msg.schema
+        typename = msg.typename
+
+        definition = connectedChannel.definedSchemas.get(schema_name)
+
+        assert definition is not None, "can't unsubscribe from a schema we don't know about!"
+        assert typename in definition, "Can't unsubscribe from a type we didn't define: %s" % (
+            typename
+        )
+
+        typedef = definition[typename]
+        typeMap = self._currentTypeMap()
+
+        existsFieldId = typeMap.fieldIdFor(schema_name, typename, " exists")
+
+        if msg.fieldname_and_value is None:
+            for fieldname in typedef.fields:
+                fieldId = typeMap.fieldIdFor(schema_name, typename, fieldname)
+
+                connectedChannel.subscribedFields.pop(fieldId, None)
+
+                if fieldId in self._field_id_to_channel:
+                    self._field_id_to_channel[fieldId].discard(connectedChannel)
+
+            existsIndexKey = IndexId(
+                fieldId=existsFieldId, indexValue=indexValueFor(bool, True)
+            )
+
+            if existsIndexKey in connectedChannel.pinnedTypeIndexKeys:
+                connectedChannel.pinnedTypeIndexKeys.discard(existsIndexKey)
+                self._kvstore.unpin(existsIndexKey)
+
+            # everything of this type that we're not holding onto for some other reason
+            droppedIds = (
+                set(
+                    self._kvstore.getSetMembers(
+                        IndexId(fieldId=existsFieldId, indexValue=indexValueFor(bool, True))
+                    )
+                )
+                - connectedChannel.subscribedIds
+            )
+        else:
+            field, val = msg.fieldname_and_value
+
+            if field == "_identity":
+                inScope = set([deserialize(ObjectBase, val)._identity])
+            else:
+                index_key = IndexId(
+                    fieldId=typeMap.fieldIdFor(schema_name, typename, field), indexValue=val
+                )
+
+                inScope = connectedChannel.subscribedIndexIdentities.pop(index_key, set())
+                connectedChannel.subscribedIndexKeys.pop(index_key, None)
+
+                if index_key in self._index_to_channel:
+                    self._removeIndexSubscriber(index_key, connectedChannel)
+
+            droppedIds = self._removeSubscribedIds(connectedChannel, inScope)
+
+            if existsFieldId in connectedChannel.subscribedFields:
+                # we're still subscribed to the whole type
+                droppedIds = set()
+
+        # tell the client to forget everything that left its scope. Nothing was
+        # written, so this happens as of the current transaction id.
+        writes = {}
+        set_removes = {}
+
+        for fieldname in typedef.fields:
+            fieldId = typeMap.fieldIdFor(schema_name, typename, fieldname)
 
-                            break
+            if fieldId is not None:
+                for ident in droppedIds:
+                    writes[ObjectFieldId(fieldId=fieldId, objId=ident)] = None
 
-                    # don't hold the lock more than 75% of the time.
-                    time.sleep((time.time() - locktime_start) / 3)
+        for fieldname in typedef.indices:
+            fieldId = typeMap.fieldIdFor(schema_name, typename, fieldname)
 
-                if self._subscriptionBackgroundThreadCallback:
-                    self._subscriptionBackgroundThreadCallback("DONE")
-            finally:
-                with self._lock:
-                    self._pendingSubscriptionRecheck = None
+            if fieldId is not None:
+                keys = [
+                    ObjectFieldId(fieldId=fieldId, objId=ident, isIndexValue=True)
+                    for ident in droppedIds
+                ]
 
-    def _completeLazySubscription(
-        self, schema_name, typename, fieldname_and_value, typedef, identities, connectedChannel
-    ):
-        index_vals = self._buildIndexValueMap(typedef, schema_name, typename, identities)
+                for key, indexValue in zip(keys, self._kvstore.getSeveral(keys)):
+                    if indexValue is not None:
+                        set_removes.setdefault(
+                            IndexId(fieldId=fieldId, indexValue=indexValue), []
+                        ).append(key.objId)
 
-        connectedChannel.channel.write(
-            ServerToClient.LazySubscriptionData(
+        connectedChannel.write(
+            ServerToClient.UnsubscribeComplete(
                 schema=schema_name,
                 typename=typename,
-                fieldname_and_value=fieldname_and_value,
-                identities=identities,
-                index_values=index_vals,
+                fieldname_and_value=msg.fieldname_and_value,
+                writes=writes,
+                set_removes={k: tuple(v) for k, v in set_removes.items()},
+                tid=self._cur_transaction_num,
             )
         )
 
-        # just send the identities
-        self._markSubscriptionComplete(
-            schema_name,
-            typename,
-            fieldname_and_value,
-            identities,
-            connectedChannel,
-            isLazy=True,
-        )
+    def _handleSubscribeChanges(self, connectedChannel, msg):
+        if msg.subscription_guid in connectedChannel.changeSubscriptions:
+            self._endChangeSubscription(
+                connectedChannel.changeSubscriptions[msg.subscription_guid],
+                "subscription_guid is already in use",
+            )
+            return
 
-        connectedChannel.channel.write(
-            ServerToClient.SubscriptionComplete(
-                schema=schema_name,
-                typename=typename,
-                fieldname_and_value=fieldname_and_value,
-                tid=self._cur_transaction_num,
+        subscription = ChangeSubscription(connectedChannel, msg)
+
+        connectedChannel.changeSubscriptions[msg.subscription_guid] = subscription
+        self._changeSubscriptions.add(subscription)
+
+        if not self._changeLog.maxTransactions:
+            self._endChangeSubscription(
+                subscription, "this server doesn't retain transactions for change streams"
             )
-        )
+            return
 
-    def _buildIndexValueMap(self, typedef, schema_name, typename, identities):
-        # build a map from reverse-index-key to {identity}
-        index_vals = {}
+        if (
+            msg.server_epoch != self._epoch
+            or msg.from_transaction_id > self._cur_transaction_num
+        ):
+            # transaction ids start over when the server restarts
+            self._endChangeSubscription(
+                subscription,
+                f"transaction {msg.from_transaction_id} is from a different run of "
+                f"the server (epoch '{msg.server_epoch}', not '{self._epoch}')",
+            )
+            return
 
-        for fieldname in typedef.indices:
-            fieldId = self._currentTypeMap().lookupOrAdd(schema_name, typename, fieldname)
+        self._pumpChanges(subscription)
 
-            keys = [
-                ObjectFieldId(fieldId=fieldId, objId=identity, isIndexValue=True)
-                for identity in identities
-            ]
+    def _handleResumeSubscriptions(self, connectedChannel, msg):
+        """Subscribe a reconnecting client to whole types without resending them.
 
-            vals = self._kvstore.getSeveral(keys)
+        If we still have every transaction since the one the client last applied,
+        we send it those (cut down to the types it subscribes to) instead of
+        every object. Otherwise we leave it to subscribe from scratch.
+        """
+        canResume = (
+            msg.server_epoch == self._epoch
+            and msg.transaction_id <= self._cur_transaction_num
+            and self._changeLog.covers(msg.transaction_id)
+            and all(
+                typename in connectedChannel.definedSchemas.get(schema, ())
+                for schema, typename, _ in msg.types
+            )
+        )
 
-            for i in range(len(keys)):
-                index_vals[keys[i]] = vals[i]
+        if not canResume:
+            self._sendToChannel(
+                connectedChannel,
+                ServerToClient.SubscriptionsResumed(
+                    resumed=False, tid=self._cur_transaction_num
+                ),
+            )
+            return
 
-        return index_vals
+        for schema, typename, fields in msg.types:
+            self._markSubscriptionComplete(
+                schema, typename, None, (), connectedChannel, isLazy=False, fields=fields
+            )
 
-    def _markSubscriptionComplete(
-        self, schema, typename, fieldname_and_value, identities, connectedChannel, isLazy
-    ):
-        if fieldname_and_value is not None:
-            # this is an index subscription
-            for ident in identities:
-                self._id_to_channel.setdefault(ident, set()).add(connectedChannel)
+        for transactionId, writes, set_adds, set_removes in self._changesVisibleTo(
+            connectedChannel, msg.transaction_id
+        ):
+            self._sendToChannel(
+                connectedChannel,
+                ServerToClient.Transaction(
+                    writes=writes,
+                    set_adds=set_adds,
+                    set_removes=set_removes,
+                    transaction_id=transactionId,
+                ),
+            )
 
-                connectedChannel.subscribedIds.add(ident)
+        self._sendToChannel(
+            connectedChannel,
+            ServerToClient.SubscriptionsResumed(resumed=True, tid=self._cur_transaction_num),
+        )
 
-            if fieldname_and_value[0] != "_identity":
-                fieldId = self._currentTypeMap().fieldIdFor(
-                    schema, typename, fieldname_and_value[0]
-                )
-                index_key = IndexId(fieldId=fieldId, indexValue=fieldname_and_value[1])
+    def _changesVisibleTo(self, connectedChannel, transactionId):
+        """Yield the change log's changes after 'transactionId' that a client can see.
 
-                if index_key not in self._index_to_channel:
-                    self._index_to_channel[index_key] = set()
+        Each is cut down to the fields the client subscribes to, and changes that
+        leave nothing are skipped.
+        """
+        visibleFieldIds = connectedChannel.subscribedFields
 
-                self._index_to_channel[index_key].add(connectedChannel)
+        for transactionId, writes, set_adds, set_removes in self._changeLog.changesAfter(
+            transactionId
+        ):
+            writes = {k: v for k, v in writes.items() if k.fieldId in visibleFieldIds}
+            set_adds = {k: v for k, v in set_adds.items() if k.fieldId in visibleFieldIds}
+            set_removes = {
+                k: v for k, v in set_removes.items() if k.fieldId in visibleFieldIds
+            }
 
-                connectedChannel.subscribedIndexKeys[index_key] = (
-                    -1 if not isLazy else self._cur_transaction_num
-                )
-            else:
-                # an object's identity cannot change,
-                # so we don't need to track our subscription to it
-                assert not isLazy
-        else:
-            # this is a type-subscription
-            for fieldname in connectedChannel.definedSchemas[schema][typename].fields:
-                fieldId = self._currentTypeMap().fieldIdFor(schema, typename, fieldname)
-                if fieldId not in self._field_id_to_channel:
-                    self._field_id_to_channel[fieldId] = set()
+            if writes or set_adds or set_removes:
+                yield transactionId, writes, set_adds, set_removes
 
-                self._field_id_to_channel[fieldId].add(connectedChannel)
+    def _pumpChanges(self, subscription):
+        """Send a change stream whatever it's ready for."""
+        messages = subscription.pendingMessages(self._changeLog, self._currentTypeMap())
 
-                connectedChannel.subscribedFields[fieldId] = (
-                    -1 if not isLazy else self._cur_transaction_num
-                )
+        if messages is None:
+            self._endChangeSubscription(
+                subscription,
+                f"transactions after {subscription.lastSentTransactionId} are no longer "
+                f"retained. We have those after {self._changeLog.retainedAfter}.",
+            )
+            return
+
+        for message in messages:
+            self._sendToChannel(subscription.connectedChannel, message)
+
+    def _endChangeSubscription(self, subscription, reason):
+        subscription.connectedChannel.changeSubscriptions.pop(subscription.guid, None)
+        self._changeSubscriptions.discard(subscription)
+
+        self._sendToChannel(
+            subscription.connectedChannel,
+            ServerToClient.ChangesUnavailable(
+                subscription_guid=subscription.guid, reason=reason
+            ),
+        )
 
     def _currentTypeMap(self):
         if self._typeMap is None:
@@ -755,9 +2211,7 @@ class Server:
                     makeNamedTuple(schema=name, typename=typename, fieldname=indexname)
                 ] = fieldId
 
-        connectedChannel.channel.write(
-            ServerToClient.SchemaMapping(schema=name, mapping=result)
-        )
+        connectedChannel.write(ServerToClient.SchemaMapping(schema=name, mapping=result))
 
         if len(currentTypes) != origSize:
             self._kvstore.set(
@@ -774,65 +2228,23 @@ class Server:
         identities,
         identities_left_to_send,
         BATCH_SIZE=100,
-        checkPending=True,
+        fields=None,
     ):
-
-        # get some objects to send
-        kvs = {}
-        index_vals = {}
-
         to_send = []
-        if checkPending:
-            for transactionMessage in self._pendingSubscriptionRecheck:
-                for key in transactionMessage.writes:
-                    # if we write to a key we've already sent, we'll need to resend it
-                    identity = key.objId
-
-                    if identity in identities:
-                        identities_left_to_send.add(identity)
-
-                for add_index_key in transactionMessage.set_adds:
-                    add_index_identities = transactionMessage.set_adds[add_index_key]
-
-                    fieldDef = self._currentTypeMap().fieldIdToDef[add_index_key.fieldId]
-
-                    if (
-                        schema_name == fieldDef.schema
-                        and typename == fieldDef.typename
-                        and (
-                            fieldname_and_value is None
-                            and fieldDef.fieldname == " exists"
-                            or fieldname_and_value is not None
-                            and tuple(fieldname_and_value)
-                            == (fieldDef.fieldname, add_index_key.indexValue)
-                        )
-                    ):
-                        identities_left_to_send.update(add_index_identities)
-
         while identities_left_to_send and (BATCH_SIZE is None or len(to_send) < BATCH_SIZE):
             to_send.append(identities_left_to_send.pop())
 
-        for fieldname in typedef.fields:
-            fieldId = self._currentTypeMap().fieldIdFor(schema_name, typename, fieldname)
-
-            keys = [ObjectFieldId(fieldId=fieldId, objId=identity) for identity in to_send]
-
-            vals = self._kvstore.getSeveral(keys)
-
-            for i in range(len(keys)):
-                kvs[keys[i]] = vals[i]
-
-        index_vals = self._buildIndexValueMap(typedef, schema_name, typename, to_send)
+        fieldIds, indexFieldIds = self._subscriptionFieldIds(
+            schema_name, typename, typedef, fields
+        )
 
-        connectedChannel.channel.write(
-            ServerToClient.SubscriptionData(
-                schema=schema_name,
-                typename=typename,
-                fieldname_and_value=fieldname_and_value,
-                values=kvs,
-                index_values=index_vals,
-                identities=None if fieldname_and_value is None else tuple(to_send),
-            )
+        self._writeSubscriptionData(
+            connectedChannel,
+            schema_name,
+            typename,
+            fieldname_and_value,
+            *self._readSubscriptionData(self._kvstore, fieldIds, indexFieldIds, to_send),
+            to_send,
         )
 
     def onClientToServerMessage(self, connectedChannel, msg):
@@ -871,7 +2283,7 @@ class Server:
                 connectionObject, identityRoot = self._createConnectionEntry()
 
             connectedChannel.dependentConnections.add(connectionObject)
-            connectedChannel.channel.write(
+            connectedChannel.write(
                 ServerToClient.DependentConnectionId(
                     guid=msg.guid,
                     connIdentity=connectionObject._identity,
@@ -891,8 +2303,13 @@ class Server:
                 self._lazyLoadCallback(msg.identity)
 
         elif msg.matches.Flush:
+            if self._groupCommitThread is not None:
+                # stay ordered behind any transactions this channel has in flight
+                self._groupCommitQueue.put((connectedChannel, msg, None))
+                return
+
             with self._lock:
-                connectedChannel.channel.write(ServerToClient.FlushResponse(guid=msg.guid))
+                connectedChannel.write(ServerToClient.FlushResponse(guid=msg.guid))
         elif msg.matches.DefineSchema:
             with self._lock:
                 self._defineSchema(connectedChannel, msg.name, msg.definition)
@@ -903,51 +2320,87 @@ class Server:
         elif msg.matches.Subscribe:
             with self._lock:
                 self._handleSubscriptionInForeground(connectedChannel, msg)
+        elif msg.matches.Unsubscribe:
+            with self._lock:
+                self._handleUnsubscribe(connectedChannel, msg)
+        elif msg.matches.SubscribeChanges:
+            with self._lock:
+                self._handleSubscribeChanges(connectedChannel, msg)
+        elif msg.matches.AcknowledgeChanges:
+            with self._lock:
+                subscription = connectedChannel.changeSubscriptions.get(msg.subscription_guid)
+
+                if subscription is not None:
+                    subscription.acknowledge(msg.transaction_id)
+                    self._pumpChanges(subscription)
+        elif msg.matches.UnsubscribeChanges:
+            with self._lock:
+                subscription = connectedChannel.changeSubscriptions.pop(
+                    msg.subscription_guid, None
+                )
+                self._changeSubscriptions.discard(subscription)
+        elif msg.matches.ResumeSubscriptions:
+            with self._lock:
+                self._handleResumeSubscriptions(connectedChannel, msg)
         elif msg.matches.TransactionData:
             connectedChannel.handleTransactionData(msg)
         elif msg.matches.CompleteTransaction:
-            isException = False
-
-            try:
-                transStartTime = time.time()
-
-                data = connectedChannel.extractTransactionData(msg.transaction_guid)
+            transStartTime = time.time()
 
-                with self._lock:
-                    if msg.as_of_version < self._min_acceptable_version_number:
-                        self._logger.exception(
-                            "Transaction had an old as_of_version %s which is before "
-                            "the oldest garbage-collected as_of_version %s",
-                            msg.as_of_version,
-                            self._min_acceptable_version_number,
-                        )
+            if self._groupCommitThread is not None:
+                self._groupCommitQueue.put((connectedChannel, msg, transStartTime))
+                return
 
-                        isOK = False
-                        badKey = "<TRANSACTION TOO OLD>"
-                    else:
-                        isOK, badKey = self._handleNewTransaction(
-                            connectedChannel,
-                            data["writes"],
-                            data["prerequisites"],
-                            data["set_adds"],
-                            data["set_removes"],
-                            data["key_versions"],
-                            data["index_versions"],
-                            msg.as_of_version,
-                            transStartTime=transStartTime,
-                            no_log=msg.no_log,
-                            transaction_guid=msg.transaction_guid,
-                        )
-            except Exception:
-                self._logger.exception("Unknown error committing transaction:")
-                isOK = False
-                isException = True
-                badKey = traceback.format_exc()
+            with self._lock:
+                isOK, badKey, isException = self._completeTransaction(
+                    connectedChannel, msg, transStartTime
+                )
 
             connectedChannel.sendTransactionSuccess(
                 msg.transaction_guid, isOK, badKey, isException=isException
             )
 
+    def _completeTransaction(self, connectedChannel, msg, transStartTime):
+        """Commit the transaction data for a CompleteTransaction message.
+
+        Must be called with the lock held.
+
+        Returns:
+            a tuple (isOK, badKey, isException)
+        """
+        try:
+            data = connectedChannel.extractTransactionData(msg.transaction_guid)
+
+            if msg.as_of_version < self._min_acceptable_version_number:
+                self._logger.exception(
+                    "Transaction had an old as_of_version %s which is before "
+                    "the oldest garbage-collected as_of_version %s",
+                    msg.as_of_version,
+                    self._min_acceptable_version_number,
+                )
+
+                return False, "<TRANSACTION TOO OLD>", False
+
+            isOK, badKey = self._handleNewTransaction(
+                connectedChannel,
+                data["writes"],
+                data["prerequisites"],
+                data["set_adds"],
+                data["set_removes"],
+                data["key_versions"],
+                data["index_versions"],
+                msg.as_of_version,
+                transStartTime=transStartTime,
+                no_log=msg.no_log,
+                transaction_guid=msg.transaction_guid,
+                field_operations=data["field_operations"],
+            )
+
+            return isOK, badKey, False
+        except Exception:
+            self._logger.exception("Unknown error committing transaction:")
+            return False, traceback.format_exc(), True
+
     def indexReverseLookupKvs(self, adds, removes):
         res = {}
 
@@ -966,19 +2419,109 @@ class Server:
 
         return res
 
+    def _transactionProjectionSignature(self, channel, sourceChannel, identitiesByFieldId):
+        """Compute the part of a transaction that 'channel' is subscribed to.
+
+        Args:
+            identitiesByFieldId: for each fieldId the transaction touches, the
+                identities it writes or moves between indices.
+
+        Returns:
+            None if the channel sees the whole transaction, or a triple
+            (visibleFieldIds, visibleIdentities, hiddenFieldIds) of frozensets. The
+            channel sees every write to a field in the first set, and every write to
+            an object in the second except those to a field in the third.
+        """
+        if channel is sourceChannel:
+            # we always echo a transaction in full to the channel that wrote it
+            return None
+
+        visibleFieldIds = []
+        visibleIdentities = []
+
+        for fieldId, identities in identitiesByFieldId.items():
+            if fieldId in channel.subscribedFields:
+                visibleFieldIds.append(fieldId)
+            elif channel.subscribedIds and fieldId not in channel.hiddenFieldIds:
+                visibleIdentities.extend(identities.intersection(channel.subscribedIds))
+
+        if len(visibleFieldIds) == len(identitiesByFieldId):
+            return None
+
+        return (
+            frozenset(visibleFieldIds),
+            frozenset(visibleIdentities),
+            frozenset(f for f in identitiesByFieldId if f in channel.hiddenFieldIds),
+        )
+
+    def _projectTransaction(
+        self,
+        transactionMessage,
+        key_value,
+        set_adds,
+        set_removes,
+        fieldIds,
+        identities,
+        hiddenFieldIds,
+    ):
+        """Cut a Transaction down to the writes to 'fieldIds' or to 'identities'.
+
+        Writes to 'hiddenFieldIds' are dropped even for objects in 'identities',
+        though we still send their index values, as subscription data does.
+        """
+
+        def projectSets(sets):
+            res = {}
+            for indexKey, setIdentities in sets.items():
+                if indexKey.fieldId in fieldIds:
+                    res[indexKey] = setIdentities
+                else:
+                    visible = tuple(i for i in setIdentities if i in identities)
+                    if visible:
+                        res[indexKey] = visible
+            return res
+
+        return ServerToClient.Transaction(
+            writes={
+                k: v
+                for k, v in key_value.items()
+                if k.fieldId in fieldIds
+                or (
+                    k.objId in identities
+                    and (k.isIndexValue or k.fieldId not in hiddenFieldIds)
+                )
+            },
+            set_adds=projectSets(set_adds),
+            set_removes=projectSets(set_removes),
+            transaction_id=transactionMessage.transaction_id,
+        )
+
+    def _replaceWritesWithAppends(self, transactionMessage, appends):
+        """Send the appends in 'appends' in place of the values they produced."""
+        return ServerToClient.Transaction(
+            writes={k: v for k, v in transactionMessage.writes.items() if k not in appends},
+            set_adds=transactionMessage.set_adds,
+            set_removes=transactionMessage.set_removes,
+            transaction_id=transactionMessage.transaction_id,
+            field_operations={
+                k: ops for k, ops in appends.items() if k in transactionMessage.writes
+            },
+        )
+
     def _broadcastSubscriptionIncrease(self, channel, indexKey, tid, newIds):
         newIds = list(newIds)
 
         fieldDef = self._currentTypeMap().fieldIdToDef[indexKey.fieldId]
 
-        channel.channel.write(
+        self._sendToChannel(
+            channel,
             ServerToClient.SubscriptionIncrease(
                 schema=fieldDef.schema,
                 typename=fieldDef.typename,
                 fieldname_and_value=(fieldDef.fieldname, indexKey.indexValue),
                 identities=newIds,
                 transaction_id=tid,
-            )
+            ),
         )
 
     def _loadValuesForObject(self, channel, schema_name, typename, identities):
@@ -1037,7 +2580,7 @@ class Server:
                     set_adds.setdefault(ik, set()).add(ident)
 
     def _loadLazyObject(self, channel, msg):
-        channel.channel.write(
+        channel.write(
             ServerToClient.LazyLoadResponse(
                 identity=msg.identity,
                 values=self._loadValuesForObject(
@@ -1048,38 +2591,45 @@ class Server:
 
     def _garbage_collect(self, intervalOverride=None):
         """Cleanup anything in '_version_numbers' where we have deleted the entry
-        and it's inactive for a long time."""
+        and it's inactive for a long time.
+
+        '_version_numbers' queues keys in the order we wrote them, so we only ever
+        look at keys that have expired. We check at most '_gc_keys_per_step' of
+        them each time so that we don't hold up commits, unless we're given an
+        'intervalOverride', in which case we check everything that's expired.
+        """
         interval = intervalOverride or self._gc_interval
 
-        if (
-            self._last_garbage_collect_timestamp is None
-            or time.time() - self._last_garbage_collect_timestamp > interval
-        ):
-            threshold = time.time() - interval
-
-            new_ts = {}
-            for key, ts in self._version_numbers_timestamps.items():
-                if ts < threshold:
-                    if isinstance(key, IndexId):
-                        if not self._kvstore.getSetMembers(key):
-                            self._min_acceptable_version_number = max(
-                                self._min_acceptable_version_number, self._version_numbers[key]
-                            )
+        t0 = time.time()
 
-                            del self._version_numbers[key]
-                    else:
-                        if self._kvstore.get(key) is None:
-                            self._min_acceptable_version_number = max(
-                                self._min_acceptable_version_number, self._version_numbers[key]
-                            )
+        expiredKeys, expiredIndices = self._version_numbers.popExpired(
+            threshold=t0 - interval,
+            max_count=-1 if intervalOverride else self._gc_keys_per_step,
+        )
 
-                            del self._version_numbers[key]
-                else:
-                    new_ts[key] = ts
+        if not expiredKeys and not expiredIndices:
+            return
+
+        values = self._kvstore.getSeveral(expiredKeys) if expiredKeys else []
+
+        deletedKeys = [key for key, value in zip(expiredKeys, values) if value is None]
+        deletedIndices = [
+            key for key in expiredIndices if not self._kvstore.getSetMembers(key)
+        ]
 
-            self._version_numbers_timestamps = new_ts
+        if deletedKeys or deletedIndices:
+            self._min_acceptable_version_number = max(
+                self._min_acceptable_version_number,
+                self._version_numbers.erase(keys=deletedKeys, indices=deletedIndices),
+            )
+
+        pause = time.time() - t0
 
-            self._last_garbage_collect_timestamp = time.time()
+        self._gcMetrics["steps"] += 1
+        self._gcMetrics["examined"] += len(expiredKeys) + len(expiredIndices)
+        self._gcMetrics["collected"] += len(deletedKeys) + len(deletedIndices)
+        self._gcMetrics["totalPause"] += pause
+        self._gcMetrics["maxPause"] = max(self._gcMetrics["maxPause"], pause)
 
     def _handleNewTransaction(
         self,
@@ -1094,8 +2644,22 @@ class Server:
         transStartTime=None,
         no_log=False,
         transaction_guid=None,
+        field_operations=None,
     ):
         try:
+            appends = None
+
+            if field_operations:
+                # fields we only append to can be broadcast as the appends themselves
+                appends = {
+                    k: ops
+                    for k, ops in field_operations.items()
+                    if k not in key_value and all(op.matches.Append for op in ops)
+                }
+
+                key_value = dict(key_value)
+                key_value.update(self._applyFieldOperations(key_value, field_operations))
+
             result, tid, broadcastConnIds = self._commitAndBroadcastNewTransaction(
                 sourceChannel,
                 key_value,
@@ -1107,10 +2671,11 @@ class Server:
                 as_of_version,
                 transStartTime,
                 transaction_guid,
+                appends=appends,
             )
 
             if self.transactionWatcher and not no_log:
-                self.transactionWatcher.onTransaction(
+                self._notifyTransactionWatcher(
                     sourceChannel.connectionObject._identity
                     if sourceChannel is not None and sourceChannel.connectionObject is not None
                     else None,
@@ -1132,7 +2697,7 @@ class Server:
             return result
         except Exception:
             if self.transactionWatcher:
-                self.transactionWatcher.onTransaction(
+                self._notifyTransactionWatcher(
                     sourceChannel.connectionObject._identity
                     if sourceChannel is not None and sourceChannel.connectionObject is not None
                     else None,
@@ -1152,6 +2717,39 @@ class Server:
                 )
             raise
 
+    def _applyFieldOperations(self, key_value, field_operations):
+        """Compute the values 'field_operations' leave in the fields they touch.
+
+        Operations on a field apply to the value 'key_value' writes to it, if
+        any, and otherwise to the value in the store.
+
+        Returns:
+            a dict from ObjectFieldId to the new serialized value.
+        """
+        priorValues = self._kvstore.getSeveralAsDictionary(
+            [k for k in field_operations if k not in key_value]
+        )
+
+        result = {}
+
+        for key, ops in field_operations.items():
+            value = key_value[key] if key in key_value else priorValues[key]
+
+            if value is None:
+                fieldDef = self._currentTypeMap().fieldIdToDef.get(key.fieldId)
+
+                raise Exception(
+                    f"Can't apply {len(ops)} operation(s) to field {fieldDef} "
+                    f"of object {key.objId} because it has no value"
+                )
+
+            for op in ops:
+                value = applyFieldOperation(value, op)
+
+            result[key] = value
+
+        return result
+
     def _commitAndBroadcastNewTransaction(
         self,
         sourceChannel,
@@ -1164,6 +2762,7 @@ class Server:
         as_of_version,
         transStartTime,
         transactionGuid,
+        appends=None,
     ):
         self._cur_transaction_num += 1
         transaction_id = self._cur_transaction_num
@@ -1189,10 +2788,7 @@ class Server:
 
                 if fieldDef.fieldname == " exists":
                     if fieldId not in sourceChannel.subscribedFields:
-                        sourceChannel.subscribedIds.update(added_identities)
-
-                        for new_id in added_identities:
-                            self._id_to_channel.setdefault(new_id, set()).add(sourceChannel)
+                        self._addSubscribedIds(sourceChannel, added_identities)
 
                         self._broadcastSubscriptionIncrease(
                             sourceChannel, add_index, transaction_id, added_identities
@@ -1213,11 +2809,22 @@ class Server:
                     identities_mentioned.update(subset[k])
 
         # check all version numbers for transaction conflicts.
-        for subset in [keys_to_check_versions, indices_to_check_versions]:
-            for key in subset:
-                last_tid = self._version_numbers.get(key, -1)
-                if as_of_version < last_tid:
-                    return ((False, key), transaction_id, [])
+        keys_to_check_versions = TupleOf(ObjectFieldId)(keys_to_check_versions)
+        indices_to_check_versions = TupleOf(IndexId)(indices_to_check_versions)
+
+        conflict = self._version_numbers.check(
+            as_of_version=as_of_version,
+            keys_to_check=keys_to_check_versions,
+            indices_to_check=indices_to_check_versions,
+        )
+
+        if conflict is not None:
+            if conflict < len(keys_to_check_versions):
+                badKey = keys_to_check_versions[conflict]
+            else:
+                badKey = indices_to_check_versions[conflict - len(keys_to_check_versions)]
+
+            return ((False, badKey), transaction_id, [])
 
         t1 = time.time()
 
@@ -1248,13 +2855,17 @@ class Server:
 
             raise Exception("\n".join(lines))
 
-        for key in keysWritingTo:
-            self._version_numbers[key] = transaction_id
-            self._version_numbers_timestamps[key] = t1
-
-        for key in setsWritingTo:
-            self._version_numbers[key] = transaction_id
-            self._version_numbers_timestamps[key] = t1
+        # mark everything we're writing with our transaction id. We already
+        # checked for conflicts, so there's nothing left to check.
+        self._version_numbers.checkAndStamp(
+            as_of_version=as_of_version,
+            keys_to_check=(),
+            indices_to_check=(),
+            transaction_id=transaction_id,
+            keys_to_stamp=TupleOf(ObjectFieldId)(keysWritingTo),
+            indices_to_stamp=TupleOf(IndexId)(setsWritingTo),
+            timestamp=t1,
+        )
 
         # set the json representation in the database
         target_kvs = {k: v for k, v in key_value.items()}
@@ -1280,6 +2891,9 @@ class Server:
 
         self._kvstore.setSeveral({}, indexSetAdds, indexSetRemoves)
 
+        # record the transaction before we widen it for index subscriptions below
+        self._changeLog.append(transaction_id, key_value, set_adds, set_removes)
+
         t2 = time.time()
 
         channelsTriggeredForPriors = set()
@@ -1302,10 +2916,15 @@ class Server:
                         # everything twice to lazy subscribers.
                         channelsTriggeredForPriors.add(channel)
 
-                    newIds = adds.difference(channel.subscribedIds)
-                    for new_id in newIds:
-                        self._id_to_channel.setdefault(new_id, set()).add(channel)
-                        channel.subscribedIds.add(new_id)
+                    inScope = channel.subscribedIndexIdentities.setdefault(index_key, set())
+                    addedToScope = adds.difference(inScope)
+                    inScope.update(addedToScope)
+
+                    self._undoIfGroupFails(
+                        functools.partial(inScope.difference_update, addedToScope)
+                    )
+
+                    newIds = self._addSubscribedIds(channel, addedToScope)
 
                     self._broadcastSubscriptionIncrease(
                         channel, index_key, transaction_id, newIds
@@ -1356,8 +2975,13 @@ class Server:
 
             self.fieldBroadcastsSinceLastLog[fieldId] += len(channelsTriggered)
 
-        for channel in channelsTriggeredForPriors:
-            channel.sendTransaction(ServerToClient.LazyTransactionPriors(writes=priorValues))
+        if channelsTriggeredForPriors:
+            priorsMessage = BroadcastMessage(
+                ServerToClient.LazyTransactionPriors(writes=priorValues)
+            )
+
+            for channel in channelsTriggeredForPriors:
+                self._sendToChannel(channel, priorsMessage)
 
         set_adds = {k: tuple(v) for k, v in set_adds.items()}
         set_removes = {k: tuple(v) for k, v in set_removes.items()}
@@ -1369,11 +2993,53 @@ class Server:
             transaction_id=transaction_id,
         )
 
-        if self._pendingSubscriptionRecheck is not None:
-            self._pendingSubscriptionRecheck.append(transaction_message)
+        for pendingTransactions in self._pendingSubscriptionRechecks.values():
+            pendingTransactions.append(transaction_message)
+
+        # cut the transaction down to what each channel can see, serializing each
+        # distinct projection (at most) once and sharing it across channels that
+        # see the same thing.
+        identitiesByFieldId = {}
+        for key in key_value:
+            identitiesByFieldId.setdefault(key.fieldId, set()).add(key.objId)
+        for subset in [set_adds, set_removes]:
+            for indexKey, identities in subset.items():
+                identitiesByFieldId.setdefault(indexKey.fieldId, set()).update(identities)
+
+        projections = {}
+
+        appendFieldIds = set(k.fieldId for k in appends) if appends else set()
 
         for channel in channelsTriggered:
-            channel.sendTransaction(transaction_message)
+            signature = self._transactionProjectionSignature(
+                channel, sourceChannel, identitiesByFieldId
+            )
+
+            # only channels that hold every value of the fields we appended to
+            # can rebuild them from the appends alone
+            sendAppends = bool(appendFieldIds) and all(
+                channel.subscribedFields.get(fieldId) == -1 for fieldId in appendFieldIds
+            )
+
+            if (signature, sendAppends) not in projections:
+                if signature is None:
+                    message = transaction_message
+                else:
+                    message = self._projectTransaction(
+                        transaction_message, key_value, set_adds, set_removes, *signature
+                    )
+
+                if sendAppends:
+                    message = self._replaceWritesWithAppends(message, appends)
+
+                projections[signature, sendAppends] = BroadcastMessage(message)
+
+            self._sendToChannel(channel, projections[signature, sendAppends])
+
+        # a group commit pumps them once it knows the group made it
+        if self._groupCommitOutbox is None:
+            for subscription in list(self._changeSubscriptions):
+                self._pumpChanges(subscription)
 
         if self.verbose or time.time() - t0 > self.longTransactionThreshold:
             self._logger.info(
@@ -1412,6 +3078,38 @@ class Server:
                 / (self.transactionsSinceLastLogEvent + 1e-6),
                 "\n".join(msg),
             )
+            subscriptionMetrics = self._subscriptionQueue.metrics()
+            if subscriptionMetrics["enqueued"] or subscriptionMetrics["maxDepth"]:
+                self._logger.info(
+                    "Subscription queue: %s queued, %s started with avg/max wait of "
+                    "%.2f/%.2f. Depth is %s priority and %s bulk over %s connections "
+                    "(max %s).",
+                    subscriptionMetrics["enqueued"],
+                    subscriptionMetrics["started"],
+                    subscriptionMetrics["avgWait"],
+                    subscriptionMetrics["maxWait"],
+                    subscriptionMetrics["priorityDepth"],
+                    subscriptionMetrics["bulkDepth"],
+                    subscriptionMetrics["bulkConnections"],
+                    subscriptionMetrics["maxDepth"],
+                )
+            self._subscriptionQueue.resetMetrics()
+
+            gcMetrics = self.gcMetrics()
+            if gcMetrics["steps"]:
+                self._logger.info(
+                    "Version GC: %s steps examined %s keys and collected %s, pausing "
+                    "%.4f/%.4f avg/max. Tracking %s keys with %s pending.",
+                    gcMetrics["steps"],
+                    gcMetrics["examined"],
+                    gcMetrics["collected"],
+                    gcMetrics["totalPause"] / gcMetrics["steps"],
+                    gcMetrics["maxPause"],
+                    gcMetrics["trackedKeys"],
+                    gcMetrics["pendingKeys"],
+                )
+            self._resetGcMetrics()
+
             self.fieldTransactionsSinceLastLog = {}
             self.fieldBroadcastsSinceLastLog = {}
 
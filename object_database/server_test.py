@@ -0,0 +1,99 @@
+#   Copyright 2017-2021 object_database Authors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+
+from object_database.server import SubscriptionScheduler
+
+
+class SubscriptionSchedulerTests(unittest.TestCase):
+    def test_priority_lane_served_first(self):
+        scheduler = SubscriptionScheduler(4)
+
+        scheduler.put("c1", "bulk", isPriority=False)
+        scheduler.put("c2", "index", isPriority=True)
+
+        self.assertEqual(scheduler.get(0.0), ("c2", "index", True))
+        self.assertEqual(scheduler.get(0.0), ("c1", "bulk", False))
+        self.assertIsNone(scheduler.get(0.0))
+
+    def test_round_robin_across_connections(self):
+        scheduler = SubscriptionScheduler(8)
+
+        for i in range(3):
+            scheduler.put("greedy", "greedy_%s" % i, isPriority=False)
+
+        scheduler.put("polite", "polite_0", isPriority=False)
+
+        order = [scheduler.get(0.0)[1] for _ in range(4)]
+
+        self.assertEqual(order, ["greedy_0", "polite_0", "greedy_1", "greedy_2"])
+
+    def test_bulk_work_leaves_a_worker_free(self):
+        scheduler = SubscriptionScheduler(2)
+
+        scheduler.put("c1", "bulk_0", isPriority=False)
+        scheduler.put("c2", "bulk_1", isPriority=False)
+
+        self.assertEqual(scheduler.get(0.0), ("c1", "bulk_0", False))
+
+        # the only other worker is held back for the priority lane
+        self.assertIsNone(scheduler.get(0.0))
+
+        scheduler.put("c3", "index", isPriority=True)
+        self.assertEqual(scheduler.get(0.0), ("c3", "index", True))
+
+        scheduler.taskDone(isPriority=False)
+        self.assertEqual(scheduler.get(0.0), ("c2", "bulk_1", False))
+
+    def test_drop_connection(self):
+        scheduler = SubscriptionScheduler(4)
+
+        scheduler.put("c1", "bulk", isPriority=False)
+        scheduler.put("c1", "index", isPriority=True)
+        scheduler.put("c2", "bulk", isPriority=False)
+
+        scheduler.dropConnection("c1")
+
+        self.assertEqual(scheduler.get(0.0), ("c2", "bulk", False))
+        self.assertIsNone(scheduler.get(0.0))
+
+    def test_metrics(self):
+        scheduler = SubscriptionScheduler(4)
+
+        scheduler.put("c1", "bulk", isPriority=False)
+        scheduler.put("c2", "index", isPriority=True)
+
+        metrics = scheduler.metrics()
+        self.assertEqual(metrics["enqueued"], 2)
+        self.assertEqual(metrics["priorityDepth"], 1)
+        self.assertEqual(metrics["bulkDepth"], 1)
+        self.assertEqual(metrics["maxDepth"], 2)
+
+        scheduler.get(0.0)
+        scheduler.get(0.0)
+
+        metrics = scheduler.metrics()
+        self.assertEqual(metrics["started"], 2)
+        self.assertEqual(metrics["activeBulkWorkers"], 1)
+        self.assertGreaterEqual(metrics["maxWait"], metrics["avgWait"])
+
+        scheduler.resetMetrics()
+        self.assertEqual(scheduler.metrics()["enqueued"], 0)
+
+    def test_stop_wakes_workers(self):
+        scheduler = SubscriptionScheduler(1)
+        scheduler.stop()
+
+        self.assertIsNone(scheduler.get(10.0))
@@ -16,7 +16,12 @@ from object_database.database_connection import DatabaseConnection
 from object_database._types import DatabaseConnectionPumpLoop
 from object_database.server import Server
 from object_database.proxy_server import ProxyServer
-from object_database.message_bus import MessageBus
+from object_database.message_bus import (
+    MessageBus,
+    PRIORITY_BULK,
+    PRIORITY_CONTROL,
+    PRIORITY_NORMAL,
+)
 from object_database.messages import ClientToServer, ServerToClient, getHeartbeatInterval
 from object_database.persistence import InMemoryPersistence
 
@@ -245,6 +250,43 @@ def connect(host, port, auth_token, timeout=10.0, retry=False):
     return conn
 
 
+def reconnect(conn, host, port, timeout=10.0, retry=False):
+    """Reconnect a disconnected DatabaseConnection, resuming its subscriptions if we can.
+
+    Returns:
+        True if the server resumed our subscriptions, False if we started over.
+    """
+    t0 = time.time()
+
+    channel, connectionDict = _connectedChannel(host, port, conn.auth_token, timeout, retry)
+
+    conn._connectionMetadata = connectionDict
+
+    channel.setOnClosed(conn._onDisconnected)
+
+    return conn.reconnect(channel, timeout=max(timeout - (time.time() - t0), 0.0))
+
+
+def _sendPriority(msg: ServerToClient):
+    """The MessageBus priority we send a ServerToClient message with.
+
+    Replies that don't depend on subscription data may get ahead of pages of it, so
+    a client with a big subscription in flight still hears about its commits and
+    flushes promptly. Everything else, including Transactions, stays in order, so
+    a committer still sees its own writes before it hears that they succeeded.
+    """
+    if msg.matches.TransactionResult or msg.matches.FlushResponse:
+        return PRIORITY_CONTROL
+
+    if msg.matches.DependentConnectionId:
+        return PRIORITY_CONTROL
+
+    if msg.matches.SubscriptionData or msg.matches.LazySubscriptionData:
+        return PRIORITY_BULK
+
+    return PRIORITY_NORMAL
+
+
 class ServerChannel(ServerToClientChannel):
     def __init__(self, bus, connectionId, source):
         self.bus = bus
@@ -253,10 +295,22 @@ class ServerChannel(ServerToClientChannel):
         self.handler = None
 
     def write(self, msg):
-        self.bus.sendMessage(self.connectionId, msg)
+        self.bus.sendMessage(self.connectionId, msg, _sendPriority(msg))
 
     def sendMessage(self, msg):
-        self.bus.sendMessage(self.connectionId, msg)
+        self.bus.sendMessage(self.connectionId, msg, _sendPriority(msg))
+
+    @property
+    def wantsSerializedMessages(self):
+        # BroadcastMessage serializes without a context, so we can only
+        # take its bytes if our bus would have done the same.
+        return self.bus.serializationContext is None
+
+    def sendSerialized(self, serializedMsg):
+        self.bus.sendSerialized(self.connectionId, serializedMsg)
+
+    def pendingBytecount(self):
+        return self.bus.pendingBytecount(self.connectionId)
 
     def setClientToServerHandler(self, handler):
         self.handler = handler
@@ -271,7 +325,16 @@ class ServerChannel(ServerToClientChannel):
 
 class TcpServer(Server):
     def __init__(
-        self, host, port, mem_store, ssl_context, auth_token, transactionWatcher=None
+        self,
+        host,
+        port,
+        mem_store,
+        ssl_context,
+        auth_token,
+        transactionWatcher=None,
+        socketThreadCount=1,
+        deserializationThreadCount=0,
+        connectionHighWaterMark=None,
     ):
         Server.__init__(
             self, mem_store or InMemoryPersistence(), auth_token, transactionWatcher
@@ -288,7 +351,14 @@ class TcpServer(Server):
             self.onEvent,
             sslContext=ssl_context,
             extraMessageSizeCheck=False,
+            socketThreadCount=socketThreadCount,
+            deserializationThreadCount=deserializationThreadCount,
         )
+
+        # if not None, the number of bytes waiting to go to a client at which we
+        # apply our slow-consumer policy to it (see Server.setSlowConsumerPolicy)
+        self.bus.setConnectionHighWaterMark(connectionHighWaterMark)
+
         self._messageBusChannels = {}
 
         self.stopped = False
@@ -332,9 +402,22 @@ class TcpServer(Server):
             if id in self._messageBusChannels:
                 self._messageBusChannels[id].receive(event.message)
 
+        if event.matches.ConnectionBackedUp:
+            id = event.connectionId
+            if id in self._messageBusChannels:
+                self.channelBackedUp(self._messageBusChannels[id], event.pendingBytes)
+
+        if event.matches.ConnectionDrained:
+            id = event.connectionId
+            if id in self._messageBusChannels:
+                self.channelDrained(self._messageBusChannels[id])
+
     def connect(self, auth_token):
         return connect(self.host, self.port, auth_token)
 
+    def reconnect(self, conn):
+        return reconnect(conn, self.host, self.port)
+
     def __enter__(self):
         self.start()
         return self
@@ -411,6 +494,9 @@ class TcpProxyServer(ProxyServer):
     def connect(self, auth_token):
         return connect(self.host, self.port, auth_token)
 
+    def reconnect(self, conn):
+        return reconnect(conn, self.host, self.port)
+
     def __enter__(self):
         self.start()
         return self
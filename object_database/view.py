@@ -18,6 +18,8 @@ import queue
 import time
 
 import object_database._types as _types
+from object_database.messages import FieldOperation
+from object_database.schema import FieldDefinition, ObjectFieldId
 
 LOG_SLOW_COMMIT_THRESHOLD = 1.0
 
@@ -38,6 +40,10 @@ class FieldNotDefaultInitializable(Exception):
     pass
 
 
+class FieldNotSubscribedException(Exception):
+    pass
+
+
 class ObjectDoesntExistException(Exception):
     def __init__(self, obj):
         super().__init__("%s(%s)" % (type(obj).__qualname__, obj._identity))
@@ -96,6 +102,9 @@ class View(object):
         self._commitTimeout = None
         self._no_log = False
 
+        # ObjectFieldId -> [FieldOperation] for the server to apply on commit
+        self._fieldOperations = {}
+
     def db(self):
         return self._db
 
@@ -158,7 +167,7 @@ class View(object):
         setAdds = self._view.extractSetAdds()
         setRemoves = self._view.extractSetRemoves()
 
-        if writes:
+        if writes or self._fieldOperations:
             tid = self._transaction_num
 
             if self._confirmCommitCallback is None:
@@ -177,6 +186,7 @@ class View(object):
                 tid,
                 confirmCallback,
                 no_log=self._no_log,
+                field_operations=self._fieldOperations,
             )
 
             # now that we no longer need to look at our
@@ -304,6 +314,120 @@ class Transaction(View):
 
         return self
 
+    def increment(self, obj, fieldname, amount=1):
+        """Have the server add 'amount' to an int or float field when we commit.
+
+        Unlike 'obj.x = obj.x + amount', this doesn't read the field, so concurrent
+        increments of the same field don't conflict with each other. Reading the
+        field in this transaction still gives the value from before the increment.
+        """
+        self._addNumericOperation(
+            obj, fieldname, lambda v: FieldOperation.Increment(amount=v), amount
+        )
+
+    def max(self, obj, fieldname, value):
+        """Have the server raise an int or float field to at least 'value' when we commit."""
+        self._addNumericOperation(obj, fieldname, lambda v: FieldOperation.Max(value=v), value)
+
+    def min(self, obj, fieldname, value):
+        """Have the server lower an int or float field to at most 'value' when we commit."""
+        self._addNumericOperation(obj, fieldname, lambda v: FieldOperation.Min(value=v), value)
+
+    def setInsert(self, obj, fieldname, values):
+        """Have the server add 'values' to a TupleOf field when we commit.
+
+        Values already in the field aren't added again.
+        """
+        self._addSetOperation(
+            obj, fieldname, lambda v: FieldOperation.SetInsert(values=v), values
+        )
+
+    def setRemove(self, obj, fieldname, values):
+        """Have the server remove all of 'values' from a TupleOf field when we commit."""
+        self._addSetOperation(
+            obj, fieldname, lambda v: FieldOperation.SetRemove(values=v), values
+        )
+
+    def append(self, obj, fieldname, suffix):
+        """Have the server append 'suffix' to a str, bytes or TupleOf field when we commit.
+
+        Only 'suffix' goes over the wire, to the server and to subscribers that
+        already hold the field's value, so this is much cheaper than
+        'obj.x += suffix' for large fields.
+        """
+        fieldType = self._fieldTypeForOperation(obj, fieldname)
+
+        if fieldType not in (str, bytes) and (
+            getattr(fieldType, "__typed_python_category__", None) != "TupleOf"
+            or fieldType.ElementType not in (int, float, str, bytes)
+        ):
+            raise TypeError(
+                f"Can't append to {type(obj).__qualname__}.{fieldname} of type {fieldType}"
+            )
+
+        self._addFieldOperation(
+            obj, fieldname, FieldOperation.Append(suffix=fieldType(suffix))
+        )
+
+    def _addNumericOperation(self, obj, fieldname, makeOperation, operand):
+        fieldType = self._fieldTypeForOperation(obj, fieldname)
+
+        if fieldType not in (int, float):
+            raise TypeError(
+                f"Can't apply a numeric operation to {type(obj).__qualname__}.{fieldname} "
+                f"of type {fieldType}"
+            )
+
+        self._addFieldOperation(obj, fieldname, makeOperation(fieldType(operand)))
+
+    def _addSetOperation(self, obj, fieldname, makeOperation, values):
+        fieldType = self._fieldTypeForOperation(obj, fieldname)
+
+        if getattr(fieldType, "__typed_python_category__", None) != "TupleOf" or (
+            fieldType.ElementType not in (int, float, str, bytes)
+        ):
+            raise TypeError(
+                f"Can't apply a set operation to {type(obj).__qualname__}.{fieldname} "
+                f"of type {fieldType}"
+            )
+
+        self._addFieldOperation(obj, fieldname, makeOperation(fieldType(values)))
+
+    def _fieldTypeForOperation(self, obj, fieldname):
+        schema = type(obj).__schema__
+        typename = type(obj).__qualname__
+
+        fieldType = schema.fieldType(typename, fieldname)
+
+        if fieldType is None:
+            raise AttributeError(f"{typename} has no field {fieldname}")
+
+        # the server doesn't know how to keep index values up to date
+        if schema.fieldIsIndexed(typename, fieldname):
+            raise TypeError(f"Can't apply operations to indexed field {typename}.{fieldname}")
+
+        return fieldType
+
+    def _addFieldOperation(self, obj, fieldname, op):
+        objType = type(obj)
+
+        fieldId = self._db._fields_to_field_ids.get(
+            FieldDefinition(
+                schema=objType.__schema__.name,
+                typename=objType.__qualname__,
+                fieldname=fieldname,
+            )
+        )
+
+        if fieldId is None:
+            raise Exception(
+                f"{objType.__qualname__}.{fieldname} isn't defined in the database"
+            )
+
+        self._fieldOperations.setdefault(
+            ObjectFieldId(objId=obj._identity, fieldId=fieldId, isIndexValue=False), []
+        ).append(op)
+
 
 def current_transaction():
     if not hasattr(_cur_view, "view"):